@@ -0,0 +1,7 @@
+"""
+Benchmarks for the ecommerce worker.
+
+These are not part of the unit test suite. Each module can be run on its own, e.g.
+
+    $ WORKER_CONFIGURATION_MODULE=ecommerce_worker.configuration.test python -m benchmarks.sailthru_dispatch
+"""
@@ -0,0 +1,194 @@
+"""
+Goodput of order fulfillment when the ecommerce service degrades, with and without the adaptive concurrency limit.
+
+A real worker fulfills a backlog of orders against the ecommerce stub, which serves --capacity
+calls at once and slows every call down in proportion beyond it. Once --degrade-after of the
+orders are fulfilled, the stub's latency is raised from --latency to --degraded-latency. With
+a fixed concurrency, every pool process keeps calling the slowed-down service: the calls
+exceed the time budget of fulfill_order, which retries them while the service still works on
+the abandoned ones. With FULFILLMENT_CONCURRENCY_LIMIT_ENABLED, the limit follows
+the latency down and the excess orders wait in the worker instead.
+
+For each mode, the benchmark reports the orders fulfilled per second (goodput) and the calls
+made per order fulfilled, before and after the service degrades. The worker runs a green pool
+by default: the pool processes of a prefork worker publish their retries and deferred orders,
+which the in-memory broker only carries within a process, so prefork runs need --broker.
+
+    $ python -m benchmarks.adaptive_limit --orders 400 --concurrency 32 --capacity 4 --output results.json
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+import time
+
+from benchmarks.harness import BenchmarkWorker, environment, percentiles, pool_unavailable
+from benchmarks.stubs import FaultProfile, start_stub_servers
+from benchmarks.throughput import FULFILL_ORDER
+
+# Whether FULFILLMENT_CONCURRENCY_LIMIT_ENABLED is set, by mode
+MODES = {
+    'fixed': False,
+    'adaptive': True,
+}
+
+
+def build_plan(orders, mode):
+    """A backlog of fulfill_order tasks, keyed by order number."""
+    for index in range(orders):
+        order_number = 'LIMIT-{}-{}'.format(mode, index)
+        yield {'task': FULFILL_ORDER, 'args': [order_number], 'queue': 'fulfillment', 'key': order_number}
+
+
+def fulfillment_settings(mode, args):
+    """The worker settings of a mode, for BENCHMARK_FULFILLMENT."""
+    return {
+        'TASK_DEADLINE_SECONDS': {FULFILL_ORDER: args.budget},
+        'FULFILLMENT_CONCURRENCY_LIMIT_ENABLED': MODES[mode],
+        'FULFILLMENT_CONCURRENCY_MAX_LIMIT': args.concurrency,
+        'FULFILLMENT_CONCURRENCY_MAX_WAIT': args.max_wait,
+    }
+
+
+def summarize(published, calls, degraded_at):
+    """
+    Compute the goodput of a run before and after the service degraded.
+
+    Arguments:
+        published (dict): publish time of each order
+        calls (list): (time, endpoint, order number, outcome) of each fulfillment call
+        degraded_at (float): time the service degraded, None if it did not
+
+    Returns:
+        dict: figures of the healthy and degraded phases
+    """
+    fulfilled = {}
+    for call_time, __, key, outcome in calls:
+        if outcome == 'ok':
+            fulfilled.setdefault(key, call_time)
+
+    def phase(call_time):
+        """The phase a call ended in."""
+        return 'degraded' if degraded_at is not None and call_time >= degraded_at else 'healthy'
+
+    result = {'published': len(published), 'fulfilled': len(fulfilled), 'healthy': None, 'degraded': None}
+    if not fulfilled:
+        return result
+    bounds = {
+        'healthy': (min(published.values()), degraded_at or max(fulfilled.values())),
+        'degraded': (degraded_at, max(fulfilled.values())),
+    }
+    for name, (begin, end) in bounds.items():
+        orders = [key for key, call_time in fulfilled.items() if phase(call_time) == name]
+        if not orders or end <= begin:
+            continue
+        phase_calls = [call for call in calls if phase(call[0]) == name]
+        latencies = [fulfilled[key] - published[key] for key in orders if key in published]
+        result[name] = {
+            'seconds': round(end - begin, 3),
+            'orders_fulfilled': len(orders),
+            'goodput_per_second': round(len(orders) / (end - begin), 2),
+            'calls_per_order': round(len(phase_calls) / float(len(orders)), 2),
+            'latency_ms': {point: round(value * 1000, 2) if value is not None else None
+                           for point, value in percentiles(latencies).items()},
+        }
+    return result
+
+
+def run(mode, args, ecommerce):
+    """Fulfill a backlog of orders in one mode, degrading the service midway, and return the results."""
+    unavailable = pool_unavailable(args.pool)
+    if unavailable:
+        return {'mode': mode, 'skipped': unavailable}
+
+    ecommerce.profile = FaultProfile(args.latency, seed=args.seed, capacity=args.capacity)
+    ecommerce.drain_calls()
+    env = {
+        'BENCHMARK_ECOMMERCE_API_ROOT': ecommerce.url + '/api/v2/',
+        'BENCHMARK_FULFILLMENT': json.dumps(fulfillment_settings(mode, args)),
+    }
+    if args.broker:
+        env['BENCHMARK_BROKER_URL'] = args.broker
+
+    worker = BenchmarkWorker(build_plan(args.orders, mode), args.pool, args.concurrency, env)
+    calls = []
+    fulfilled = set()
+    degraded_at = []
+
+    def is_done():
+        """All orders are fulfilled; degrades the service once enough of them are."""
+        for call in ecommerce.drain_calls():
+            calls.append(call)
+            if call[3] == 'ok':
+                fulfilled.add(call[2])
+        if not degraded_at and len(fulfilled) >= args.degrade_after * args.orders:
+            ecommerce.profile = FaultProfile(args.degraded_latency, seed=args.seed, capacity=args.capacity)
+            degraded_at.append(time.time())
+        return len(fulfilled) >= args.orders
+
+    finished = worker.wait(is_done, args.timeout)
+    processes = worker.stop()
+    calls.extend(ecommerce.drain_calls())
+
+    result = {'mode': mode, 'finished': finished, 'processes': processes}
+    if not finished:
+        result['worker_exit_code'] = worker.process.returncode
+    result.update(summarize(worker.published() or {}, calls, degraded_at[0] if degraded_at else None))
+    return result
+
+
+def main():
+    """Run the benchmark and write the results."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=400)
+    parser.add_argument('--modes', default=','.join(sorted(MODES)))
+    parser.add_argument('--pool', default='gevent')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--capacity', type=int, default=4, help='calls the ecommerce stub serves at once')
+    parser.add_argument('--latency', default='exp:0.05', help='latency spec of the healthy service')
+    parser.add_argument('--degraded-latency', default='exp:0.4', help='latency spec of the degraded service')
+    parser.add_argument('--degrade-after', type=float, default=0.25,
+                        help='fraction of the orders fulfilled before the service degrades')
+    parser.add_argument('--budget', type=float, default=2, help='time budget of fulfill_order in seconds')
+    parser.add_argument('--max-wait', type=float, default=1,
+                        help='seconds an order waits for a slot of the limit before it is deferred')
+    parser.add_argument('--broker', help='broker URL (default: in-memory broker inside the worker process)')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file receiving the JSON results (default: stdout)')
+    args = parser.parse_args()
+
+    ecommerce, sailthru = start_stub_servers()
+    try:
+        results = [run(mode, args, ecommerce) for mode in args.modes.split(',')]
+    finally:
+        ecommerce.stop()
+        sailthru.stop()
+
+    report = {
+        'benchmark': 'adaptive_limit',
+        'environment': environment(),
+        'parameters': {
+            'orders': args.orders,
+            'pool': args.pool,
+            'concurrency': args.concurrency,
+            'capacity': args.capacity,
+            'latency': args.latency,
+            'degraded_latency': args.degraded_latency,
+            'degrade_after': args.degrade_after,
+            'budget_seconds': args.budget,
+            'max_wait_seconds': args.max_wait,
+            'broker': args.broker or 'memory://',
+        },
+        'results': results,
+    }
+    output = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
+    if args.output:
+        output.close()
+
+
+if __name__ == '__main__':
+    main()
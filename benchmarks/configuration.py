@@ -0,0 +1,82 @@
+"""
+Worker configuration used by the end-to-end benchmarks.
+
+Broker and API endpoints are read from the environment so that a benchmark can point the
+worker at its own broker and stub servers:
+
+* BENCHMARK_BROKER_URL (default: memory://)
+* BENCHMARK_BROKER_DIR, the directory of the filesystem:// broker shared by several workers
+* BENCHMARK_ECOMMERCE_API_ROOT
+* BENCHMARK_SAILTHRU_API_URL
+* BENCHMARK_PRIORITY_LANES, JSON of the PRIORITY_LANES setting; enables the priority lanes
+* BENCHMARK_PRELOAD, 0 to disable the preloading of the main process (default: 1)
+* BENCHMARK_RECYCLING, JSON of the RECYCLING settings to override
+* BENCHMARK_FULFILLMENT, JSON of the fulfillment settings to override, such as the concurrency limit
+* BENCHMARK_LEAK_KB, kilobytes leaked by every task, see benchmarks.leak
+* BENCHMARK_CAPTURE_PATH, file capturing the tasks received, see ecommerce_worker.capture
+"""
+# pylint: disable=invalid-name
+import json
+from logging.config import dictConfig
+import os
+import tempfile
+
+from ecommerce_worker.configuration.base import *  # pylint: disable=wildcard-import
+from ecommerce_worker.configuration.logger import get_logger_config
+
+# CELERY
+BROKER_URL = os.environ.get('BENCHMARK_BROKER_URL', 'memory://')
+# Virtual transports, such as the in-memory one, poll for messages.
+BROKER_TRANSPORT_OPTIONS = {'polling_interval': 0.01}
+if os.environ.get('BENCHMARK_BROKER_DIR'):
+    BROKER_TRANSPORT_OPTIONS.update(
+        data_folder_in=os.environ['BENCHMARK_BROKER_DIR'],
+        data_folder_out=os.environ['BENCHMARK_BROKER_DIR'],
+    )
+# END CELERY
+
+# ORDER FULFILLMENT
+ECOMMERCE_API_ROOT = os.environ.get('BENCHMARK_ECOMMERCE_API_ROOT', 'http://127.0.0.1:8002/api/v2/')
+# END ORDER FULFILLMENT
+
+# AUTHENTICATION
+JWT_SECRET_KEY = 'benchmark-secret-key'
+JWT_ISSUER = 'ecommerce_worker'
+# END AUTHENTICATION
+
+# LOGGING
+logger_config = get_logger_config(debug=True, dev_env=True, local_loglevel='WARNING')
+logger_config['handlers']['console']['level'] = 'WARNING'
+dictConfig(logger_config)
+# END LOGGING
+
+LOCAL_STATE_DIR = tempfile.mkdtemp(prefix='ecomworker-benchmark-')
+
+SITE_OVERRIDES = {}
+
+PRELOAD_ENABLED = os.environ.get('BENCHMARK_PRELOAD', '1') == '1'
+
+vars().update(json.loads(os.environ.get('BENCHMARK_RECYCLING', '{}')))
+vars().update(json.loads(os.environ.get('BENCHMARK_FULFILLMENT', '{}')))
+
+if os.environ.get('BENCHMARK_LEAK_KB'):
+    CELERY_IMPORTS += ('benchmarks.leak',)  # pylint: disable=undefined-variable
+
+if os.environ.get('BENCHMARK_CAPTURE_PATH'):
+    CAPTURE_ENABLED = True
+    CAPTURE_PATH = os.environ['BENCHMARK_CAPTURE_PATH']
+
+if os.environ.get('BENCHMARK_PRIORITY_LANES'):
+    PRIORITY_LANES_ENABLED = True
+    PRIORITY_LANES = json.loads(os.environ['BENCHMARK_PRIORITY_LANES'])
+
+SAILTHRU = dict(
+    SAILTHRU,  # pylint: disable=undefined-variable
+    SAILTHRU_KEY='benchmark-key',
+    SAILTHRU_SECRET='benchmark-secret',
+    SAILTHRU_API_URL=os.environ.get('BENCHMARK_SAILTHRU_API_URL', 'http://127.0.0.1:8003'),
+    SAILTHRU_UPGRADE_TEMPLATE='upgrade_template',
+    SAILTHRU_PURCHASE_TEMPLATE='purchase_template',
+    SAILTHRU_ENROLL_TEMPLATE='enroll_template',
+    SAILTHRU_ABANDONED_CART_TEMPLATE='abandoned_template',
+)
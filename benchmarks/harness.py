@@ -0,0 +1,236 @@
+"""
+Helpers shared by the end-to-end benchmarks: worker processes, process sampling and statistics.
+"""
+import json
+import os
+import platform
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from ecommerce_worker.configuration import CONFIGURATION_MODULE
+
+POOLS = ('prefork', 'threads', 'eventlet', 'gevent')
+
+# Packages a pool needs besides Celery
+POOL_REQUIREMENTS = {
+    'threads': 'threadpool',
+    'eventlet': 'eventlet',
+    'gevent': 'gevent',
+}
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def pool_unavailable(pool):
+    """Return why a pool cannot be benchmarked here, or None if it can."""
+    requirement = POOL_REQUIREMENTS.get(pool)
+    if requirement:
+        try:
+            __import__(requirement)
+        except ImportError:
+            return '{} is not installed'.format(requirement)
+    return None
+
+
+def percentiles(values, points=(50, 95, 99)):
+    """Nearest-rank percentiles of values, keyed 'p50', 'p95', ..."""
+    ordered = sorted(values)
+    if not ordered:
+        return {'p{}'.format(point): None for point in points}
+    return {
+        'p{}'.format(point): ordered[max(0, int(round(point / 100.0 * len(ordered))) - 1)]
+        for point in points
+    }
+
+
+def environment():
+    """Describe the machine running the benchmark, so results can be compared over time."""
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        'timestamp': time.time(),
+        'git_revision': revision,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.sysconf('SC_NPROCESSORS_ONLN') if hasattr(os, 'sysconf') else None,
+    }
+
+
+def read_private_bytes(pid):
+    """Read the resident bytes of a process not shared with any other process, or None if unknown.
+
+    Pages a prefork child still shares copy-on-write with its parent are not private. Relies on
+    /proc/<pid>/smaps_rollup, available since Linux 4.14.
+    """
+    private_kb = 0
+    try:
+        with open('/proc/{}/smaps_rollup'.format(pid)) as smaps_file:
+            for line in smaps_file:
+                if line.startswith(('Private_Clean:', 'Private_Dirty:')):
+                    private_kb += int(line.split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return private_kb * 1024
+
+
+def read_process(pid):
+    """Read (parent pid, CPU seconds, RSS bytes) of a process from /proc, or None if it is gone."""
+    try:
+        with open('/proc/{}/stat'.format(pid)) as stat_file:
+            stat = stat_file.read()
+        with open('/proc/{}/statm'.format(pid)) as statm_file:
+            rss_pages = int(statm_file.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+    # the command name is in parentheses and may contain spaces
+    fields = stat[stat.rindex(')') + 2:].split()
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)
+    return int(fields[1]), cpu_seconds, rss_pages * PAGE_SIZE
+
+
+class ProcessSampler(threading.Thread):
+    """
+    Periodically samples the CPU time and RSS of a process and all of its descendants.
+
+    Relies on /proc, so it only reports figures on Linux.
+    """
+
+    def __init__(self, root_pid, interval=0.2):
+        super(ProcessSampler, self).__init__(name='ProcessSampler')
+        self.daemon = True
+        self.root_pid = root_pid
+        self.interval = interval
+        self.processes = {}
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        """Take one sample of the process tree."""
+        tree = {self.root_pid}
+        readings = {}
+        for entry in os.listdir('/proc') if os.path.isdir('/proc') else []:
+            if entry.isdigit():
+                reading = read_process(int(entry))
+                if reading:
+                    readings[int(entry)] = reading
+
+        # add the children of processes in the tree until it stops growing
+        size = 0
+        while size != len(tree):
+            size = len(tree)
+            tree.update(pid for pid, reading in readings.items() if reading[0] in tree)
+
+        for pid in tree:
+            if pid not in readings:
+                continue
+            __, cpu_seconds, rss = readings[pid]
+            process = self.processes.setdefault(pid, {
+                'pid': pid,
+                'role': 'main' if pid == self.root_pid else 'child',
+                'first_cpu_seconds': cpu_seconds,
+                'cpu_seconds': 0.0,
+                'max_rss_bytes': 0,
+                'max_private_bytes': None,
+            })
+            process['cpu_seconds'] = cpu_seconds - process['first_cpu_seconds']
+            process['max_rss_bytes'] = max(process['max_rss_bytes'], rss)
+            private = read_private_bytes(pid)
+            if private is not None:
+                process['max_private_bytes'] = max(process['max_private_bytes'] or 0, private)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.sample()
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        """Stop sampling and return the figures of every process seen."""
+        self._stop_event.set()
+        self.join()
+        self.sample()
+        return [
+            {
+                'pid': process['pid'],
+                'role': process['role'],
+                'cpu_seconds': round(process['cpu_seconds'], 3),
+                'max_rss_mb': round(process['max_rss_bytes'] / 1048576.0, 2),
+                'max_private_mb': (round(process['max_private_bytes'] / 1048576.0, 2)
+                                   if process['max_private_bytes'] is not None else None),
+            }
+            for process in sorted(self.processes.values(), key=lambda process: process['pid'])
+        ]
+
+
+class BenchmarkWorker(object):
+    """
+    A benchmarks.worker process publishing a plan to itself.
+
+    Arguments:
+        plan (iterable): dicts describing the tasks to publish, see benchmarks.worker
+        pool (str): Celery pool implementation
+        concurrency (int): number of pool processes or threads
+        env (dict): extra environment variables for the worker process
+        extra_args (list): extra command line arguments for benchmarks.worker
+    """
+
+    def __init__(self, plan, pool='prefork', concurrency=4, env=None, extra_args=None):
+        self.directory = tempfile.mkdtemp(prefix='ecomworker-benchmark-')
+        self.plan_path = os.path.join(self.directory, 'plan.jsonl')
+        self.published_path = os.path.join(self.directory, 'published.json')
+        with open(self.plan_path, 'w') as plan_file:
+            for entry in plan:
+                plan_file.write(json.dumps(entry) + '\n')
+
+        command = [
+            sys.executable, '-m', 'benchmarks.worker',
+            '--pool', pool, '--concurrency', str(concurrency),
+            '--plan', self.plan_path, '--published', self.published_path,
+        ] + list(extra_args or [])
+        process_env = dict(os.environ)
+        process_env[CONFIGURATION_MODULE] = 'benchmarks.configuration'
+        process_env.update(env or {})
+        self.process = subprocess.Popen(command, env=process_env)
+        self.sampler = ProcessSampler(self.process.pid)
+        self.sampler.start()
+
+    def published(self):
+        """The publish time of each key, or None until the whole plan has been published."""
+        if not os.path.exists(self.published_path):
+            return None
+        with open(self.published_path) as published_file:
+            return json.load(published_file)
+
+    def wait(self, is_done, timeout, interval=0.05):
+        """Wait until is_done() is true, the worker died or the timeout elapsed.
+
+        Returns:
+            bool: True if is_done() became true
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if is_done():
+                return True
+            if self.process.poll() is not None:
+                return False
+            time.sleep(interval)
+        return False
+
+    def stop(self, timeout=30):
+        """Shut the worker down and return the CPU and RSS figures of its processes."""
+        processes = self.sampler.stop()
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            deadline = time.time() + timeout
+            while self.process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if self.process.poll() is None:
+                self.process.kill()
+                self.process.wait()
+        return processes
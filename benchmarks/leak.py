@@ -0,0 +1,18 @@
+"""
+Synthetic memory leak of the benchmark worker's tasks.
+
+Imported by the worker when BENCHMARK_LEAK_KB is set: every task then leaves that many
+kilobytes allocated in the process running it, the way a leaking client library would.
+"""
+import os
+
+from celery.signals import task_postrun
+
+# blocks kept alive for the life of the process
+leaked = []  # pylint: disable=invalid-name
+
+
+@task_postrun.connect
+def leak(**kwargs):  # pylint: disable=unused-argument
+    """Leave memory allocated after every task."""
+    leaked.append(bytearray(int(float(os.environ.get('BENCHMARK_LEAK_KB', 0)) * 1024)))
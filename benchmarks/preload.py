@@ -0,0 +1,127 @@
+"""
+First-task latency and memory of prefork children, with and without preloading the main process.
+
+For each setting of PRELOAD_ENABLED, two prefork workers are run:
+
+* first_task: children are replaced after every task and tasks are published one at a time,
+  so every task is the first task of a fresh child; the benchmark reports the p50/p95/p99
+  latency from publish to the task's final API call;
+* steady: children are kept and run a batch of tasks; the benchmark reports the peak RSS of
+  each child and the part of it not shared with other processes.
+
+    $ python -m benchmarks.preload --tasks 40 --output results.json
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+
+from benchmarks.harness import BenchmarkWorker, environment, percentiles
+from benchmarks.stubs import FaultProfile, start_stub_servers
+from benchmarks.throughput import build_plan, completions
+
+
+def run_worker(plan, args, env, extra_args, ecommerce, sailthru):
+    """Run a prefork worker until every task of the plan made its final call.
+
+    Returns:
+        tuple: (publish time of each key, completion time of each key, processes of the worker)
+    """
+    ecommerce.drain_calls()
+    sailthru.drain_calls()
+    worker = BenchmarkWorker(plan, 'prefork', args.concurrency, env, extra_args)
+    completed = {}
+
+    def is_done():
+        """All published tasks have made their final call."""
+        completions(ecommerce, sailthru, completed)
+        published = worker.published()
+        return published is not None and all(key in completed for key in published)
+
+    worker.wait(is_done, args.timeout)
+    processes = worker.stop()
+    completions(ecommerce, sailthru, completed)
+    return worker.published() or {}, completed, processes
+
+
+def milliseconds(values):
+    """Percentiles in milliseconds."""
+    return {name: round(value * 1000, 2) if value is not None else None
+            for name, value in percentiles(values).items()}
+
+
+def run(preload, args, ecommerce, sailthru):
+    """Measure the first tasks and the memory of the children with preloading enabled or not."""
+    env = {
+        'BENCHMARK_ECOMMERCE_API_ROOT': ecommerce.url + '/api/v2/',
+        'BENCHMARK_SAILTHRU_API_URL': sailthru.url,
+        'BENCHMARK_PRELOAD': '1' if preload else '0',
+    }
+
+    # one task at a time, each run by a fresh child
+    first_plan = list(build_plan(args.tasks // 2, 'first-{}'.format(int(preload))))
+    for index, entry in enumerate(first_plan):
+        entry['at'] = index * args.interval
+    published, completed, __ = run_worker(first_plan, args, env, ['--speed', '1', '--max-tasks-per-child', '1'],
+                                          ecommerce, sailthru)
+    first_task = [completed[key] - published[key] for key in published if key in completed]
+
+    steady_plan = build_plan(args.steady_tasks, 'steady-{}'.format(int(preload)))
+    __, __, processes = run_worker(steady_plan, args, env, [], ecommerce, sailthru)
+    children = [process for process in processes if process['role'] == 'child']
+
+    return {
+        'preload': preload,
+        'first_task_completed': len(first_task),
+        'first_task_latency_ms': milliseconds(first_task),
+        'children': len(children),
+        'child_max_rss_mb': max([child['max_rss_mb'] for child in children] or [None]),
+        'child_max_private_mb': max([child['max_private_mb'] for child in children] or [None]),
+        'processes': processes,
+    }
+
+
+def main():
+    """Run the benchmark with and without preloading and write the results."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tasks', type=int, default=40, help='number of first tasks measured')
+    parser.add_argument('--interval', type=float, default=0.5, help='seconds between two first tasks')
+    parser.add_argument('--steady-tasks', type=int, default=200,
+                        help='number of tasks of each type run by the children whose memory is measured')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--latency', default='exp:0.02', help='latency spec of the stub APIs')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file receiving the JSON results (default: stdout)')
+    args = parser.parse_args()
+
+    ecommerce, sailthru = start_stub_servers(FaultProfile(args.latency, seed=args.seed),
+                                             FaultProfile(args.latency, seed=args.seed))
+    try:
+        results = [run(preload, args, ecommerce, sailthru) for preload in (False, True)]
+    finally:
+        ecommerce.stop()
+        sailthru.stop()
+
+    report = {
+        'benchmark': 'preload',
+        'environment': environment(),
+        'parameters': {
+            'first_tasks': args.tasks,
+            'first_task_interval_seconds': args.interval,
+            'steady_tasks_per_type': args.steady_tasks,
+            'concurrency': args.concurrency,
+            'stub_latency': args.latency,
+        },
+        'results': results,
+    }
+    output = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
+    if args.output:
+        output.close()
+
+
+if __name__ == '__main__':
+    main()
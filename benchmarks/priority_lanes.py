@@ -0,0 +1,181 @@
+"""
+Latency of priority tasks under a flood of low-priority tasks, with and without priority lanes.
+
+A flood of abandoned cart events is published at once, followed by a steady trickle of
+order fulfillments and completed purchases. The plan is run twice against a filesystem
+broker shared by the worker processes:
+
+* shared: one worker with the pool of both lanes consumes every task from the fulfillment
+  and email_marketing queues, so priority tasks wait behind the flood;
+* lanes: PRIORITY_LANES_ENABLED routes the priority tasks to the priority queue, served by
+  a priority@ worker, while a bulk@ worker drains the flood.
+
+The benchmark reports the p50/p95/p99 latency of the priority tasks, from publish to their
+final API call, and how long the flood took to drain.
+
+    $ python -m benchmarks.priority_lanes --flood 2000 --priority 50 --output results.json
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+
+from benchmarks.harness import BenchmarkWorker, environment, percentiles
+from benchmarks.stubs import FaultProfile, start_stub_servers
+from benchmarks.throughput import FULFILL_ORDER, UPDATE_COURSE_ENROLLMENT, completions
+
+SCENARIOS = ('shared', 'lanes')
+
+
+def enrollment(email, index, purchase_incomplete):
+    """A verified enrollment event of a course."""
+    return {
+        'task': UPDATE_COURSE_ENROLLMENT,
+        'args': [email, 'https://courses.example.com/courses/course-{}/info'.format(index % 50),
+                 purchase_incomplete, 'verified'],
+        'kwargs': {'unit_cost': 49, 'course_id': 'course-v1:edX+Bench+{}'.format(index % 50)},
+        'queue': 'email_marketing',
+        'key': email,
+    }
+
+
+def build_plan(flood, priority, interval, run_id):
+    """
+    A flood of abandoned cart events at once, then priority tasks every interval seconds.
+
+    Priority tasks alternate between fulfillments and completed purchases. Their keys are
+    returned apart from the plan, to tell their latency from the flood's.
+
+    Returns:
+        tuple: (list of plan entries, set of the keys of the priority tasks)
+    """
+    plan = [enrollment('flood-{}-{}@example.com'.format(run_id, index), index, True) for index in range(flood)]
+    priority_keys = set()
+    for index in range(priority):
+        if index % 2:
+            entry = enrollment('priority-{}-{}@example.com'.format(run_id, index), index, False)
+        else:
+            order_number = 'PRIORITY-{}-{}'.format(run_id, index)
+            entry = {'task': FULFILL_ORDER, 'args': [order_number], 'queue': 'fulfillment', 'key': order_number}
+        entry['at'] = index * interval
+        plan.append(entry)
+        priority_keys.add(entry['key'])
+    return plan, priority_keys
+
+
+def summarize(published, completed, priority_keys):
+    """Latency of the priority tasks and drain time of the flood."""
+    def latencies(keys):
+        """Latencies of the completed tasks among keys."""
+        return [completed[key] - published[key] for key in keys if key in completed]
+
+    flood_keys = [key for key in published if key not in priority_keys]
+    flood_done = [completed[key] for key in flood_keys if key in completed]
+    return {
+        'priority_completed': len(latencies(priority_keys)),
+        'priority_latency_ms': {name: round(value * 1000, 2) if value is not None else None
+                                for name, value in percentiles(latencies(priority_keys)).items()},
+        'flood_completed': len(flood_done),
+        'flood_drain_seconds': round(max(flood_done) - min(published.values()), 3) if flood_done else None,
+    }
+
+
+def run(scenario, args, ecommerce, sailthru):
+    """Run the plan with a shared worker or with a worker per lane."""
+    plan, priority_keys = build_plan(args.flood, args.priority, args.interval, scenario)
+    lanes = {
+        'priority': {'concurrency': args.priority_concurrency, 'prefetch_multiplier': 1},
+        'bulk': {'concurrency': args.bulk_concurrency, 'prefetch_multiplier': args.prefetch_multiplier},
+    }
+    broker_dir = tempfile.mkdtemp(prefix='ecomworker-broker-')
+    env = {
+        'BENCHMARK_ECOMMERCE_API_ROOT': ecommerce.url + '/api/v2/',
+        'BENCHMARK_SAILTHRU_API_URL': sailthru.url,
+        'BENCHMARK_BROKER_URL': 'filesystem://',
+        'BENCHMARK_BROKER_DIR': broker_dir,
+    }
+    ecommerce.drain_calls()
+    sailthru.drain_calls()
+
+    if scenario == 'shared':
+        workers = [BenchmarkWorker(plan, concurrency=args.priority_concurrency + args.bulk_concurrency, env=env,
+                                   extra_args=['--speed', '1',
+                                               '--prefetch-multiplier', str(args.prefetch_multiplier)])]
+    else:
+        env['BENCHMARK_PRIORITY_LANES'] = json.dumps(lanes)
+        for entry in plan:
+            # leave the queue to the router
+            del entry['queue']
+        workers = [
+            BenchmarkWorker([], env=env, extra_args=['--hostname', 'priority@benchmark', '--queues', 'priority']),
+            BenchmarkWorker(plan, env=env, extra_args=['--hostname', 'bulk@benchmark', '--speed', '1']),
+        ]
+
+    completed = {}
+
+    def is_done():
+        """All published tasks have made their final call."""
+        completions(ecommerce, sailthru, completed)
+        published = workers[-1].published()
+        return published is not None and all(key in completed for key in published)
+
+    finished = workers[-1].wait(is_done, args.timeout)
+    processes = [process for worker in workers for process in worker.stop()]
+    completions(ecommerce, sailthru, completed)
+    shutil.rmtree(broker_dir, ignore_errors=True)
+
+    result = {'scenario': scenario, 'finished': finished, 'processes': processes}
+    result.update(summarize(workers[-1].published() or {}, completed, priority_keys))
+    return result
+
+
+def main():
+    """Run both scenarios and write the results."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--flood', type=int, default=1000, help='number of abandoned cart events')
+    parser.add_argument('--priority', type=int, default=40, help='number of priority tasks')
+    parser.add_argument('--interval', type=float, default=0.1, help='seconds between two priority tasks')
+    parser.add_argument('--priority-concurrency', type=int, default=2)
+    parser.add_argument('--bulk-concurrency', type=int, default=6)
+    parser.add_argument('--prefetch-multiplier', type=int, default=4)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--latency', default='exp:0.02', help='latency spec of the stub APIs')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file receiving the JSON results (default: stdout)')
+    args = parser.parse_args()
+
+    ecommerce, sailthru = start_stub_servers(FaultProfile(args.latency, seed=args.seed),
+                                             FaultProfile(args.latency, seed=args.seed))
+    try:
+        results = [run(scenario, args, ecommerce, sailthru) for scenario in args.scenarios.split(',')]
+    finally:
+        ecommerce.stop()
+        sailthru.stop()
+
+    report = {
+        'benchmark': 'priority_lanes',
+        'environment': environment(),
+        'parameters': {
+            'flood': args.flood,
+            'priority_tasks': args.priority,
+            'priority_interval_seconds': args.interval,
+            'priority_concurrency': args.priority_concurrency,
+            'bulk_concurrency': args.bulk_concurrency,
+            'prefetch_multiplier': args.prefetch_multiplier,
+            'stub_latency': args.latency,
+        },
+        'results': results,
+    }
+    output = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
+    if args.output:
+        output.close()
+
+
+if __name__ == '__main__':
+    main()
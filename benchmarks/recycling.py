@@ -0,0 +1,134 @@
+"""
+Throughput and memory of prefork children under the child recycling policies.
+
+Runs a prefork worker whose tasks leak --leak-kb kilobytes each (see benchmarks.leak), then one
+whose tasks do not leak, under each policy:
+
+* none: children are never replaced;
+* max_tasks: children are replaced after --max-tasks-per-child tasks, however much they grew;
+* growth: children are replaced once they grow by more than --max-growth-kb per task on
+  average, after a warm-up (CHILD_MAX_RSS_GROWTH_KB_PER_TASK);
+* rss: children are replaced once their RSS exceeds --max-rss-mb (CHILD_MAX_RSS_MB).
+
+The benchmark reports tasks per second, latency, the number of children started and the peak
+RSS of the children.
+
+    $ python -m benchmarks.recycling --tasks 2000 --output results.json
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+
+from benchmarks.harness import BenchmarkWorker, environment
+from benchmarks.stubs import FaultProfile, start_stub_servers
+from benchmarks.throughput import build_plan, completions, summarize
+
+POLICIES = ('none', 'max_tasks', 'growth', 'rss')
+
+
+def policy_settings(policy, args):
+    """Worker command line arguments and recycling settings of a policy."""
+    if policy == 'max_tasks':
+        return ['--max-tasks-per-child', str(args.max_tasks_per_child)], {}
+    if policy == 'growth':
+        return [], {
+            'CHILD_MAX_RSS_GROWTH_KB_PER_TASK': args.max_growth_kb,
+            'CHILD_RSS_WARMUP_TASKS': args.warmup_tasks,
+            'CHILD_RSS_GROWTH_MIN_TASKS': args.growth_min_tasks,
+        }
+    if policy == 'rss':
+        return [], {'CHILD_MAX_RSS_MB': args.max_rss_mb}
+    return [], {}
+
+
+def run(policy, leak_kb, args, ecommerce, sailthru):
+    """Benchmark one recycling policy."""
+    ecommerce.drain_calls()
+    sailthru.drain_calls()
+    extra_args, settings = policy_settings(policy, args)
+    env = {
+        'BENCHMARK_ECOMMERCE_API_ROOT': ecommerce.url + '/api/v2/',
+        'BENCHMARK_SAILTHRU_API_URL': sailthru.url,
+        'BENCHMARK_RECYCLING': json.dumps(settings),
+        'BENCHMARK_LEAK_KB': str(leak_kb),
+    }
+    worker = BenchmarkWorker(build_plan(args.tasks, '{}-{}'.format(policy, leak_kb)), 'prefork', args.concurrency,
+                             env, extra_args)
+    completed = {}
+
+    def is_done():
+        """All published tasks have made their final call."""
+        completions(ecommerce, sailthru, completed)
+        published = worker.published()
+        return published is not None and all(key in completed for key in published)
+
+    finished = worker.wait(is_done, args.timeout)
+    processes = worker.stop()
+    completions(ecommerce, sailthru, completed)
+
+    children = [process for process in processes if process['role'] == 'child']
+    result = {
+        'policy': policy,
+        'leak_kb': leak_kb,
+        'finished': finished,
+        'children': len(children),
+        'child_max_rss_mb': max([child['max_rss_mb'] for child in children] or [None]),
+    }
+    result.update(summarize(worker.published() or {}, completed, processes))
+    return result
+
+
+def main():
+    """Run the benchmark for each policy, with and without a leak, and write the results."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tasks', type=int, default=2000, help='number of tasks of each type')
+    parser.add_argument('--policies', default=','.join(POLICIES))
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--leak-kb', type=float, default=64, help='kilobytes leaked by every task of the leaking run')
+    parser.add_argument('--max-tasks-per-child', type=int, default=100)
+    parser.add_argument('--max-growth-kb', type=float, default=16)
+    parser.add_argument('--warmup-tasks', type=int, default=20)
+    parser.add_argument('--growth-min-tasks', type=int, default=100)
+    parser.add_argument('--max-rss-mb', type=int, default=48)
+    parser.add_argument('--latency', default='exp:0.005', help='latency spec of the stub APIs')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file receiving the JSON results (default: stdout)')
+    args = parser.parse_args()
+
+    ecommerce, sailthru = start_stub_servers(FaultProfile(args.latency, seed=args.seed),
+                                             FaultProfile(args.latency, seed=args.seed))
+    try:
+        results = [run(policy, leak_kb, args, ecommerce, sailthru)
+                   for leak_kb in (args.leak_kb, 0) for policy in args.policies.split(',')]
+    finally:
+        ecommerce.stop()
+        sailthru.stop()
+
+    report = {
+        'benchmark': 'recycling',
+        'environment': environment(),
+        'parameters': {
+            'tasks_per_type': args.tasks,
+            'concurrency': args.concurrency,
+            'leak_kb': args.leak_kb,
+            'max_tasks_per_child': args.max_tasks_per_child,
+            'max_growth_kb_per_task': args.max_growth_kb,
+            'warmup_tasks': args.warmup_tasks,
+            'growth_min_tasks': args.growth_min_tasks,
+            'max_rss_mb': args.max_rss_mb,
+            'stub_latency': args.latency,
+        },
+        'results': results,
+    }
+    output = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
+    if args.output:
+        output.close()
+
+
+if __name__ == '__main__':
+    main()
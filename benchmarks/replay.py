@@ -0,0 +1,192 @@
+"""
+Replay of a capture of production traffic against a local worker and the stub APIs.
+
+Plays the fulfill_order and update_course_enrollment tasks of a capture file written by
+ecommerce_worker.capture with their original spacing, sped up --speed times (0 publishes them
+as fast as possible), to a benchmarks.worker process calling the local stub APIs. Order
+numbers and email addresses are made unique to the run, so a capture can be replayed any
+number of times and each task is told apart in the stubs' call records. The benchmark
+reports tasks per second and the p50/p95/p99 latency from publish to the task's final API
+call, per task, so pool and configuration changes can be compared on a real traffic mix.
+
+    $ python -m benchmarks.replay capture.bin --speed 10 --pool prefork --concurrency 8 --output results.json
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+
+from benchmarks.harness import BenchmarkWorker, environment, percentiles, pool_unavailable
+from benchmarks.stubs import FaultProfile, start_stub_servers
+from benchmarks.throughput import FULFILL_ORDER, UPDATE_COURSE_ENROLLMENT, completions
+from ecommerce_worker.capture import read_capture
+
+# Queue the local worker consumes each replayed task from, and the argument telling its calls apart
+REPLAYED_TASKS = {
+    FULFILL_ORDER: ('fulfillment', 'order_number', 0),
+    UPDATE_COURSE_ENROLLMENT: ('email_marketing', 'email', 0),
+}
+
+
+def unique_key(task, value, run_id, index):
+    """An order number or email address unique to the task of a run."""
+    if task == UPDATE_COURSE_ENROLLMENT:
+        return 'replay-{}-{}-{}'.format(run_id, index, value)
+    return 'REPLAY-{}-{}-{}'.format(run_id, index, value)
+
+
+def build_plan(records, run_id, limit=None):
+    """
+    Turn captured tasks into a benchmarks.worker plan.
+
+    Arguments:
+        records (iterable): captured tasks, see ecommerce_worker.capture.read_capture
+        run_id (str): identifies the run in the order numbers and email addresses
+        limit (int): maximum number of tasks replayed
+
+    Returns:
+        tuple: (plan entries, number of captured tasks skipped because they are not replayed)
+    """
+    plan = []
+    skipped = 0
+    for record in records:
+        if limit is not None and len(plan) >= limit:
+            break
+        if record['task'] not in REPLAYED_TASKS:
+            skipped += 1
+            continue
+
+        queue, name, position = REPLAYED_TASKS[record['task']]
+        args = list(record['args'])
+        kwargs = dict(record['kwargs'])
+        if name in kwargs:
+            kwargs[name] = key = unique_key(record['task'], kwargs[name], run_id, len(plan))
+        elif position < len(args):
+            args[position] = key = unique_key(record['task'], args[position], run_id, len(plan))
+        else:
+            skipped += 1
+            continue
+
+        plan.append({'task': record['task'], 'args': args, 'kwargs': kwargs, 'queue': queue, 'key': key,
+                     'at': record['at']})
+
+    # workers sharing a capture file append their tasks in nearly, but not exactly, arrival order
+    plan.sort(key=lambda entry: entry['at'])
+    start = plan[0]['at'] if plan else 0
+    for entry in plan:
+        entry['at'] = round(entry['at'] - start, 6)
+    return plan, skipped
+
+
+def summarize(plan, published, completed):
+    """Compute throughput and latency figures of a replay."""
+    task_of_key = {entry['key']: entry['task'] for entry in plan}
+    keys = [key for key in published if key in completed]
+    duration = max(completed[key] for key in keys) - min(published.values()) if keys else None
+
+    def milliseconds(task=None):
+        """Latency percentiles in milliseconds, of one task or all of them."""
+        values = [completed[key] - published[key] for key in keys if task in (None, task_of_key[key])]
+        return {name: round(value * 1000, 2) if value is not None else None
+                for name, value in percentiles(values).items()}
+
+    return {
+        'published': len(published),
+        'completed': len(keys),
+        'duration_seconds': round(duration, 3) if duration else None,
+        'tasks_per_second': round(len(keys) / duration, 2) if duration else None,
+        'latency_ms': milliseconds(),
+        'latency_ms_by_task': {task.rpartition('.')[2]: milliseconds(task) for task in REPLAYED_TASKS},
+    }
+
+
+def replay(plan, args, ecommerce, sailthru):
+    """Replay a plan to a local worker and return the results."""
+    unavailable = pool_unavailable(args.pool)
+    if unavailable:
+        return {'pool': args.pool, 'skipped': unavailable}
+
+    ecommerce.drain_calls()
+    sailthru.drain_calls()
+    env = {
+        'BENCHMARK_ECOMMERCE_API_ROOT': ecommerce.url + '/api/v2/',
+        'BENCHMARK_SAILTHRU_API_URL': sailthru.url,
+    }
+    if args.broker:
+        env['BENCHMARK_BROKER_URL'] = args.broker
+
+    worker = BenchmarkWorker(plan, args.pool, args.concurrency, env,
+                             ['--prefetch-multiplier', str(args.prefetch_multiplier), '--speed', str(args.speed)])
+    completed = {}
+
+    def is_done():
+        """All published tasks have made their final call."""
+        completions(ecommerce, sailthru, completed)
+        published = worker.published()
+        return published is not None and all(key in completed for key in published)
+
+    finished = worker.wait(is_done, args.timeout)
+    processes = worker.stop()
+    completions(ecommerce, sailthru, completed)
+
+    result = {'pool': args.pool, 'concurrency': args.concurrency, 'finished': finished, 'processes': processes}
+    if not finished:
+        result['worker_exit_code'] = worker.process.returncode
+    result.update(summarize(plan, worker.published() or {}, completed))
+    return result
+
+
+def main():
+    """Replay a capture and write the results."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('capture', help='capture file written by ecommerce_worker.capture')
+    parser.add_argument('--speed', type=float, default=1,
+                        help='speed-up of the captured arrival times (0 publishes as fast as possible)')
+    parser.add_argument('--limit', type=int, help='maximum number of tasks replayed')
+    parser.add_argument('--pool', default='prefork')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--prefetch-multiplier', type=int, default=4)
+    parser.add_argument('--broker', help='broker URL (default: in-memory broker inside the worker process)')
+    parser.add_argument('--latency', default='exp:0.02', help='latency spec of the stub APIs')
+    parser.add_argument('--timeout', type=float, default=3600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--run-id', default='run', help='identifies the run in order numbers and emails')
+    parser.add_argument('--output', help='file receiving the JSON results (default: stdout)')
+    args = parser.parse_args()
+
+    with open(args.capture, 'rb') as capture:
+        plan, skipped = build_plan(read_capture(capture), args.run_id, args.limit)
+
+    ecommerce, sailthru = start_stub_servers(FaultProfile(args.latency, seed=args.seed),
+                                             FaultProfile(args.latency, seed=args.seed))
+    try:
+        result = replay(plan, args, ecommerce, sailthru)
+    finally:
+        ecommerce.stop()
+        sailthru.stop()
+
+    report = {
+        'benchmark': 'replay',
+        'environment': environment(),
+        'parameters': {
+            'capture': args.capture,
+            'tasks': len(plan),
+            'skipped_tasks': skipped,
+            'capture_seconds': plan[-1]['at'] if plan else 0,
+            'speed': args.speed,
+            'prefetch_multiplier': args.prefetch_multiplier,
+            'broker': args.broker or 'memory://',
+            'stub_latency': args.latency,
+        },
+        'results': [result],
+    }
+    output = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
+    if args.output:
+        output.close()
+
+
+if __name__ == '__main__':
+    main()
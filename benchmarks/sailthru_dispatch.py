@@ -0,0 +1,146 @@
+"""
+Micro-benchmark of the CPU spent preparing a Sailthru purchase call.
+
+Compares the per-event work done before the dispatch tables existed (reading the SAILTHRU
+settings, branching on mode, building the options and the item) with the prebuilt
+dispatch table and cached item template. Course data is served from the cache in both
+cases, so no network calls are made.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+
+from ecommerce_worker.sailthru.v1 import tasks
+from ecommerce_worker.utils import get_configuration
+
+COURSE_ID = 'course-v1:edX+DemoX+Demo_Course'
+COURSE_URL = 'https://courses.example.com/courses/course-v1:edX+DemoX+Demo_Course/info'
+COURSE_DATA = {
+    'title': 'Demo Course',
+    'tags': 'demo,course',
+    'vars': {'upgrade_deadline_verified': '2020-03-12', 'marketing_slug': 'demo'},
+}
+EVENTS = [
+    # (mode, purchase_incomplete, unit_cost)
+    ('verified', True, 49),
+    ('verified', False, 49),
+    ('audit', False, 0),
+    ('credit', False, 99),
+]
+
+
+def legacy_prepare(mode, purchase_incomplete, unit_cost, site_code=None):
+    """The per-event preparation as it was done before dispatch tables."""
+    config = get_configuration('SAILTHRU', site_code=site_code)
+    if not config.get('SAILTHRU_ENABLE'):
+        return None
+    if not (config.get('SAILTHRU_KEY') and config.get('SAILTHRU_SECRET')):
+        return None
+
+    new_enroll = False
+    send_template = None
+    if not purchase_incomplete:
+        if mode == 'verified':
+            send_template = config.get('SAILTHRU_UPGRADE_TEMPLATE')
+        elif mode == 'audit' or mode == 'honor':
+            new_enroll = True
+            send_template = config.get('SAILTHRU_ENROLL_TEMPLATE')
+        else:
+            new_enroll = True
+            send_template = config.get('SAILTHRU_PURCHASE_TEMPLATE')
+
+    cost_in_cents = int(unit_cost * 100)
+    if not cost_in_cents:
+        cost_in_cents = config.get('SAILTHRU_MINIMUM_COST')
+
+    course_data = tasks.cache.get("{}:{}".format(site_code, COURSE_URL))
+    item = {
+        'id': "{}-{}".format(COURSE_ID, mode),
+        'url': COURSE_URL,
+        'price': cost_in_cents,
+        'qty': 1,
+    }
+    if 'title' in course_data:
+        item['title'] = course_data['title']
+    else:
+        item['title'] = 'Course {} mode: {}'.format(COURSE_ID, mode)
+    if 'tags' in course_data:
+        item['tags'] = course_data['tags']
+    item['vars'] = dict(course_data.get('vars', {}), mode=mode, course_run_id=COURSE_ID)
+
+    options = {}
+    if purchase_incomplete and config.get('SAILTHRU_ABANDONED_CART_TEMPLATE'):
+        options['reminder_template'] = config.get('SAILTHRU_ABANDONED_CART_TEMPLATE')
+        options['reminder_time'] = "+{} minutes".format(config.get('SAILTHRU_ABANDONED_CART_DELAY'))
+    if send_template:
+        options['send_template'] = send_template
+
+    return new_enroll, item, options
+
+
+def dispatch_prepare(mode, purchase_incomplete, unit_cost, site_code=None):
+    """The per-event preparation using the dispatch table and item templates."""
+    dispatch = tasks.get_site_dispatch(site_code)
+    if not dispatch.enabled or not (dispatch.key and dispatch.secret):
+        return None
+
+    new_enroll, options = dispatch.event(mode, purchase_incomplete)
+    cost_in_cents = int(unit_cost * 100)
+    if not cost_in_cents:
+        cost_in_cents = dispatch.minimum_cost
+
+    item_template = tasks._get_item_template(  # pylint: disable=protected-access
+        COURSE_ID, COURSE_URL, mode, None, site_code, dispatch
+    )
+    item = tasks._build_purchase_item(item_template, cost_in_cents)  # pylint: disable=protected-access
+    return new_enroll, item, options
+
+
+def cpu_seconds():
+    """User and system CPU time consumed by this process so far."""
+    times = os.times()
+    return times[0] + times[1]
+
+
+def measure(prepare, iterations):
+    """Return the CPU microseconds spent per event by prepare."""
+    start = cpu_seconds()
+    for __ in range(iterations):
+        for mode, purchase_incomplete, unit_cost in EVENTS:
+            prepare(mode, purchase_incomplete, unit_cost)
+    return (cpu_seconds() - start) * 1e6 / (iterations * len(EVENTS))
+
+
+def main():
+    """Run the benchmark and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=50000)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    ttl = get_configuration('SAILTHRU')['SAILTHRU_CACHE_TTL_SECONDS']
+    tasks.cache.set("{}:{}".format(None, COURSE_URL), COURSE_DATA, ttl)
+
+    # both paths must produce the same purchase call
+    for mode, purchase_incomplete, unit_cost in EVENTS:
+        assert legacy_prepare(mode, purchase_incomplete, unit_cost) == \
+            dispatch_prepare(mode, purchase_incomplete, unit_cost)
+
+    results = {
+        'legacy_us_per_event': measure(legacy_prepare, args.iterations),
+        'dispatch_us_per_event': measure(dispatch_prepare, args.iterations),
+    }
+    results['speedup'] = results['legacy_us_per_event'] / results['dispatch_us_per_event']
+
+    if args.json:
+        print(json.dumps(results, sort_keys=True))
+    else:
+        print('legacy:   {legacy_us_per_event:8.2f} us/event'.format(**results))
+        print('dispatch: {dispatch_us_per_event:8.2f} us/event'.format(**results))
+        print('speedup:  {speedup:8.2f}x'.format(**results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Micro-benchmark of the serializers of task messages: size, encode and decode time.
+
+Compares Celery's default serializer (pickle) and the json and msgpack serializers with the
+compact serializer of ecommerce_worker.serialization, with and without compression, on the
+messages of fulfill_order and of update_course_enrollment called the way the LMS calls it, with
+a Decimal unit cost. The msgpack serializer of kombu does not support Decimals, so its figures
+for update_course_enrollment are reported as unsupported.
+
+    $ python -m benchmarks.serialization --iterations 20000
+"""
+from __future__ import print_function
+
+import argparse
+from decimal import Decimal
+import functools
+import json
+import os
+
+from celery import uuid
+from kombu.exceptions import EncodeError
+from kombu.serialization import dumps, loads
+
+from ecommerce_worker import serialization
+from ecommerce_worker.fulfillment.v1.tasks import fulfill_order
+from ecommerce_worker.sailthru.v1.tasks import update_course_enrollment
+
+SERIALIZERS = ('pickle', 'json', 'msgpack', 'compact', 'compact-zlib')
+
+COURSE_ID = 'course-v1:edX+DemoX+Demo_Course'
+
+
+def message(task, args, kwargs):
+    """A task message as published by Celery."""
+    return {
+        'task': task, 'id': uuid(), 'args': args, 'kwargs': kwargs, 'retries': 0, 'eta': None,
+        'expires': None, 'utc': True, 'callbacks': None, 'errbacks': None, 'timelimit': (None, None),
+        'taskset': None, 'chord': None,
+    }
+
+
+MESSAGES = {
+    'fulfill_order': message(fulfill_order.name, ('EDX-100042',), {'site_code': 'edx'}),
+    'update_course_enrollment': message(
+        update_course_enrollment.name,
+        ('learner@example.com', 'https://courses.edx.org/courses/{}/info'.format(COURSE_ID), False, 'verified'),
+        {'unit_cost': Decimal('49.00'), 'course_id': COURSE_ID, 'currency': 'USD',
+         'message_id': '1a2b3c4d5e6f7a8b9c0d1e2f3a4b5c6d', 'site_code': 'edx'},
+    ),
+}
+
+
+def codec(serializer):
+    """Return (encode, decode) functions of a serializer."""
+    if serializer == 'compact-zlib':
+        return functools.partial(serialization.pack, compression_threshold=1), serialization.unpack
+
+    def encode(body):
+        """Serialize body with the kombu serializer."""
+        return dumps(body, serializer=serializer)
+
+    def decode(encoded):
+        """Deserialize what encode returned."""
+        return loads(encoded[2], encoded[0], encoded[1], accept=[encoded[0]])
+
+    return encode, decode
+
+
+def payload_size(encoded):
+    """Size in bytes of an encoded message."""
+    return len(encoded if isinstance(encoded, str) else encoded[2])
+
+
+def cpu_seconds():
+    """User and system CPU time consumed by this process so far."""
+    times = os.times()
+    return times[0] + times[1]
+
+
+def measure(function, argument, iterations):
+    """Return the CPU microseconds spent per call of function."""
+    start = cpu_seconds()
+    for __ in range(iterations):
+        function(argument)
+    return (cpu_seconds() - start) * 1e6 / iterations
+
+
+def main():
+    """Run the benchmark and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    results = []
+    for name, body in sorted(MESSAGES.items()):
+        for serializer in SERIALIZERS:
+            encode, decode = codec(serializer)
+            try:
+                encoded = encode(body)
+            except EncodeError:
+                results.append({'message': name, 'serializer': serializer, 'unsupported': True})
+                continue
+            results.append({
+                'message': name,
+                'serializer': serializer,
+                'bytes': payload_size(encoded),
+                'encode_us': round(measure(encode, body, args.iterations), 2),
+                'decode_us': round(measure(decode, encoded, args.iterations), 2),
+            })
+
+    if args.json:
+        print(json.dumps(results, sort_keys=True))
+    else:
+        print('{:26} {:14} {:>7} {:>10} {:>10}'.format('message', 'serializer', 'bytes', 'encode us', 'decode us'))
+        for result in results:
+            if result.get('unsupported'):
+                print('{message:26} {serializer:14} {:>7}'.format('unsupported', **result))
+                continue
+            print('{message:26} {serializer:14} {bytes:7d} {encode_us:10.2f} {decode_us:10.2f}'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+"""
+Local stand-in servers for the ecommerce and Sailthru APIs.
+
+The stubs answer the calls made by the worker's tasks:
+
+* ecommerce: ``PUT .../orders/<number>/fulfill/``
+* Sailthru: ``GET /user``, ``POST /user``, ``GET /content`` and ``POST /purchase``
+
+Each server injects latency drawn from a configurable distribution and fails a configurable
+fraction of calls. Latency specs are ``none``, ``fixed:<s>``, ``uniform:<low>,<high>``,
+``exp:<mean>`` or ``lognormal:<median>,<sigma>``. Error specs map an outcome to its rate,
+e.g. ``406=0.05,500=0.01`` for the ecommerce stub or ``9=0.01,43=0.02,503=0.01`` for the
+Sailthru stub, where 9 and 43 are Sailthru error codes. A server given a capacity stands for a
+service serving that many calls at once: each call arriving while more calls are in flight is
+slowed down in proportion, so sending more calls than the capacity only makes them all slower.
+
+The fault profile of a running server can be changed over HTTP by posting a JSON document
+such as ``{"latency": "exp:0.2", "errors": {"500": 0.1}, "capacity": 4}`` to ``/_stub/profile``;
+``GET /_stub/stats`` returns the calls served so far.
+
+To run both stubs until interrupted:
+
+    $ python -m benchmarks.stubs --ecommerce-port 8002 --sailthru-port 8003 --latency exp:0.05
+
+Then point the worker at them with ``ECOMMERCE_API_ROOT = 'http://localhost:8002/api/v2/'``
+and ``SAILTHRU_API_URL = 'http://localhost:8003'``.
+"""
+from __future__ import print_function
+
+import argparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import Counter
+import json
+import random
+import re
+from SocketServer import ThreadingMixIn
+import threading
+import time
+from urlparse import parse_qs, urlparse
+
+FULFILL_PATH = re.compile(r'/orders/(?P<number>[^/]+)/fulfill/?$')
+
+# HTTP status returned along with each Sailthru error code
+SAILTHRU_ERROR_STATUS = {9: 500, 43: 429}
+
+
+class Latency(object):
+    """A latency distribution, in seconds, parsed from a spec such as 'exp:0.05'."""
+
+    def __init__(self, spec='none', rng=None):
+        self.spec = spec
+        self.rng = rng or random.Random()
+        kind, __, params = spec.partition(':')
+        values = [float(value) for value in params.split(',') if value]
+
+        samplers = {
+            'none': (0, lambda: 0.0),
+            'fixed': (1, lambda: values[0]),
+            'uniform': (2, lambda: self.rng.uniform(values[0], values[1])),
+            'exp': (1, lambda: self.rng.expovariate(1.0 / values[0])),
+            # the median of a lognormal distribution is exp(mu)
+            'lognormal': (2, lambda: values[0] * self.rng.lognormvariate(0, values[1])),
+        }
+        if kind not in samplers or len(values) != samplers[kind][0]:
+            raise ValueError('Invalid latency spec: {}'.format(spec))
+        self.sample = samplers[kind][1]
+
+
+class FaultProfile(object):
+    """
+    Latency and error injection settings of a stub server.
+
+    Arguments:
+        latency (str): latency spec
+        errors (dict): maps an outcome (HTTP status or Sailthru error code) to its rate
+        seed (int): seed making the injected faults reproducible
+        capacity (int): number of calls served at once without slowing down, 0 for no limit
+    """
+
+    def __init__(self, latency='none', errors=None, seed=None, capacity=0):
+        self.rng = random.Random(seed)
+        self.latency = Latency(latency, self.rng)
+        self.capacity = capacity
+        self.errors = sorted((int(outcome), float(rate)) for outcome, rate in (errors or {}).items())
+        if sum(rate for __, rate in self.errors) > 1:
+            raise ValueError('Error rates add up to more than 1: {}'.format(errors))
+
+    def delay(self, in_flight=1):
+        """Sleep for a latency drawn from the distribution, slowed down by the calls in flight beyond the capacity."""
+        seconds = self.latency.sample()
+        if self.capacity:
+            seconds *= max(1.0, float(in_flight) / self.capacity)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def outcome(self):
+        """Draw the error to inject into a call, or None for a successful call."""
+        draw = self.rng.random()
+        for outcome, rate in self.errors:
+            if draw < rate:
+                return outcome
+            draw -= rate
+        return None
+
+
+def parse_errors(spec):
+    """Parse an error spec such as '406=0.05,500=0.01' into a dict."""
+    errors = {}
+    for part in spec.split(','):
+        if part:
+            outcome, __, rate = part.partition('=')
+            errors[int(outcome)] = float(rate)
+    return errors
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server recording the calls it serves.
+
+    Every call is recorded as a (time, endpoint, key, outcome) tuple, where key identifies
+    the order or user the call was about and outcome is 'ok' or the injected error.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    # workers open many connections at once; the default backlog of 5 delays their connects
+    request_queue_size = 128
+
+    def __init__(self, handler_class, profile=None, host='127.0.0.1', port=0):
+        HTTPServer.__init__(self, (host, port), handler_class)
+        self.profile = profile or FaultProfile()
+        self.calls = []
+        self.calls_lock = threading.Lock()
+        self.fulfilled_orders = set()
+        self.in_flight = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        """Root URL of the server."""
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def start(self):
+        """Serve requests on a background thread."""
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05},
+                                       name=self.__class__.__name__)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and release the socket."""
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def delay(self):
+        """Inject the latency of the current profile into a call, given the calls in flight."""
+        with self.calls_lock:
+            self.in_flight += 1
+            in_flight = self.in_flight
+        try:
+            self.profile.delay(in_flight)
+        finally:
+            with self.calls_lock:
+                self.in_flight -= 1
+
+    def record(self, endpoint, key, outcome):
+        """Record a call."""
+        with self.calls_lock:
+            self.calls.append((time.time(), endpoint, key, outcome))
+
+    def drain_calls(self):
+        """Return and forget the calls recorded so far."""
+        with self.calls_lock:
+            calls, self.calls = self.calls, []
+        return calls
+
+    def stats(self):
+        """Count the calls recorded so far by endpoint and outcome."""
+        with self.calls_lock:
+            counts = Counter('{} {}'.format(endpoint, outcome) for __, endpoint, __, outcome in self.calls)
+        return dict(counts)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Base request handler, serving the /_stub admin endpoints."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Keep the console quiet; calls are recorded by the server instead."""
+        pass
+
+    def send_json(self, status, document):
+        """Send a JSON response."""
+        body = json.dumps(document)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        """Read the request body."""
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else ''
+
+    def handle_admin(self, method):
+        """Serve the admin endpoints; return False if the path is not one of them."""
+        path = urlparse(self.path).path
+        if method == 'GET' and path == '/_stub/stats':
+            self.send_json(200, self.server.stats())
+        elif method == 'POST' and path == '/_stub/profile':
+            document = json.loads(self.read_body())
+            self.server.profile = FaultProfile(document.get('latency', 'none'), document.get('errors'),
+                                               document.get('seed'), document.get('capacity', 0))
+            self.send_json(200, {'ok': True})
+        else:
+            return False
+        return True
+
+
+class EcommerceHandler(StubHandler):
+    """Stand-in for the ecommerce order fulfillment API."""
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        """Fulfill an order."""
+        self.read_body()
+        match = FULFILL_PATH.search(urlparse(self.path).path)
+        if not match:
+            self.send_json(404, {'detail': 'Not found.'})
+            return
+
+        number = match.group('number')
+        self.server.delay()
+        status = self.server.profile.outcome()
+        if status is None and number in self.server.fulfilled_orders:
+            # the ecommerce service refuses to fulfill an order twice
+            status = 406
+        if status is None:
+            self.server.fulfilled_orders.add(number)
+
+        self.server.record('fulfill', number, status or 'ok')
+        if status is None:
+            self.send_json(200, {'number': number, 'status': 'Complete'})
+        else:
+            self.send_json(status, {'detail': 'Injected error.'})
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Serve the admin endpoints."""
+        if not self.handle_admin('GET'):
+            self.send_json(404, {'detail': 'Not found.'})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Serve the admin endpoints."""
+        if not self.handle_admin('POST'):
+            self.send_json(404, {'detail': 'Not found.'})
+
+
+class SailthruHandler(StubHandler):
+    """Stand-in for the Sailthru user, content and purchase APIs."""
+
+    RESPONSES = {
+        ('GET', 'user'): lambda data: {'keys': {'email': data.get('id')}, 'vars': {'unenrolled': []}},
+        ('POST', 'user'): lambda data: {'ok': True},
+        ('GET', 'content'): lambda data: {'url': data.get('id'), 'title': 'Stub course', 'tags': 'stub', 'vars': {}},
+        ('POST', 'purchase'): lambda data: {'purchase': {'email': data.get('email'), 'items': data.get('items')}},
+    }
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Read a user record or content item."""
+        if not self.handle_admin('GET'):
+            self.handle_api('GET', parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Update a user record or record a purchase."""
+        if not self.handle_admin('POST'):
+            self.handle_api('POST', parse_qs(self.read_body()))
+
+    def handle_api(self, method, params):
+        """Answer an API call, injecting faults."""
+        action = urlparse(self.path).path.strip('/')
+        respond = self.RESPONSES.get((method, action))
+        if respond is None:
+            self.send_json(404, {'error': 99, 'errormsg': 'Unknown action'})
+            return
+
+        data = json.loads(params.get('json', ['{}'])[0])
+        key = data.get('email') or data.get('id')
+        self.server.delay()
+        outcome = self.server.profile.outcome()
+        self.server.record(action, key, outcome or 'ok')
+
+        if outcome is None:
+            self.send_json(200, respond(data))
+        elif outcome in SAILTHRU_ERROR_STATUS:
+            self.send_json(SAILTHRU_ERROR_STATUS[outcome], {'error': outcome, 'errormsg': 'Injected error'})
+        else:
+            self.send_json(outcome, {'error': 9, 'errormsg': 'Injected HTTP error'})
+
+
+def start_stub_servers(ecommerce_profile=None, sailthru_profile=None, host='127.0.0.1',
+                       ecommerce_port=0, sailthru_port=0):
+    """Start both stub servers on background threads.
+
+    Returns:
+        tuple: (ecommerce server, Sailthru server)
+    """
+    ecommerce = StubServer(EcommerceHandler, ecommerce_profile, host, ecommerce_port).start()
+    sailthru = StubServer(SailthruHandler, sailthru_profile, host, sailthru_port).start()
+    return ecommerce, sailthru
+
+
+def main():
+    """Run the stub servers until interrupted."""
+    parser = argparse.ArgumentParser(description='Run local stand-ins for the ecommerce and Sailthru APIs.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--ecommerce-port', type=int, default=8002)
+    parser.add_argument('--sailthru-port', type=int, default=8003)
+    parser.add_argument('--latency', default='none', help='latency spec applied to both stubs')
+    parser.add_argument('--ecommerce-latency', help='latency spec for the ecommerce stub')
+    parser.add_argument('--sailthru-latency', help='latency spec for the Sailthru stub')
+    parser.add_argument('--ecommerce-errors', default='', help='e.g. 406=0.05,500=0.01')
+    parser.add_argument('--sailthru-errors', default='', help='e.g. 9=0.01,43=0.02')
+    parser.add_argument('--ecommerce-capacity', type=int, default=0,
+                        help='calls the ecommerce stub serves at once before slowing down (default: no limit)')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    ecommerce, sailthru = start_stub_servers(
+        FaultProfile(args.ecommerce_latency or args.latency, parse_errors(args.ecommerce_errors), args.seed,
+                     args.ecommerce_capacity),
+        FaultProfile(args.sailthru_latency or args.latency, parse_errors(args.sailthru_errors), args.seed),
+        args.host, args.ecommerce_port, args.sailthru_port
+    )
+    print('ecommerce stub: {}/api/v2/'.format(ecommerce.url))
+    print('Sailthru stub:  {}'.format(sailthru.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ecommerce.stop()
+        sailthru.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""Tests of the benchmark harness."""
+import argparse
+import os
+from unittest import TestCase
+
+from benchmarks import adaptive_limit, priority_lanes, publishing, recycling, replay
+from benchmarks.harness import ProcessSampler, percentiles, pool_unavailable, read_private_bytes, read_process
+from benchmarks.throughput import build_plan, summarize
+
+
+class HarnessTests(TestCase):
+    """Tests of the statistics and process sampling helpers."""
+
+    def test_percentiles(self):
+        self.assertEqual(percentiles(range(1, 101)), {'p50': 50, 'p95': 95, 'p99': 99})
+        self.assertEqual(percentiles([3]), {'p50': 3, 'p95': 3, 'p99': 3})
+        self.assertEqual(percentiles([]), {'p50': None, 'p95': None, 'p99': None})
+
+    def test_pool_unavailable(self):
+        self.assertIsNone(pool_unavailable('prefork'))
+        self.assertIsNone(pool_unavailable('solo'))
+
+    def test_process_sampler(self):
+        if read_process(os.getpid()) is None:
+            self.skipTest('/proc is not available')
+
+        sampler = ProcessSampler(os.getpid())
+        sampler.sample()
+        self.assertEqual([process['role'] for process in sampler.processes.values()], ['main'])
+        private = read_private_bytes(os.getpid())
+        self.assertTrue(private is None or 0 < private <= read_process(os.getpid())[2])
+
+
+class ThroughputTests(TestCase):
+    """Tests of the throughput benchmark's plan and summary."""
+
+    def test_build_plan(self):
+        plan = list(build_plan(3, 'run'))
+        self.assertEqual(len(plan), 6)
+        self.assertEqual([entry['queue'] for entry in plan[:2]], ['fulfillment', 'email_marketing'])
+        self.assertEqual(len({entry['key'] for entry in plan}), 6)
+
+    def test_summarize(self):
+        published = {'BENCH-run-0': 10.0, 'bench-run-0@example.com': 10.0, 'BENCH-run-1': 11.0}
+        completed = {'BENCH-run-0': 10.5, 'bench-run-0@example.com': 11.0}
+        summary = summarize(published, completed, [{'cpu_seconds': 1.5}, {'cpu_seconds': 0.5}])
+        self.assertEqual(summary['completed'], 2)
+        self.assertEqual(summary['tasks_per_second'], 2.0)
+        self.assertEqual(summary['latency_ms_by_task']['fulfill_order']['p50'], 500.0)
+        self.assertEqual(summary['total_cpu_seconds'], 2.0)
+
+
+class PriorityLanesTests(TestCase):
+    """Tests of the priority lanes benchmark's plan and summary."""
+
+    def test_build_plan(self):
+        plan, priority_keys = priority_lanes.build_plan(4, 3, 0.5, 'run')
+        self.assertEqual(len(plan), 7)
+        self.assertEqual([entry.get('at') for entry in plan[4:]], [0, 0.5, 1.0])
+        self.assertEqual(priority_keys, {entry['key'] for entry in plan[4:]})
+
+    def test_summarize(self):
+        published = {'flood': 10.0, 'order': 10.0, 'purchase': 11.0}
+        completed = {'flood': 13.0, 'order': 10.1, 'purchase': 11.3}
+        summary = priority_lanes.summarize(published, completed, {'order', 'purchase'})
+        self.assertEqual(summary['priority_completed'], 2)
+        self.assertEqual(summary['priority_latency_ms']['p99'], 300.0)
+        self.assertEqual(summary['flood_drain_seconds'], 3.0)
+
+
+class RecyclingTests(TestCase):
+    """Tests of the recycling benchmark's policies."""
+
+    def test_policy_settings(self):
+        args = argparse.Namespace(max_tasks_per_child=100, max_growth_kb=16, warmup_tasks=20, growth_min_tasks=100,
+                                  max_rss_mb=128)
+        self.assertEqual(recycling.policy_settings('none', args), ([], {}))
+        self.assertEqual(recycling.policy_settings('max_tasks', args), (['--max-tasks-per-child', '100'], {}))
+        self.assertEqual(recycling.policy_settings('rss', args), ([], {'CHILD_MAX_RSS_MB': 128}))
+        __, settings = recycling.policy_settings('growth', args)
+        self.assertEqual(settings['CHILD_MAX_RSS_GROWTH_KB_PER_TASK'], 16)
+
+
+class PublishingTests(TestCase):
+    """Tests of the publishing benchmark."""
+
+    def test_run(self):
+        for mode in publishing.MODES:
+            result = publishing.run(mode, 'memory://', 10, chunk_size=4)
+            self.assertEqual((result['mode'], result['messages'], result['failed']), (mode, 10, 0))
+
+
+class ReplayTests(TestCase):
+    """Tests of the replay benchmark's plan and summary."""
+
+    def test_build_plan(self):
+        records = [
+            {'at': 1000.5, 'task': replay.UPDATE_COURSE_ENROLLMENT, 'args': ['a@capture.invalid', 'url', False],
+             'kwargs': {'mode': 'verified'}, 'site_code': None},
+            {'at': 1000.0, 'task': replay.FULFILL_ORDER, 'args': [], 'kwargs': {'order_number': 'EDX-1'},
+             'site_code': 'edx'},
+            {'at': 1001.0, 'task': 'other.task', 'args': [], 'kwargs': {}, 'site_code': None},
+        ]
+        plan, skipped = replay.build_plan(records, 'run')
+        self.assertEqual(skipped, 1)
+        self.assertEqual([(entry['key'], entry['queue'], entry['at']) for entry in plan], [
+            ('REPLAY-run-1-EDX-1', 'fulfillment', 0),
+            ('replay-run-0-a@capture.invalid', 'email_marketing', 0.5),
+        ])
+        self.assertEqual(plan[0]['kwargs'], {'order_number': 'REPLAY-run-1-EDX-1'})
+        self.assertEqual(plan[1]['args'][0], 'replay-run-0-a@capture.invalid')
+        self.assertEqual(len(replay.build_plan(records, 'run', limit=1)[0]), 1)
+
+    def test_summarize(self):
+        plan = [{'key': 'order', 'task': replay.FULFILL_ORDER},
+                {'key': 'email', 'task': replay.UPDATE_COURSE_ENROLLMENT}]
+        summary = replay.summarize(plan, {'order': 10.0, 'email': 10.5}, {'order': 10.2, 'email': 11.0})
+        self.assertEqual(summary['completed'], 2)
+        self.assertEqual(summary['tasks_per_second'], 2.0)
+        self.assertEqual(summary['latency_ms_by_task']['fulfill_order']['p50'], 200.0)
+
+
+class AdaptiveLimitTests(TestCase):
+    """Tests of the adaptive concurrency limit benchmark's settings and summary."""
+
+    def test_fulfillment_settings(self):
+        args = argparse.Namespace(budget=2.0, concurrency=32, max_wait=1.0)
+        settings = adaptive_limit.fulfillment_settings('adaptive', args)
+        self.assertTrue(settings['FULFILLMENT_CONCURRENCY_LIMIT_ENABLED'])
+        self.assertEqual(settings['TASK_DEADLINE_SECONDS'], {adaptive_limit.FULFILL_ORDER: 2.0})
+        self.assertFalse(adaptive_limit.fulfillment_settings('fixed', args)['FULFILLMENT_CONCURRENCY_LIMIT_ENABLED'])
+
+    def test_summarize(self):
+        published = {'A': 10.0, 'B': 10.0, 'C': 10.0}
+        calls = [
+            (10.5, 'fulfill', 'A', 'ok'),
+            (11.5, 'fulfill', 'B', 'ok'),
+            # C timed out in the worker, which called again
+            (13.0, 'fulfill', 'C', 'ok'),
+            (14.0, 'fulfill', 'C', 406),
+        ]
+        summary = adaptive_limit.summarize(published, calls, degraded_at=11.0)
+        self.assertEqual(summary['fulfilled'], 3)
+        self.assertDictContainsSubset({'orders_fulfilled': 1, 'goodput_per_second': 1.0}, summary['healthy'])
+        self.assertDictContainsSubset({'orders_fulfilled': 2, 'goodput_per_second': 1.0, 'calls_per_order': 1.5},
+                                      summary['degraded'])
+        self.assertIsNone(adaptive_limit.summarize(published, [], None)['healthy'])
@@ -0,0 +1,128 @@
+"""Tests of the local ecommerce and Sailthru stub servers."""
+# pylint: disable=no-value-for-parameter
+import json
+from unittest import TestCase
+
+from celery.exceptions import Ignore
+import ddt
+from edx_rest_api_client import exceptions
+from edx_rest_api_client.client import EdxRestApiClient
+import mock
+import requests
+from sailthru.sailthru_client import SailthruClient
+
+from benchmarks.stubs import FaultProfile, Latency, parse_errors, start_stub_servers
+# Ensures that a Celery app is initialized when tests are run.
+from ecommerce_worker import celery_app  # pylint: disable=unused-import
+from ecommerce_worker.fulfillment.v1.tasks import fulfill_order
+from ecommerce_worker.sailthru.v1.tasks import dispatch_tables, update_course_enrollment
+from ecommerce_worker.utils import get_configuration
+
+
+@ddt.ddt
+class FaultProfileTests(TestCase):
+    """Tests of latency and error injection."""
+
+    @ddt.data('none', 'fixed:0.1', 'uniform:0.1,0.2', 'exp:0.1', 'lognormal:0.1,0.5')
+    def test_latency_specs(self, spec):
+        sample = Latency(spec).sample()
+        self.assertGreaterEqual(sample, 0)
+
+    @ddt.data('fixed', 'uniform:0.1', 'gaussian:0.1', 'exp:a')
+    def test_invalid_latency_specs(self, spec):
+        with self.assertRaises(ValueError):
+            Latency(spec)
+
+    def test_outcomes(self):
+        profile = FaultProfile(errors={406: 0.25, 500: 0.25}, seed=1)
+        outcomes = [profile.outcome() for __ in range(4000)]
+        self.assertAlmostEqual(outcomes.count(406) / 4000.0, 0.25, delta=0.03)
+        self.assertAlmostEqual(outcomes.count(500) / 4000.0, 0.25, delta=0.03)
+        self.assertAlmostEqual(outcomes.count(None) / 4000.0, 0.5, delta=0.03)
+
+    def test_capacity(self):
+        profile = FaultProfile('fixed:0.1', capacity=2)
+        with mock.patch('benchmarks.stubs.time.sleep') as sleep:
+            profile.delay(in_flight=1)
+            profile.delay(in_flight=2)
+            profile.delay(in_flight=6)
+        self.assertEqual([call[0][0] for call in sleep.call_args_list], [0.1, 0.1, 0.1 * 3])
+
+    def test_invalid_rates(self):
+        with self.assertRaises(ValueError):
+            FaultProfile(errors={500: 0.6, 503: 0.6})
+
+    def test_parse_errors(self):
+        self.assertEqual(parse_errors('406=0.05,500=0.01'), {406: 0.05, 500: 0.01})
+        self.assertEqual(parse_errors(''), {})
+
+
+class StubServerTests(TestCase):
+    """Tests of the stub servers, driven by the clients and tasks of the worker."""
+
+    def setUp(self):
+        super(StubServerTests, self).setUp()
+        self.ecommerce, self.sailthru = start_stub_servers()
+        self.addCleanup(self.ecommerce.stop)
+        self.addCleanup(self.sailthru.stop)
+        dispatch_tables.clear()
+        self.addCleanup(dispatch_tables.clear)
+
+    def test_fulfillment(self):
+        api = EdxRestApiClient(self.ecommerce.url + '/api/v2/')
+        api.orders('ORDER-1').fulfill.put()
+
+        # a second fulfillment of the same order is refused
+        with self.assertRaises(exceptions.HttpClientError) as context:
+            api.orders('ORDER-1').fulfill.put()
+        self.assertEqual(context.exception.response.status_code, 406)
+
+        self.assertEqual([call[1:] for call in self.ecommerce.drain_calls()],
+                         [('fulfill', 'ORDER-1', 'ok'), ('fulfill', 'ORDER-1', 406)])
+        self.assertEqual(self.ecommerce.drain_calls(), [])
+
+    def test_injected_server_error(self):
+        self.ecommerce.profile = FaultProfile(errors={503: 1})
+        api = EdxRestApiClient(self.ecommerce.url + '/api/v2/')
+        with self.assertRaises(exceptions.HttpServerError):
+            api.orders('ORDER-2').fulfill.put()
+
+    def test_fulfill_order_task(self):
+        with mock.patch('ecommerce_worker.configuration.test.ECOMMERCE_API_ROOT', self.ecommerce.url + '/api/v2/'):
+            fulfill_order('ORDER-3')
+            with self.assertRaises(Ignore):
+                fulfill_order('ORDER-3')
+
+    def test_sailthru_calls(self):
+        client = SailthruClient('key', 'secret', api_url=self.sailthru.url)
+        self.assertTrue(client.api_get('user', {'id': 'user@example.com'}).is_ok())
+        self.assertEqual(client.api_get('content', {'id': 'http://course'}).json['title'], 'Stub course')
+        self.assertTrue(client.api_post('user', {'id': 'user@example.com', 'vars': {}}).is_ok())
+        self.assertTrue(client.purchase('user@example.com', [{'id': 'item'}]).is_ok())
+        self.assertEqual(self.sailthru.stats(), {'user ok': 2, 'content ok': 1, 'purchase ok': 1})
+
+    def test_sailthru_error_codes(self):
+        client = SailthruClient('key', 'secret', api_url=self.sailthru.url)
+        for code in (9, 43):
+            self.sailthru.profile = FaultProfile(errors={code: 1})
+            response = client.purchase('user@example.com', [{'id': 'item'}])
+            self.assertFalse(response.is_ok())
+            self.assertEqual(response.get_error().get_error_code(), code)
+
+    def test_update_course_enrollment_task(self):
+        config = dict(get_configuration('SAILTHRU'), SAILTHRU_API_URL=self.sailthru.url)
+        with mock.patch('ecommerce_worker.sailthru.v1.tasks.get_configuration', return_value=config):
+            update_course_enrollment('user@example.com', 'http://course', False, 'credit',
+                                     unit_cost=49, course_id='course-v1:edX+stub+run')
+        self.assertEqual([call[1:] for call in self.sailthru.drain_calls()],
+                         [('user', 'user@example.com', 'ok'),
+                          ('content', 'http://course', 'ok'),
+                          ('purchase', 'user@example.com', 'ok')])
+
+    def test_change_profile(self):
+        response = requests.post(self.ecommerce.url + '/_stub/profile', data=json.dumps({'errors': {'500': 1}}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.ecommerce.profile.outcome(), 500)
+
+        requests.put(self.ecommerce.url + '/api/v2/orders/ORDER-4/fulfill/')
+        self.assertEqual(requests.get(self.ecommerce.url + '/_stub/stats').json(), {'fulfill 500': 1})
@@ -0,0 +1,169 @@
+"""
+End-to-end throughput benchmark of the fulfillment and email marketing queues.
+
+For each pool type, a real worker consumes N fulfill_order and N update_course_enrollment
+tasks from the broker and calls the local stub APIs. The benchmark reports tasks per second,
+p50/p95/p99 latency from publish to the task's final API call, and the CPU time and peak
+RSS of every worker process. Results are written as JSON so runs can be compared over time.
+
+    $ python -m benchmarks.throughput --tasks 2000 --pools prefork,threads,eventlet,gevent --output results.json
+
+Pools whose requirements are not installed are reported as skipped.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+
+from benchmarks.harness import POOLS, BenchmarkWorker, environment, percentiles, pool_unavailable
+from benchmarks.stubs import FaultProfile, start_stub_servers
+
+FULFILL_ORDER = 'ecommerce_worker.fulfillment.v1.tasks.fulfill_order'
+UPDATE_COURSE_ENROLLMENT = 'ecommerce_worker.sailthru.v1.tasks.update_course_enrollment'
+
+# (mode, purchase_incomplete, unit_cost) of the enrollment events, cycled through
+ENROLLMENT_EVENTS = (
+    ('verified', True, 49),
+    ('verified', False, 49),
+    ('audit', False, 0),
+    ('credit', False, 99),
+)
+
+
+def build_plan(tasks, run_id):
+    """Interleave fulfillment and enrollment tasks, keyed by order number and email."""
+    for index in range(tasks):
+        order_number = 'BENCH-{}-{}'.format(run_id, index)
+        yield {
+            'task': FULFILL_ORDER,
+            'args': [order_number],
+            'queue': 'fulfillment',
+            'key': order_number,
+        }
+
+        mode, purchase_incomplete, unit_cost = ENROLLMENT_EVENTS[index % len(ENROLLMENT_EVENTS)]
+        email = 'bench-{}-{}@example.com'.format(run_id, index)
+        yield {
+            'task': UPDATE_COURSE_ENROLLMENT,
+            'args': [email, 'https://courses.example.com/courses/course-{}/info'.format(index % 50),
+                     purchase_incomplete, mode],
+            'kwargs': {'unit_cost': unit_cost, 'course_id': 'course-v1:edX+Bench+{}'.format(index % 50)},
+            'queue': 'email_marketing',
+            'key': email,
+        }
+
+
+def completions(ecommerce, sailthru, completed):
+    """Record the first successful final call of each task: fulfill for orders, purchase for emails."""
+    for call_time, endpoint, key, outcome in ecommerce.drain_calls() + sailthru.drain_calls():
+        if outcome == 'ok' and endpoint in ('fulfill', 'purchase'):
+            completed.setdefault(key, call_time)
+
+
+def summarize(published, completed, processes):
+    """Compute throughput and latency figures of a run."""
+    keys = [key for key in published if key in completed]
+    latencies = {
+        'fulfill_order': [completed[key] - published[key] for key in keys if key.startswith('BENCH-')],
+        'update_course_enrollment': [completed[key] - published[key] for key in keys if '@' in key],
+    }
+    all_latencies = latencies['fulfill_order'] + latencies['update_course_enrollment']
+    duration = max(completed[key] for key in keys) - min(published.values()) if keys else None
+
+    def milliseconds(values):
+        """Percentiles in milliseconds."""
+        return {name: round(value * 1000, 2) if value is not None else None
+                for name, value in percentiles(values).items()}
+
+    return {
+        'published': len(published),
+        'completed': len(keys),
+        'duration_seconds': round(duration, 3) if duration else None,
+        'tasks_per_second': round(len(keys) / duration, 2) if duration else None,
+        'latency_ms': milliseconds(all_latencies),
+        'latency_ms_by_task': {name: milliseconds(values) for name, values in latencies.items()},
+        'processes': processes,
+        'total_cpu_seconds': round(sum(process['cpu_seconds'] for process in processes), 3),
+    }
+
+
+def run(pool, args, ecommerce, sailthru):
+    """Benchmark one pool type."""
+    unavailable = pool_unavailable(pool)
+    if unavailable:
+        return {'pool': pool, 'skipped': unavailable}
+
+    ecommerce.drain_calls()
+    sailthru.drain_calls()
+    env = {
+        'BENCHMARK_ECOMMERCE_API_ROOT': ecommerce.url + '/api/v2/',
+        'BENCHMARK_SAILTHRU_API_URL': sailthru.url,
+    }
+    if args.broker:
+        env['BENCHMARK_BROKER_URL'] = args.broker
+
+    worker = BenchmarkWorker(build_plan(args.tasks, pool), pool, args.concurrency, env,
+                             ['--prefetch-multiplier', str(args.prefetch_multiplier)])
+    completed = {}
+
+    def is_done():
+        """All published tasks have made their final call."""
+        completions(ecommerce, sailthru, completed)
+        published = worker.published()
+        return published is not None and all(key in completed for key in published)
+
+    finished = worker.wait(is_done, args.timeout)
+    processes = worker.stop()
+    completions(ecommerce, sailthru, completed)
+
+    result = {'pool': pool, 'concurrency': args.concurrency, 'finished': finished}
+    if not finished:
+        result['worker_exit_code'] = worker.process.returncode
+    result.update(summarize(worker.published() or {}, completed, processes))
+    return result
+
+
+def main():
+    """Run the benchmark for each requested pool and write the results."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tasks', type=int, default=1000, help='number of tasks of each type')
+    parser.add_argument('--pools', default=','.join(POOLS))
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--prefetch-multiplier', type=int, default=4)
+    parser.add_argument('--broker', help='broker URL (default: in-memory broker inside the worker process)')
+    parser.add_argument('--latency', default='exp:0.02', help='latency spec of the stub APIs')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file receiving the JSON results (default: stdout)')
+    args = parser.parse_args()
+
+    ecommerce, sailthru = start_stub_servers(FaultProfile(args.latency, seed=args.seed),
+                                             FaultProfile(args.latency, seed=args.seed))
+    try:
+        results = [run(pool, args, ecommerce, sailthru) for pool in args.pools.split(',')]
+    finally:
+        ecommerce.stop()
+        sailthru.stop()
+
+    report = {
+        'benchmark': 'throughput',
+        'environment': environment(),
+        'parameters': {
+            'tasks_per_type': args.tasks,
+            'concurrency': args.concurrency,
+            'prefetch_multiplier': args.prefetch_multiplier,
+            'broker': args.broker or 'memory://',
+            'stub_latency': args.latency,
+        },
+        'results': results,
+    }
+    output = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
+    if args.output:
+        output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Run a Celery worker and a producer publishing a workload plan, in one process.
+
+The in-memory broker only carries messages within a process, so the producer publishes
+from a thread of the worker process once the worker is ready. The same runner works
+against a real local broker by setting BENCHMARK_BROKER_URL.
+
+A plan is a JSON-lines file; each line describes one task to publish:
+
+    {"task": "...", "args": [...], "kwargs": {...}, "queue": "fulfillment", "key": "ORDER-1", "at": 0.5}
+
+``key`` identifies the task in the stub servers' call records, ``queue`` (optional) overrides
+the configured routes and ``at`` (optional) is the offset in seconds from the start of
+publishing. Once everything has been published, the publish time of each key is written as
+a JSON object to the --published file.
+
+    $ python -m benchmarks.worker --pool prefork --concurrency 4 --plan plan.jsonl --published published.json
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+
+def parse_args():
+    """Parse the command line."""
+    parser = argparse.ArgumentParser(description='Run a benchmark worker with an embedded producer.')
+    parser.add_argument('--pool', default='prefork')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--prefetch-multiplier', type=int, default=4)
+    parser.add_argument('--queues', default='fulfillment,email_marketing')
+    parser.add_argument('--hostname', help='node name of the worker, e.g. priority@benchmark')
+    parser.add_argument('--max-tasks-per-child', type=int, help='tasks run by a prefork child before it is replaced')
+    parser.add_argument('--plan', required=True, help='JSON-lines file of tasks to publish')
+    parser.add_argument('--published', required=True, help='file receiving the publish time of each key')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='replay speed of the plan offsets (0 publishes as fast as possible)')
+    return parser.parse_args()
+
+
+def publish(app, plan_path, published_path, speed, ready):
+    """Publish every task of the plan once the worker is ready."""
+    ready.wait()
+    published = {}
+    start = time.time()
+    with app.producer_or_acquire() as producer:
+        with open(plan_path) as plan:
+            for line in plan:
+                entry = json.loads(line)
+                if speed and entry.get('at'):
+                    delay = start + entry['at'] / speed - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                published[entry['key']] = time.time()
+                app.send_task(entry['task'], args=entry.get('args'), kwargs=entry.get('kwargs'),
+                              queue=entry.get('queue'), producer=producer)
+
+    # write atomically, the orchestrator polls for the file
+    with open(published_path + '.tmp', 'w') as output:
+        json.dump(published, output)
+    os.rename(published_path + '.tmp', published_path)
+
+
+def main():
+    """Start the producer thread and run the worker until it is told to stop."""
+    args = parse_args()
+
+    # green pools need the process patched before anything else is imported
+    if args.pool == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+    elif args.pool == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+
+    from celery.signals import worker_ready
+    from ecommerce_worker.configuration import CONFIGURATION_MODULE
+    os.environ.setdefault(CONFIGURATION_MODULE, 'benchmarks.configuration')
+    from ecommerce_worker.celery_app import app
+
+    ready = threading.Event()
+    worker_ready.connect(lambda **kwargs: ready.set(), weak=False)
+
+    producer = threading.Thread(target=publish, args=(app, args.plan, args.published, args.speed, ready))
+    producer.daemon = True
+    producer.start()
+
+    worker = app.Worker(pool_cls=args.pool, concurrency=args.concurrency, queues=args.queues.split(','),
+                        prefetch_multiplier=args.prefetch_multiplier, hostname=args.hostname,
+                        max_tasks_per_child=args.max_tasks_per_child, loglevel='WARNING', quiet=True)
+    worker.start()
+
+
+if __name__ == '__main__':
+    main()
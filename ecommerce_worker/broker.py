@@ -0,0 +1,128 @@
+"""
+Broker connections pooled with health checks.
+
+Load balancers in front of the broker silently drop idle connections, which is why pooling
+is disabled by default and every publish, including every retry, opens its own connection.
+Operators setting BROKER_POOL_LIMIT opt in to a pool whose connections are checked before
+use, and replaced when:
+
+* they have been open for more than BROKER_POOL_MAX_AGE seconds,
+* they have been idle in the pool for more than BROKER_POOL_MAX_IDLE seconds, which should
+  be shorter than the load balancer's idle timeout,
+* the transport reports them closed, or
+* their socket is readable while no reply is expected, meaning the peer closed it or sent
+  a connection close.
+
+Replacements connect lazily on first use. Errors that still slip through while publishing
+are retried on a fresh connection by Celery's publish retry policy.
+"""
+import select
+import time
+
+from celery.app.amqp import AMQP as CeleryAMQP
+from celery.utils.log import get_logger
+from kombu import Connection
+from kombu.connection import ConnectionPool
+
+from ecommerce_worker.metrics import registry
+from ecommerce_worker.utils import get_configuration
+
+logger = get_logger(__name__)  # pylint: disable=invalid-name
+
+broker_connection_recycles = registry.counter(  # pylint: disable=invalid-name
+    'ecommerce_worker_broker_connection_recycles_total',
+    'Pooled broker connections replaced before use, by reason (age, idle, closed, severed).',
+    ('reason',)
+)
+
+
+def _socket_readable(connection):
+    """Return True if the socket of an idle AMQP connection has something to read."""
+    transport = getattr(connection._connection, 'transport', None)  # pylint: disable=protected-access
+    sock = getattr(transport, 'sock', None)
+    if sock is None:
+        # not a socket-based transport
+        return False
+    try:
+        readable, __, __ = select.select([sock], [], [], 0)
+    except (select.error, ValueError, TypeError):
+        # the socket is already closed
+        return True
+    return bool(readable)
+
+
+class HealthCheckedConnectionPool(ConnectionPool):
+    """
+    Connection pool replacing stale or broken connections when they are acquired.
+
+    Arguments:
+        connection (Connection): connection cloned to create the pool's connections
+        limit (int): maximum number of connections
+        preload (int): number of connections opened when the pool is created
+        max_age (float): seconds after which an open connection is replaced
+        max_idle (float): seconds a connection can stay unused before being replaced
+    """
+
+    def __init__(self, connection, limit=None, preload=None, max_age=None, max_idle=None):
+        self.max_age = max_age
+        self.max_idle = max_idle
+        super(HealthCheckedConnectionPool, self).__init__(connection, limit=limit, preload=preload)
+
+    def new(self):
+        connection = super(HealthCheckedConnectionPool, self).new()
+        connection.pool_created_at = time.time()
+        connection.pool_released_at = None
+        return connection
+
+    def release_resource(self, resource):
+        resource.pool_released_at = time.time()
+        super(HealthCheckedConnectionPool, self).release_resource(resource)
+
+    def prepare(self, resource):
+        resource = super(HealthCheckedConnectionPool, self).prepare(resource)
+        reason = self.recycle_reason(resource)
+        if reason is None:
+            return resource
+
+        logger.info('Replacing pooled broker connection: %s.', reason)
+        broker_connection_recycles.inc(reason=reason)
+        try:
+            self.collect_resource(resource)
+        except Exception:  # pylint: disable=broad-except
+            # the connection is being thrown away anyway
+            pass
+        return self.new()
+
+    def recycle_reason(self, connection):
+        """Tell why a connection should be replaced before use, or None if it is healthy."""
+        if connection._connection is None:  # pylint: disable=protected-access
+            # not connected yet; it will connect on first use
+            return None
+
+        now = time.time()
+        if self.max_age and now - connection.pool_created_at >= self.max_age:
+            return 'age'
+        if self.max_idle and connection.pool_released_at and now - connection.pool_released_at >= self.max_idle:
+            return 'idle'
+        if not connection.connected:
+            return 'closed'
+        if _socket_readable(connection):
+            return 'severed'
+        return None
+
+
+class HealthCheckedConnection(Connection):
+    """Broker connection whose pools check connections before handing them out."""
+
+    def Pool(self, limit=None, preload=None):  # pylint: disable=invalid-name
+        return HealthCheckedConnectionPool(
+            self, limit=limit, preload=preload,
+            max_age=get_configuration('BROKER_POOL_MAX_AGE'),
+            max_idle=get_configuration('BROKER_POOL_MAX_IDLE'),
+        )
+
+
+class AMQP(CeleryAMQP):
+    """Celery's AMQP support, using health-checked connections."""
+    Connection = HealthCheckedConnection
+    BrokerConnection = HealthCheckedConnection
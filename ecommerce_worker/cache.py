@@ -1,10 +1,12 @@
 """
 This file contains a primitive cache
 """
-import threading
 import time
 
-lock = threading.Lock()  # pylint: disable=invalid-name
+from ecommerce_worker.concurrency import Lock
+from ecommerce_worker.metrics import cache_events
+
+lock = Lock()  # pylint: disable=invalid-name
 
 
 class CacheObject(object):
@@ -32,10 +34,12 @@ class Cache(dict):
         lock.acquire()
         try:
             if key not in self:
+                cache_events.inc(event='miss')
                 return None
 
             current_time = time.time()
             if self[key].expire > current_time:
+                cache_events.inc(event='hit')
                 return self[key].value
 
             # expired key, clean out all expired keys
@@ -46,6 +50,8 @@ class Cache(dict):
             for k in deletes:
                 del self[k]
 
+            cache_events.inc(event='miss')
+            cache_events.inc(len(deletes), event='eviction')
             return None
         finally:
             lock.release()
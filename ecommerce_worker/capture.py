@@ -0,0 +1,236 @@
+"""
+Capture of the tasks received by a worker, for replaying real traffic against a local worker.
+
+When CAPTURE_ENABLED is set, the worker's consumer appends every task it receives from the
+broker to CAPTURE_PATH, as it arrives and before it waits for a pool process: its name, its
+arguments, its site code and its arrival time. Retries are left out, since a replayed task
+retries by itself. Arguments which look like email addresses are replaced by a pseudonym,
+<digest>@capture.invalid, where digest is an HMAC of the address keyed with a random salt kept
+next to the capture file, in CAPTURE_PATH.salt. The same learner keeps the same pseudonym
+within a capture, but pseudonyms cannot be matched with hash_email in logs, nor across captures.
+
+The file is a stream of msgpack arrays, [arrival time, task, args, kwargs, site code], each
+written at once to a file opened for appending, so several workers of a host can share it.
+Decimals, such as the unit_cost of update_course_enrollment, are packed as the compact
+serializer packs them. Capturing stops once the file reaches CAPTURE_MAX_BYTES, whichever
+worker wrote to it. Requires msgpack-python, listed in requirements/optional.txt.
+
+benchmarks.replay plays a capture against a local worker and the stub APIs:
+
+    $ python -m benchmarks.replay capture.bin --speed 10
+"""
+import errno
+import hashlib
+import hmac
+import os
+import re
+import time
+
+from celery import bootsteps
+from celery.utils.log import get_logger
+try:
+    import msgpack
+except ImportError:
+    msgpack = None  # pylint: disable=invalid-name
+
+from ecommerce_worker.routing import get_site_code
+from ecommerce_worker.serialization import pack_extension, unpack_extension
+from ecommerce_worker.utils import get_configuration
+
+logger = get_logger(__name__)  # pylint: disable=invalid-name
+
+EMAIL = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+PSEUDONYM_DOMAIN = 'capture.invalid'
+
+# Fields of a captured task, in the order they are packed
+CAPTURE_FIELDS = ('at', 'task', 'args', 'kwargs', 'site_code')
+
+
+def _make_directory(path):
+    """Create the directory of a file if it does not exist."""
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+
+def get_capture_salt(path):
+    """
+    Get the salt of the pseudonyms of a capture file, creating it if the capture has none yet.
+
+    The salt is written to a temporary file which is then linked to <path>.salt, so that the
+    processes sharing a capture all read the salt of the first one.
+
+    Arguments:
+        path (str): path of the capture file
+
+    Returns:
+        str: the salt, as hex digits
+    """
+    salt_path = path + '.salt'
+    if not os.path.exists(salt_path):
+        _make_directory(path)
+        temporary_path = '{}.{}'.format(salt_path, os.getpid())
+        with open(temporary_path, 'w') as salt_file:
+            os.chmod(temporary_path, 0o600)
+            salt_file.write(os.urandom(16).encode('hex'))
+        try:
+            os.link(temporary_path, salt_path)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        finally:
+            os.unlink(temporary_path)
+    with open(salt_path) as salt_file:
+        return salt_file.read().strip()
+
+
+def pseudonymize(value, salt):
+    """Replace an email address by its pseudonym under a salt; other values are returned as they are."""
+    if isinstance(value, basestring) and EMAIL.match(value.strip()):
+        email = value.strip().lower()
+        if isinstance(email, unicode):
+            email = email.encode('utf-8')
+        return '{}@{}'.format(hmac.new(str(salt), email, hashlib.sha256).hexdigest()[:16], PSEUDONYM_DOMAIN)
+    return value
+
+
+def capture_record(task, body, received_at, salt):
+    """
+    Describe a task message received by the worker, for the capture file.
+
+    Arguments:
+        task (Task): the registered task
+        body (dict): the task message
+        received_at (float): arrival time of the message
+        salt (str): salt of the pseudonyms of the capture
+
+    Returns:
+        list: the CAPTURE_FIELDS of the task, or None for a retry
+    """
+    if body.get('retries'):
+        return None
+    args = body.get('args') or ()
+    kwargs = body.get('kwargs') or {}
+    return [
+        received_at,
+        body['task'],
+        [pseudonymize(value, salt) for value in args],
+        {name: pseudonymize(value, salt) for name, value in kwargs.items()},
+        get_site_code(task, args, kwargs),
+    ]
+
+
+class CaptureWriter(object):
+    """
+    Appends captured tasks to a file, until it reaches a size.
+
+    The size of the file is read before each record is appended, since other processes may
+    append to it too.
+
+    Arguments:
+        path (str): path of the capture file
+        max_bytes (int): size of the file past which nothing is appended (0 for no limit)
+    """
+
+    def __init__(self, path, max_bytes=0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.full = False
+        self._fd = None
+        self._salt = None
+
+    @property
+    def salt(self):
+        """Salt of the pseudonyms of the capture, shared by the processes writing it."""
+        if self._salt is None:
+            self._salt = get_capture_salt(self.path)
+        return self._salt
+
+    def _open(self):
+        """Open the file for appending, creating it and its directory if needed."""
+        _make_directory(self.path)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+
+    def write(self, record):
+        """
+        Append a captured task.
+
+        Returns:
+            bool: False once the file is full
+        """
+        if self._fd is None:
+            self._open()
+        if self.max_bytes and os.fstat(self._fd).st_size >= self.max_bytes:
+            if not self.full:
+                logger.warning('Stopped capturing tasks: %s reached CAPTURE_MAX_BYTES.', self.path)
+                self.full = True
+            return False
+        # a single write per record, so that records of several processes do not interleave
+        packed = msgpack.packb(record, use_bin_type=True, default=pack_extension)
+        os.write(self._fd, packed)
+        return True
+
+    def close(self):
+        """Close the file."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def read_capture(stream):
+    """
+    Read the tasks of a capture file.
+
+    Arguments:
+        stream (file): the capture file, opened in binary mode
+
+    Yields:
+        dict: the CAPTURE_FIELDS of each task, in the order they were captured
+    """
+    for record in msgpack.Unpacker(stream, encoding='utf-8', ext_hook=unpack_extension):
+        yield dict(zip(CAPTURE_FIELDS, record))
+
+
+def capturing(strategy, task, writer):
+    """Wrap the strategy of a task, which handles its messages, to capture them first."""
+    def handle_message(message, body, *args, **kwargs):
+        """Capture the task, then handle it as usual."""
+        try:
+            record = capture_record(task, body, time.time(), writer.salt)
+            if record is not None:
+                writer.write(record)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Failed to capture a [%s] task.', task.name)
+        return strategy(message, body, *args, **kwargs)
+
+    return handle_message
+
+
+class Capture(bootsteps.StartStopStep):
+    """Consumer bootstep capturing the tasks received from the broker, when CAPTURE_ENABLED is set."""
+    requires = ('celery.worker.consumer:Tasks',)
+
+    def __init__(self, c, **kwargs):  # pylint: disable=unused-argument
+        super(Capture, self).__init__(c, **kwargs)
+        self.writer = None
+
+    def start(self, c):  # pylint: disable=invalid-name
+        if not get_configuration('CAPTURE_ENABLED'):
+            return
+        if msgpack is None:
+            logger.warning('Tasks are not captured: msgpack-python is not installed.')
+            return
+
+        if self.writer is None:
+            self.writer = CaptureWriter(get_configuration('CAPTURE_PATH'), get_configuration('CAPTURE_MAX_BYTES'))
+            logger.info('Capturing the tasks received to %s.', self.writer.path)
+        # the strategies are created again each time the consumer connects
+        for name, strategy in c.strategies.items():
+            c.strategies[name] = capturing(strategy, c.app.tasks[name], self.writer)
+
+    def shutdown(self, c):  # pylint: disable=invalid-name,unused-argument
+        """Close the capture file."""
+        if self.writer is not None:
+            self.writer.close()
@@ -1,12 +1,18 @@
 import os
 from celery import Celery
 
+from ecommerce_worker.capture import Capture
 from ecommerce_worker.configuration import CONFIGURATION_MODULE
+from ecommerce_worker.routing import FairShare
+# register the compact serializer
+import ecommerce_worker.serialization  # pylint: disable=unused-import
 
 
 # Set the default configuration module, if one is not aleady defined.
 os.environ.setdefault(CONFIGURATION_MODULE, 'ecommerce_worker.configuration.local')
 
-app = Celery('ecommerce_worker')
+app = Celery('ecommerce_worker', amqp='ecommerce_worker.broker:AMQP')
 # See http://celery.readthedocs.org/en/latest/userguide/application.html#config-from-envvar.
 app.config_from_envvar(CONFIGURATION_MODULE)
+app.steps['worker'].add(FairShare)
+app.steps['consumer'].add(Capture)
@@ -0,0 +1,127 @@
+"""
+Primitives for the state shared by the tasks of a worker process, under every pool.
+
+The eventlet and gevent pools monkey-patch the process when the worker starts, which can be
+after this package's modules are imported. A lock or thread-local created at import time
+would then be an OS-thread one: a lock held by a green thread which yields blocks every other
+green thread of the process, and a thread-local is shared by all the green threads, e.g. the
+HTTP session carrying one site's credentials. Lock and Local create what they wrap on first
+use instead, from the thread modules as they are patched by then, and so cooperate with the
+green threads of eventlet and gevent as well as with the OS threads of the other pools.
+"""
+import sys
+import thread
+import threading
+
+
+def green_library():
+    """Name of the library whose green threads the process is patched to run ('eventlet', 'gevent'), or None."""
+    if 'eventlet' in sys.modules:
+        from eventlet import patcher
+        if patcher.is_monkey_patched('thread'):
+            return 'eventlet'
+    if 'gevent.monkey' in sys.modules:
+        from gevent import monkey
+        if monkey.is_module_patched('thread'):
+            return 'gevent'
+    return None
+
+
+def os_thread_ident():
+    """Get a function returning the identity of the calling OS thread, even when green threads are patched in."""
+    if 'eventlet' in sys.modules:
+        from eventlet.patcher import original
+        return original('thread').get_ident
+    if 'gevent.monkey' in sys.modules:
+        from gevent.monkey import get_original
+        return get_original('thread', 'get_ident')
+    return thread.get_ident
+
+
+class Lock(object):
+    """
+    Mutual exclusion lock created on first use, which waits cooperatively in green threads.
+
+    Offers the acquire and release methods and the context manager of threading.Lock.
+    """
+
+    def _lock(self):
+        """The wrapped lock."""
+        lock = self.__dict__.get('lock')
+        if lock is None:
+            # setdefault keeps a single lock if threads race to create it
+            lock = self.__dict__.setdefault('lock', thread.allocate_lock())
+        return lock
+
+    def acquire(self, blocking=True):
+        """Acquire the lock; return whether it was acquired."""
+        return self._lock().acquire(blocking)
+
+    def release(self):
+        """Release the lock."""
+        self._lock().release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class Local(object):
+    """
+    Attributes with a value of their own in each thread, green thread or greenlet, created on first use.
+    """
+
+    def _local(self):
+        """The wrapped thread-local."""
+        local = self.__dict__.get('local')
+        if local is None:
+            local = self.__dict__.setdefault('local', threading.local())
+        return local
+
+    def __getattr__(self, name):
+        return getattr(self._local(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._local(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._local(), name)
+
+
+class OSThreadLocal(object):
+    """
+    Attributes with a value of their own in each OS thread, shared by the green threads it runs.
+
+    For state tied to the OS thread, such as sqlite3 connections and profiler hooks.
+    """
+
+    def _namespace(self):
+        """The attributes of the calling OS thread."""
+        get_ident = self.__dict__.get('get_ident')
+        if get_ident is None:
+            # resolved on first use, once green thread libraries have patched the process
+            get_ident = self.__dict__.setdefault('get_ident', os_thread_ident())
+        namespaces = self.__dict__.setdefault('namespaces', {})
+        ident = get_ident()
+        namespace = namespaces.get(ident)
+        if namespace is None:
+            namespace = namespaces.setdefault(ident, {})
+        return namespace
+
+    def __getattr__(self, name):
+        try:
+            return self._namespace()[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self._namespace()[name] = value
+
+    def __delattr__(self, name):
+        try:
+            del self._namespace()[name]
+        except KeyError:
+            raise AttributeError(name)
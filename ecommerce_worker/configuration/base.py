@@ -5,9 +5,19 @@ BROKER_URL = None
 # Disable connection pooling. Connections may be severed by load balancers.
 # This forces the application to connect explicitly to the broker each time
 # rather than assume a long-lived connection.
+# Set BROKER_POOL_LIMIT to the number of connections to pool instead, e.g. 10: pooled
+# connections are checked before use and replaced when they are older than BROKER_POOL_MAX_AGE
+# seconds, have been idle for more than BROKER_POOL_MAX_IDLE seconds (keep this below the
+# load balancer's idle timeout), or appear closed.
 BROKER_POOL_LIMIT = 0
+BROKER_POOL_MAX_AGE = 300
+BROKER_POOL_MAX_IDLE = 30
 BROKER_CONNECTION_TIMEOUT = 1
 
+# Publishing on a connection found broken is retried on a new connection.
+# See http://celery.readthedocs.org/en/latest/configuration.html#celery-task-publish-retry.
+CELERY_TASK_PUBLISH_RETRY = True
+
 # Use heartbeats to prevent broker connection loss. When the broker
 # is behind a load balancer, the load balancer may timeout Celery's
 # connection to the broker, causing messages to be lost.
@@ -23,8 +33,29 @@ CELERY_RESULT_BACKEND = None
 CELERY_IMPORTS = (
     'ecommerce_worker.fulfillment.v1.tasks',
     'ecommerce_worker.sailthru.v1.tasks',
+    'ecommerce_worker.profiling',
+    'ecommerce_worker.metrics',
+    'ecommerce_worker.http_timing',
+    'ecommerce_worker.delayed_retry',
+    'ecommerce_worker.routing',
+    'ecommerce_worker.preload',
+    'ecommerce_worker.recycling',
+    'ecommerce_worker.deadline',
 )
 
+# Routes applied to the tasks published by this package, such as retries.
+# See http://celery.readthedocs.org/en/latest/configuration.html#celery-routes.
+CELERY_ROUTES = ('ecommerce_worker.routing.TaskRouter',)
+
+# Content types accepted from the broker: Celery's defaults and the compact serializer of
+# ecommerce_worker.serialization. Set CELERY_TASK_SERIALIZER to 'compact' to publish tasks
+# with it once every worker accepts it.
+# See http://celery.readthedocs.org/en/latest/configuration.html#celery-accept-content.
+CELERY_ACCEPT_CONTENT = ['pickle', 'json', 'msgpack', 'yaml', 'application/x-ecommerce-worker-compact']
+
+# Compact messages larger than this many bytes are compressed with zlib (0 disables compression).
+COMPACT_COMPRESSION_THRESHOLD = 1024
+
 # Prevent Celery from removing handlers on the root logger. Allows setting custom logging handlers.
 # See http://celery.readthedocs.org/en/latest/configuration.html#celeryd-hijack-root-logger.
 CELERYD_HIJACK_ROOT_LOGGER = False
@@ -40,6 +71,28 @@ ECOMMERCE_API_ROOT = None
 # time of 2047 seconds (about 30 minutes). Defaulting this to None could yield
 # unwanted behavior: infinite retries.
 MAX_FULFILLMENT_RETRIES = 11
+
+# When the ecommerce service answers 429 or 503, the order is retried after the delay of its
+# Retry-After header, capped to FULFILLMENT_MAX_RETRY_AFTER seconds, and the other orders of the
+# site are held back on the host until then. Held back orders are spread over an extra
+# FULFILLMENT_BACKOFF_JITTER seconds.
+FULFILLMENT_MAX_RETRY_AFTER = 600
+FULFILLMENT_BACKOFF_JITTER = 5
+
+# Limit the fulfillment calls in flight from the host to each site to a number adapted to the
+# latency and errors of the calls, between FULFILLMENT_CONCURRENCY_MIN_LIMIT and
+# FULFILLMENT_CONCURRENCY_MAX_LIMIT. A call failing because the service is overloaded multiplies
+# the limit by FULFILLMENT_CONCURRENCY_BACKOFF_RATIO; calls whose recent latency exceeds
+# FULFILLMENT_CONCURRENCY_LATENCY_TOLERANCE times their usual latency lower it. Orders wait for a
+# free slot for at most FULFILLMENT_CONCURRENCY_MAX_WAIT seconds, then are deferred.
+# See ecommerce_worker.fulfillment.v1.limiter.
+FULFILLMENT_CONCURRENCY_LIMIT_ENABLED = False
+FULFILLMENT_CONCURRENCY_INITIAL_LIMIT = 4
+FULFILLMENT_CONCURRENCY_MIN_LIMIT = 1
+FULFILLMENT_CONCURRENCY_MAX_LIMIT = 50
+FULFILLMENT_CONCURRENCY_BACKOFF_RATIO = 0.5
+FULFILLMENT_CONCURRENCY_LATENCY_TOLERANCE = 2.0
+FULFILLMENT_CONCURRENCY_MAX_WAIT = 10
 # END ORDER FULFILLMENT
 
 # AUTHENTICATION
@@ -49,6 +102,138 @@ JWT_ISSUER = None
 ECOMMERCE_SERVICE_USERNAME = 'ecommerce_worker'
 # END AUTHENTICATION
 
+# LOCAL STATE
+# Directory holding host-local state shared by the worker processes on a machine,
+# such as the SQLite stores of delayed retries and dead letters.
+LOCAL_STATE_DIR = '/var/tmp/ecomworker'
+# END LOCAL STATE
+
+# DELAYED RETRIES
+# Keep retries delayed by at least DURABLE_RETRY_MIN_COUNTDOWN seconds in a SQLite store in
+# LOCAL_STATE_DIR instead of holding them in worker memory as ETA messages. The worker's main
+# process re-publishes up to DURABLE_RETRY_BATCH_SIZE due retries at a time, checking every
+# DURABLE_RETRY_POLL_INTERVAL seconds. LOCAL_STATE_DIR must then survive worker restarts.
+DURABLE_RETRY_ENABLED = False
+DURABLE_RETRY_MIN_COUNTDOWN = 60
+DURABLE_RETRY_POLL_INTERVAL = 5
+DURABLE_RETRY_BATCH_SIZE = 100
+# END DELAYED RETRIES
+
+# FAIR SHARE
+# Route the tasks listed in TASK_QUEUES to a sub-queue per site listed in SITE_OVERRIDES,
+# named <queue>.<site_code>, and consume the site sub-queues of the queues the worker is
+# started with, so a burst of tasks from one site only fills that site's sub-queue.
+FAIR_SHARE_ENABLED = False
+
+# Shared queue of each task routed per site or lane.
+TASK_QUEUES = {
+    'ecommerce_worker.fulfillment.v1.tasks.fulfill_order': 'fulfillment',
+    'ecommerce_worker.sailthru.v1.tasks.update_course_enrollment': 'email_marketing',
+}
+
+# Relative share of the worker given to each site's tasks waiting for a free process, keyed
+# by site code (None for tasks without a site). Sites not listed weigh 1.
+FAIR_SHARE_WEIGHTS = {}
+# END FAIR SHARE
+
+# PRELOAD
+# Do the first-use work of the tasks in the worker's main process before the pool starts, so
+# prefork children inherit it instead of paying for it on their first task.
+PRELOAD_ENABLED = False
+# END PRELOAD
+
+# RECYCLING
+# Replace a prefork child once its RSS exceeds CHILD_MAX_RSS_MB, or once it has grown by more
+# than CHILD_MAX_RSS_GROWTH_KB_PER_TASK per task on average since its first CHILD_RSS_WARMUP_TASKS
+# tasks, measured over at least CHILD_RSS_GROWTH_MIN_TASKS tasks. 0 disables a limit.
+CHILD_MAX_RSS_MB = 0
+CHILD_MAX_RSS_GROWTH_KB_PER_TASK = 0
+CHILD_RSS_WARMUP_TASKS = 50
+CHILD_RSS_GROWTH_MIN_TASKS = 500
+
+# Tasks run by a prefork child between two reads of its RSS.
+CHILD_RSS_CHECK_INTERVAL = 10
+
+# Log the TRACEMALLOC_TOP allocation sites of a prefork child which grew the most every
+# TRACEMALLOC_SNAPSHOT_INTERVAL tasks (0 only logs them when the child is recycled). Uses the
+# tracemalloc module where available, otherwise counts the live objects per type; both are slow.
+TRACEMALLOC_ENABLED = False
+TRACEMALLOC_SNAPSHOT_INTERVAL = 1000
+TRACEMALLOC_TOP = 10
+# END RECYCLING
+
+# PRIORITY LANES
+# Route order fulfillment and completed purchases to PRIORITY_LANE_QUEUE, ahead of abandoned
+# cart and free enrollment events, which stay on their queue in TASK_QUEUES.
+PRIORITY_LANES_ENABLED = False
+PRIORITY_LANE_QUEUE = 'priority'
+
+# Pool size and prefetch multiplier of the workers serving each lane, keyed by the node name
+# the worker is started with, e.g. --hostname=priority@%h. A small prefetch keeps priority
+# tasks from waiting in a busy process's buffer.
+PRIORITY_LANES = {
+    'priority': {'concurrency': 4, 'prefetch_multiplier': 1},
+    'bulk': {'concurrency': 4, 'prefetch_multiplier': 4},
+}
+# END PRIORITY LANES
+
+# PROFILING
+# Fraction of the executions of each task to run under cProfile, keyed by task name, e.g.
+# {'ecommerce_worker.fulfillment.v1.tasks.fulfill_order': 0.01}. Tasks not listed are never profiled.
+TASK_PROFILING_SAMPLE_RATES = {}
+
+# Directory receiving the aggregated profiles, one file per task, process and dump interval.
+TASK_PROFILING_DIR = '/var/tmp/ecomworker/profiles'
+
+# Seconds during which the profiles of a task are aggregated before being written.
+TASK_PROFILING_DUMP_INTERVAL = 300
+
+# Number of profile files kept in the directory; the oldest are removed first.
+TASK_PROFILING_MAX_DUMPS = 100
+# END PROFILING
+
+# METRICS
+# Local port serving the worker's metrics in the Prometheus text format at /metrics (0 disables it).
+METRICS_PORT = 0
+METRICS_HOST = '127.0.0.1'
+
+# Seconds between two snapshots of the metrics of a prefork child, collected by the main process.
+METRICS_SNAPSHOT_INTERVAL = 5
+
+# Outbound HTTP calls taking longer than this many seconds are logged with the time spent on
+# DNS, connect, TLS and the server, and kept in a buffer of the most recent slow calls.
+HTTP_SLOW_CALL_SECONDS = 1.0
+HTTP_SLOW_CALL_BUFFER_SIZE = 100
+# END METRICS
+
+# DEADLINES
+# Time budget in seconds of each execution of a task, keyed by task name, such as
+# {'ecommerce_worker.fulfillment.v1.tasks.fulfill_order': 30}. Each outbound HTTP call of the task
+# gets the remaining budget as its timeout; a task whose budget ran out is retried on its usual
+# schedule. Tasks not listed have no budget. A site's TASK_DEADLINE_SECONDS in SITE_OVERRIDES
+# replaces this one.
+TASK_DEADLINE_SECONDS = {}
+# END DEADLINES
+
+# CAPTURE
+# Append the tasks received by the worker, other than retries, to CAPTURE_PATH with their arguments,
+# site code and arrival time, email addresses replaced by pseudonyms, for benchmarks.replay. Capturing
+# stops once the file reaches CAPTURE_MAX_BYTES (0 for no limit). Requires msgpack-python.
+CAPTURE_ENABLED = False
+CAPTURE_PATH = '/var/tmp/ecomworker/capture.bin'
+CAPTURE_MAX_BYTES = 1024 * 1024 * 1024
+# END CAPTURE
+
+# LOGGING
+# Read by the production configurations, after the values from disk. With LOGGING_QUEUED, tasks only
+# queue their log records and a thread writes them, dropping and counting the records beyond
+# LOGGING_QUEUE_SIZE. Repeats of a warning or error within LOGGING_DEDUP_WINDOW seconds of its first
+# occurrence are suppressed (0 to keep every record).
+LOGGING_QUEUED = False
+LOGGING_QUEUE_SIZE = 10000
+LOGGING_DEDUP_WINDOW = 0
+# END LOGGING
+
 # Site Overrides provide support for site/partner-specific configuration settings where applicable
 # For example, the ECOMMERCE_API_ROOT value is different from one ecommerce site to the next
 SITE_OVERRIDES = None
@@ -73,10 +258,20 @@ SAILTHRU = {
     # minutes to delay before abandoned cart message
     'SAILTHRU_ABANDONED_CART_DELAY': 60,
 
+    # seconds to hold an abandoned cart event so that repeated add-to-cart events for the
+    # same user and item collapse into the latest one (0 sends every event immediately).
+    #  Note: the reminder delay above is counted from the moment the coalesced event is sent
+    #  Note: pending events are recorded in a var of the user's Sailthru record, at the cost of
+    #  a user update per add-to-cart and completed purchase and a user read per event sent
+    'SAILTHRU_ABANDONED_CART_COALESCE_SECONDS': 0,
+
     # Sailthru key and secret required for integration
     'SAILTHRU_KEY': None,
     'SAILTHRU_SECRET': None,
 
+    # Root URL of the Sailthru API (None uses the client's default, https://api.sailthru.com)
+    'SAILTHRU_API_URL': None,
+
     # Retry settings for Sailthru celery tasks
     'SAILTHRU_RETRY_SECONDS': 3600,
     'SAILTHRU_RETRY_ATTEMPTS': 24,
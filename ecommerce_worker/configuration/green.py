@@ -0,0 +1,20 @@
+"""
+Production configuration for workers running the eventlet or gevent pool.
+
+The pool itself must be selected on the command line (--pool=eventlet or --pool=gevent), so
+that Celery monkey-patches the process before anything else is imported. See `make worker_green`.
+"""
+from ecommerce_worker.configuration.production import *
+
+
+# CELERY
+# Green threads wait on the network without holding a core, so a worker runs many more tasks at a time.
+CELERYD_CONCURRENCY = 100
+
+# Green threads take their messages as they become free, rather than reserving batches.
+CELERYD_PREFETCH_MULTIPLIER = 1
+# END CELERY
+
+
+# Values from disk take precedence over those of this profile.
+vars().update(config_from_yaml)
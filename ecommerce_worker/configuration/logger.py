@@ -1,8 +1,214 @@
 """Logging configuration"""
+import logging
 from logging.handlers import SysLogHandler
 import os
 import platform
+import Queue
 import sys
+import threading
+
+from ecommerce_worker.concurrency import Lock
+
+# Placed on a handler's queue to stop its listener
+_STOP = object()
+
+
+def _no_flush():
+    """Stand-in for a handler's flush while it writes a batch."""
+    pass
+
+
+class QueueHandler(logging.Handler):
+    """
+    Hands records to a listener thread which formats and writes them with a target handler.
+
+    The calling thread only puts the record on a bounded queue, so a slow destination (such
+    as a stalled /dev/log) cannot block it. When the queue is full, records are dropped and
+    counted; the listener reports the count once it catches up. The listener writes records
+    in batches of up to batch_size, flushing the target once per batch.
+
+    A listener is started on first use in each process, so a handler configured before the
+    worker forks its pool processes keeps working in each of them.
+
+    Arguments:
+        target (dict): the target handler's 'class' (dotted path), and optionally its 'level',
+            'format' and constructor arguments
+        queue_size (int): maximum number of records waiting to be written
+        batch_size (int): maximum number of records written at once
+    """
+
+    def __init__(self, target, queue_size=10000, batch_size=100):
+        logging.Handler.__init__(self)
+        target = dict(target)
+        module_name, __, class_name = target.pop('class').rpartition('.')
+        target_format = target.pop('format', None)
+        target_level = target.pop('level', logging.NOTSET)
+        self.target = getattr(__import__(module_name, fromlist=[class_name]), class_name)(**target)
+        self.target.setLevel(target_level)
+        if target_format:
+            self.target.setFormatter(logging.Formatter(target_format))
+
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._pid = None
+        self._queue = None
+        self._listener = None
+        self._start_lock = Lock()
+
+    def _start(self):
+        """Start a listener for the calling process."""
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # a queue inherited across a fork may hold locks taken by threads that are gone
+            self._queue = Queue.Queue(self.queue_size)
+            self._listener = threading.Thread(target=self._listen, name='QueueHandlerListener')
+            self._listener.daemon = True
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def emit(self, record):
+        """Queue a record, or count it as dropped if the queue is full."""
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _listen(self):
+        """Write queued records until told to stop."""
+        queue = self._queue
+        while True:
+            batch = [queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            stop = _STOP in batch
+            self._write([record for record in batch if record is not _STOP])
+            for __ in batch:
+                queue.task_done()
+            if stop:
+                return
+
+    def _write(self, batch):
+        """Write a batch of records with the target handler, flushing once."""
+        dropped = self.dropped
+        if dropped != self._reported_dropped:
+            batch.append(logging.makeLogRecord({
+                'name': __name__,
+                'levelno': logging.WARNING,
+                'levelname': 'WARNING',
+                'msg': '%d log records were dropped because the logging queue was full.',
+                'args': (dropped - self._reported_dropped,),
+            }))
+            self._reported_dropped = dropped
+        if not batch:
+            return
+
+        target = self.target
+        target.acquire()
+        try:
+            target.flush = _no_flush
+            try:
+                for record in batch:
+                    if record.levelno >= target.level:
+                        target.handle(record)
+            finally:
+                del target.flush
+            target.flush()
+        except Exception:  # pylint: disable=broad-except
+            # never let a bad record or destination kill the listener
+            target.handleError(batch[-1])
+        finally:
+            target.release()
+
+    def flush(self):
+        """Wait until the records queued by this process have been written."""
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    def close(self):
+        """Write the queued records, then stop the listener and close the target."""
+        if self._pid == os.getpid() and self._listener.is_alive():
+            self._queue.put(_STOP)
+            self._listener.join(5)
+        self.target.close()
+        logging.Handler.close(self)
+
+
+class DedupFilter(logging.Filter):
+    """
+    Collapses repeated records into one line per window.
+
+    Records are keyed by logger name, level, message template (before arguments are merged
+    in) and exception type. The first record of a key passes; identical records within the
+    next window seconds are dropped before any handler formats them or their tracebacks. The
+    first record after the window passes with the number of records suppressed in between.
+
+    Records below min_level always pass, as do records logged with extra={'dedup': False},
+    such as those of orders given up on, which differ only by their arguments. A record
+    handled by several handlers sharing the filter is only counted once.
+
+    Arguments:
+        window (float): seconds during which repeats of a record are suppressed
+        min_level (int): level from which records are deduplicated
+        max_keys (int): number of keys tracked before expired ones are forgotten
+    """
+
+    def __init__(self, window=60, min_level=logging.WARNING, max_keys=1000):
+        logging.Filter.__init__(self)
+        self.window = window
+        self.min_level = min_level
+        self.max_keys = max_keys
+        # maps a key to [window start, suppressed count]
+        self._seen = {}
+        self._lock = Lock()
+
+    def filter(self, record):
+        if record.levelno < self.min_level or not getattr(record, 'dedup', True):
+            return True
+        decision = getattr(record, 'dedup_decision', None)
+        if decision is not None:
+            return decision
+
+        exc_type = record.exc_info[0] if record.exc_info else None
+        key = (record.name, record.levelno, record.msg, exc_type)
+        try:
+            hash(key)
+        except TypeError:
+            return True
+        now = record.created
+        suppressed = 0
+        with self._lock:
+            seen = self._seen.get(key)
+            if seen is not None and now - seen[0] < self.window:
+                seen[1] += 1
+                decision = False
+            else:
+                if seen:
+                    suppressed = seen[1]
+                if len(self._seen) >= self.max_keys:
+                    self._forget_expired(now)
+                self._seen[key] = [now, 0]
+                decision = True
+
+        if decision and suppressed:
+            record.msg = '%s [%d similar messages suppressed in the last %.0f seconds]' % (
+                record.msg, suppressed, now - seen[0])
+        record.dedup_decision = decision
+        return decision
+
+    def _forget_expired(self, now):
+        """Drop the keys whose window has ended, or every key if none has."""
+        expired = [key for key, (start, __) in self._seen.items() if now - start >= self.window]
+        for key in expired or list(self._seen):
+            del self._seen[key]
 
 
 def get_logger_config(log_dir='/var/tmp',
@@ -11,7 +217,10 @@ def get_logger_config(log_dir='/var/tmp',
                       dev_env=False,
                       debug=False,
                       local_loglevel='INFO',
-                      service_variant='ecomworker'):
+                      service_variant='ecomworker',
+                      queued=False,
+                      queue_size=10000,
+                      dedup_window=0):
 
     """
     Returns a dictionary containing logging configuration.
@@ -19,6 +228,14 @@ def get_logger_config(log_dir='/var/tmp',
     If dev_env is True, logging will not be done via local rsyslogd.
     Instead, application logs will be dropped into log_dir. 'edx_filename'
     is ignored unless dev_env is True.
+
+    If queued is True, the local handler only queues records; a listener
+    thread writes them to syslog or the log file. Up to queue_size records
+    may wait to be written, further records are dropped and counted.
+
+    If dedup_window is set, repeats of a warning or error logged within
+    dedup_window seconds of its first occurrence are suppressed, and the
+    next occurrence reports how many were.
     """
     # Revert to INFO if an invalid string is passed in
     if local_loglevel not in ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']:
@@ -97,4 +314,26 @@ def get_logger_config(log_dir='/var/tmp',
             },
         })
 
+    if dedup_window:
+        logger_config['filters'] = {
+            'dedup': {
+                '()': 'ecommerce_worker.configuration.logger.DedupFilter',
+                'window': dedup_window,
+            },
+        }
+        for handler in logger_config['handlers'].values():
+            handler['filters'] = ['dedup']
+
+    if queued:
+        target = dict(logger_config['handlers']['local'])
+        target['format'] = logger_config['formatters'][target.pop('formatter')]['format']
+        logger_config['handlers']['local'] = {
+            '()': 'ecommerce_worker.configuration.logger.QueueHandler',
+            'level': local_loglevel,
+            # filter before queueing, so suppressed records never reach the queue
+            'filters': target.pop('filters', []),
+            'target': target,
+            'queue_size': queue_size,
+        }
+
     return logger_config
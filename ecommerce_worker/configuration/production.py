@@ -7,15 +7,17 @@ from ecommerce_worker.configuration.base import *
 from ecommerce_worker.configuration.logger import get_logger_config
 
 
-# LOGGING
-logger_config = get_logger_config()
-dictConfig(logger_config)
-# END LOGGING
-
-
 filename = get_overrides_filename('ECOMMERCE_WORKER_CFG')
 with open(filename) as f:
     config_from_yaml = yaml.load(f)
 
 # Override base configuration with values from disk.
 vars().update(config_from_yaml)
+
+
+# LOGGING
+logger_config = get_logger_config(queued=LOGGING_QUEUED,
+                                  queue_size=LOGGING_QUEUE_SIZE,
+                                  dedup_window=LOGGING_DEDUP_WINDOW)
+dictConfig(logger_config)
+# END LOGGING
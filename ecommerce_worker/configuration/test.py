@@ -1,4 +1,8 @@
+import atexit
 from logging.config import dictConfig
+import os
+import shutil
+import tempfile
 
 from ecommerce_worker.configuration.base import *
 from ecommerce_worker.configuration.logger import get_logger_config
@@ -29,6 +33,19 @@ ECOMMERCE_SERVICE_USERNAME = 'service'
 # END AUTHENTICATION
 
 
+# LOCAL STATE
+LOCAL_STATE_DIR = tempfile.mkdtemp(prefix='ecomworker-test-')
+
+
+def remove_local_state_dir(path=LOCAL_STATE_DIR, pid=os.getpid()):
+    """Remove the local state directory when the process which created it exits."""
+    if os.getpid() == pid:
+        shutil.rmtree(path, ignore_errors=True)
+
+atexit.register(remove_local_state_dir)
+# END LOCAL STATE
+
+
 # SITE-SPECIFIC CONFIGURATION OVERRIDES
 SITE_OVERRIDES = {}
 
@@ -0,0 +1,223 @@
+"""
+Dead-letter capture and replay of tasks whose retries are exhausted.
+
+When fulfill_order reaches MAX_FULFILLMENT_RETRIES or a Sailthru task reaches
+SAILTHRU_RETRY_ATTEMPTS, the task is recorded in a SQLite store in LOCAL_STATE_DIR with its
+arguments, site and last error, before the failure is raised as usual.
+
+Recorded tasks can be listed and published again, with a fresh retry budget, by the
+ecommerce-worker-replay command. Replays are paced to a fixed rate so that draining the
+store after an outage does not overwhelm the services which have just recovered:
+
+    WORKER_CONFIGURATION_MODULE=... ecommerce-worker-replay --list
+    WORKER_CONFIGURATION_MODULE=... ecommerce-worker-replay --rate 5 --site-code edx
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import inspect
+import time
+
+from celery import current_app
+from celery.canvas import signature
+from celery.utils.log import get_logger
+
+from ecommerce_worker.local_store import LocalStore, dump_payload, get_local_store_path, load_payload
+from ecommerce_worker.metrics import registry
+
+logger = get_logger(__name__)  # pylint: disable=invalid-name
+
+dead_letters = registry.counter(  # pylint: disable=invalid-name
+    'ecommerce_worker_dead_letters_total',
+    'Tasks recorded in the dead-letter store after exhausting their retries, by task.',
+    ('task',)
+)
+
+stores = {}  # pylint: disable=invalid-name
+
+LETTER_FIELDS = ('id', 'failed_at', 'task', 'task_id', 'site_code', 'retries', 'error')
+
+
+class DeadLetterStore(LocalStore):
+    """
+    Tasks whose retries are exhausted, stored as serialized task signatures.
+
+    Replayed tasks are kept, with the time of their replay, until the store is cleared.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS dead_letter ('
+        ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+        ' failed_at REAL NOT NULL,'
+        ' task TEXT NOT NULL,'
+        ' task_id TEXT,'
+        ' site_code TEXT,'
+        ' retries INTEGER NOT NULL,'
+        ' error TEXT,'
+        ' content_type TEXT NOT NULL,'
+        ' content_encoding TEXT NOT NULL,'
+        ' body BLOB NOT NULL,'
+        ' replayed_at REAL)',
+        'CREATE INDEX IF NOT EXISTS dead_letter_pending ON dead_letter (replayed_at, id)',
+    )
+
+    def add(self, task_signature, task_id, site_code, retries, error, serializer):
+        """Record a task whose retries are exhausted.
+
+        Arguments:
+            task_signature (Signature): the task to publish when replaying it
+            task_id (str): id of the failed task
+            site_code (str): site code
+            retries (int): number of retries made
+            error (str): description of the last error
+            serializer (str): name of the serializer used for the signature
+        """
+        self.execute(
+            'INSERT INTO dead_letter (failed_at, task, task_id, site_code, retries, error,'
+            ' content_type, content_encoding, body) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (time.time(), task_signature['task'], task_id, site_code, retries, error) +
+            dump_payload(dict(task_signature), serializer)
+        )
+
+    def pending(self, task=None, site_code=None, after_id=0, limit=100):
+        """Get recorded tasks which have not been replayed yet, oldest first.
+
+        Arguments:
+            task (str): only get tasks of this name
+            site_code (str): only get tasks of this site
+            after_id (int): only get tasks recorded after this one
+            limit (int): maximum number of tasks
+
+        Returns:
+            list: dicts holding the LETTER_FIELDS and the task's signature
+        """
+        sql = 'SELECT {}, content_type, content_encoding, body FROM dead_letter' \
+              ' WHERE replayed_at IS NULL AND id > ?'.format(', '.join(LETTER_FIELDS))
+        parameters = [after_id]
+        if task:
+            sql += ' AND task = ?'
+            parameters.append(task)
+        if site_code:
+            sql += ' AND site_code = ?'
+            parameters.append(site_code)
+        sql += ' ORDER BY id LIMIT ?'
+        parameters.append(limit)
+
+        letters = []
+        for row in self.execute(sql, parameters).fetchall():
+            letter = dict(zip(LETTER_FIELDS, row))
+            letter['signature'] = load_payload(*row[len(LETTER_FIELDS):])
+            letters.append(letter)
+        return letters
+
+    def mark_replayed(self, letter_id):
+        """Record that a task has been published again."""
+        self.execute('UPDATE dead_letter SET replayed_at = ? WHERE id = ?', (time.time(), letter_id))
+
+
+def get_dead_letter_store():
+    """Get the dead-letter store for the configured local state directory"""
+    path = get_local_store_path('dead_letter.db')
+    store = stores.get(path)
+    if store is None:
+        store = stores[path] = DeadLetterStore(path)
+    return store
+
+
+def describe_error(exc):
+    """Describe an error in a line, for the dead-letter store."""
+    if exc is None:
+        return None
+    return '{}: {}'.format(exc.__class__.__name__, exc)
+
+
+def record_exhausted(task, error=None):
+    """
+    Record the current execution of a task in the dead-letter store.
+
+    Failing to record the task is logged, never raised, so the task's own failure is reported.
+
+    Arguments:
+        task (Task): bound task whose retries are exhausted
+        error (str): description of the last error
+    """
+    request = task.request
+    args = request.args or ()
+    kwargs = request.kwargs or {}
+    try:
+        site_code = inspect.getcallargs(task.run, *args, **kwargs).get('site_code')
+    except TypeError:
+        site_code = None
+    # replays go to the queue the task came from
+    delivery_info = request.delivery_info or {}
+    options = {key: delivery_info[key] for key in ('exchange', 'routing_key') if delivery_info.get(key)}
+
+    try:
+        get_dead_letter_store().add(task.subtask(args, kwargs, **options), request.id, site_code,
+                                    request.retries, error, task.serializer)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception('Failed to record task [%s] in the dead-letter store.', request.id)
+        return
+    dead_letters.inc(task=task.name)
+    logger.warning('Recorded task [%s] of [%s] in the dead-letter store after %d retries: %s',
+                   request.id, task.name, request.retries, error)
+
+
+def replay(store, rate, task=None, site_code=None, limit=None, batch_size=100):
+    """
+    Publish recorded tasks again, at most rate tasks per second, oldest first.
+
+    Arguments:
+        store (DeadLetterStore): store of the tasks
+        rate (float): maximum number of tasks published per second
+        task (str): only replay tasks of this name
+        site_code (str): only replay tasks of this site
+        limit (int): maximum number of tasks to replay
+        batch_size (int): number of tasks loaded in memory at once
+
+    Returns:
+        int: number of tasks replayed
+    """
+    start = time.time()
+    replayed = 0
+    after_id = 0
+    while limit is None or replayed < limit:
+        count = batch_size if limit is None else min(batch_size, limit - replayed)
+        letters = store.pending(task, site_code, after_id, count)
+        if not letters:
+            break
+
+        for letter in letters:
+            delay = start + replayed / float(rate) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            signature(letter['signature'], app=current_app).apply_async()
+            store.mark_replayed(letter['id'])
+            after_id = letter['id']
+            replayed += 1
+        logger.info('Replayed %d tasks.', replayed)
+    return replayed
+
+
+def main(argv=None):
+    """List or replay the tasks recorded in the dead-letter store."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=float, default=10, help='tasks published per second')
+    parser.add_argument('--task', help='only replay tasks of this name')
+    parser.add_argument('--site-code', help='only replay tasks of this site')
+    parser.add_argument('--limit', type=int, help='maximum number of tasks to replay')
+    parser.add_argument('--list', action='store_true', help='list the tasks instead of replaying them')
+    args = parser.parse_args(argv)
+
+    # configure the app from WORKER_CONFIGURATION_MODULE
+    from ecommerce_worker import celery_app  # pylint: disable=unused-variable
+    store = get_dead_letter_store()
+
+    if args.list:
+        for letter in store.pending(args.task, args.site_code, limit=args.limit or -1):
+            print('{id}\t{failed}\t{task}\t{task_id}\t{site_code}\t{retries}\t{error}'.format(
+                failed=datetime.datetime.utcfromtimestamp(letter['failed_at']).isoformat(), **letter))
+        return
+
+    replayed = replay(store, args.rate, args.task, args.site_code, args.limit)
+    print('Replayed {} tasks.'.format(replayed))
@@ -0,0 +1,153 @@
+"""
+Time budgets of task executions, applied as the timeout of their outbound HTTP calls.
+
+Without a budget, a call waits for as long as its client library lets it: EdxRestApiClient
+sets no timeout at all, and SailthruClient waits up to 10 seconds on each of the up to four
+calls of update_course_enrollment. TASK_DEADLINE_SECONDS sets the budget of each execution of
+a task, by task name; a site can set its own budgets in SITE_OVERRIDES.
+
+Once installed, every request sent through requests gets the remaining budget of the task
+making it as its timeout, unless its own timeout is shorter. A request made once the budget
+has run out fails right away with DeadlineExceeded, a requests Timeout, so the clients report
+it as they report timeouts. Such failures are retried on the task's usual schedule: the budget
+bounds how long an execution waits, not how soon it is attempted again, so a hung backend is not
+called again at once by every retry.
+
+requests applies its timeout to connecting and to each read, so a server trickling its
+response can still overrun the budget by the duration of a read; the next call fails fast.
+"""
+import time
+
+from celery.signals import task_postrun, task_prerun, worker_init
+from requests.adapters import HTTPAdapter
+from requests.exceptions import Timeout
+
+from ecommerce_worker.concurrency import Local
+from ecommerce_worker.metrics import registry
+from ecommerce_worker.routing import get_site_code
+from ecommerce_worker.utils import get_configuration
+
+deadlines_exceeded = registry.counter(  # pylint: disable=invalid-name
+    'ecommerce_worker_deadlines_exceeded_total',
+    'Outbound calls refused or cut short because the time budget of their task ran out, by task.',
+    ('task',)
+)
+
+# (task name, deadline) of the task running in each thread
+_state = Local()  # pylint: disable=invalid-name
+
+
+class DeadlineExceeded(Timeout):
+    """The time budget of the task ran out before an outbound call."""
+
+
+def get_budget(task_name, site_code=None):
+    """
+    Get the time budget of a task's executions for a site.
+
+    Returns:
+        float: seconds, or None if the task has no budget.
+    """
+    try:
+        budgets = get_configuration('TASK_DEADLINE_SECONDS', site_code=site_code)
+    except RuntimeError:
+        return None
+    return budgets.get(task_name)
+
+
+def start(task_name, budget):
+    """Give the task running in the calling thread budget seconds (None for no budget)."""
+    _state.task = task_name
+    _state.deadline = time.time() + budget if budget else None
+
+
+def clear():
+    """Forget the budget of the task running in the calling thread."""
+    _state.task = None
+    _state.deadline = None
+
+
+def remaining():
+    """
+    Get the time left to the task running in the calling thread.
+
+    Returns:
+        float: seconds, negative once the budget has run out, or None if the task has no budget.
+    """
+    deadline = getattr(_state, 'deadline', None)
+    return deadline - time.time() if deadline is not None else None
+
+
+def expired():
+    """Return True if the budget of the task running in the calling thread has run out."""
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def bound_timeout(timeout, limit):
+    """
+    Cap a requests timeout to limit seconds.
+
+    Arguments:
+        timeout: None, seconds, or a (connect, read) tuple of them
+        limit (float): seconds
+
+    Returns:
+        the timeout, of the same form, none of whose parts exceeds limit
+    """
+    if isinstance(timeout, tuple):
+        return tuple(bound_timeout(part, limit) for part in timeout)
+    if timeout is None:
+        return limit
+    if isinstance(timeout, (int, float)):
+        return min(timeout, limit)
+    # e.g. a urllib3 Timeout, which carries its own total
+    return timeout
+
+
+def _wrap_send(original):
+    """Apply the remaining budget of the calling thread's task to each request."""
+    def send(self, request, stream=False, timeout=None, *args, **kwargs):
+        """Send the request with the remaining budget as its timeout, or refuse to send it."""
+        left = remaining()
+        if left is None:
+            return original(self, request, stream, timeout, *args, **kwargs)
+
+        task_name = getattr(_state, 'task', None)
+        if left <= 0:
+            deadlines_exceeded.inc(task=task_name)
+            raise DeadlineExceeded('Time budget of {} ran out before {} {}'.format(
+                task_name, request.method, request.url.split('?', 1)[0]), request=request)
+        try:
+            return original(self, request, stream, bound_timeout(timeout, left), *args, **kwargs)
+        except Timeout:
+            if expired():
+                deadlines_exceeded.inc(task=task_name)
+            raise
+
+    send.deadline = True
+    return send
+
+
+def install():
+    """Apply task budgets to the requests sent through requests. Calling it again does nothing."""
+    if not getattr(HTTPAdapter.send, 'deadline', False):
+        HTTPAdapter.send = _wrap_send(HTTPAdapter.__dict__['send'])
+
+
+@worker_init.connect
+def install_deadlines(**kwargs):  # pylint: disable=unused-argument
+    """Apply task budgets to outbound calls when the worker starts."""
+    install()
+
+
+@task_prerun.connect
+def start_deadline(task=None, args=None, kwargs=None, **extra):  # pylint: disable=unused-argument
+    """Start the budget of a task execution."""
+    start(task.name, get_budget(task.name, get_site_code(task, args, kwargs)))
+
+
+@task_postrun.connect
+def clear_deadline(**kwargs):  # pylint: disable=unused-argument
+    """Forget the budget of a finished task execution."""
+    clear()
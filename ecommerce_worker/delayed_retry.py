@@ -0,0 +1,270 @@
+"""
+Durable scheduling of delayed retries.
+
+Celery implements a retry's countdown by publishing an ETA message which the worker
+prefetches and holds, unacknowledged, until it is due. Sailthru retries wait an hour and
+fulfillment retries up to about 17 minutes, so during an outage every pending retry sits in
+the memory of a worker and counts against its prefetch and the broker's unacked messages.
+
+When DURABLE_RETRY_ENABLED is set, retries delayed by at least DURABLE_RETRY_MIN_COUNTDOWN
+seconds are written to a SQLite store in LOCAL_STATE_DIR instead, and the worker's main
+process re-publishes them as regular messages once they are due. Retries are claimed for
+a lease before being published and only removed once published, so a retry is published
+at least once even if the worker dies in between, and never by two processes at a time.
+"""
+import threading
+import time
+
+from celery import current_app
+from celery.canvas import signature
+from celery.exceptions import Retry
+from celery.signals import worker_ready, worker_shutdown
+from celery.utils.log import get_logger
+
+from ecommerce_worker.dead_letter import describe_error, record_exhausted
+from ecommerce_worker.local_store import LocalStore, dump_payload, get_local_store_path, load_payload
+from ecommerce_worker.metrics import registry
+from ecommerce_worker.utils import get_configuration
+
+logger = get_logger(__name__)  # pylint: disable=invalid-name
+
+durable_retries = registry.counter(  # pylint: disable=invalid-name
+    'ecommerce_worker_durable_retries_total',
+    'Retries kept in the delayed retry store, by event (stored, published).',
+    ('event',)
+)
+
+stores = {}  # pylint: disable=invalid-name
+publisher = None  # pylint: disable=invalid-name
+
+
+class DelayedRetryStore(LocalStore):
+    """
+    Retries waiting to be published, stored as serialized task signatures.
+
+    Rows are claimed until claimed_until while they are being published; a row whose claim
+    expired without being removed is published again.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS delayed_retry ('
+        ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+        ' due REAL NOT NULL,'
+        ' task TEXT NOT NULL,'
+        ' content_type TEXT NOT NULL,'
+        ' content_encoding TEXT NOT NULL,'
+        ' body BLOB NOT NULL,'
+        ' claimed_until REAL NOT NULL DEFAULT 0)',
+        'CREATE INDEX IF NOT EXISTS delayed_retry_due ON delayed_retry (due)',
+    )
+
+    def add(self, task_signature, due, serializer):
+        """Store a retry.
+
+        Arguments:
+            task_signature (Signature): the retry to publish
+            due (float): timestamp after which it is published
+            serializer (str): name of the serializer used for the signature
+        """
+        self.execute(
+            'INSERT INTO delayed_retry (due, task, content_type, content_encoding, body) VALUES (?, ?, ?, ?, ?)',
+            (due, task_signature['task']) + dump_payload(dict(task_signature), serializer)
+        )
+
+    def claim(self, now, limit, lease):
+        """Claim the retries which are due and not claimed by another process.
+
+        Arguments:
+            now (float): current timestamp
+            limit (int): maximum number of retries to claim
+            lease (float): seconds after which retries still claimed can be claimed again
+
+        Returns:
+            list: (id, signature dict) tuples, earliest due first
+        """
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute(
+                'SELECT id, content_type, content_encoding, body FROM delayed_retry'
+                ' WHERE due <= ? AND claimed_until <= ? ORDER BY due LIMIT ?',
+                (now, now, limit)
+            ).fetchall()
+            connection.executemany('UPDATE delayed_retry SET claimed_until = ? WHERE id = ?',
+                                   [(now + lease, row[0]) for row in rows])
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return [(row[0], load_payload(*row[1:])) for row in rows]
+
+    def remove(self, retry_id):
+        """Forget a retry once it has been published."""
+        self.execute('DELETE FROM delayed_retry WHERE id = ?', (retry_id,))
+
+    def release(self, retry_id):
+        """Give up the claim on a retry which could not be published."""
+        self.execute('UPDATE delayed_retry SET claimed_until = 0 WHERE id = ?', (retry_id,))
+
+    def count(self):
+        """Number of retries waiting in the store."""
+        return self.execute('SELECT COUNT(*) FROM delayed_retry').fetchone()[0]
+
+
+def get_retry_store():
+    """Get the delayed retry store for the configured local state directory"""
+    path = get_local_store_path('delayed_retry.db')
+    store = stores.get(path)
+    if store is None:
+        store = stores[path] = DelayedRetryStore(path)
+    return store
+
+
+def _is_durable(request, countdown):
+    """Return True if a retry of the request should be kept in the store."""
+    if request.called_directly or request.is_eager:
+        # nothing waits in worker memory
+        return False
+    return get_configuration('DURABLE_RETRY_ENABLED') and countdown >= get_configuration('DURABLE_RETRY_MIN_COUNTDOWN')
+
+
+def retry_task(task, countdown, max_retries, exc=None, error=None):
+    """
+    Retry the current execution of a task after countdown seconds.
+
+    Behaves like Task.retry, and uses it unless the retry is to be stored: when durable
+    retries are disabled, the delay is short, the task runs eagerly or the retry limit
+    is reached. Tasks whose retries are exhausted are recorded in the dead-letter store.
+
+    Arguments:
+        task (Task): bound task being executed
+        countdown (int): seconds before the retry
+        max_retries (int): maximum number of retries
+        exc (Exception): error causing the retry, raised once the retries are exhausted
+        error (str): description of the error kept in the dead-letter store, defaults to exc
+
+    Raises:
+        Retry: always, unless retries are exhausted
+    """
+    request = task.request
+    retries = request.retries + 1
+    exhausted = max_retries is not None and retries > max_retries
+    if exhausted and not request.called_directly:
+        record_exhausted(task, error or describe_error(exc))
+    if exhausted or not _is_durable(request, countdown):
+        raise task.retry(exc=exc, countdown=countdown, max_retries=max_retries)
+
+    task_signature = task.subtask_from_request(request, retries=retries)
+    get_retry_store().add(task_signature, time.time() + countdown, task.serializer)
+    durable_retries.inc(event='stored')
+    # the tracer records the retry; the message itself is acknowledged
+    raise Retry(exc=exc, when=countdown)
+
+
+def defer_task(task, countdown, kwargs=None):
+    """
+    Run the current execution of a task again after countdown seconds, as if it had not run.
+
+    Unlike retry_task, the retry count is kept: the task did not fail, it was held back.
+    Long delays are kept in the delayed retry store like retries.
+
+    Arguments:
+        task (Task): bound task being executed
+        countdown (float): seconds before the task runs again
+        kwargs (dict): keyword arguments to update those of the execution with
+    """
+    request = task.request
+    task_signature = task.subtask_from_request(request, retries=request.retries)
+    if kwargs:
+        task_signature['kwargs'] = dict(task_signature['kwargs'] or {}, **kwargs)
+    if _is_durable(request, countdown):
+        get_retry_store().add(task_signature, time.time() + countdown, task.serializer)
+        durable_retries.inc(event='stored')
+    else:
+        task_signature.apply_async(countdown=countdown)
+
+
+class RetryPublisher(object):
+    """
+    Publishes due retries from a daemon thread.
+
+    Arguments:
+        store (DelayedRetryStore): store of the retries
+        interval (float): seconds between two checks for due retries
+        batch_size (int): maximum number of retries loaded in memory at once
+        lease (float): seconds after which retries claimed but not published are claimed again
+    """
+
+    def __init__(self, store, interval, batch_size, lease=60):
+        self.store = store
+        self.interval = interval
+        self.batch_size = batch_size
+        self.lease = lease
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def publish_due(self):
+        """Publish the retries which are due.
+
+        Returns:
+            int: number of retries published
+        """
+        published = 0
+        while True:
+            claimed = self.store.claim(time.time(), self.batch_size, self.lease)
+            for index, (retry_id, task_signature) in enumerate(claimed):
+                try:
+                    signature(task_signature, app=current_app).apply_async()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception('Failed to publish the delayed retry of [%s].', task_signature['task'])
+                    # leave the rest of the batch to the next check
+                    for unpublished_id, __ in claimed[index:]:
+                        self.store.release(unpublished_id)
+                    return published
+                self.store.remove(retry_id)
+                durable_retries.inc(event='published')
+                published += 1
+            if len(claimed) < self.batch_size:
+                return published
+
+    def run(self):
+        """Check for due retries until stopped."""
+        while not self._stopped.wait(self.interval):
+            try:
+                self.publish_due()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Failed to publish delayed retries.')
+
+    def start(self):
+        """Start publishing on a daemon thread."""
+        self._thread = threading.Thread(target=self.run, name='RetryPublisher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop publishing and wait for the batch in progress."""
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+
+@worker_ready.connect
+def start_retry_publisher(**kwargs):  # pylint: disable=unused-argument
+    """Publish due retries from the worker's main process if durable retries are enabled."""
+    global publisher  # pylint: disable=global-statement,invalid-name
+    if not get_configuration('DURABLE_RETRY_ENABLED'):
+        return
+
+    store = get_retry_store()
+    publisher = RetryPublisher(store, get_configuration('DURABLE_RETRY_POLL_INTERVAL'),
+                               get_configuration('DURABLE_RETRY_BATCH_SIZE'))
+    publisher.start()
+    logger.info('Publishing delayed retries from [%s], [%d] waiting.', store.path, store.count())
+
+
+@worker_shutdown.connect
+def stop_retry_publisher(**kwargs):  # pylint: disable=unused-argument
+    """Stop publishing retries when the worker stops."""
+    global publisher  # pylint: disable=global-statement,invalid-name
+    if publisher:
+        publisher.stop()
+        publisher = None
@@ -0,0 +1,81 @@
+"""
+Throttling signals of the ecommerce service, and the per-site backoff they feed.
+
+The ecommerce service answers 429 (Too Many Requests) or 503 (Service Unavailable) when it
+cannot take more load, usually with a Retry-After header giving the number of seconds, or
+the date, after which it can. The fulfillment of the order is retried after that delay,
+and the site is put in backoff until then: the worker processes of the host check the
+backoff of a site before calling the service, and defer their orders until it ends.
+"""
+from email.utils import mktime_tz, parsedate_tz
+import time
+
+from ecommerce_worker.local_store import LocalStore
+
+THROTTLING_STATUSES = (429, 503)
+
+
+def parse_retry_after(value, now=None):
+    """
+    Parse the value of a Retry-After header.
+
+    Arguments:
+        value (str): a number of seconds or an HTTP date
+        now (float): current timestamp, used to convert dates
+
+    Returns:
+        float: seconds to wait, or None if the value cannot be parsed.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(mktime_tz(parsed) - (now if now is not None else time.time()), 0.0)
+
+
+def get_throttle_delay(response):
+    """
+    Read the throttling signal of a response.
+
+    Arguments:
+        response (Response): response of the ecommerce service, or None
+
+    Returns:
+        tuple: (throttled, delay), where delay is the seconds given by Retry-After, or None.
+    """
+    if response is None or response.status_code not in THROTTLING_STATUSES:
+        return False, None
+    return True, parse_retry_after(response.headers.get('Retry-After'))
+
+
+class SiteBackoff(LocalStore):
+    """
+    The time until which each site asked not to be called, shared by the processes of a host.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS site_backoff ('
+        ' site_code TEXT PRIMARY KEY,'
+        ' until REAL NOT NULL)',
+    )
+
+    def extend(self, site_code, seconds):
+        """Back off from a site for the next seconds, unless it already backs off for longer.
+
+        Arguments:
+            site_code (str): site code
+            seconds (float): duration of the backoff
+        """
+        until = time.time() + seconds
+        self.execute('INSERT OR IGNORE INTO site_backoff (site_code, until) VALUES (?, 0)', (site_code or '',))
+        self.execute('UPDATE site_backoff SET until = ? WHERE site_code = ? AND until < ?',
+                     (until, site_code or '', until))
+
+    def remaining(self, site_code):
+        """Seconds left before a site can be called again, 0 if it is not backed off."""
+        row = self.execute('SELECT until FROM site_backoff WHERE site_code = ?', (site_code or '',)).fetchone()
+        return max(row[0] - time.time(), 0.0) if row else 0.0
@@ -0,0 +1,230 @@
+"""
+Bulk fulfillment of orders, such as the orders affected by an incident.
+
+The ecommerce-worker-fulfill command reads order numbers from a file, or stdin, one per line
+and optionally followed by the code of their site:
+
+    EDX-100001
+    EDX-100002,edx
+
+It fulfills them from a pool of threads the way fulfill_order does: each attempt gets the time
+budget of fulfill_order, failures are retried with the same countdowns, up to the
+MAX_FULFILLMENT_RETRIES of their site unless --max-retries is given, and the backoff asked
+for by a throttling site is honored by every thread, as is the concurrency limit of the site
+when FULFILLMENT_CONCURRENCY_LIMIT_ENABLED is set. The input is read as orders are fulfilled,
+so it can be of any size.
+
+Each finished order is recorded in a checkpoint, a SQLite store in LOCAL_STATE_DIR unless
+--checkpoint is given. Orders recorded as fulfilled are skipped, so an interrupted run resumes
+where it stopped when it is started again with the same input. Orders whose retries ran out
+are recorded as failed, listed by --list-failed, and attempted again by the next run.
+
+    WORKER_CONFIGURATION_MODULE=... ecommerce-worker-fulfill --concurrency 16 orders.txt
+    WORKER_CONFIGURATION_MODULE=... ecommerce-worker-fulfill --list-failed
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import random
+import re
+import sys
+import time
+
+from celery.utils.log import get_logger
+from edx_rest_api_client import exceptions
+
+from ecommerce_worker import deadline
+from ecommerce_worker.dead_letter import describe_error
+from ecommerce_worker.fulfillment.v1.tasks import (
+    acquire_slot, fulfill_order, get_retry_countdown, get_site_backoff, request_fulfillment
+)
+from ecommerce_worker.local_store import LocalStore, get_local_store_path
+from ecommerce_worker.streaming import Progress, process_stream
+from ecommerce_worker.utils import get_configuration
+
+logger = get_logger(__name__)  # pylint: disable=invalid-name
+
+FULFILLED = 'fulfilled'
+ALREADY_FULFILLED = 'already_fulfilled'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class FulfillmentCheckpoint(LocalStore):
+    """
+    The outcome of each order processed by bulk fulfillment.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS bulk_fulfillment ('
+        ' site_code TEXT NOT NULL,'
+        ' order_number TEXT NOT NULL,'
+        ' outcome TEXT NOT NULL,'
+        ' error TEXT,'
+        ' finished_at REAL NOT NULL,'
+        ' PRIMARY KEY (site_code, order_number))',
+    )
+
+    def record(self, order_number, site_code, outcome, error=None):
+        """Record the outcome of an order, replacing that of a previous run."""
+        self.execute(
+            'INSERT OR REPLACE INTO bulk_fulfillment (site_code, order_number, outcome, error, finished_at)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            (site_code or '', order_number, outcome, error, time.time())
+        )
+
+    def is_done(self, order_number, site_code):
+        """Return True if the order was fulfilled by a previous run."""
+        row = self.execute('SELECT outcome FROM bulk_fulfillment WHERE site_code = ? AND order_number = ?',
+                           (site_code or '', order_number)).fetchone()
+        return row is not None and row[0] != FAILED
+
+    def failed(self):
+        """
+        List the orders whose fulfillment failed.
+
+        Returns:
+            list: dicts with the order_number, site_code, error and finished_at of each order
+        """
+        rows = self.execute('SELECT order_number, site_code, error, finished_at FROM bulk_fulfillment'
+                            ' WHERE outcome = ? ORDER BY finished_at', (FAILED,))
+        return [
+            {'order_number': row[0], 'site_code': row[1] or None, 'error': row[2], 'finished_at': row[3]}
+            for row in rows
+        ]
+
+
+def parse_orders(lines, site_code=None):
+    """
+    Read the orders to fulfill, skipping blank lines and # comments.
+
+    Arguments:
+        lines (iterable): lines holding an order number, optionally followed by a site code
+            after a comma or whitespace
+        site_code (str): site of the orders whose line has none
+
+    Yields:
+        tuple: (order number, site code)
+    """
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = re.split(r'[\s,]+', line)
+        yield fields[0], fields[1] if len(fields) > 1 else site_code
+
+
+def fulfill(order_number, site_code=None, max_retries=None):
+    """
+    Fulfill an order the way fulfill_order does, waiting for its retries in the calling thread.
+
+    Arguments:
+        order_number (str): order to fulfill
+        site_code (str): site of the order
+        max_retries (int): maximum number of retries (default: MAX_FULFILLMENT_RETRIES of the site)
+
+    Returns:
+        tuple: (outcome, error), where error describes the last failure of a failed order.
+    """
+    if max_retries is None:
+        max_retries = get_configuration('MAX_FULFILLMENT_RETRIES', site_code=site_code)
+    retries = 0
+    while True:
+        wait = get_site_backoff().remaining(site_code)
+        if wait:
+            time.sleep(wait + random.uniform(0, get_configuration('FULFILLMENT_BACKOFF_JITTER', site_code=site_code)))
+
+        slot = acquire_slot(site_code)
+        deadline.start(fulfill_order.name, deadline.get_budget(fulfill_order.name, site_code))
+        try:
+            with slot:
+                fulfilled = request_fulfillment(order_number, site_code)
+            return (FULFILLED if fulfilled else ALREADY_FULFILLED), None
+        except (exceptions.HttpClientError, exceptions.HttpServerError, exceptions.Timeout) as exc:
+            if retries >= max_retries:
+                logger.warning('Fulfillment of order [%s] failed. Giving up.', order_number, exc_info=True,
+                               extra={'dedup': False})
+                return FAILED, describe_error(exc)
+            countdown = get_retry_countdown(exc, retries, site_code)
+        finally:
+            deadline.clear()
+
+        retries += 1
+        time.sleep(countdown)
+
+
+def fulfill_orders(orders, checkpoint, progress, concurrency=8, max_retries=None):
+    """
+    Fulfill orders from concurrency threads, skipping those the checkpoint holds as fulfilled.
+
+    When interrupted, the orders in progress are finished and recorded, and the orders read
+    ahead are left to the next run.
+
+    Arguments:
+        orders (iterable): (order number, site code) tuples
+        checkpoint (FulfillmentCheckpoint): outcomes of the orders
+        progress (Progress): counts the outcomes
+        concurrency (int): number of orders fulfilled at a time
+        max_retries (int): maximum number of retries of each order (default: MAX_FULFILLMENT_RETRIES of its site)
+    """
+    def pending():
+        """Orders not fulfilled by a previous run."""
+        for order_number, site_code in orders:
+            if checkpoint.is_done(order_number, site_code):
+                progress.add(SKIPPED)
+            else:
+                yield order_number, site_code
+
+    def handle(order):
+        """Fulfill an order and record its outcome."""
+        order_number, site_code = order
+        try:
+            outcome, error = fulfill(order_number, site_code, max_retries)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.exception('Fulfillment of order [%s] failed.', order_number)
+            outcome, error = FAILED, describe_error(exc)
+        checkpoint.record(order_number, site_code, outcome, error)
+        progress.add(outcome)
+
+    try:
+        process_stream(pending(), handle, concurrency)
+    except KeyboardInterrupt:
+        print('Interrupted, the orders in progress were finished.', file=progress.out)
+        raise
+
+
+def main(argv=None):
+    """Fulfill the orders read from a file or stdin, or list the orders which failed."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', nargs='?', default='-', help='file of order numbers, - for stdin')
+    parser.add_argument('--site-code', help='site of the orders listed without one')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of orders fulfilled at a time')
+    parser.add_argument('--max-retries', type=int,
+                        help='maximum number of retries of each order, defaults to MAX_FULFILLMENT_RETRIES of its site')
+    parser.add_argument('--checkpoint', help='checkpoint file, defaults to one in LOCAL_STATE_DIR')
+    parser.add_argument('--report-interval', type=float, default=10, help='seconds between two progress reports')
+    parser.add_argument('--list-failed', action='store_true', help='list the orders which failed instead')
+    args = parser.parse_args(argv)
+
+    # configure the app from WORKER_CONFIGURATION_MODULE
+    from ecommerce_worker import celery_app  # pylint: disable=unused-variable
+    deadline.install()
+    checkpoint = FulfillmentCheckpoint(args.checkpoint or get_local_store_path('bulk_fulfillment.db'))
+
+    if args.list_failed:
+        for order in checkpoint.failed():
+            print('{order_number}\t{site_code}\t{finished}\t{error}'.format(
+                finished=datetime.datetime.utcfromtimestamp(order['finished_at']).isoformat(), **order))
+        return
+
+    progress = Progress(args.report_interval, 'orders', passed=(SKIPPED,))
+    lines = sys.stdin if args.input == '-' else open(args.input)
+    try:
+        fulfill_orders(parse_orders(lines, args.site_code), checkpoint, progress, args.concurrency,
+                       args.max_retries)
+    except KeyboardInterrupt:
+        sys.exit('Interrupted. Run the command again to resume.')
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+        progress.report()
@@ -0,0 +1,303 @@
+"""
+Adaptive limit of the fulfillment calls made to the ecommerce service of each site at a time.
+
+A fixed worker concurrency either leaves a healthy ecommerce service under-used or keeps
+sending it as many calls as ever once it slows down. When FULFILLMENT_CONCURRENCY_LIMIT_ENABLED
+is set, the worker processes of a host share a limit per site on the fulfillment calls in
+flight, which adapts to the latency and errors of the calls, in the manner of AIMD limiters:
+
+* a call failing with a server error, a timeout or a throttling answer (429, 503) divides the
+  limit by 1 / FULFILLMENT_CONCURRENCY_BACKOFF_RATIO;
+* while the recent latency of the calls exceeds FULFILLMENT_CONCURRENCY_LATENCY_TOLERANCE times
+  their long-term latency, each call lowers the limit by a tenth;
+* otherwise the limit grows by one for every limit calls, as long as at least half of it is in use.
+
+The limit stays between FULFILLMENT_CONCURRENCY_MIN_LIMIT and FULFILLMENT_CONCURRENCY_MAX_LIMIT.
+An order finding the limit of its site reached waits for a free slot in its worker process,
+for at most FULFILLMENT_CONCURRENCY_MAX_WAIT seconds and within its time budget, and is then
+deferred without counting a retry, up to MAX_FULFILLMENT_RETRIES times; beyond that, each
+time the order finds no free slot counts as a retry, so that it is not deferred forever.
+Slots are leased, so a process dying during a call does not hold its slot for longer than
+the lease.
+
+SQLite waits for a lock in its busy handler, which blocks the whole process, green threads
+included. The limiter therefore gives SQLite a busy timeout of a few milliseconds and waits for
+the write lock of its store with time.sleep, which yields to other green threads. An order
+polling for a slot only takes the write lock when a read finds a slot free.
+"""
+from contextlib import contextmanager
+import random
+import sqlite3
+import time
+
+from celery.utils.log import get_logger
+from edx_rest_api_client import exceptions
+
+from ecommerce_worker.deadline import DeadlineExceeded
+from ecommerce_worker.fulfillment.v1.backoff import THROTTLING_STATUSES
+from ecommerce_worker.local_store import LocalStore
+from ecommerce_worker.utils import get_configuration
+
+logger = get_logger(__name__)  # pylint: disable=invalid-name
+
+# Smoothing of the recent and long-term latency of the calls of a site
+SHORT_SMOOTHING = 0.3
+LONG_SMOOTHING = 0.02
+# Factor applied to the limit by each call slower than tolerated
+LATENCY_DECREASE = 0.9
+# Seconds between two attempts to take a slot, or the write lock of the store
+POLL_INTERVAL = 0.05
+# Seconds SQLite itself waits for a lock, blocking the process
+LOCK_TIMEOUT = 0.01
+# Seconds to wait for the write lock of the store when releasing a slot
+LOCK_WAIT = 5.0
+
+
+class ConcurrencyLimitReached(Exception):
+    """An order found no free slot of its site after being deferred as many times as allowed."""
+
+
+def is_locked(exc):
+    """Return True if a SQLite error tells that the store was locked by another connection."""
+    return isinstance(exc, sqlite3.OperationalError) and 'locked' in str(exc)
+
+
+def is_overload(exc):
+    """Return True if a fulfillment call failed in a way telling the ecommerce service is overloaded."""
+    if isinstance(exc, DeadlineExceeded):
+        # refused before reaching the service, because the task's budget ran out
+        return False
+    if isinstance(exc, (exceptions.HttpServerError, exceptions.Timeout)):
+        return True
+    response = getattr(exc, 'response', None)
+    return isinstance(exc, exceptions.HttpClientError) and getattr(response, 'status_code', None) in THROTTLING_STATUSES
+
+
+class AdaptiveLimit(object):
+    """
+    Concurrency limit of a site, adjusted after each call.
+
+    Arguments:
+        settings (dict): minimum, maximum, backoff_ratio and latency_tolerance of the limit
+        limit (float): current limit
+        short_latency (float): recent latency of the calls, smoothed, or None before the first call
+        long_latency (float): long-term latency of the calls, smoothed, or None before the first call
+    """
+
+    def __init__(self, settings, limit, short_latency=None, long_latency=None):
+        self.settings = settings
+        self.limit = limit
+        self.short_latency = short_latency
+        self.long_latency = long_latency
+
+    def update(self, latency, overloaded, in_flight):
+        """
+        Adjust the limit after a call.
+
+        Arguments:
+            latency (float): seconds the call took, None if it was not made
+            overloaded (boolean): True if the call failed because the service is overloaded
+            in_flight (int): number of calls in flight when the call ended, itself included
+        """
+        settings = self.settings
+        if overloaded:
+            self.limit = max(self.limit * settings['backoff_ratio'], settings['minimum'])
+            return
+        if latency is None:
+            return
+
+        if self.short_latency is None:
+            self.short_latency = self.long_latency = latency
+        else:
+            self.short_latency += SHORT_SMOOTHING * (latency - self.short_latency)
+            self.long_latency += LONG_SMOOTHING * (latency - self.long_latency)
+
+        if self.short_latency > self.long_latency * settings['latency_tolerance']:
+            self.limit = max(self.limit * LATENCY_DECREASE, settings['minimum'])
+        elif in_flight * 2 >= self.limit:
+            # one more call per round of calls
+            self.limit = min(self.limit + 1.0 / self.limit, settings['maximum'])
+
+
+def get_limit_settings(site_code=None):
+    """Get the settings of the adaptive concurrency limit of a site."""
+    return {
+        'initial': get_configuration('FULFILLMENT_CONCURRENCY_INITIAL_LIMIT', site_code=site_code),
+        'minimum': get_configuration('FULFILLMENT_CONCURRENCY_MIN_LIMIT', site_code=site_code),
+        'maximum': get_configuration('FULFILLMENT_CONCURRENCY_MAX_LIMIT', site_code=site_code),
+        'backoff_ratio': get_configuration('FULFILLMENT_CONCURRENCY_BACKOFF_RATIO', site_code=site_code),
+        'latency_tolerance': get_configuration('FULFILLMENT_CONCURRENCY_LATENCY_TOLERANCE', site_code=site_code),
+    }
+
+
+class ConcurrencyLimiter(LocalStore):
+    """
+    The adaptive concurrency limit of each site and the calls in flight, shared by the processes of a host.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS concurrency_limit ('
+        ' site_code TEXT PRIMARY KEY,'
+        ' "limit" REAL NOT NULL,'
+        ' short_latency REAL,'
+        ' long_latency REAL)',
+        'CREATE TABLE IF NOT EXISTS concurrency_slot ('
+        ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+        ' site_code TEXT NOT NULL,'
+        ' expires REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS concurrency_slot_site ON concurrency_slot (site_code, expires)',
+    )
+
+    def __init__(self, path, timeout=LOCK_TIMEOUT):
+        super(ConcurrencyLimiter, self).__init__(path, timeout)
+
+    def _begin(self, wait):
+        """Take the write lock of the store, sleeping between attempts for at most wait seconds."""
+        give_up = time.time() + wait
+        while True:
+            try:
+                self.execute('BEGIN IMMEDIATE')
+                return
+            except sqlite3.OperationalError as exc:
+                if not is_locked(exc) or time.time() >= give_up:
+                    raise
+            time.sleep(random.uniform(0.5, 1.5) * POLL_INTERVAL)
+
+    @contextmanager
+    def _transaction(self, wait=None):
+        """
+        Run statements in a transaction holding the write lock of the store.
+
+        Arguments:
+            wait (float): seconds to wait for the lock at most (default: LOCK_WAIT)
+        """
+        self._begin(LOCK_WAIT if wait is None else wait)
+        try:
+            yield
+        except Exception:
+            self.execute('ROLLBACK')
+            raise
+        self.execute('COMMIT')
+
+    def _load(self, site_code, settings):
+        """Get the AdaptiveLimit of a site."""
+        row = self.execute('SELECT "limit", short_latency, long_latency FROM concurrency_limit WHERE site_code = ?',
+                           (site_code or '',)).fetchone()
+        if row is None:
+            return AdaptiveLimit(settings, settings['initial'])
+        # the bounds may have changed since the limit was stored
+        return AdaptiveLimit(settings, min(max(row[0], settings['minimum']), settings['maximum']), row[1], row[2])
+
+    def _in_flight(self, site_code, now):
+        """Number of calls in flight to a site."""
+        return self.execute('SELECT COUNT(*) FROM concurrency_slot WHERE site_code = ? AND expires > ?',
+                            (site_code or '', now)).fetchone()[0]
+
+    def limit(self, site_code):
+        """
+        Get the current limit of a site and the number of calls in flight.
+
+        Returns:
+            tuple: (limit, calls in flight)
+        """
+        adaptive_limit = self._load(site_code, get_limit_settings(site_code))
+        return int(adaptive_limit.limit), self._in_flight(site_code, time.time())
+
+    def try_acquire(self, site_code, lease):
+        """
+        Take a slot of a site if its limit allows another call.
+
+        Arguments:
+            site_code (str): site code
+            lease (float): seconds after which the slot is freed if it was not released
+
+        Returns:
+            int: id of the slot, or None if the limit is reached or the store is locked
+        """
+        now = time.time()
+        settings = get_limit_settings(site_code)
+        # reads take no lock: a slot is only taken under the write lock once one looks free
+        if self._in_flight(site_code, now) >= int(self._load(site_code, settings).limit):
+            return None
+        try:
+            with self._transaction(wait=0):
+                self.execute('DELETE FROM concurrency_slot WHERE site_code = ? AND expires <= ?',
+                             (site_code or '', now))
+                if self._in_flight(site_code, now) >= int(self._load(site_code, settings).limit):
+                    return None
+                return self.execute('INSERT INTO concurrency_slot (site_code, expires) VALUES (?, ?)',
+                                    (site_code or '', now + lease)).lastrowid
+        except sqlite3.OperationalError as exc:
+            if not is_locked(exc):
+                raise
+            return None
+
+    def acquire(self, site_code, timeout=None, lease=60):
+        """
+        Wait for a slot of a site.
+
+        Arguments:
+            site_code (str): site code
+            timeout (float): seconds to wait at most, None to wait until a slot frees up
+            lease (float): seconds after which the slot is freed if it was not released
+
+        Returns:
+            Slot: the slot, to use as a context manager around the call, or None if none freed up in time
+        """
+        give_up = time.time() + timeout if timeout is not None else None
+        while True:
+            slot_id = self.try_acquire(site_code, lease)
+            if slot_id is not None:
+                return Slot(self, site_code, slot_id)
+            if give_up is not None and time.time() >= give_up:
+                return None
+            # spread the processes polling the same site
+            time.sleep(random.uniform(0.5, 1.5) * POLL_INTERVAL)
+
+    def release(self, site_code, slot_id, latency, overloaded):
+        """
+        Free a slot once its call is done, and adjust the limit of its site.
+
+        Arguments:
+            site_code (str): site code
+            slot_id (int): id of the slot
+            latency (float): seconds the call took, None if it was not made
+            overloaded (boolean): True if the call failed because the service is overloaded
+        """
+        with self._transaction():
+            in_flight = self._in_flight(site_code, time.time())
+            self.execute('DELETE FROM concurrency_slot WHERE id = ?', (slot_id,))
+            adaptive_limit = self._load(site_code, get_limit_settings(site_code))
+            adaptive_limit.update(latency, overloaded, in_flight)
+            self.execute('INSERT OR REPLACE INTO concurrency_limit (site_code, "limit", short_latency, long_latency)'
+                         ' VALUES (?, ?, ?, ?)', (site_code or '', adaptive_limit.limit,
+                                                  adaptive_limit.short_latency, adaptive_limit.long_latency))
+
+
+class Slot(object):
+    """
+    A slot of the concurrency limit of a site, held by a call: releasing it on exit measures the call.
+
+    A Slot without a limiter, for calls which are not limited, does nothing. A slot which cannot
+    be released, because the store stayed locked, is left to expire with its lease rather than
+    replace the outcome of the call.
+    """
+
+    def __init__(self, limiter=None, site_code=None, slot_id=None):
+        self.limiter = limiter
+        self.site_code = site_code
+        self.slot_id = slot_id
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.limiter is not None:
+            # a call refused because the task's budget ran out tells nothing of the service's latency
+            latency = None if isinstance(exc_value, DeadlineExceeded) else time.time() - self.started
+            try:
+                self.limiter.release(self.site_code, self.slot_id, latency, is_overload(exc_value))
+            except Exception:  # pylint: disable=broad-except
+                logger.warning('Failed to release slot [%s] of site [%s]; it is freed when its lease ends.',
+                               self.slot_id, self.site_code, exc_info=True)
@@ -1,66 +1,267 @@
 """Order fulfillment tasks."""
+import random
+import time
+
 from celery import shared_task
 from celery.exceptions import Ignore
 from celery.utils.log import get_task_logger
 from edx_rest_api_client import exceptions
 from edx_rest_api_client.client import EdxRestApiClient
+import requests
 
+from ecommerce_worker import deadline
+from ecommerce_worker.concurrency import Local
+from ecommerce_worker.delayed_retry import defer_task, retry_task
+from ecommerce_worker.fulfillment.v1.backoff import SiteBackoff, get_throttle_delay
+from ecommerce_worker.fulfillment.v1.limiter import ConcurrencyLimitReached, ConcurrencyLimiter, Slot
+from ecommerce_worker.local_store import get_local_store_path
+from ecommerce_worker.metrics import fulfill_order_outcomes, fulfillment_slot_wait_seconds
 from ecommerce_worker.utils import get_configuration
 
 logger = get_task_logger(__name__)  # pylint: disable=invalid-name
+# HTTP session of each thread's ecommerce API clients; clients set their credentials on it, so green
+# threads each need their own
+_sessions = Local()  # pylint: disable=invalid-name
+backoffs = {}  # pylint: disable=invalid-name
+limiters = {}  # pylint: disable=invalid-name
+
+# Seconds a slot of the concurrency limit is held at most by tasks without a time budget
+DEFAULT_SLOT_LEASE = 300
+
+
+def get_api_session():
+    """Get the calling thread's HTTP session, which keeps connections to the ecommerce API alive between tasks."""
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        session = _sessions.session = requests.Session()
+    return session
+
+
+def reset_api_sessions():
+    """Drop the HTTP sessions, so that this process does not use connections opened by another one."""
+    global _sessions  # pylint: disable=global-statement,invalid-name
+    _sessions = Local()
+
+
+def get_site_backoff():
+    """Get the per-site backoff for the configured local state directory"""
+    path = get_local_store_path('fulfillment_backoff.db')
+    backoff = backoffs.get(path)
+    if backoff is None:
+        backoff = backoffs[path] = SiteBackoff(path)
+    return backoff
+
+
+def get_concurrency_limiter():
+    """Get the per-site concurrency limiter for the configured local state directory"""
+    path = get_local_store_path('fulfillment_limits.db')
+    limiter = limiters.get(path)
+    if limiter is None:
+        limiter = limiters[path] = ConcurrencyLimiter(path)
+    return limiter
+
+
+def acquire_slot(site_code=None, max_wait=None):
+    """
+    Wait for a slot of the concurrency limit of a site, when FULFILLMENT_CONCURRENCY_LIMIT_ENABLED is set.
+
+    Arguments:
+        site_code (str): site of the order
+        max_wait (float): seconds to wait at most, None to wait until a slot frees up
+
+    Returns:
+        Slot: to hold during the fulfillment call, or None if no slot freed up in time
+    """
+    if not get_configuration('FULFILLMENT_CONCURRENCY_LIMIT_ENABLED', site_code=site_code):
+        return Slot()
+
+    lease = deadline.get_budget(fulfill_order.name, site_code) or DEFAULT_SLOT_LEASE
+    start = time.time()
+    slot = get_concurrency_limiter().acquire(site_code, max_wait, lease)
+    fulfillment_slot_wait_seconds.observe(time.time() - start)
+    return slot
 
 
-def _retry_order(self, exception, max_fulfillment_retries, order_number):
+def _retry_order(self, exception, max_fulfillment_retries, order_number, site_code=None):
     """
     Retry with exponential backoff until fulfillment
     succeeds or the retry limit is reached. If the retry limit is exceeded,
     the exception is re-raised.
+
+    When the ecommerce service throttles the worker (429 or 503), the retry waits for the
+    delay given by its Retry-After header instead, and the site is backed off meanwhile.
     """
     retries = self.request.retries
     if retries == max_fulfillment_retries:
-        logger.exception('Fulfillment of order [%s] failed. Giving up.', order_number)
+        fulfill_order_outcomes.inc(outcome='give_up')
+        logger.exception('Fulfillment of order [%s] failed. Giving up.', order_number, extra={'dedup': False})
     else:
+        fulfill_order_outcomes.inc(outcome='retry')
         logger.warning('Fulfillment of order [%s] failed. Retrying.', order_number)
 
-    countdown = 2 ** retries
-    raise self.retry(exc=exception, countdown=countdown, max_retries=max_fulfillment_retries)
+    countdown = get_retry_countdown(exception, retries, site_code)
+    retry_task(self, countdown, max_fulfillment_retries, exc=exception)
 
 
-@shared_task(bind=True, ignore_result=True)
-def fulfill_order(self, order_number, site_code=None):
-    """Fulfills an order.
+def get_retry_countdown(exception, retries, site_code=None):
+    """
+    Get the seconds to wait before retrying a failed fulfillment: 2 ** retries, or the delay
+    asked for by the ecommerce service when it throttles the worker, in which case the site is
+    backed off meanwhile.
+
+    Arguments:
+        exception (Exception): error of the failed fulfillment
+        retries (int): number of times the fulfillment was retried so far
+        site_code (str): site of the order
+
+    Returns:
+        float: seconds
+    """
+    throttled, retry_after = get_throttle_delay(getattr(exception, 'response', None))
+    if throttled:
+        countdown = min(retry_after if retry_after is not None else 2 ** retries,
+                        get_configuration('FULFILLMENT_MAX_RETRY_AFTER', site_code=site_code))
+        logger.warning('The ecommerce service of site [%s] asked to back off for %.0f seconds.', site_code, countdown)
+        get_site_backoff().extend(site_code, countdown)
+        return countdown
+    return 2 ** retries
+
+
+def _defer_order(self, order_number, site_code):
+    """
+    Hold an order back while its site is backed off, without counting a retry.
+
+    Returns:
+        bool: True if the order was deferred
+    """
+    wait = get_site_backoff().remaining(site_code)
+    # eager executions would run again at once
+    if not wait or self.request.is_eager:
+        return False
+
+    # spread the deferred orders so they do not all reach the service the moment the backoff ends
+    countdown = wait + random.uniform(0, get_configuration('FULFILLMENT_BACKOFF_JITTER', site_code=site_code))
+    fulfill_order_outcomes.inc(outcome='deferred')
+    logger.info('Deferring fulfillment of order [%s] by %.0f seconds while site [%s] is backed off.',
+                order_number, countdown, site_code)
+    defer_task(self, countdown)
+    return True
+
+
+def _acquire_slot(self, order_number, site_code, deferrals):
+    """
+    Wait for a slot of the concurrency limit of the order's site, or defer the order if none frees up in time.
+
+    Arguments:
+        deferrals (int): number of times the order was deferred for lack of a slot so far
+
+    Returns:
+        Slot: to hold during the fulfillment call, or None if the order was deferred
+
+    Raises:
+        ConcurrencyLimitReached: no slot freed up and the order was deferred MAX_FULFILLMENT_RETRIES times
+    """
+    # eager executions would run again at once
+    if self.request.is_eager:
+        return Slot()
+
+    max_wait = get_configuration('FULFILLMENT_CONCURRENCY_MAX_WAIT', site_code=site_code)
+    budget = deadline.remaining()
+    if budget is not None:
+        max_wait = max(min(max_wait, budget), 0)
+    slot = acquire_slot(site_code, max_wait)
+    if slot is not None:
+        return slot
+
+    if deferrals >= get_configuration('MAX_FULFILLMENT_RETRIES', site_code=site_code):
+        raise ConcurrencyLimitReached(
+            'Site [{}] had no free slot for order [{}] after {} deferrals.'.format(site_code, order_number, deferrals)
+        )
+    countdown = random.uniform(1, 2) * get_configuration('FULFILLMENT_CONCURRENCY_MAX_WAIT', site_code=site_code)
+    fulfill_order_outcomes.inc(outcome='deferred')
+    logger.info('Deferring fulfillment of order [%s] by %.0f seconds: site [%s] has reached its concurrency limit.',
+                order_number, countdown, site_code)
+    defer_task(self, countdown, kwargs={'deferrals': deferrals + 1})
+    return None
+
+
+def request_fulfillment(order_number, site_code=None):
+    """
+    Ask the ecommerce service of a site to fulfill an order.
 
     Arguments:
         order_number (str): Order number indicating which order to fulfill.
+        site_code (str): Site of the order.
 
     Returns:
-        None
+        bool: True if the order was fulfilled, False if it had already been.
+
+    Raises:
+        HttpClientError, HttpServerError, Timeout: the fulfillment failed and may be retried.
     """
     ecommerce_api_root = get_configuration('ECOMMERCE_API_ROOT', site_code=site_code)
-    max_fulfillment_retries = get_configuration('MAX_FULFILLMENT_RETRIES', site_code=site_code)
     signing_key = get_configuration('JWT_SECRET_KEY', site_code=site_code)
     issuer = get_configuration('JWT_ISSUER', site_code=site_code)
     service_username = get_configuration('ECOMMERCE_SERVICE_USERNAME', site_code=site_code)
 
-    api = EdxRestApiClient(ecommerce_api_root, signing_key=signing_key, issuer=issuer, username=service_username)
+    api = EdxRestApiClient(ecommerce_api_root, signing_key=signing_key, issuer=issuer, username=service_username,
+                           session=get_api_session())
     try:
         logger.info('Requesting fulfillment of order [%s].', order_number)
         api.orders(order_number).fulfill.put()
     except exceptions.HttpClientError as exc:
-        status_code = exc.response.status_code  # pylint: disable=no-member
-        if status_code == 406:
+        if exc.response.status_code == 406:  # pylint: disable=no-member
             # The order is not fulfillable. Therefore, it must be complete.
             logger.info('Order [%s] has already been fulfilled. Ignoring.', order_number)
-            raise Ignore()
-        else:
-            # Unknown client error. Let's retry to resolve it.
-            logger.warning(
-                'Fulfillment of order [%s] failed because of HttpClientError. Retrying',
-                order_number,
-                exc_info=True
-            )
-            _retry_order(self, exc, max_fulfillment_retries, order_number)
+            return False
+        raise
+    return True
+
+
+@shared_task(bind=True, ignore_result=True)
+def fulfill_order(self, order_number, site_code=None, deferrals=0):
+    """Fulfills an order.
+
+    Arguments:
+        order_number (str): Order number indicating which order to fulfill.
+        site_code (str): Site of the order.
+        deferrals (int): Number of times the order was deferred for lack of a slot of its site's concurrency limit.
+
+    Returns:
+        None
+    """
+    max_fulfillment_retries = get_configuration('MAX_FULFILLMENT_RETRIES', site_code=site_code)
+
+    if _defer_order(self, order_number, site_code):
+        return
+
+    try:
+        slot = _acquire_slot(self, order_number, site_code, deferrals)
+    except ConcurrencyLimitReached as exc:
+        _retry_order(self, exc, max_fulfillment_retries, order_number, site_code)
+        return
+    if slot is None:
+        return
+
+    try:
+        with slot:
+            fulfilled = request_fulfillment(order_number, site_code)
+    except exceptions.HttpClientError as exc:
+        # Unknown client error. Let's retry to resolve it.
+        logger.warning(
+            'Fulfillment of order [%s] failed because of HttpClientError. Retrying',
+            order_number,
+            exc_info=True
+        )
+        _retry_order(self, exc, max_fulfillment_retries, order_number, site_code)
 
     except (exceptions.HttpServerError, exceptions.Timeout) as exc:
         # Fulfillment failed, retry
-        _retry_order(self, exc, max_fulfillment_retries, order_number)
+        _retry_order(self, exc, max_fulfillment_retries, order_number, site_code)
+
+    else:
+        if fulfilled:
+            fulfill_order_outcomes.inc(outcome='success')
+        else:
+            fulfill_order_outcomes.inc(outcome='already_fulfilled')
+            raise Ignore()
@@ -0,0 +1,66 @@
+"""Tests of the throttling signals of the ecommerce service and the per-site backoff."""
+from unittest import TestCase
+
+import ddt
+import mock
+
+from ecommerce_worker.fulfillment.v1.backoff import SiteBackoff, get_throttle_delay, parse_retry_after
+from ecommerce_worker.tests.mixins import TemporaryDirectoryMixin
+
+
+@ddt.ddt
+class ThrottleSignalTests(TestCase):
+    """Tests covering the parsing of throttling signals."""
+
+    @ddt.data(
+        ('120', 120.0),
+        (' 5 ', 5.0),
+        ('Wed, 21 Oct 2015 07:28:30 GMT', 30.0),
+        ('Wed, 21 Oct 2015 07:27:00 GMT', 0.0),
+        ('soon', None),
+        ('-5', None),
+        (None, None),
+    )
+    @ddt.unpack
+    def test_parse_retry_after(self, value, expected):
+        # 2015-10-21 07:28:00 UTC
+        self.assertEqual(parse_retry_after(value, now=1445412480.0), expected)
+
+    @ddt.data(
+        (429, {'Retry-After': '30'}, (True, 30.0)),
+        (503, {'Retry-After': '7'}, (True, 7.0)),
+        (503, {}, (True, None)),
+        (500, {'Retry-After': '30'}, (False, None)),
+    )
+    @ddt.unpack
+    def test_get_throttle_delay(self, status_code, headers, expected):
+        response = mock.Mock(status_code=status_code, headers=headers)
+        self.assertEqual(get_throttle_delay(response), expected)
+
+    def test_no_response(self):
+        self.assertEqual(get_throttle_delay(None), (False, None))
+
+
+class SiteBackoffTests(TemporaryDirectoryMixin, TestCase):
+    """Tests covering SiteBackoff."""
+
+    def setUp(self):
+        super(SiteBackoffTests, self).setUp()
+        self.path = self.temporary_path('backoff.db')
+        self.backoff = SiteBackoff(self.path)
+
+    def test_backoff(self):
+        self.assertEqual(self.backoff.remaining('edx'), 0)
+        with mock.patch('ecommerce_worker.fulfillment.v1.backoff.time.time', return_value=1000.0):
+            self.backoff.extend('edx', 30)
+            # a shorter backoff does not end a longer one
+            self.backoff.extend('edx', 10)
+            self.assertEqual(self.backoff.remaining('edx'), 30)
+            self.assertEqual(self.backoff.remaining(None), 0)
+            # shared with the other processes of the host
+            self.assertEqual(SiteBackoff(self.path).remaining('edx'), 30)
+
+            self.backoff.extend('edx', 60)
+            self.assertEqual(self.backoff.remaining('edx'), 60)
+        with mock.patch('ecommerce_worker.fulfillment.v1.backoff.time.time', return_value=1100.0):
+            self.assertEqual(self.backoff.remaining('edx'), 0)
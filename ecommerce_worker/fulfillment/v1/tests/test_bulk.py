@@ -0,0 +1,171 @@
+"""Tests of bulk fulfillment."""
+from StringIO import StringIO
+from unittest import TestCase
+
+import ddt
+import httpretty
+import mock
+
+# Ensures that a Celery app is initialized when tests are run.
+from ecommerce_worker import celery_app  # pylint: disable=unused-import
+from ecommerce_worker.fulfillment.v1 import bulk, tasks
+from ecommerce_worker.fulfillment.v1.bulk import (
+    ALREADY_FULFILLED, FAILED, FULFILLED, SKIPPED, FulfillmentCheckpoint, fulfill, fulfill_orders, main,
+    parse_orders
+)
+from ecommerce_worker.streaming import Progress
+from ecommerce_worker.tests.mixins import TemporaryDirectoryMixin
+from ecommerce_worker.utils import get_configuration
+
+API_ROOT = get_configuration('ECOMMERCE_API_ROOT').strip('/')
+
+
+def register_order(order_number, *statuses):
+    """Make the fulfillment of an order answer the statuses in turn, the last one repeatedly."""
+    httpretty.register_uri(
+        httpretty.PUT, '{}/orders/{}/fulfill/'.format(API_ROOT, order_number),
+        responses=[httpretty.Response(body='{}', status=status) for status in statuses]
+    )
+
+
+@ddt.ddt
+class BulkFulfillmentTests(TemporaryDirectoryMixin, TestCase):
+    """Tests covering bulk fulfillment."""
+
+    def setUp(self):
+        super(BulkFulfillmentTests, self).setUp()
+        self.checkpoint = FulfillmentCheckpoint(self.temporary_path('checkpoint.db'))
+        self.backoff = mock.Mock(**{'remaining.return_value': 0})
+        for patcher in (mock.patch.object(bulk, 'get_site_backoff', return_value=self.backoff),
+                        mock.patch.object(tasks, 'get_site_backoff', return_value=self.backoff)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(bulk.time, 'sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_parse_orders(self):
+        lines = ['ORDER-1\n', '\n', '# comment\n', 'ORDER-2,edx\n', ' ORDER-3\tother \n', 'ORDER-4, edx\n']
+        self.assertEqual(list(parse_orders(lines, 'default')), [
+            ('ORDER-1', 'default'), ('ORDER-2', 'edx'), ('ORDER-3', 'other'), ('ORDER-4', 'edx'),
+        ])
+
+    def test_checkpoint(self):
+        self.checkpoint.record('ORDER-1', None, FULFILLED)
+        self.checkpoint.record('ORDER-2', 'edx', FAILED, 'HttpServerError: 500')
+        self.assertTrue(self.checkpoint.is_done('ORDER-1', None))
+        self.assertFalse(self.checkpoint.is_done('ORDER-1', 'edx'))
+        self.assertFalse(self.checkpoint.is_done('ORDER-2', 'edx'))
+        self.assertEqual([(order['order_number'], order['site_code']) for order in self.checkpoint.failed()],
+                         [('ORDER-2', 'edx')])
+
+        # a later run replaces the outcome
+        self.checkpoint.record('ORDER-2', 'edx', ALREADY_FULFILLED)
+        self.assertTrue(self.checkpoint.is_done('ORDER-2', 'edx'))
+        self.assertEqual(self.checkpoint.failed(), [])
+
+    @ddt.data(
+        ((200,), FULFILLED, None),
+        ((406,), ALREADY_FULFILLED, None),
+        ((500, 404, 200), FULFILLED, None),
+        ((500, 500, 500, 500), FAILED, 'HttpServerError: Server Error 500: '),
+    )
+    @ddt.unpack
+    @httpretty.activate
+    def test_fulfill(self, statuses, expected_outcome, expected_error):
+        """Verify that orders are retried the way fulfill_order retries them."""
+        register_order('ORDER-1', *statuses)
+        outcome, error = fulfill('ORDER-1', max_retries=3)
+        self.assertEqual(outcome, expected_outcome)
+        self.assertEqual(error and error[:len(expected_error)], expected_error)
+        self.assertEqual([call[0][0] for call in self.sleep.call_args_list], [1, 2, 4][:len(statuses) - 1])
+
+    @httpretty.activate
+    @mock.patch('ecommerce_worker.configuration.test.MAX_FULFILLMENT_RETRIES', 2)
+    def test_fulfill_default_retries(self):
+        """Verify that orders are retried up to MAX_FULFILLMENT_RETRIES by default, as fulfill_order is."""
+        register_order('ORDER-1', 500, 500, 500, 200)
+        self.assertEqual(fulfill('ORDER-1')[0], FAILED)
+        self.assertEqual([call[0][0] for call in self.sleep.call_args_list], [1, 2])
+
+    @httpretty.activate
+    def test_fulfill_throttled(self):
+        """Verify that the backoff asked for by a site is honored."""
+        httpretty.register_uri(
+            httpretty.PUT, '{}/orders/ORDER-1/fulfill/'.format(API_ROOT),
+            responses=[httpretty.Response(body='{}', status=429, adding_headers={'Retry-After': '30'}),
+                       httpretty.Response(body='{}', status=200)]
+        )
+        self.assertEqual(fulfill('ORDER-1', 'edx'), (FULFILLED, None))
+        self.backoff.extend.assert_called_once_with('edx', 30)
+
+        self.backoff.remaining.return_value = 12.0
+        self.assertEqual(fulfill('ORDER-1', 'edx'), (FULFILLED, None))
+        wait = self.sleep.call_args[0][0]
+        self.assertGreaterEqual(wait, 12)
+        self.assertLessEqual(wait, 12 + get_configuration('FULFILLMENT_BACKOFF_JITTER'))
+
+    @httpretty.activate
+    def test_fulfill_orders(self):
+        """Verify that orders are fulfilled and checkpointed, and that a later run only retries what is left."""
+        register_order('ORDER-1', 200)
+        register_order('ORDER-2', 406)
+        register_order('ORDER-3', 500)
+        orders = [('ORDER-1', None), ('ORDER-2', None), ('ORDER-3', 'edx')]
+
+        progress = Progress(0, out=StringIO())
+        fulfill_orders(iter(orders), self.checkpoint, progress, concurrency=2, max_retries=1)
+        self.assertEqual(progress.counts, {FULFILLED: 1, ALREADY_FULFILLED: 1, FAILED: 1})
+        self.assertEqual([order['order_number'] for order in self.checkpoint.failed()], ['ORDER-3'])
+
+        register_order('ORDER-3', 200)
+        progress = Progress(0, out=StringIO())
+        fulfill_orders(iter(orders), self.checkpoint, progress, concurrency=2, max_retries=1)
+        self.assertEqual(progress.counts, {SKIPPED: 2, FULFILLED: 1})
+        self.assertEqual(self.checkpoint.failed(), [])
+
+    def test_unexpected_error(self):
+        """Verify that an unexpected error fails the order without stopping the run."""
+        progress = Progress(0, out=StringIO())
+        with mock.patch.object(bulk, 'fulfill', side_effect=[RuntimeError('no configuration'), (FULFILLED, None)]):
+            fulfill_orders(iter([('ORDER-1', None), ('ORDER-2', None)]), self.checkpoint, progress, concurrency=1)
+        self.assertEqual(progress.counts, {FAILED: 1, FULFILLED: 1})
+        self.assertEqual(self.checkpoint.failed()[0]['error'], 'RuntimeError: no configuration')
+
+    def test_interrupted(self):
+        """Verify that an interrupted run finishes the orders in progress and leaves the rest to the next one."""
+        def orders():
+            """Orders read until interrupted."""
+            yield 'ORDER-1', None
+            raise KeyboardInterrupt
+
+        progress = Progress(0, out=StringIO())
+        with mock.patch.object(bulk, 'fulfill', return_value=(FULFILLED, None)):
+            with self.assertRaises(KeyboardInterrupt):
+                fulfill_orders(orders(), self.checkpoint, progress, concurrency=1)
+        self.assertLessEqual(progress.counts[FULFILLED], 1)
+        self.assertIn('Interrupted', progress.out.getvalue())
+
+    @httpretty.activate
+    def test_command(self):
+        register_order('ORDER-1', 200)
+        register_order('ORDER-2', 500)
+        path = self.temporary_path('orders.txt')
+        with open(path, 'w') as orders:
+            orders.write('ORDER-1\nORDER-2,edx\n')
+        checkpoint = self.temporary_path('command.db')
+
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            main([path, '--checkpoint', checkpoint, '--max-retries', '0'])
+        self.assertIn('2 orders processed', stdout.getvalue())
+        self.assertIn('1 fulfilled', stdout.getvalue())
+
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            main(['--checkpoint', checkpoint, '--list-failed'])
+        self.assertTrue(stdout.getvalue().startswith('ORDER-2\tedx\t'))
+
+        # without --max-retries, each order is retried up to MAX_FULFILLMENT_RETRIES of its site
+        with mock.patch.object(bulk, 'fulfill', return_value=(FULFILLED, None)) as fulfill_order:
+            with mock.patch('sys.stdout', new_callable=StringIO):
+                main([path, '--checkpoint', checkpoint])
+        fulfill_order.assert_called_once_with('ORDER-2', 'edx', None)
@@ -0,0 +1,201 @@
+"""Tests of the adaptive concurrency limit of the fulfillment calls."""
+import sqlite3
+from unittest import TestCase
+
+import ddt
+from edx_rest_api_client import exceptions
+import mock
+
+from ecommerce_worker.deadline import DeadlineExceeded
+from ecommerce_worker.fulfillment.v1 import limiter as limiter_module
+from ecommerce_worker.fulfillment.v1.limiter import AdaptiveLimit, ConcurrencyLimiter, Slot, is_overload
+from ecommerce_worker.tests.mixins import TemporaryDirectoryMixin
+
+SETTINGS = {'initial': 4, 'minimum': 1, 'maximum': 10, 'backoff_ratio': 0.5, 'latency_tolerance': 2.0}
+
+
+def http_error(error_class, status_code):
+    """An error of the ecommerce API client carrying a response."""
+    return error_class(response=mock.Mock(status_code=status_code))
+
+
+@ddt.ddt
+class AdaptiveLimitTests(TestCase):
+    """Tests covering the adjustment of the limit."""
+
+    @ddt.data(
+        (http_error(exceptions.HttpServerError, 500), True),
+        (exceptions.Timeout(), True),
+        (DeadlineExceeded(), False),
+        (http_error(exceptions.HttpClientError, 429), True),
+        (http_error(exceptions.HttpClientError, 503), True),
+        (http_error(exceptions.HttpClientError, 404), False),
+        (ValueError(), False),
+        (None, False),
+    )
+    @ddt.unpack
+    def test_is_overload(self, exc, expected):
+        self.assertEqual(is_overload(exc), expected)
+
+    def test_increases_while_in_use(self):
+        limit = AdaptiveLimit(SETTINGS, 4)
+        limit.update(0.1, False, in_flight=2)
+        self.assertEqual(limit.limit, 4.25)
+        # less than half of the limit is in use
+        limit.update(0.1, False, in_flight=2)
+        self.assertEqual(limit.limit, 4.25)
+        for __ in range(100):
+            limit.update(0.1, False, in_flight=10)
+        self.assertEqual(limit.limit, 10)
+
+    def test_decreases_on_overload(self):
+        limit = AdaptiveLimit(SETTINGS, 8)
+        limit.update(5.0, True, in_flight=8)
+        self.assertEqual(limit.limit, 4)
+        self.assertIsNone(limit.short_latency)
+        for __ in range(5):
+            limit.update(5.0, True, in_flight=8)
+        self.assertEqual(limit.limit, 1)
+
+    def test_decreases_on_latency(self):
+        limit = AdaptiveLimit(SETTINGS, 8, short_latency=0.1, long_latency=0.1)
+        limit.update(1.0, False, in_flight=8)
+        # the recent latency is 0.37, the long-term latency 0.118
+        self.assertAlmostEqual(limit.limit, 7.2)
+        self.assertAlmostEqual(limit.short_latency, 0.37)
+        self.assertAlmostEqual(limit.long_latency, 0.118)
+
+    def test_call_not_made(self):
+        limit = AdaptiveLimit(SETTINGS, 4, short_latency=0.1, long_latency=0.1)
+        limit.update(None, False, in_flight=4)
+        self.assertEqual((limit.limit, limit.short_latency), (4, 0.1))
+
+
+class ConcurrencyLimiterTests(TemporaryDirectoryMixin, TestCase):
+    """Tests covering ConcurrencyLimiter."""
+
+    def setUp(self):
+        super(ConcurrencyLimiterTests, self).setUp()
+        self.path = self.temporary_path('limits.db')
+        self.limiter = ConcurrencyLimiter(self.path)
+        patcher = mock.patch.object(limiter_module, 'get_limit_settings', return_value=dict(SETTINGS, initial=2.8))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_limits_calls_in_flight(self):
+        first = self.limiter.try_acquire('edx', lease=60)
+        self.assertIsNotNone(self.limiter.try_acquire('edx', lease=60))
+        self.assertIsNone(self.limiter.try_acquire('edx', lease=60))
+        # sites have limits of their own
+        self.assertIsNotNone(self.limiter.try_acquire('other', lease=60))
+        self.assertEqual(self.limiter.limit('edx'), (2, 2))
+
+        # both calls were in flight: the limit grows
+        self.limiter.release('edx', first, 0.1, False)
+        self.assertEqual(self.limiter.limit('edx'), (3, 1))
+
+    def lock_store(self):
+        """Take the write lock of the store from another connection, returning the connection."""
+        connection = sqlite3.connect(self.path, isolation_level=None)
+        self.addCleanup(connection.close)
+        connection.execute('BEGIN IMMEDIATE')
+        return connection
+
+    def test_polls_without_write_lock(self):
+        """Polls finding the limit reached only read the store, and a locked store does not block them."""
+        self.limiter.try_acquire('edx', lease=60)
+        self.limiter.try_acquire('edx', lease=60)
+        self.lock_store()
+        with mock.patch.object(limiter_module.time, 'sleep') as sleep:
+            begin_lock = self.limiter._begin  # pylint: disable=protected-access
+            with mock.patch.object(self.limiter, '_begin', wraps=begin_lock) as begin:
+                self.assertIsNone(self.limiter.try_acquire('edx', lease=60))
+                begin.assert_not_called()
+                # a slot looks free, but the write lock is held elsewhere
+                self.assertIsNone(self.limiter.try_acquire('other', lease=60))
+                self.assertEqual(begin.call_count, 1)
+        sleep.assert_not_called()
+        self.assertEqual(self.limiter.limit('edx'), (2, 2))
+
+    def test_release_waits_for_lock(self):
+        """Releasing a slot waits for the write lock with time.sleep, which yields to green threads."""
+        slot_id = self.limiter.try_acquire('edx', lease=60)
+        connection = self.lock_store()
+
+        def unlock(seconds):  # pylint: disable=unused-argument
+            """The other connection releases the lock while the limiter sleeps."""
+            connection.execute('ROLLBACK')
+
+        with mock.patch.object(limiter_module.time, 'sleep', side_effect=unlock):
+            self.limiter.release('edx', slot_id, 0.1, False)
+        self.assertEqual(self.limiter.limit('edx'), (2, 0))
+        self.assertEqual(self.limiter.timeout, limiter_module.LOCK_TIMEOUT)
+
+    def test_release_gives_up(self):
+        slot_id = self.limiter.try_acquire('edx', lease=60)
+        self.lock_store()
+        with mock.patch.object(limiter_module, 'LOCK_WAIT', 0.1):
+            with self.assertRaises(sqlite3.OperationalError):
+                self.limiter.release('edx', slot_id, 0.1, False)
+
+    def test_lease(self):
+        with mock.patch.object(limiter_module.time, 'time', return_value=1000.0):
+            self.limiter.try_acquire('edx', lease=30)
+            self.limiter.try_acquire('edx', lease=30)
+        with mock.patch.object(limiter_module.time, 'time', return_value=1030.0):
+            self.assertIsNotNone(self.limiter.try_acquire('edx', lease=30))
+
+    def test_acquire_waits(self):
+        slot_ids = [None, None, 7]
+        with mock.patch.object(self.limiter, 'try_acquire', side_effect=slot_ids) as try_acquire:
+            with mock.patch.object(limiter_module.time, 'sleep') as sleep:
+                slot = self.limiter.acquire('edx', lease=30)
+        self.assertEqual((slot.site_code, slot.slot_id), ('edx', 7))
+        self.assertEqual(try_acquire.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_acquire_timeout(self):
+        with mock.patch.object(limiter_module.time, 'time', side_effect=[1000.0, 1000.5, 1001.0]):
+            with mock.patch.object(self.limiter, 'try_acquire', return_value=None):
+                with mock.patch.object(limiter_module.time, 'sleep'):
+                    self.assertIsNone(self.limiter.acquire('edx', timeout=1))
+
+    def test_slot(self):
+        """Verify that slots are released with the latency and outcome of their call."""
+        patcher = mock.patch.object(self.limiter, 'release')
+        release = patcher.start()
+        self.addCleanup(patcher.stop)
+        with mock.patch.object(limiter_module.time, 'time', side_effect=[1000.0, 1000.25]):
+            with Slot(self.limiter, 'edx', 7):
+                pass
+        release.assert_called_once_with('edx', 7, 0.25, False)
+
+        with self.assertRaises(exceptions.Timeout):
+            with Slot(self.limiter, 'edx', 8):
+                raise exceptions.Timeout()
+        self.assertEqual(release.call_args[0][1:], (8, mock.ANY, True))
+
+        with self.assertRaises(DeadlineExceeded):
+            with Slot(self.limiter, 'edx', 9):
+                raise DeadlineExceeded()
+        self.assertEqual(release.call_args[0][1:], (9, None, False))
+
+        # calls which are not limited release nothing
+        with Slot():
+            pass
+        self.assertEqual(release.call_count, 3)
+
+    def test_slot_release_fails(self):
+        """Verify that a slot which cannot be released leaves the outcome of its call unchanged."""
+        patcher = mock.patch.object(self.limiter, 'release', side_effect=sqlite3.OperationalError('database is locked'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with mock.patch.object(limiter_module.logger, 'warning') as warning:
+            with Slot(self.limiter, 'edx', 7):
+                pass
+            self.assertEqual(warning.call_count, 1)
+
+            with self.assertRaises(exceptions.Timeout):
+                with Slot(self.limiter, 'edx', 8):
+                    raise exceptions.Timeout()
+            self.assertEqual(warning.call_count, 2)
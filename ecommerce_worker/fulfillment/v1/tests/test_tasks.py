@@ -11,7 +11,10 @@ import mock
 
 # Ensures that a Celery app is initialized when tests are run.
 from ecommerce_worker import celery_app  # pylint: disable=unused-import
+from ecommerce_worker import deadline
+from ecommerce_worker.fulfillment.v1.limiter import ConcurrencyLimitReached, Slot
 from ecommerce_worker.fulfillment.v1.tasks import fulfill_order
+from ecommerce_worker.metrics import registry
 from ecommerce_worker.utils import get_configuration
 
 
@@ -97,6 +100,23 @@ class OrderFulfillmentTaskTests(TestCase):
         with self.assertRaises(exceptions.Timeout):
             fulfill_order.delay(self.ORDER_NUMBER).get()
 
+    @httpretty.activate
+    def test_fulfillment_budget_exhausted(self):
+        """Verify that a task whose time budget ran out is retried on its usual schedule."""
+        httpretty.register_uri(httpretty.PUT, self.API_URL, status=200, body={})
+        deadline.install()
+        fulfill_order.push_request(id='task-id', args=(self.ORDER_NUMBER,), kwargs={}, retries=3,
+                                   called_directly=False, is_eager=False)
+        self.addCleanup(fulfill_order.pop_request)
+
+        with mock.patch('ecommerce_worker.deadline.expired', return_value=True):
+            with mock.patch('ecommerce_worker.fulfillment.v1.tasks.retry_task') as retry_task:
+                with mock.patch('ecommerce_worker.deadline.remaining', return_value=0):
+                    fulfill_order.run(self.ORDER_NUMBER)
+        self.assertEqual(retry_task.call_args[0][1], 2 ** 3)
+        self.assertIsInstance(retry_task.call_args[1]['exc'], exceptions.Timeout)
+        self.assertFalse(httpretty.has_request())
+
     @httpretty.activate
     def test_fulfillment_retry_success(self):
         """Verify that the task is capable of successfully retrying after fulfillment failure."""
@@ -108,6 +128,137 @@ class OrderFulfillmentTaskTests(TestCase):
         result = fulfill_order.delay(self.ORDER_NUMBER).get()
         self.assertIsNone(result)
 
+    @ddt.data(
+        ([200], {'success': 1}),
+        ([406], {'already_fulfilled': 1}),
+        ([500, 404, 200], {'retry': 2, 'success': 1}),
+    )
+    @ddt.unpack
+    @httpretty.activate
+    def test_fulfillment_outcome_metrics(self, statuses, expected_outcomes):
+        """Verify that the outcome of every fulfillment attempt is counted."""
+        httpretty.register_uri(httpretty.PUT, self.API_URL, responses=[
+            httpretty.Response(status=status, body={}) for status in statuses
+        ])
+
+        before = registry.collect()
+        try:
+            fulfill_order.delay(self.ORDER_NUMBER).get()
+        except Ignore:
+            pass
+        after = registry.collect()
+
+        outcomes = {}
+        for (name, labels), value in after.items():
+            if name == 'ecommerce_worker_fulfill_order_total' and value != before.get((name, labels), 0):
+                outcomes[labels[0]] = value - before.get((name, labels), 0)
+        self.assertEqual(outcomes, expected_outcomes)
+
+    @ddt.data(
+        (429, {'Retry-After': '30'}, 30),
+        (503, {'Retry-After': '7'}, 7),
+        (503, {}, 1),
+        (429, {'Retry-After': '86400'}, 600),
+    )
+    @ddt.unpack
+    @httpretty.activate
+    def test_fulfillment_throttled(self, status, headers, countdown):
+        """Verify that throttled orders are retried when the service asks, and that the site is backed off."""
+        httpretty.register_uri(httpretty.PUT, self.API_URL, status=status, body={}, adding_headers=headers)
+        backoff = mock.Mock()
+
+        with mock.patch('ecommerce_worker.fulfillment.v1.tasks.get_site_backoff', return_value=backoff):
+            with mock.patch('ecommerce_worker.fulfillment.v1.tasks.retry_task') as retry_task:
+                fulfill_order.delay(self.ORDER_NUMBER, site_code='test_site').get()
+        self.assertEqual(retry_task.call_args[0][1], countdown)
+        backoff.extend.assert_called_once_with('test_site', countdown)
+
+    def test_fulfillment_backed_off(self):
+        """Verify that orders of a backed off site are deferred without calling the service."""
+        fulfill_order.push_request(id='task-id', args=(self.ORDER_NUMBER,), kwargs={}, retries=3,
+                                   called_directly=False, is_eager=False)
+        self.addCleanup(fulfill_order.pop_request)
+        backoff = mock.Mock(**{'remaining.return_value': 20.0})
+
+        with mock.patch('ecommerce_worker.fulfillment.v1.tasks.get_site_backoff', return_value=backoff):
+            with mock.patch('ecommerce_worker.fulfillment.v1.tasks.defer_task') as defer_task:
+                with mock.patch('ecommerce_worker.fulfillment.v1.tasks.EdxRestApiClient') as client:
+                    fulfill_order.run(self.ORDER_NUMBER)
+        self.assertFalse(client.called)
+        countdown = defer_task.call_args[0][1]
+        self.assertGreaterEqual(countdown, 20)
+        self.assertLessEqual(countdown, 20 + get_configuration('FULFILLMENT_BACKOFF_JITTER'))
+
+        backoff.remaining.return_value = 0
+        with mock.patch('ecommerce_worker.fulfillment.v1.tasks.get_site_backoff', return_value=backoff):
+            with mock.patch('ecommerce_worker.fulfillment.v1.tasks.EdxRestApiClient') as client:
+                fulfill_order.run(self.ORDER_NUMBER)
+        self.assertTrue(client.called)
+
+    @httpretty.activate
+    @mock.patch('ecommerce_worker.configuration.test.FULFILLMENT_CONCURRENCY_LIMIT_ENABLED', True)
+    @mock.patch('ecommerce_worker.configuration.test.TASK_DEADLINE_SECONDS', {fulfill_order.name: 30})
+    def test_fulfillment_concurrency_limited(self):
+        """Verify that the fulfillment call holds a slot of its site's limit, released with the outcome of the call."""
+        httpretty.register_uri(httpretty.PUT, self.API_URL, status=503, body={})
+        fulfill_order.push_request(id='task-id', args=(self.ORDER_NUMBER,), kwargs={}, retries=0,
+                                   called_directly=False, is_eager=False)
+        self.addCleanup(fulfill_order.pop_request)
+        limiter = mock.Mock()
+        limiter.acquire.return_value = Slot(limiter, 'test_site', 7)
+
+        with mock.patch('ecommerce_worker.fulfillment.v1.tasks.get_concurrency_limiter', return_value=limiter):
+            with mock.patch('ecommerce_worker.fulfillment.v1.tasks.retry_task'):
+                fulfill_order.run(self.ORDER_NUMBER, site_code='test_site')
+        limiter.acquire.assert_called_once_with('test_site', get_configuration('FULFILLMENT_CONCURRENCY_MAX_WAIT'),
+                                                get_configuration('TASK_DEADLINE_SECONDS')[fulfill_order.name])
+        limiter.release.assert_called_once_with('test_site', 7, mock.ANY, True)
+
+    @mock.patch('ecommerce_worker.configuration.test.FULFILLMENT_CONCURRENCY_LIMIT_ENABLED', True)
+    def test_fulfillment_concurrency_limit_reached(self):
+        """Verify that orders finding no free slot in time are deferred without calling the service."""
+        fulfill_order.push_request(id='task-id', args=(self.ORDER_NUMBER,), kwargs={}, retries=3,
+                                   called_directly=False, is_eager=False)
+        self.addCleanup(fulfill_order.pop_request)
+        limiter = mock.Mock(**{'acquire.return_value': None})
+        deadline.start(fulfill_order.name, 2)
+        self.addCleanup(deadline.clear)
+
+        with mock.patch('ecommerce_worker.fulfillment.v1.tasks.get_concurrency_limiter', return_value=limiter):
+            with mock.patch('ecommerce_worker.fulfillment.v1.tasks.defer_task') as defer_task:
+                with mock.patch('ecommerce_worker.fulfillment.v1.tasks.EdxRestApiClient') as client:
+                    fulfill_order.run(self.ORDER_NUMBER)
+        self.assertFalse(client.called)
+        # the order waits no longer than its time budget
+        self.assertLessEqual(limiter.acquire.call_args[0][1], 2)
+        max_wait = get_configuration('FULFILLMENT_CONCURRENCY_MAX_WAIT')
+        self.assertGreaterEqual(defer_task.call_args[0][1], max_wait)
+        self.assertLessEqual(defer_task.call_args[0][1], 2 * max_wait)
+        self.assertEqual(defer_task.call_args[1], {'kwargs': {'deferrals': 1}})
+
+    @mock.patch('ecommerce_worker.configuration.test.FULFILLMENT_CONCURRENCY_LIMIT_ENABLED', True)
+    @mock.patch('ecommerce_worker.configuration.test.MAX_FULFILLMENT_RETRIES', 2)
+    def test_fulfillment_deferrals_bounded(self):
+        """Verify that deferrals for lack of a slot are counted, and count as retries beyond MAX_FULFILLMENT_RETRIES."""
+        limiter = mock.Mock(**{'acquire.return_value': None})
+        patchers = (mock.patch('ecommerce_worker.fulfillment.v1.tasks.get_concurrency_limiter', return_value=limiter),
+                    mock.patch('ecommerce_worker.fulfillment.v1.tasks.defer_task'),
+                    mock.patch('ecommerce_worker.fulfillment.v1.tasks.retry_task'))
+        defer_task, retry_task = [patcher.start() for patcher in patchers][1:]
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+
+        for deferrals in range(3):
+            fulfill_order.push_request(id='task-id', args=(self.ORDER_NUMBER,), kwargs={'deferrals': deferrals},
+                                       retries=1, called_directly=False, is_eager=False)
+            fulfill_order.run(self.ORDER_NUMBER, deferrals=deferrals)
+            fulfill_order.pop_request()
+
+        self.assertEqual([call[1]['kwargs'] for call in defer_task.call_args_list],
+                         [{'deferrals': 1}, {'deferrals': 2}])
+        retry_task.assert_called_once_with(mock.ANY, 2, 2, exc=mock.ANY)
+        self.assertIsInstance(retry_task.call_args[1]['exc'], ConcurrencyLimitReached)
+
     def _timeout_body(self, request, uri, headers):  # pylint: disable=unused-argument
         """Helper used to force httpretty to raise Timeout exceptions."""
         raise exceptions.Timeout
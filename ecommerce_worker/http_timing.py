@@ -0,0 +1,225 @@
+"""
+Timing of the outbound HTTP calls made by the ecommerce and Sailthru clients.
+
+Both EdxRestApiClient and SailthruClient send their requests through requests and urllib3.
+Once installed, the instrumentation wraps urllib3's connection handling so each request's
+time is split into phases:
+
+* dns: resolving the host name
+* connect: establishing the TCP connection
+* tls: the TLS handshake
+* server: sending the request and waiting for the response headers
+
+Phases that did not happen, such as dns, connect and tls on a reused connection, count as
+zero. Phase durations are recorded in the ecommerce_worker_http_phase_seconds histogram.
+Calls slower than HTTP_SLOW_CALL_SECONDS are logged and kept in a ring buffer of the
+HTTP_SLOW_CALL_BUFFER_SIZE most recent ones, along with the task, site and order number or
+email hash they were made for.
+"""
+from collections import deque
+import inspect
+import socket
+import time
+import urlparse
+
+from celery import current_task
+from celery.signals import worker_init
+from celery.utils.log import get_logger
+
+from ecommerce_worker.concurrency import Local
+from ecommerce_worker.metrics import registry
+from ecommerce_worker.utils import get_configuration, hash_email
+
+logger = get_logger(__name__)  # pylint: disable=invalid-name
+
+PHASES = ('dns', 'connect', 'tls', 'server')
+
+http_phase_seconds = registry.histogram(  # pylint: disable=invalid-name
+    'ecommerce_worker_http_phase_seconds',
+    'Duration of the phases of outbound HTTP calls (dns, connect, tls, server), by host.',
+    ('host', 'phase')
+)
+
+# the most recent slow calls of this process, newest last
+slow_calls = deque(maxlen=100)  # pylint: disable=invalid-name
+_settings = {'threshold': 1.0}  # pylint: disable=invalid-name
+_state = Local()  # pylint: disable=invalid-name
+
+
+def _current_timing():
+    """The phase timings of the call in progress on the calling thread, or None."""
+    return getattr(_state, 'timing', None)
+
+
+def _wrap_create_connection(original):
+    """Time name resolution and TCP connection separately."""
+    def create_connection(address, *args, **kwargs):
+        """Resolve the host, then connect to each of its addresses in turn."""
+        timing = _current_timing()
+        if timing is None:
+            return original(address, *args, **kwargs)
+
+        host, port = address
+        start = time.time()
+        try:
+            addresses = socket.getaddrinfo(host.strip('[]'), port, 0, socket.SOCK_STREAM)
+        finally:
+            resolved = time.time()
+            timing['dns'] += resolved - start
+
+        try:
+            error = None
+            for __, __, __, __, sockaddr in addresses:
+                try:
+                    # resolving an address is immediate, so this only connects
+                    return original((sockaddr[0], port), *args, **kwargs)
+                except socket.error as exc:
+                    error = exc
+            raise error or socket.error('getaddrinfo returns an empty list')
+        finally:
+            timing['connect'] += time.time() - resolved
+
+    create_connection.http_timing = True
+    return create_connection
+
+
+def _wrap_tls_connect(original):
+    """Time the TLS handshake of HTTPS connections."""
+    def connect(self):
+        """Connect, counting the time not spent on DNS and TCP as the TLS handshake."""
+        timing = _current_timing()
+        if timing is None:
+            return original(self)
+
+        before = timing['dns'] + timing['connect']
+        start = time.time()
+        try:
+            return original(self)
+        finally:
+            timing['tls'] += time.time() - start - (timing['dns'] + timing['connect'] - before)
+
+    connect.http_timing = True
+    return connect
+
+
+def _wrap_make_request(original):
+    """Time whole requests and record their phases."""
+    def _make_request(self, conn, method, url, *args, **kwargs):
+        """Make the request, then record its timing."""
+        timing = _state.timing = dict.fromkeys(PHASES, 0.0)
+        start = time.time()
+        status = None
+        try:
+            response = original(self, conn, method, url, *args, **kwargs)
+            status = response.status
+            return response
+        finally:
+            _state.timing = None
+            _record(self.host, method, url, status, time.time() - start, timing)
+
+    _make_request.http_timing = True
+    return _make_request
+
+
+def _urllib3_modules():
+    """The urllib3 packages in use: the standalone one and, in old requests releases, a vendored copy."""
+    modules = []
+    try:
+        import urllib3
+        modules.append(urllib3)
+    except ImportError:
+        pass
+    try:
+        from requests.packages import urllib3 as vendored
+        if vendored not in modules:
+            modules.append(vendored)
+    except ImportError:
+        pass
+    return modules
+
+
+def install(threshold=1.0, buffer_size=100):
+    """
+    Instrument urllib3. Calling it again only updates the settings.
+
+    Arguments:
+        threshold (float): seconds above which a call is kept as slow
+        buffer_size (int): number of slow calls kept
+    """
+    global slow_calls  # pylint: disable=global-statement,invalid-name
+    _settings['threshold'] = threshold
+    if slow_calls.maxlen != buffer_size:
+        slow_calls = deque(slow_calls, maxlen=buffer_size)
+
+    for urllib3 in _urllib3_modules():
+        connection_module = urllib3.util.connection
+        if not getattr(connection_module.create_connection, 'http_timing', False):
+            connection_module.create_connection = _wrap_create_connection(connection_module.create_connection)
+
+        https_class = urllib3.connectionpool.HTTPSConnectionPool.ConnectionCls
+        if https_class and not getattr(https_class.connect, 'http_timing', False):
+            https_class.connect = _wrap_tls_connect(https_class.__dict__.get('connect', https_class.connect))
+
+        pool_class = urllib3.connectionpool.HTTPConnectionPool
+        if not getattr(pool_class._make_request, 'http_timing', False):  # pylint: disable=protected-access
+            pool_class._make_request = _wrap_make_request(  # pylint: disable=protected-access
+                pool_class.__dict__['_make_request'])
+
+
+def _task_context():
+    """Describe the task making the current call: its id, name, site and order or user."""
+    task = current_task
+    if not task:
+        return {}
+
+    request = task.request
+    context = {'task_id': request.id, 'task': task.name}
+    try:
+        arguments = inspect.getcallargs(task.run, *(request.args or ()), **(request.kwargs or {}))
+    except TypeError:
+        return context
+
+    for name in ('site_code', 'order_number'):
+        if arguments.get(name) is not None:
+            context[name] = arguments[name]
+    if arguments.get('email'):
+        context['email_hash'] = hash_email(arguments['email'])
+    return context
+
+
+def _record(host, method, url, status, duration, timing):
+    """Record the phases of a call and keep it if it was slow."""
+    timing['server'] = max(duration - timing['dns'] - timing['connect'] - timing['tls'], 0.0)
+    for phase in PHASES:
+        http_phase_seconds.observe(timing[phase], host=host, phase=phase)
+
+    if duration < _settings['threshold']:
+        return
+
+    call = {
+        'time': time.time(),
+        'host': host,
+        'method': method,
+        # the query string may hold credentials or personal data
+        'path': urlparse.urlsplit(url).path,
+        'status': status,
+        'duration_ms': round(duration * 1000, 1),
+        'phases_ms': {phase: round(timing[phase] * 1000, 1) for phase in PHASES},
+    }
+    call.update(_task_context())
+    slow_calls.append(call)
+    logger.warning('Slow HTTP call: %s %s%s took %.0f ms (%s) for %s', method, host, call['path'],
+                   call['duration_ms'], ', '.join('{} {}'.format(phase, call['phases_ms'][phase]) for phase in PHASES),
+                   ', '.join('{} {}'.format(key, call[key]) for key in
+                             ('task', 'task_id', 'site_code', 'order_number', 'email_hash') if key in call))
+
+
+def get_slow_calls():
+    """The slow calls kept by this process, oldest first."""
+    return list(slow_calls)
+
+
+@worker_init.connect
+def install_http_timing(**kwargs):  # pylint: disable=unused-argument
+    """Instrument outbound HTTP calls when the worker starts."""
+    install(get_configuration('HTTP_SLOW_CALL_SECONDS'), get_configuration('HTTP_SLOW_CALL_BUFFER_SIZE'))
@@ -0,0 +1,98 @@
+"""
+Host-local SQLite storage shared by the worker processes running on a machine.
+"""
+import errno
+import os
+import sqlite3
+
+from celery import current_app
+from kombu.serialization import dumps, loads, prepare_accept_content
+
+from ecommerce_worker.concurrency import OSThreadLocal
+from ecommerce_worker.utils import get_configuration
+
+
+def get_local_store_path(filename):
+    """
+    Get the path of a store kept in the worker's local state directory.
+
+    Arguments:
+        filename (str): Name of the store's file.
+
+    Returns:
+        str: Absolute path of the file inside LOCAL_STATE_DIR.
+    """
+    return os.path.join(get_configuration('LOCAL_STATE_DIR'), filename)
+
+
+def dump_payload(data, serializer):
+    """
+    Serialize data for storage the way Celery serializes task messages.
+
+    Arguments:
+        data (object): Data to serialize, such as a task signature.
+        serializer (str): Name of the serializer, usually the task's.
+
+    Returns:
+        tuple: Content type, content encoding and body, ready to be stored.
+    """
+    content_type, content_encoding, body = dumps(data, serializer=serializer)
+    return content_type, content_encoding, buffer(body)
+
+
+def load_payload(content_type, content_encoding, body):
+    """
+    Deserialize data stored by dump_payload, accepting the content the worker accepts from the broker.
+
+    Returns:
+        object: The stored data.
+    """
+    accept = prepare_accept_content(current_app.conf.CELERY_ACCEPT_CONTENT)
+    return loads(str(body), content_type, content_encoding, accept=accept)
+
+
+class LocalStore(object):
+    """
+    Base class for small SQLite-backed stores kept on local disk.
+
+    Connections are opened lazily, one per process and OS thread, so a store created in the
+    worker's main process remains usable in prefork children. Green threads share the
+    connection of their OS thread: its statements never yield to another green thread. Subclasses list the DDL
+    statements they need in SCHEMA; these are run whenever a connection is opened.
+    """
+    SCHEMA = ()
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = OSThreadLocal()
+
+    @property
+    def connection(self):
+        """The sqlite3 connection owned by the calling process and thread."""
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            self._local.pid = pid
+            self._local.connection = self._connect()
+        return self._local.connection
+
+    def _connect(self):
+        """Open a connection in autocommit mode and make sure the schema exists."""
+        directory = os.path.dirname(self.path)
+        if directory:
+            try:
+                os.makedirs(directory)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        # WAL lets readers in one process proceed while another process writes.
+        connection.execute('PRAGMA journal_mode=WAL')
+        for statement in self.SCHEMA:
+            connection.execute(statement)
+        return connection
+
+    def execute(self, sql, parameters=()):
+        """Run a single statement and return its cursor."""
+        return self.connection.execute(sql, parameters)
@@ -0,0 +1,419 @@
+"""
+In-process metrics, exposed in the Prometheus text format on a local HTTP port.
+
+Recording a sample takes no lock: every OS thread writes to its own shard of the registry,
+and shards are only summed when the metrics are read. Green threads share the shard of the
+OS thread running them, which is safe since they cannot preempt each other.
+
+With the prefork pool, each child process periodically writes a snapshot of its registry to
+a directory owned by the worker's main process, which serves the sum of its own registry and
+every child's snapshot. Snapshots of children that have exited are folded into a single
+retired snapshot, so counters keep growing when children are replaced.
+
+Set METRICS_PORT to enable the endpoint:
+
+    $ curl http://127.0.0.1:9540/metrics
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import errno
+import json
+import os
+import threading
+import time
+
+from celery.signals import task_postrun, worker_init, worker_process_init, worker_process_shutdown
+from celery.utils.log import get_logger
+
+from ecommerce_worker.concurrency import Lock, os_thread_ident
+from ecommerce_worker.utils import get_configuration
+
+logger = get_logger(__name__)  # pylint: disable=invalid-name
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RETIRED_SNAPSHOT = 'retired.json'
+
+
+class Registry(object):
+    """
+    Collection of metrics whose samples are kept in per-thread shards.
+
+    A shard maps (metric name, label values) to a sample: a number for counters, and a list
+    of bucket counts followed by the sum and count of observations for histograms.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self._shards = {}
+        self._shards_lock = Lock()
+        self._get_ident = None
+
+    def counter(self, name, documentation, labels=()):
+        """Register a counter."""
+        return self._register(Counter(self, name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        """Register a histogram."""
+        return self._register(Histogram(self, name, documentation, labels, buckets))
+
+    def _register(self, metric):
+        """Add a metric to the registry."""
+        self.metrics.append(metric)
+        return metric
+
+    def shard(self):
+        """The shard of the calling thread."""
+        if self._get_ident is None:
+            # resolved on first use, once green thread libraries have patched the process
+            self._get_ident = os_thread_ident()
+        ident = self._get_ident()
+        shard = self._shards.get(ident)
+        if shard is None:
+            with self._shards_lock:
+                shard = self._shards.setdefault(ident, {})
+        return shard
+
+    def reset(self):
+        """Drop every sample, e.g. in a process inheriting its parent's registry."""
+        with self._shards_lock:
+            self._shards = {}
+
+    def collect(self):
+        """
+        Sum the shards of every thread.
+
+        Returns:
+            dict: maps (metric name, label values) to the summed sample
+        """
+        with self._shards_lock:
+            shards = list(self._shards.values())
+        samples = {}
+        for shard in shards:
+            # a shard may gain keys while being copied by another thread
+            for key, value in list(shard.items()):
+                merge_sample(samples, key, value)
+        return samples
+
+
+def merge_sample(samples, key, value):
+    """Add a sample into samples."""
+    current = samples.get(key)
+    if current is None:
+        samples[key] = list(value) if isinstance(value, list) else value
+    elif isinstance(current, list):
+        for index, item in enumerate(value):
+            current[index] += item
+    else:
+        samples[key] = current + value
+
+
+class Metric(object):
+    """Base class of the metric types."""
+    type_name = None
+
+    def __init__(self, metric_registry, name, documentation, labels):
+        self.registry = metric_registry
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+    def _key(self, label_values):
+        """The shard key of a sample with the given label values."""
+        return (self.name, tuple(str(label_values[label]) for label in self.labels))
+
+    def expose(self, samples):
+        """Lines of the text exposition format for this metric's samples."""
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.type_name),
+        ]
+        for (name, label_values), value in sorted(samples.items()):
+            if name == self.name:
+                lines.extend(self._expose_sample(zip(self.labels, label_values), value))
+        return lines
+
+    def _expose_sample(self, labels, value):
+        """Lines of one sample."""
+        raise NotImplementedError
+
+
+def _format_labels(labels):
+    """Format label pairs as {name="value",...}."""
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value.replace('"', '\\"')) for name, value in labels) + '}'
+
+
+def _format_value(value):
+    """Format a sample value."""
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(Metric):
+    """A monotonically increasing count."""
+    type_name = 'counter'
+
+    def inc(self, amount=1, **label_values):
+        """Increment the count of the given labels."""
+        shard = self.registry.shard()
+        key = self._key(label_values)
+        shard[key] = shard.get(key, 0) + amount
+
+    def _expose_sample(self, labels, value):
+        return ['{}{} {}'.format(self.name, _format_labels(labels), _format_value(value))]
+
+
+class Histogram(Metric):
+    """Observations counted in cumulative buckets."""
+    type_name = 'histogram'
+
+    def __init__(self, metric_registry, name, documentation, labels, buckets):
+        super(Histogram, self).__init__(metric_registry, name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **label_values):
+        """Record an observation for the given labels."""
+        shard = self.registry.shard()
+        key = self._key(label_values)
+        sample = shard.get(key)
+        if sample is None:
+            # bucket counts, sum, count
+            sample = shard[key] = [0] * len(self.buckets) + [0.0, 0]
+
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                sample[index] += 1
+                break
+        sample[-2] += value
+        sample[-1] += 1
+
+    def time(self, **label_values):
+        """Context manager observing the duration of its block."""
+        return _Timer(self, label_values)
+
+    def _expose_sample(self, labels, value):
+        labels = list(labels)
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, value):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                self.name, _format_labels(labels + [('le', _format_value(bound))]), cumulative))
+        lines.append('{}_bucket{} {}'.format(self.name, _format_labels(labels + [('le', '+Inf')]), value[-1]))
+        lines.append('{}_sum{} {}'.format(self.name, _format_labels(labels), _format_value(value[-2])))
+        lines.append('{}_count{} {}'.format(self.name, _format_labels(labels), value[-1]))
+        return lines
+
+
+class _Timer(object):
+    """Observes the duration of a block; labels can be changed inside it."""
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.labels = label_values
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+
+
+registry = Registry()  # pylint: disable=invalid-name
+
+fulfill_order_outcomes = registry.counter(  # pylint: disable=invalid-name
+    'ecommerce_worker_fulfill_order_total',
+    'Attempts to fulfill an order, by outcome (success, already_fulfilled, retry, give_up, deferred).',
+    ('outcome',)
+)
+fulfillment_slot_wait_seconds = registry.histogram(  # pylint: disable=invalid-name
+    'ecommerce_worker_fulfillment_slot_wait_seconds',
+    'Time orders waited for a slot of the concurrency limit of their site, including orders deferred.'
+)
+sailthru_request_seconds = registry.histogram(  # pylint: disable=invalid-name
+    'ecommerce_worker_sailthru_request_seconds',
+    'Duration of Sailthru API calls, by endpoint and Sailthru error code (none for successful calls).',
+    ('endpoint', 'error')
+)
+cache_events = registry.counter(  # pylint: disable=invalid-name
+    'ecommerce_worker_cache_events_total',
+    'Lookups and evictions of the in-process cache, by event (hit, miss, eviction).',
+    ('event',)
+)
+
+
+def _read_snapshot(path):
+    """Read the samples of a snapshot file, or None if it is gone or incomplete."""
+    try:
+        with open(path) as snapshot_file:
+            return {(name, tuple(label_values)): value for name, label_values, value in json.load(snapshot_file)}
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write_snapshot(path, samples):
+    """Atomically write samples to a snapshot file."""
+    with open(path + '.tmp', 'w') as snapshot_file:
+        json.dump([[name, list(label_values), value] for (name, label_values), value in samples.items()],
+                  snapshot_file)
+    os.rename(path + '.tmp', path)
+
+
+def _process_exists(pid):
+    """Return True if a process is running with the given pid."""
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno == errno.EPERM
+    return True
+
+
+class SnapshotDirectory(object):
+    """
+    Directory through which prefork children hand their metrics to the main process.
+
+    Arguments:
+        path (str): directory owned by one worker main process
+        interval (float): minimum seconds between two snapshots of a child
+    """
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.main_pid = os.getpid()
+        self._last_write = 0
+
+    def prepare(self):
+        """Create the directory, dropping snapshots left over by a previous worker with the same pid."""
+        try:
+            os.makedirs(self.path)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        for name in os.listdir(self.path):
+            os.remove(os.path.join(self.path, name))
+
+    def write(self, force=False):
+        """Write the snapshot of the calling child process if the interval has elapsed."""
+        now = time.time()
+        if os.getpid() == self.main_pid or not (force or now - self._last_write >= self.interval):
+            return
+        self._last_write = now
+        try:
+            _write_snapshot(os.path.join(self.path, '{}.json'.format(os.getpid())), registry.collect())
+        except (IOError, OSError):
+            logger.exception('Failed to write the metrics snapshot of process [%d].', os.getpid())
+
+    def collect(self):
+        """Sum the samples of the calling process and of every child snapshot."""
+        samples = registry.collect()
+        retired_path = os.path.join(self.path, RETIRED_SNAPSHOT)
+        retired = _read_snapshot(retired_path) or {}
+        retired_changed = False
+
+        for name in os.listdir(self.path):
+            pid, extension = os.path.splitext(name)
+            if extension != '.json' or not pid.isdigit():
+                continue
+            path = os.path.join(self.path, name)
+            snapshot = _read_snapshot(path)
+            if snapshot is None:
+                continue
+            if _process_exists(int(pid)):
+                target = samples
+            else:
+                # the child's final snapshot; keep its counts after it is gone
+                target = retired
+                retired_changed = True
+                os.remove(path)
+            for key, value in snapshot.items():
+                merge_sample(target, key, value)
+
+        if retired_changed:
+            _write_snapshot(retired_path, retired)
+        for key, value in retired.items():
+            merge_sample(samples, key, value)
+        return samples
+
+
+# snapshot directory of the running worker; None when metrics are not exposed
+snapshots = None  # pylint: disable=invalid-name
+
+
+def exposition(samples):
+    """Render samples in the Prometheus text exposition format."""
+    lines = []
+    for metric in registry.metrics:
+        lines.extend(metric.expose(samples))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the worker's metrics at /metrics."""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Serve the metrics."""
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = exposition(snapshots.collect() if snapshots else registry.collect())
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Scrapes are not worth a log line."""
+        pass
+
+
+def start_metrics_server(host, port):
+    """Serve the metrics on a daemon thread.
+
+    Returns:
+        HTTPServer
+    """
+    server = HTTPServer((host, port), MetricsHandler)
+    server_thread = threading.Thread(target=server.serve_forever, name='MetricsServer')
+    server_thread.daemon = True
+    server_thread.start()
+    return server
+
+
+@worker_init.connect
+def start_metrics(**kwargs):  # pylint: disable=unused-argument
+    """Serve the metrics from the worker's main process if METRICS_PORT is set."""
+    global snapshots  # pylint: disable=global-statement,invalid-name
+    port = get_configuration('METRICS_PORT')
+    if not port:
+        return
+
+    snapshots = SnapshotDirectory(
+        os.path.join(get_configuration('LOCAL_STATE_DIR'), 'metrics', str(os.getpid())),
+        get_configuration('METRICS_SNAPSHOT_INTERVAL')
+    )
+    snapshots.prepare()
+    start_metrics_server(get_configuration('METRICS_HOST'), port)
+    logger.info('Serving metrics on port [%d].', port)
+
+
+@worker_process_init.connect
+def reset_child_metrics(**kwargs):  # pylint: disable=unused-argument
+    """Start a prefork child without the samples it inherited from the main process."""
+    registry.reset()
+
+
+@task_postrun.connect
+def write_metrics_snapshot(**kwargs):  # pylint: disable=unused-argument
+    """Hand the metrics of a prefork child to the main process from time to time."""
+    if snapshots:
+        snapshots.write()
+
+
+@worker_process_shutdown.connect
+def write_final_metrics_snapshot(**kwargs):  # pylint: disable=unused-argument
+    """Hand the last metrics of a prefork child to the main process."""
+    if snapshots:
+        snapshots.write(force=True)
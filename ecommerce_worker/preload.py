@@ -0,0 +1,85 @@
+"""
+Preloading of the worker's main process before the prefork children are forked.
+
+A prefork child, including each child started after a recycle, otherwise pays on its first
+task for the work done lazily on first use: the modules imported by requests when it
+prepares its first request, the signing of the first JWT and the per-site settings and
+dispatch tables. When PRELOAD_ENABLED is set, the main process does this work once the
+worker is set up, so children inherit it from their parent. Preloading is opt-in.
+
+With the prefork pool, the garbage left by the preload is then collected once, before the
+children fork. Where gc.freeze is available (Python 3.7+), the objects surviving it are also
+frozen out of the garbage collector, so that collections in the children do not write to the
+pages holding them and these pages stay shared copy-on-write. Other Pythons keep the default
+thresholds of the garbage collector: the children still collect their cyclic garbage as often.
+
+Children re-create what must not be shared with their parent, such as the HTTP sessions
+holding sockets, when worker_process_init is sent.
+"""
+import gc
+
+from celery.concurrency.prefork import TaskPool as PreforkPool
+from celery.signals import celeryd_after_setup, worker_process_init
+from celery.utils.log import get_logger
+from edx_rest_api_client.client import EdxRestApiClient
+import requests
+
+from ecommerce_worker.fulfillment.v1 import tasks as fulfillment_tasks
+from ecommerce_worker.routing import get_site_codes
+from ecommerce_worker.sailthru.v1 import tasks as sailthru_tasks
+from ecommerce_worker.utils import get_configuration
+
+logger = get_logger(__name__)  # pylint: disable=invalid-name
+
+
+def warm_up(site_code):
+    """
+    Do the first-use work of the tasks of a site, without calling any service.
+
+    Arguments:
+        site_code (str): site code
+    """
+    sailthru_tasks.get_site_dispatch(site_code)
+
+    # signs a JWT and prepares a request the way fulfill_order does, importing what requests imports lazily
+    api = EdxRestApiClient(
+        get_configuration('ECOMMERCE_API_ROOT', site_code=site_code),
+        signing_key=get_configuration('JWT_SECRET_KEY', site_code=site_code),
+        issuer=get_configuration('JWT_ISSUER', site_code=site_code),
+        username=get_configuration('ECOMMERCE_SERVICE_USERNAME', site_code=site_code),
+        session=requests.Session(),
+    )
+    session = api._store['session']  # pylint: disable=protected-access
+    session.prepare_request(requests.Request('PUT', api.orders('PRELOAD').fulfill.url()))
+
+
+def freeze_objects():
+    """Collect the garbage, then keep the garbage collector from writing to the pages of the objects alive now."""
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()  # pylint: disable=no-member
+
+
+@celeryd_after_setup.connect
+def preload(instance, **kwargs):  # pylint: disable=unused-argument
+    """Preload the worker's main process once it is set up, before the pool starts."""
+    if not get_configuration('PRELOAD_ENABLED'):
+        return
+
+    # None stands for the default settings
+    site_codes = [None] + get_site_codes()
+    for site_code in site_codes:
+        try:
+            warm_up(site_code)
+        except Exception:  # pylint: disable=broad-except
+            logger.warning('Failed to preload the tasks of site [%s].', site_code, exc_info=True)
+
+    if isinstance(instance.pool_cls, type) and issubclass(instance.pool_cls, PreforkPool):
+        freeze_objects()
+    logger.info('Preloaded the worker for %d sites.', len(site_codes))
+
+
+@worker_process_init.connect
+def reset_sockets(**kwargs):  # pylint: disable=unused-argument
+    """Give a prefork child HTTP sessions of its own."""
+    fulfillment_tasks.reset_api_sessions()
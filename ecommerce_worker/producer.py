@@ -0,0 +1,275 @@
+"""
+Publishing many task calls at once, for producers such as the ecommerce service.
+
+Calling apply_async once per task acquires a broker connection for every message, and opens
+a new one every time when BROKER_POOL_LIMIT is 0. publish_many publishes an iterable of task
+calls, such as fulfill_order.s(order_number) signatures, over a single connection and channel:
+
+    report = publish_many(fulfill_order.s(number) for number in order_numbers)
+    for failure in report.failures:
+        ...
+
+Calls are published the way apply_async publishes them, with the routing, serializer and
+options of their task. Calls of tasks not registered in the producer are published by name,
+as send_task does.
+
+Calls are published in chunks of chunk_size. On brokers supporting publisher confirms, such as
+RabbitMQ, the channel is put in confirm mode and each chunk waits for the broker to confirm
+each of its messages; a message the broker rejects, or does not confirm within confirm_timeout
+seconds, is reported as failed. Other brokers, such as the virtual transports, do not confirm
+messages: a message is published once the transport accepted it.
+
+A call which cannot be published, for instance because its arguments cannot be serialized,
+is reported as failed without stopping the others. When the connection is lost, the messages
+awaiting confirmation are reported as failed and publishing goes on over a new connection.
+"""
+from collections import namedtuple
+import socket
+import time
+
+from celery import current_app
+from celery.canvas import signature
+from celery.utils.log import get_logger
+
+logger = get_logger(__name__)  # pylint: disable=invalid-name
+
+# a call which could not be published: its position in the calls, the call and the error
+PublishFailure = namedtuple('PublishFailure', 'index call error')
+
+
+class NotConfirmed(Exception):
+    """The broker rejected a message, or did not confirm it in time."""
+
+
+class PublishReport(object):
+    """
+    Outcome of publish_many.
+
+    Attributes:
+        published (int): number of messages published, and confirmed if the broker confirms messages
+        failures (list): PublishFailure of each call which was not published
+    """
+
+    def __init__(self):
+        self.published = 0
+        self.failures = []
+
+    def __repr__(self):
+        return '<PublishReport published={} failed={}>'.format(self.published, len(self.failures))
+
+
+class ConfirmTracker(object):
+    """
+    Tracks the publisher confirms of a channel in confirm mode.
+
+    The broker numbers the messages published on the channel from 1, and acknowledges or
+    rejects them, one at a time or all up to a number.
+
+    Arguments:
+        channel: py-amqp channel supporting confirm_select
+    """
+
+    def __init__(self, channel):
+        self.delivery_tag = 0
+        # delivery tag: (index, call) of the messages not confirmed yet
+        self.pending = {}
+        self.acknowledged = 0
+        # (index, call) of the messages the broker rejected
+        self.rejected = []
+        channel.confirm_select()
+        channel.events['basic_ack'].add(self.on_ack)
+        channel.events['basic_nack'].add(self.on_nack)
+
+    def published(self, index, call):
+        """Count a message published on the channel."""
+        self.delivery_tag += 1
+        self.pending[self.delivery_tag] = (index, call)
+
+    def _settle(self, delivery_tag, multiple):
+        """Forget the messages settled by an acknowledgement or rejection, and return them."""
+        tags = [tag for tag in self.pending if tag <= delivery_tag] if multiple else [delivery_tag]
+        return [self.pending.pop(tag) for tag in tags if tag in self.pending]
+
+    def on_ack(self, delivery_tag, multiple):
+        """Handle a Basic.Ack of the broker."""
+        self.acknowledged += len(self._settle(delivery_tag, multiple))
+        return True
+
+    def on_nack(self, delivery_tag, multiple, requeue):  # pylint: disable=unused-argument
+        """Handle a Basic.Nack of the broker."""
+        self.rejected.extend(self._settle(delivery_tag, multiple))
+        return True
+
+    def take(self):
+        """
+        Collect the outcome of the messages published so far, and forget them.
+
+        Returns:
+            tuple: (number of messages acknowledged, (index, call) of those rejected,
+                (index, call) of those not confirmed yet, in publishing order)
+        """
+        pending = [self.pending[tag] for tag in sorted(self.pending)]
+        outcome = (self.acknowledged, self.rejected, pending)
+        self.acknowledged, self.rejected = 0, []
+        self.pending.clear()
+        return outcome
+
+
+def supports_confirms(channel):
+    """Return True if the channel can be put in confirm mode."""
+    return hasattr(channel, 'confirm_select') and hasattr(channel, 'events')
+
+
+class BulkPublisher(object):
+    """
+    Publishes task calls over a single connection and channel.
+
+    Arguments:
+        app (Celery): app whose broker and routes are used
+        confirm (boolean): wait for publisher confirms where the broker supports them
+        confirm_timeout (float): seconds to wait for the confirms of a chunk
+    """
+
+    def __init__(self, app, confirm=True, confirm_timeout=30.0):
+        self.app = app
+        self.confirm = confirm
+        self.confirm_timeout = confirm_timeout
+        self.connection = None
+        self.producer = None
+        self.confirms = None
+        # errors meaning the connection or its channel cannot be used anymore
+        connection = app.connection()
+        self.connection_errors = connection.connection_errors + connection.channel_errors + (socket.error,)
+
+    def open(self):
+        """Connect, and open the channel and producer publishing the calls."""
+        self.connection = self.app.connection()
+        channel = self.connection.default_channel
+        self.producer = self.app.amqp.TaskProducer(channel)
+        self.confirms = ConfirmTracker(channel) if self.confirm and supports_confirms(channel) else None
+
+    def close(self):
+        """Close the connection."""
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except self.connection_errors:
+                # the connection is lost already
+                pass
+            self.connection = self.producer = self.confirms = None
+
+    def publish(self, call):
+        """
+        Publish a task call, the way apply_async publishes it.
+
+        Arguments:
+            call (Signature): task call
+        """
+        options = dict(call.options, producer=self.producer, retry=False)
+        task = self.app.tasks.get(call.task)
+        if task is not None:
+            task.apply_async(call.args, call.kwargs, **options)
+        else:
+            self.app.send_task(call.task, call.args, call.kwargs, **options)
+
+    def publish_chunk(self, chunk, report):
+        """
+        Publish a chunk of task calls, and wait for their confirms.
+
+        Arguments:
+            chunk (list): (index, Signature) tuples
+            report (PublishReport): where the outcome of each call is counted
+        """
+        for index, call in chunk:
+            try:
+                if self.connection is None:
+                    self.open()
+                self.publish(call)
+            except self.connection_errors as exc:
+                logger.warning('Lost the broker connection while publishing [%s]: %s', call.task, exc)
+                report.failures.append(PublishFailure(index, call, exc))
+                self.abandon(report, exc)
+                continue
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.warning('Failed to publish [%s]: %s', call.task, exc)
+                report.failures.append(PublishFailure(index, call, exc))
+                continue
+
+            if self.confirms is None:
+                report.published += 1
+            else:
+                self.confirms.published(index, call)
+
+        if self.confirms is not None and self.confirms.pending:
+            self.wait_for_confirms(report)
+
+    def wait_for_confirms(self, report):
+        """Wait until the broker confirmed or rejected every message published."""
+        deadline = time.time() + self.confirm_timeout
+        try:
+            while self.confirms.pending:
+                left = deadline - time.time()
+                if left <= 0:
+                    raise socket.timeout()
+                self.connection.drain_events(timeout=left)
+        except socket.timeout:
+            self.collect(report, NotConfirmed('not confirmed within {} seconds'.format(self.confirm_timeout)))
+        except self.connection_errors as exc:
+            self.abandon(report, exc)
+        else:
+            self.collect(report)
+
+    def collect(self, report, error=None):
+        """Count the messages confirmed, and report those rejected or not confirmed as failed."""
+        acknowledged, rejected, pending = self.confirms.take()
+        report.published += acknowledged
+        for index, call in rejected:
+            report.failures.append(PublishFailure(index, call, NotConfirmed('rejected by the broker')))
+        for index, call in pending:
+            report.failures.append(PublishFailure(index, call, error))
+
+    def abandon(self, report, error):
+        """Give up the lost connection, failing the messages it did not confirm."""
+        if self.confirms is not None:
+            self.collect(report, error)
+        self.close()
+
+
+def _chunks(iterable, size):
+    """Split an iterable in lists of size (index, item) tuples, the last one possibly shorter."""
+    chunk = []
+    for item in enumerate(iterable):
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def publish_many(calls, app=None, chunk_size=100, confirm=True, confirm_timeout=30.0):
+    """
+    Publish task calls over a single broker connection and channel.
+
+    Arguments:
+        calls (iterable): task calls, as signatures or their dict form
+        app (Celery): app whose broker is used, the current app by default
+        chunk_size (int): number of messages published between two waits for confirms
+        confirm (boolean): wait for publisher confirms where the broker supports them
+        confirm_timeout (float): seconds to wait for the confirms of a chunk
+
+    Returns:
+        PublishReport
+    """
+    app = app or current_app
+    publisher = BulkPublisher(app, confirm, confirm_timeout)
+    report = PublishReport()
+    try:
+        for chunk in _chunks((signature(call, app=app) for call in calls), chunk_size):
+            publisher.publish_chunk(chunk, report)
+    finally:
+        publisher.close()
+
+    if report.failures:
+        logger.warning('Published %d task calls, %d failed.', report.published, len(report.failures))
+    return report
@@ -0,0 +1,180 @@
+"""
+Sampled cProfile capture of live tasks.
+
+A fraction of the executions of each task, set per task name in TASK_PROFILING_SAMPLE_RATES,
+run under cProfile. The profiles of a task are aggregated in memory and written to
+TASK_PROFILING_DIR every TASK_PROFILING_DUMP_INTERVAL seconds, as one file per task and window:
+
+    <task name>.<host>.<pid>.<timestamp>.prof
+
+Only the newest TASK_PROFILING_MAX_DUMPS files are kept. Dumps can be read with pstats or
+tools such as snakeviz. Tasks that are not sampled only pay for a dict lookup and a random draw.
+
+cProfile hooks the thread that enables it, so with green pools a profile also covers the
+green threads that ran while the sampled task was waiting on I/O.
+"""
+import cProfile
+import errno
+import os
+import pstats
+import random
+import socket
+import time
+
+from celery.signals import task_postrun, task_prerun, worker_process_shutdown, worker_shutdown
+from celery.utils.log import get_task_logger
+
+from ecommerce_worker.concurrency import Lock, OSThreadLocal
+from ecommerce_worker.utils import get_configuration
+
+logger = get_task_logger(__name__)  # pylint: disable=invalid-name
+
+
+class TaskProfiler(object):
+    """
+    Samples task executions and aggregates their profiles per task name.
+
+    Arguments:
+        sample_rates (dict): maps a task name to the fraction of its executions to profile
+        directory (str): directory receiving the profile dumps
+        dump_interval (int): seconds between two dumps of a task's aggregated profile
+        max_dumps (int): number of dump files kept in the directory
+    """
+
+    def __init__(self, sample_rates, directory, dump_interval, max_dumps):
+        self.sample_rates = sample_rates
+        self.directory = directory
+        self.dump_interval = dump_interval
+        self.max_dumps = max_dumps
+        self._active = {}
+        # cProfile hooks the OS thread, whichever green thread enables it
+        self._local = OSThreadLocal()
+        self._stats = {}
+        self._window_start = {}
+        self._lock = Lock()
+
+    def start(self, task_id, task_name):
+        """Start profiling the execution of a task if it is sampled."""
+        rate = self.sample_rates.get(task_name)
+        if not rate or random.random() >= rate:
+            return
+
+        # only one profiler can hook a thread at a time
+        if getattr(self._local, 'profiling', False):
+            return
+        self._local.profiling = True
+
+        profiler = cProfile.Profile()
+        self._active[task_id] = profiler
+        profiler.enable()
+
+    def stop(self, task_id, task_name):
+        """Stop profiling a task and add its profile to the task's aggregate."""
+        profiler = self._active.pop(task_id, None)
+        if profiler is None:
+            return
+        profiler.disable()
+        self._local.profiling = False
+
+        now = time.time()
+        with self._lock:
+            stats = self._stats.get(task_name)
+            if stats is None:
+                self._stats[task_name] = pstats.Stats(profiler)
+                self._window_start[task_name] = now
+            else:
+                stats.add(profiler)
+
+            if now - self._window_start[task_name] >= self.dump_interval:
+                self._dump(task_name, now)
+
+    def flush(self):
+        """Write the aggregated profiles of every task."""
+        now = time.time()
+        with self._lock:
+            for task_name in list(self._stats):
+                self._dump(task_name, now)
+
+    def _dump(self, task_name, now):
+        """Write a task's aggregate, start a new window and remove the oldest dumps."""
+        stats = self._stats.pop(task_name)
+        del self._window_start[task_name]
+        filename = '{}.{}.{}.{}.prof'.format(task_name, socket.gethostname(), os.getpid(), int(now))
+        try:
+            try:
+                os.makedirs(self.directory)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+            stats.dump_stats(os.path.join(self.directory, filename))
+            self._prune()
+        except (IOError, OSError):
+            logger.exception('Failed to write the profile of [%s] to [%s].', task_name, self.directory)
+
+    def _prune(self):
+        """Keep the newest max_dumps files of the directory."""
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.prof')]
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:-self.max_dumps] if self.max_dumps else paths:
+            try:
+                os.remove(path)
+            except OSError:
+                # another process pruned it first
+                pass
+
+
+# (pid, profiler) of the current process; the profiler is None when no task is sampled
+_process_profiler = (None, None)  # pylint: disable=invalid-name
+
+
+def get_profiler():
+    """
+    Get the profiler of the current process, built from the configuration on first use.
+
+    Returns:
+        TaskProfiler, or None if no task is sampled.
+    """
+    global _process_profiler  # pylint: disable=global-statement,invalid-name
+    pid, profiler = _process_profiler
+    if pid != os.getpid():
+        # profiles are aggregated per process; a forked child starts empty
+        sample_rates = get_configuration('TASK_PROFILING_SAMPLE_RATES')
+        profiler = TaskProfiler(
+            sample_rates,
+            get_configuration('TASK_PROFILING_DIR'),
+            get_configuration('TASK_PROFILING_DUMP_INTERVAL'),
+            get_configuration('TASK_PROFILING_MAX_DUMPS'),
+        ) if sample_rates else None
+        _process_profiler = (os.getpid(), profiler)
+    return profiler
+
+
+def reset_profiler():
+    """Forget the profiler of the current process, so it is rebuilt from the configuration."""
+    global _process_profiler  # pylint: disable=global-statement,invalid-name
+    _process_profiler = (None, None)
+
+
+@task_prerun.connect
+def start_task_profile(task_id=None, task=None, **kwargs):  # pylint: disable=unused-argument
+    """Profile the task if it is sampled."""
+    profiler = get_profiler()
+    if profiler:
+        profiler.start(task_id, task.name)
+
+
+@task_postrun.connect
+def stop_task_profile(task_id=None, task=None, **kwargs):  # pylint: disable=unused-argument
+    """Aggregate the profile of a sampled task."""
+    profiler = get_profiler()
+    if profiler:
+        profiler.stop(task_id, task.name)
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def flush_task_profiles(**kwargs):  # pylint: disable=unused-argument
+    """Write the profiles aggregated since the last dump before the process exits."""
+    pid, profiler = _process_profiler
+    if profiler and pid == os.getpid():
+        profiler.flush()
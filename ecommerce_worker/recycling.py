@@ -0,0 +1,245 @@
+"""
+Recycling of prefork children whose memory grows, and diagnostics of the growth.
+
+A prefork child reads its RSS every CHILD_RSS_CHECK_INTERVAL tasks and is replaced once:
+
+* its RSS exceeds CHILD_MAX_RSS_MB, or
+* it has grown by more than CHILD_MAX_RSS_GROWTH_KB_PER_TASK per task on average since its
+  first CHILD_RSS_WARMUP_TASKS tasks, which fill caches and connection pools, measured over
+  at least CHILD_RSS_GROWTH_MIN_TASKS tasks.
+
+The child finishes the task during which the limit was passed, reports its result, and exits
+instead of taking its next job; the pool then starts a new child, as it does for
+--max-tasks-per-child. Children staying within the limits are kept however many tasks they run.
+
+With TRACEMALLOC_ENABLED, a child also logs the allocation sites which grew the most every
+TRACEMALLOC_SNAPSHOT_INTERVAL tasks and when it is recycled: the bytes allocated per source line
+where the tracemalloc module is available, otherwise the live objects per type.
+"""
+from collections import Counter
+import gc
+import resource
+import sys
+
+from billiard.pool import EX_RECYCLE
+from billiard.process import current_process
+from celery.signals import task_postrun, worker_process_init
+from celery.utils.log import get_logger
+
+from ecommerce_worker.metrics import registry
+from ecommerce_worker.utils import get_configuration
+
+try:
+    import tracemalloc  # pylint: disable=import-error
+except ImportError:  # pragma: no cover
+    tracemalloc = None  # pylint: disable=invalid-name
+
+logger = get_logger(__name__)  # pylint: disable=invalid-name
+
+child_recycles = registry.counter(  # pylint: disable=invalid-name
+    'ecommerce_worker_child_recycles_total',
+    'Prefork children replaced because of their memory, by reason (rss, growth).',
+    ('reason',)
+)
+
+PAGE_SIZE = resource.getpagesize()
+
+MB = 1024 * 1024
+
+
+def read_rss():
+    """
+    Get the resident set size of the current process.
+
+    Returns:
+        int: bytes, or None where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+
+def allocation_sites():
+    """
+    Measure what is allocated, per allocation site.
+
+    Returns:
+        dict: bytes allocated per source line with tracemalloc, otherwise live objects per type.
+    """
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot()
+        return {str(stat.traceback): stat.size for stat in snapshot.statistics('lineno')}
+    return Counter('{}.{}'.format(type(obj).__module__, type(obj).__name__) for obj in gc.get_objects())
+
+
+class AllocationTracker(object):
+    """
+    Reports the allocation sites which grew the most between two snapshots.
+
+    Arguments:
+        top (int): number of sites reported
+    """
+
+    def __init__(self, top):
+        self.top = top
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.unit = 'bytes' if tracemalloc is not None else 'objects'
+        self.previous = allocation_sites()
+
+    def snapshot(self):
+        """
+        Take a snapshot and compare it with the previous one.
+
+        Returns:
+            list: (site, growth) of the sites which grew the most, largest first.
+        """
+        current = allocation_sites()
+        growth = Counter(current)
+        growth.subtract(self.previous)
+        self.previous = current
+        return [(site, size) for site, size in growth.most_common(self.top) if size > 0]
+
+    def log(self, reason):
+        """Log the sites which grew the most since the previous snapshot."""
+        for site, size in self.snapshot():
+            logger.info('Allocation growth (%s) %+d %s at %s', reason, size, self.unit, site)
+
+
+class MemoryMonitor(object):
+    """
+    Tracks the RSS of a process across its tasks and decides when the process should be replaced.
+
+    Arguments:
+        max_rss (int): bytes beyond which the process is replaced (0 disables the limit)
+        max_growth (int): average growth in bytes per task beyond which the process is replaced
+            (0 disables the limit)
+        warmup_tasks (int): tasks run before the RSS the growth is measured from is read
+        min_tasks (int): tasks run since the warm-up before the growth is judged
+        check_interval (int): tasks between two reads of the RSS
+        tracker (AllocationTracker): reports the allocation sites which grew, or None
+        snapshot_interval (int): tasks between two reports of the tracker
+    """
+
+    def __init__(self, max_rss, max_growth, warmup_tasks, min_tasks, check_interval, tracker=None,
+                 snapshot_interval=0):
+        self.max_rss = max_rss
+        self.max_growth = max_growth
+        self.warmup_tasks = warmup_tasks
+        self.min_tasks = min_tasks
+        self.check_interval = max(check_interval, 1)
+        self.tracker = tracker
+        self.snapshot_interval = snapshot_interval
+        self.tasks = 0
+        # (tasks, RSS) once warmed up
+        self.baseline = None
+        self.reason = None
+
+    def task_done(self):
+        """
+        Count a finished task and check the memory of the process when due.
+
+        Returns:
+            str: why the process should be replaced ('rss' or 'growth'), or None.
+        """
+        self.tasks += 1
+        if self.tracker and self.snapshot_interval and self.tasks % self.snapshot_interval == 0:
+            self.tracker.log('snapshot')
+        if self.reason or self.tasks % self.check_interval:
+            return self.reason
+
+        rss = read_rss()
+        if rss is None:
+            return None
+
+        growth = None
+        if self.baseline is None:
+            if self.tasks >= self.warmup_tasks:
+                self.baseline = (self.tasks, rss)
+        elif self.tasks - self.baseline[0] >= self.min_tasks:
+            growth = float(rss - self.baseline[1]) / (self.tasks - self.baseline[0])
+
+        if self.max_rss and rss > self.max_rss:
+            self.reason = 'rss'
+        elif self.max_growth and growth is not None and growth > self.max_growth:
+            self.reason = 'growth'
+        else:
+            return None
+
+        logger.warning(
+            'Recycling the process after %d tasks: RSS of %.1f MB, growing by %s KB per task.',
+            self.tasks, float(rss) / MB, '{:.1f}'.format(growth / 1024) if growth is not None else 'unknown'
+        )
+        child_recycles.inc(reason=self.reason)
+        if self.tracker:
+            self.tracker.log('recycle')
+        return self.reason
+
+
+def build_monitor():
+    """
+    Build the memory monitor of a process from the configuration.
+
+    Returns:
+        MemoryMonitor, or None if neither a limit nor allocation tracking is enabled.
+    """
+    max_rss = get_configuration('CHILD_MAX_RSS_MB') * MB
+    max_growth = get_configuration('CHILD_MAX_RSS_GROWTH_KB_PER_TASK') * 1024
+    tracing = get_configuration('TRACEMALLOC_ENABLED')
+    if not (max_rss or max_growth or tracing):
+        return None
+
+    return MemoryMonitor(
+        max_rss,
+        max_growth,
+        get_configuration('CHILD_RSS_WARMUP_TASKS'),
+        get_configuration('CHILD_RSS_GROWTH_MIN_TASKS'),
+        get_configuration('CHILD_RSS_CHECK_INTERVAL'),
+        tracker=AllocationTracker(get_configuration('TRACEMALLOC_TOP')) if tracing else None,
+        snapshot_interval=get_configuration('TRACEMALLOC_SNAPSHOT_INTERVAL'),
+    )
+
+
+def exit_when_recycled(process, monitor):
+    """
+    Make a pool process exit instead of taking its next job once the monitor asks for it to be replaced.
+
+    The process reports the result of its last task before waiting for the next job, so no task is lost.
+    """
+    wait_for_job = process.wait_for_job
+
+    def receive(*args, **kwargs):
+        """Wait for the next job, unless the process must be replaced."""
+        if monitor.reason:
+            sys.exit(EX_RECYCLE)
+        return wait_for_job(*args, **kwargs)
+
+    process.wait_for_job = receive
+
+
+# memory monitor of the current prefork child, None in other processes
+_monitor = None  # pylint: disable=invalid-name
+
+
+@worker_process_init.connect
+def start_memory_monitor(**kwargs):  # pylint: disable=unused-argument
+    """Monitor the memory of a new prefork child."""
+    global _monitor  # pylint: disable=global-statement,invalid-name
+    _monitor = build_monitor()
+    if _monitor is None:
+        return
+
+    process = current_process()
+    if hasattr(process, 'wait_for_job'):
+        exit_when_recycled(process, _monitor)
+    else:
+        logger.warning('Process [%s] cannot be recycled because of its memory.', process.name)
+
+
+@task_postrun.connect
+def check_memory(**kwargs):  # pylint: disable=unused-argument
+    """Check the memory of the prefork child once it has run a task."""
+    if _monitor is not None:
+        _monitor.task_done()
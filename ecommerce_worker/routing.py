@@ -0,0 +1,241 @@
+"""
+Routing of tasks to priority lanes and per-site queues, and fair sharing of the worker between sites.
+
+Priority lanes: when PRIORITY_LANES_ENABLED is set, TaskRouter sends fulfill_order and
+completed purchases to PRIORITY_LANE_QUEUE, so they do not wait behind abandoned cart and
+enrollment events. Workers started with --hostname=<lane>@%h take the pool size and
+prefetch multiplier of their lane from PRIORITY_LANES.
+
+Fair share: all sites share the fulfillment and email_marketing queues, so a burst of tasks
+from one site delays every other site's tasks queued behind it. When FAIR_SHARE_ENABLED is set:
+
+* TaskRouter sends the tasks listed in TASK_QUEUES to a sub-queue per site listed in
+  SITE_OVERRIDES, named <queue>.<site_code>. Producers publishing through this package's
+  routes, or naming the sub-queue themselves, keep a burst from one site out of the other
+  sites' queues. Tasks of other sites keep using the shared queue.
+* Workers consume the site sub-queues of each shared queue they are started with.
+* Tasks received from the broker and waiting for a free pool process are handed to the pool
+  by deficit round-robin between sites, in proportion to FAIR_SHARE_WEIGHTS, rather than in
+  order of arrival. This applies to pools run by the worker's event loop, such as prefork
+  with an AMQP broker.
+"""
+from collections import deque
+import inspect
+
+from celery import bootsteps, current_app
+from celery.signals import celeryd_after_setup, worker_init
+from celery.utils.log import get_logger
+
+from ecommerce_worker.sailthru.v1.dispatch import FREE_MODES
+from ecommerce_worker.utils import get_configuration
+
+logger = get_logger(__name__)  # pylint: disable=invalid-name
+
+FULFILL_ORDER = 'ecommerce_worker.fulfillment.v1.tasks.fulfill_order'
+UPDATE_COURSE_ENROLLMENT = 'ecommerce_worker.sailthru.v1.tasks.update_course_enrollment'
+
+
+def get_call_argument(task, args, kwargs, name):
+    """
+    Get an argument of a call to a task, whether it is passed by position or keyword.
+
+    Arguments:
+        task (Task): the task, or None if it is not registered
+        args (tuple): positional arguments of the call
+        kwargs (dict): keyword arguments of the call
+        name (str): name of the argument
+
+    Returns:
+        the argument's value, or None
+    """
+    kwargs = kwargs or {}
+    if name in kwargs or task is None:
+        return kwargs.get(name)
+    try:
+        return inspect.getcallargs(task.run, *(args or ()), **kwargs).get(name)
+    except TypeError:
+        return None
+
+
+def get_site_code(task, args, kwargs):
+    """Get the site code a task is called for, or None."""
+    return get_call_argument(task, args, kwargs, 'site_code')
+
+
+def is_priority(task_name, task, args, kwargs):
+    """Return True if a call to a task belongs on the priority lane: order fulfillment and completed purchases."""
+    if task_name == FULFILL_ORDER:
+        return True
+    if task_name == UPDATE_COURSE_ENROLLMENT:
+        return (not get_call_argument(task, args, kwargs, 'purchase_incomplete') and
+                get_call_argument(task, args, kwargs, 'mode') not in FREE_MODES)
+    return False
+
+
+def site_queue(queue, site_code):
+    """Name of the sub-queue of a site."""
+    return '{}.{}'.format(queue, site_code)
+
+
+def get_site_codes():
+    """Codes of the sites listed in SITE_OVERRIDES."""
+    try:
+        return sorted(get_configuration('SITE_OVERRIDES'))
+    except RuntimeError:
+        return []
+
+
+class TaskRouter(object):
+    """Celery router sending tasks to their priority lane and to the sub-queue of their site."""
+
+    def route_for_task(self, task, args=None, kwargs=None):
+        """Route a task by name and arguments; None leaves the task to the other routes."""
+        lanes = get_configuration('PRIORITY_LANES_ENABLED')
+        fair_share = get_configuration('FAIR_SHARE_ENABLED')
+        queue = get_configuration('TASK_QUEUES').get(task)
+        if queue is None or not (lanes or fair_share):
+            return None
+
+        registered = current_app.tasks.get(task)
+        if lanes and is_priority(task, registered, args, kwargs):
+            queue = get_configuration('PRIORITY_LANE_QUEUE')
+        if fair_share and get_site_code(registered, args, kwargs) in get_site_codes():
+            queue = site_queue(queue, get_site_code(registered, args, kwargs))
+        return {'queue': queue}
+
+
+@worker_init.connect
+def configure_lane(sender, **kwargs):  # pylint: disable=unused-argument
+    """Size the pool and prefetch of a worker named after a lane, e.g. priority@host."""
+    lane = sender.hostname.partition('@')[0]
+    settings = get_configuration('PRIORITY_LANES').get(lane)
+    if not settings:
+        return
+
+    # the pool and consumer are created from these once the worker's bootsteps start
+    sender.concurrency = settings.get('concurrency', sender.concurrency)
+    sender.prefetch_multiplier = settings.get('prefetch_multiplier', sender.prefetch_multiplier)
+    logger.info('Serving the [%s] lane with %d processes and a prefetch multiplier of %d.',
+                lane, sender.concurrency, sender.prefetch_multiplier)
+
+
+@celeryd_after_setup.connect
+def add_site_queues(instance, **kwargs):  # pylint: disable=unused-argument
+    """Consume the site sub-queues of the shared queues the worker consumes."""
+    if not get_configuration('FAIR_SHARE_ENABLED'):
+        return
+
+    queues = instance.app.amqp.queues
+    shared_queues = set(get_configuration('TASK_QUEUES').values())
+    shared_queues.add(get_configuration('PRIORITY_LANE_QUEUE'))
+    for queue in sorted(shared_queues & set(queues.consume_from)):
+        for site_code in get_site_codes():
+            queues.select_add(site_queue(queue, site_code))
+
+
+class DeficitRoundRobinQueue(object):
+    """
+    Queue serving its items by deficit round-robin between the keys of the items.
+
+    Keys with waiting items take turns. Each turn adds the key's weight to its deficit, and the
+    key is served while its deficit covers the unit cost of an item, so over time each busy key
+    gets a share of the items served proportional to its weight. A key which runs out of items
+    leaves the rotation and loses its remaining deficit.
+
+    The queue offers the append, popleft and clear methods of a deque.
+
+    Arguments:
+        key (callable): function returning the key of an item
+        weights (dict): positive weight of each key; keys not listed weigh 1
+    """
+
+    def __init__(self, key, weights=None):
+        self.key = key
+        self.weights = weights or {}
+        self._queues = {}
+        self._deficits = {}
+        self._rotation = deque()
+        self._turn_started = False
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def append(self, item):
+        """Add an item at the end of its key's queue."""
+        key = self.key(item)
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            self._deficits[key] = 0
+            self._rotation.append(key)
+        queue.append(item)
+        self._length += 1
+
+    def popleft(self):
+        """Remove and return the next item to serve.
+
+        Raises:
+            IndexError: if the queue is empty
+        """
+        if not self._length:
+            raise IndexError('pop from an empty queue')
+
+        while True:
+            key = self._rotation[0]
+            if not self._turn_started:
+                self._deficits[key] += self.weights.get(key, 1)
+                self._turn_started = True
+            if self._deficits[key] >= 1:
+                break
+            # the key's turn is over
+            self._rotation.rotate(-1)
+            self._turn_started = False
+
+        self._deficits[key] -= 1
+        queue = self._queues[key]
+        item = queue.popleft()
+        self._length -= 1
+        if not queue:
+            del self._queues[key]
+            del self._deficits[key]
+            self._rotation.popleft()
+            self._turn_started = False
+        return item
+
+    def clear(self):
+        """Remove every item."""
+        self._queues.clear()
+        self._deficits.clear()
+        self._rotation.clear()
+        self._turn_started = False
+        self._length = 0
+
+
+def _waiting_request_site_code(waiter):
+    """Site code of a task request waiting for the pool, as (callback, (request,))."""
+    __, (request,) = waiter
+    return get_site_code(request.task, request.args, request.kwargs)
+
+
+class FairShare(bootsteps.Step):
+    """Worker bootstep handing waiting tasks to the pool by deficit round-robin between sites."""
+    requires = ('celery.worker.components:Pool',)
+
+    def create(self, w):  # pylint: disable=invalid-name
+        semaphore = getattr(w, 'semaphore', None)
+        if not get_configuration('FAIR_SHARE_ENABLED'):
+            return
+        if semaphore is None:
+            logger.info('Waiting tasks are served in order of arrival with this pool.')
+            return
+
+        weights = get_configuration('FAIR_SHARE_WEIGHTS')
+        if any(weight <= 0 for weight in weights.values()):
+            raise ValueError('FAIR_SHARE_WEIGHTS must be positive.')
+
+        # the semaphore admitting tasks to the pool keeps waiting tasks in a deque of its own
+        waiting = DeficitRoundRobinQueue(_waiting_request_site_code, weights)
+        semaphore._waiting = waiting  # pylint: disable=protected-access
+        semaphore._add_waiter = waiting.append  # pylint: disable=protected-access
+        semaphore._pop_waiter = waiting.popleft  # pylint: disable=protected-access
@@ -0,0 +1,252 @@
+"""
+Backfill of the enrollment and purchase events Sailthru missed.
+
+Events are lost while Sailthru is disabled for a site, with SAILTHRU_ENABLE false, or
+misconfigured. The ecommerce-worker-sailthru-backfill command reads them from a CSV file with
+a header row, or a file of JSON objects, one per line, with the arguments of
+update_course_enrollment as fields:
+
+    email,course_url,purchase_incomplete,mode,unit_cost,course_id,currency,message_id,site_code
+
+and records each of them the way update_course_enrollment does, from a pool of threads sharing
+a Sailthru client per site and the cache of course content. Events are sent to each site at a
+limited rate, and the input is read as events are sent, so memory stays constant whatever the
+size of the input. Abandoned cart events are not coalesced.
+
+Emails are only sent, as the task sends them, with --send-templates: by default, reminders and
+confirmations of events long past are not sent. Events failing with a retryable error after
+their retries are written to the --failures file, which can be fed back to the command.
+
+    WORKER_CONFIGURATION_MODULE=... ecommerce-worker-sailthru-backfill --rate 20 events.csv
+"""
+import argparse
+import csv
+from decimal import Decimal, InvalidOperation
+import json
+import os
+import sys
+import time
+
+from celery.utils.log import get_logger
+from sailthru.sailthru_client import SailthruClient
+
+from ecommerce_worker import deadline
+from ecommerce_worker.concurrency import Lock
+from ecommerce_worker.sailthru.v1.tasks import get_site_dispatch, send_enrollment, update_course_enrollment
+from ecommerce_worker.streaming import Progress, RateLimiter, process_stream
+
+logger = get_logger(__name__)  # pylint: disable=invalid-name
+
+SENT = 'sent'
+IGNORED = 'ignored'
+DISABLED = 'disabled'
+INVALID = 'invalid'
+FAILED = 'failed'
+
+REQUIRED_FIELDS = ('email', 'course_url', 'mode')
+OPTIONAL_FIELDS = ('course_id', 'message_id', 'site_code')
+TRUE_VALUES = ('1', 'true', 't', 'yes', 'y')
+
+
+def read_records(lines, input_format):
+    """
+    Read the events of a file.
+
+    Arguments:
+        lines (iterable): lines of the file
+        input_format (str): 'csv' for a CSV file with a header row, 'jsonl' for a JSON object per line
+
+    Yields:
+        dict: fields of each event, as read
+    """
+    if input_format == 'csv':
+        for row in csv.DictReader(lines):
+            yield row
+        return
+
+    for line in lines:
+        line = line.strip()
+        if line:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # kept as is, and reported as invalid
+                yield {'line': line}
+
+
+def parse_event(record, site_code=None):
+    """
+    Get the arguments of send_enrollment from the fields of an event.
+
+    Arguments:
+        record (dict): fields of the event; empty fields are missing
+        site_code (str): site of the events which do not name one
+
+    Returns:
+        dict: keyword arguments of send_enrollment
+
+    Raises:
+        ValueError: if a required field is missing or a field cannot be read
+    """
+    event = {}
+    for field in REQUIRED_FIELDS:
+        if not record.get(field):
+            raise ValueError('missing {}'.format(field))
+        event[field] = record[field]
+    for field in OPTIONAL_FIELDS:
+        event[field] = record.get(field) or None
+
+    purchase_incomplete = record.get('purchase_incomplete')
+    if not isinstance(purchase_incomplete, bool):
+        purchase_incomplete = str(purchase_incomplete or '').strip().lower() in TRUE_VALUES
+    event['purchase_incomplete'] = purchase_incomplete
+    # a Decimal, as the LMS sends it: the float of a price such as 19.99 is one cent short once in cents
+    try:
+        event['unit_cost'] = Decimal(str(record.get('unit_cost') or 0).strip())
+    except InvalidOperation:
+        raise ValueError('invalid unit_cost {!r}'.format(record.get('unit_cost')))
+    if not event['unit_cost'].is_finite():
+        raise ValueError('invalid unit_cost {!r}'.format(record.get('unit_cost')))
+    event['site_code'] = event['site_code'] or site_code
+    return event
+
+
+class Backfill(object):
+    """
+    Records events in Sailthru, with a client and a rate limit per site.
+
+    Arguments:
+        rate (float): events sent per second to each site (0 for no limit)
+        max_retries (int): maximum number of retries of an event failing with a retryable error
+        retry_seconds (float): seconds between two attempts of an event
+        send_templates (boolean): True to send the emails of the events
+        site_code (str): site of the events which do not name one
+        failures (file): where the events which failed are written, as JSON lines
+    """
+
+    def __init__(self, rate, max_retries=2, retry_seconds=30, send_templates=False, site_code=None, failures=None):
+        self.rate = rate
+        self.max_retries = max_retries
+        self.retry_seconds = retry_seconds
+        self.send_templates = send_templates
+        self.site_code = site_code
+        self.failures = failures
+        # (SailthruClient, RateLimiter) per site
+        self.sites = {}
+        self._lock = Lock()
+
+    def _get_site(self, site_code, dispatch):
+        """Get the client and rate limiter of a site, shared by the threads sending its events."""
+        with self._lock:
+            site = self.sites.get(site_code)
+            if site is None:
+                site = self.sites[site_code] = (
+                    SailthruClient(dispatch.key, dispatch.secret, api_url=dispatch.api_url),
+                    RateLimiter(self.rate),
+                )
+            return site
+
+    def send(self, record):
+        """
+        Record an event in Sailthru.
+
+        Arguments:
+            record (dict): fields of the event
+
+        Returns:
+            str: outcome of the event
+        """
+        try:
+            event = parse_event(record, self.site_code)
+        except (ValueError, TypeError, AttributeError) as exc:
+            logger.warning('Skipping invalid event %r: %s', record, exc)
+            return INVALID
+
+        site_code = event['site_code']
+        dispatch = get_site_dispatch(site_code)
+        if not (dispatch.enabled and dispatch.key and dispatch.secret):
+            return DISABLED
+
+        sailthru_client, limiter = self._get_site(site_code, dispatch)
+        budget = deadline.get_budget(update_course_enrollment.name, site_code)
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.retry_seconds)
+            limiter.wait()
+            deadline.start(update_course_enrollment.name, budget)
+            try:
+                sent, item = send_enrollment(sailthru_client, dispatch, send_templates=self.send_templates, **event)
+            finally:
+                deadline.clear()
+            if sent:
+                return SENT if item is not None else IGNORED
+
+        self.record_failure(record)
+        return FAILED
+
+    def record_failure(self, record):
+        """Write an event which failed to the failures file."""
+        if self.failures is None:
+            return
+        with self._lock:
+            self.failures.write(json.dumps(record) + '\n')
+            self.failures.flush()
+
+
+def backfill(records, sender, progress, concurrency=8):
+    """
+    Record events in Sailthru from concurrency threads.
+
+    Arguments:
+        records (iterable): fields of the events
+        sender (Backfill): records each event
+        progress (Progress): counts the outcomes
+        concurrency (int): number of events sent at a time
+    """
+    def handle(record):
+        """Send an event and count its outcome."""
+        try:
+            outcome = sender.send(record)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Failed to record event %r in Sailthru.', record)
+            sender.record_failure(record)
+            outcome = FAILED
+        progress.add(outcome)
+
+    process_stream(records, handle, concurrency)
+
+
+def main(argv=None):
+    """Record the events read from a file or stdin in Sailthru."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', nargs='?', default='-', help='file of events, - for stdin')
+    parser.add_argument('--format', choices=('csv', 'jsonl'),
+                        help='format of the input, by default csv for .csv files and jsonl otherwise')
+    parser.add_argument('--site-code', help='site of the events which do not name one')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of events sent at a time')
+    parser.add_argument('--rate', type=float, default=10, help='events sent per second to each site')
+    parser.add_argument('--max-retries', type=int, default=2, help='maximum number of retries of each event')
+    parser.add_argument('--retry-seconds', type=float, default=30, help='seconds between two attempts of an event')
+    parser.add_argument('--send-templates', action='store_true', help='send the emails of the events')
+    parser.add_argument('--failures', help='file to which the events which failed are appended')
+    parser.add_argument('--report-interval', type=float, default=10, help='seconds between two progress reports')
+    args = parser.parse_args(argv)
+
+    # configure the app from WORKER_CONFIGURATION_MODULE
+    from ecommerce_worker import celery_app  # pylint: disable=unused-variable
+    deadline.install()
+
+    input_format = args.format or ('csv' if os.path.splitext(args.input)[1].lower() == '.csv' else 'jsonl')
+    lines = sys.stdin if args.input == '-' else open(args.input)
+    failures = open(args.failures, 'a') if args.failures else None
+    sender = Backfill(args.rate, args.max_retries, args.retry_seconds, args.send_templates, args.site_code, failures)
+    progress = Progress(args.report_interval, 'events')
+    try:
+        backfill(read_records(lines, input_format), sender, progress, args.concurrency)
+    except KeyboardInterrupt:
+        sys.exit('Interrupted.')
+    finally:
+        for stream in (lines, failures):
+            if stream not in (None, sys.stdin):
+                stream.close()
+        progress.report()
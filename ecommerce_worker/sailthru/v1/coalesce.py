@@ -0,0 +1,49 @@
+"""
+Coalescing of repeated abandoned cart events.
+
+Every add-to-cart produces an incomplete purchase call to Sailthru. When coalescing is
+enabled, an incomplete event is parked for a short window and only the latest event
+for a given (site, email, item) is sent once the window has elapsed. A completed
+purchase of the item cancels any event still waiting to be sent.
+
+A deferred event may be taken by a worker on any host, so the pending events are recorded
+where every worker sees them: in a var of the user's Sailthru record, one per (site, item).
+Deferring an event stores its token in the var and a completed purchase empties it; when the
+event is due, it is only sent if the var still holds its token. The var keeps the token of the
+last event sent until the next add-to-cart or purchase of the item replaces it.
+"""
+import hashlib
+import uuid
+
+PENDING_CART_VAR_PREFIX = 'pending_cart_'
+
+
+def new_token():
+    """Return a token identifying a new pending event"""
+    return uuid.uuid4().hex
+
+
+def pending_cart_var(site_code, item_id):
+    """Return the name of the user var holding the token of the pending event for a site and item
+
+    Item ids contain characters such as ':' and '+', so the var is named after their digest.
+    """
+    key = u'{}:{}'.format(site_code or '', item_id).encode('utf-8')
+    return PENDING_CART_VAR_PREFIX + hashlib.sha1(key).hexdigest()[:16]
+
+
+def is_superseded(user_vars, site_code, item_id, token):
+    """
+    Return True if the pending event identified by token was superseded or cancelled.
+
+    Arguments:
+        user_vars (dict): vars of the user's Sailthru record
+        site_code (str): site code
+        item_id (str): Sailthru purchase item id
+        token (str): token of the pending event
+
+    An event whose var is missing, e.g. because it was deferred before coalescing was
+    recorded in Sailthru, is not superseded.
+    """
+    value = (user_vars or {}).get(pending_cart_var(site_code, item_id))
+    return value is not None and value != token
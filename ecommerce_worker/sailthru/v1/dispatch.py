@@ -0,0 +1,65 @@
+"""
+Per-site Sailthru dispatch tables.
+
+Everything update_course_enrollment needs from the SAILTHRU settings of a site is resolved
+once: whether the integration is enabled, the client credentials, retry and cache settings,
+and the purchase API options for each kind of event. Tasks then only look up their entry.
+"""
+
+# Enrollment modes which do not require payment
+FREE_MODES = ('audit', 'honor')
+
+
+class SiteDispatch(object):
+    """
+    Sailthru settings for one site, with prebuilt purchase API options.
+
+    The options dicts are shared by every task using the table and must not be modified;
+    SailthruClient.purchase copies them before adding per-call values.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.enabled = bool(config.get('SAILTHRU_ENABLE'))
+        self.key = config.get('SAILTHRU_KEY')
+        self.secret = config.get('SAILTHRU_SECRET')
+        self.api_url = config.get('SAILTHRU_API_URL')
+        self.minimum_cost = config.get('SAILTHRU_MINIMUM_COST')
+        self.cache_ttl = config.get('SAILTHRU_CACHE_TTL_SECONDS')
+        self.coalesce_seconds = config.get('SAILTHRU_ABANDONED_CART_COALESCE_SECONDS')
+
+        # abandoned cart events get a reminder, if a template is configured
+        self.incomplete_options = {}
+        if config.get('SAILTHRU_ABANDONED_CART_TEMPLATE'):
+            self.incomplete_options = {
+                'reminder_template': config.get('SAILTHRU_ABANDONED_CART_TEMPLATE'),
+                # Sailthru reminder time format is '+n time unit'
+                'reminder_time': "+{} minutes".format(config.get('SAILTHRU_ABANDONED_CART_DELAY')),
+            }
+
+        # completed events are (new enrollment, options) pairs
+        self.upgrade = (False, self._send_options(config.get('SAILTHRU_UPGRADE_TEMPLATE')))
+        self.free_enroll = (True, self._send_options(config.get('SAILTHRU_ENROLL_TEMPLATE')))
+        self.paid_enroll = (True, self._send_options(config.get('SAILTHRU_PURCHASE_TEMPLATE')))
+
+    @staticmethod
+    def _send_options(send_template):
+        """Build the purchase options sending the given template"""
+        return {'send_template': send_template} if send_template else {}
+
+    def event(self, mode, purchase_incomplete):
+        """Look up how to process an event.
+
+        Arguments:
+            mode (str): enroll mode (audit, verified, ...)
+            purchase_incomplete (boolean): True if adding to cart
+
+        Returns:
+            tuple: (True if this is a new enrollment, purchase API options)
+        """
+        if purchase_incomplete:
+            return False, self.incomplete_options
+        if mode == 'verified':
+            return self.upgrade
+        if mode in FREE_MODES:
+            return self.free_enroll
+        return self.paid_enroll
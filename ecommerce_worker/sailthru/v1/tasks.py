@@ -1,24 +1,33 @@
 """
 This file contains celery tasks for email marketing signal handler.
 """
-
 from celery import shared_task
+from celery.signals import worker_init
 from celery.utils.log import get_task_logger
 from sailthru.sailthru_client import SailthruClient
 from sailthru.sailthru_error import SailthruClientError
 
 from ecommerce_worker.cache import Cache
+from ecommerce_worker.concurrency import Local
+from ecommerce_worker.delayed_retry import retry_task
+from ecommerce_worker.metrics import sailthru_request_seconds
+from ecommerce_worker.sailthru.v1.coalesce import is_superseded, new_token, pending_cart_var
+from ecommerce_worker.sailthru.v1.dispatch import SiteDispatch
 from ecommerce_worker.utils import get_configuration
 
 logger = get_task_logger(__name__)  # pylint: disable=invalid-name
 cache = Cache()  # pylint: disable=invalid-name
+dispatch_tables = {}  # pylint: disable=invalid-name
+# the last failed Sailthru call of each thread, kept with tasks whose retries are exhausted
+_last_error = Local()  # pylint: disable=invalid-name
 
 
 # pylint: disable=not-callable
 @shared_task(bind=True, ignore_result=True)
 def update_course_enrollment(self, email, course_url, purchase_incomplete, mode,
                              unit_cost=None, course_id=None,
-                             currency=None, message_id=None, site_code=None):  # pylint: disable=unused-argument
+                             currency=None, message_id=None, site_code=None,
+                             coalesce_token=None):  # pylint: disable=unused-argument
     """Adds/updates Sailthru when a user adds to cart/purchases/upgrades a course
 
      Args:
@@ -31,92 +40,168 @@ def update_course_enrollment(self, email, course_url, purchase_incomplete, mode,
         currency(str): currency if purchase event - currently ignored since Sailthru only supports USD
         message_id(str): value from Sailthru marketing campaign cookie
         site_code(str): site code
+        coalesce_token(str): set on abandoned cart events deferred by the coalescing window
 
     Returns:
         None
     """
-    # Get configuration
-    config = get_configuration('SAILTHRU', site_code=site_code)
+    dispatch = get_site_dispatch(site_code)
 
     # Return if Sailthru integration disabled
-    if not config.get('SAILTHRU_ENABLE'):
+    if not dispatch.enabled:
         return
 
     # Make sure key and secret configured
-    sailthru_key = config.get('SAILTHRU_KEY')
-    sailthru_secret = config.get('SAILTHRU_SECRET')
-    if not (sailthru_key and sailthru_secret):
+    if not (dispatch.key and dispatch.secret):
         logger.error("Sailthru key and or secret not specified for site %s", site_code)
         return
 
-    sailthru_client = SailthruClient(sailthru_key, sailthru_secret)
+    sailthru_client = SailthruClient(dispatch.key, dispatch.secret, api_url=dispatch.api_url)
+
+    # Collapse repeated abandoned cart events for the same item
+    if dispatch.coalesce_seconds:
+        item_id = _purchase_item_id(course_id, mode)
+        if not purchase_incomplete:
+            # a completed purchase makes any pending abandoned cart event for the item obsolete
+            _set_pending_cart(sailthru_client, email, site_code, item_id, '')
+        elif coalesce_token is None:
+            coalesce_token = new_token()
+            if _set_pending_cart(sailthru_client, email, site_code, item_id, coalesce_token):
+                self.apply_async(
+                    args=(email, course_url, purchase_incomplete, mode),
+                    kwargs={'unit_cost': unit_cost, 'course_id': course_id, 'currency': currency,
+                            'message_id': message_id, 'site_code': site_code, 'coalesce_token': coalesce_token},
+                    countdown=dispatch.coalesce_seconds
+                )
+                return
+            # the event could not be recorded as pending, so it is sent without waiting
+        else:
+            checked, superseded = _is_pending_cart_superseded(sailthru_client, email, site_code, item_id,
+                                                              coalesce_token)
+            if not checked:
+                _schedule_retry(self, dispatch.config)
+                return
+            if superseded:
+                logger.info("Dropping superseded abandoned cart event for item %s on site %s", item_id, site_code)
+                return
+
+    sent, __ = send_enrollment(sailthru_client, dispatch, email, course_url, purchase_incomplete, mode,
+                               unit_cost, course_id, message_id, site_code)
+    if not sent:
+        _schedule_retry(self, dispatch.config)
+
+
+def send_enrollment(sailthru_client, dispatch, email, course_url, purchase_incomplete, mode, unit_cost=None,
+                    course_id=None, message_id=None, site_code=None, send_templates=True):
+    """Record an enrollment event in Sailthru: the user's unenrolled list and the purchase
 
+    Arguments:
+        sailthru_client (object): SailthruClient of the site
+        dispatch (SiteDispatch): dispatch table of the site
+        send_templates (boolean): False to record the event without sending its emails
+        others: see update_course_enrollment
+
+    Returns:
+        tuple: (False if a retryable error occurred, the purchase item recorded or None)
+    """
     # Use event type to figure out processing required
-    new_enroll = False
-    send_template = None
-
-    if not purchase_incomplete:
-        if mode == 'verified':
-            # upgrade complete
-            send_template = config.get('SAILTHRU_UPGRADE_TEMPLATE')
-        elif mode == 'audit' or mode == 'honor':
-            # free enroll
-            new_enroll = True
-            send_template = config.get('SAILTHRU_ENROLL_TEMPLATE')
-        else:
-            # paid course purchase complete
-            new_enroll = True
-            send_template = config.get('SAILTHRU_PURCHASE_TEMPLATE')
+    new_enroll, options = dispatch.event(mode, purchase_incomplete)
+    if not send_templates:
+        options = {}
 
     # calc price in pennies for Sailthru
     #  https://getstarted.sailthru.com/new-for-developers-overview/advanced-features/purchase/
     cost_in_cents = int(unit_cost * 100)
     if not cost_in_cents:
-        cost_in_cents = config.get('SAILTHRU_MINIMUM_COST')
+        cost_in_cents = dispatch.minimum_cost
         # if still zero, ignore purchase since Sailthru can't deal with $0 transactions
         if not cost_in_cents:
-            return
+            return True, None
 
     # update the "unenrolled" course array in the user record on Sailthru if new enroll or unenroll
     if new_enroll:
         if not _update_unenrolled_list(sailthru_client, email, course_url, False):
-            _schedule_retry(self, config)
+            return False, None
 
-    # Get course data from Sailthru content library or cache
-    course_data = _get_course_content(course_url, sailthru_client, site_code, config)
+    # build item description from course data in the Sailthru content library or cache
+    item_template = _get_item_template(course_id, course_url, mode, sailthru_client, site_code, dispatch)
+    item = _build_purchase_item(item_template, cost_in_cents)
+
+    return _record_purchase(sailthru_client, email, item, purchase_incomplete, message_id, options), item
+
+
+def get_site_dispatch(site_code):
+    """Get the Sailthru dispatch table of a site, building it on first use
+
+    Arguments:
+        site_code (str): site code
+
+    Returns:
+        SiteDispatch
+    """
+    dispatch = dispatch_tables.get(site_code)
+    if dispatch is None:
+        dispatch = dispatch_tables[site_code] = SiteDispatch(get_configuration('SAILTHRU', site_code=site_code))
+    return dispatch
 
-    # build item description
-    item = _build_purchase_item(course_id, course_url, cost_in_cents, mode, course_data)
 
-    # build purchase api options list
-    options = {}
-    if purchase_incomplete and config.get('SAILTHRU_ABANDONED_CART_TEMPLATE'):
-        options['reminder_template'] = config.get('SAILTHRU_ABANDONED_CART_TEMPLATE')
-        # Sailthru reminder time format is '+n time unit'
-        options['reminder_time'] = "+{} minutes".format(config.get('SAILTHRU_ABANDONED_CART_DELAY'))
+@worker_init.connect
+def build_dispatch_tables(**kwargs):  # pylint: disable=unused-argument
+    """Build the dispatch tables of every configured site when the worker starts"""
+    dispatch_tables.clear()
+    try:
+        site_codes = list(get_configuration('SITE_OVERRIDES'))
+    except RuntimeError:
+        site_codes = []
+
+    for site_code in [None] + site_codes:
+        get_site_dispatch(site_code)
 
-    # add appropriate send template
-    if send_template:
-        options['send_template'] = send_template
 
-    if not _record_purchase(sailthru_client, email, item, purchase_incomplete, message_id, options):
-        _schedule_retry(self, config)
+def _purchase_item_id(course_id, mode):
+    """Return the Sailthru purchase item id for a course mode"""
+    return "{}-{}".format(course_id, mode)
 
 
 def _schedule_retry(self, config):
-    """Schedule a retry"""
-    raise self.retry(countdown=config.get('SAILTHRU_RETRY_SECONDS'),
-                     max_retries=config.get('SAILTHRU_RETRY_ATTEMPTS'))
+    """Schedule a retry after SAILTHRU_RETRY_SECONDS"""
+    retry_task(self, config.get('SAILTHRU_RETRY_SECONDS'), config.get('SAILTHRU_RETRY_ATTEMPTS'),
+               error=getattr(_last_error, 'message', None))
 
 
-def _build_purchase_item(course_id, course_url, cost_in_cents, mode, course_data):
-    """Build and return Sailthru purchase item object"""
+def _get_item_template(course_id, course_url, mode, sailthru_client, site_code, dispatch):
+    """Get the purchase item template of a course mode, with course data merged in
+
+    Arguments:
+        course_id (str): course id
+        course_url (str): LMS url for course info page.
+        mode (str): enroll mode
+        sailthru_client (object): SailthruClient
+        site_code (str): site code
+        dispatch (SiteDispatch): dispatch table of the site
+
+    Returns:
+        dict: Sailthru purchase item, without its price
+    """
+    cache_key = "item:{}:{}:{}:{}".format(site_code, course_url, course_id, mode)
+    item_template = cache.get(cache_key)
+    if not item_template:
+        course_data = _get_course_content(course_url, sailthru_client, site_code, dispatch.config)
+        item_template = _build_item_template(course_id, course_url, mode, course_data)
+        # only keep templates built from actual course data, so failed lookups are retried
+        if course_data:
+            cache.set(cache_key, item_template, dispatch.cache_ttl)
+
+    return item_template
+
+
+def _build_item_template(course_id, course_url, mode, course_data):
+    """Build and return the price-independent part of a Sailthru purchase item object"""
 
     # build item description
     item = {
-        'id': "{}-{}".format(course_id, mode),
+        'id': _purchase_item_id(course_id, mode),
         'url': course_url,
-        'price': cost_in_cents,
         'qty': 1,
     }
 
@@ -136,6 +221,11 @@ def _build_purchase_item(course_id, course_url, cost_in_cents, mode, course_data
     return item
 
 
+def _build_purchase_item(item_template, cost_in_cents):
+    """Build and return Sailthru purchase item object"""
+    return dict(item_template, price=cost_in_cents)
+
+
 def _record_purchase(sailthru_client, email, item, purchase_incomplete, message_id, options):
     """Record a purchase in Sailthru
 
@@ -151,9 +241,9 @@ def _record_purchase(sailthru_client, email, item, purchase_incomplete, message_
         False if retryable error, else True
     """
     try:
-        sailthru_response = sailthru_client.purchase(email, [item],
-                                                     incomplete=purchase_incomplete, message_id=message_id,
-                                                     options=options)
+        sailthru_response = _call_sailthru('purchase', sailthru_client.purchase, email, [item],
+                                           incomplete=purchase_incomplete, message_id=message_id,
+                                           options=options)
 
         if not sailthru_response.is_ok():
             error = sailthru_response.get_error()
@@ -186,7 +276,7 @@ def _get_course_content(course_url, sailthru_client, site_code, config):
     response = cache.get(cache_key)
     if not response:
         try:
-            sailthru_response = sailthru_client.api_get("content", {"id": course_url})
+            sailthru_response = _call_sailthru('get_content', sailthru_client.api_get, "content", {"id": course_url})
             if not sailthru_response.is_ok():
                 return {}
 
@@ -213,7 +303,8 @@ def _update_unenrolled_list(sailthru_client, email, course_url, unenroll):
     """
     try:
         # get the user 'vars' values from sailthru
-        sailthru_response = sailthru_client.api_get("user", {"id": email, "fields": {"vars": 1}})
+        sailthru_response = _call_sailthru('get_user', sailthru_client.api_get,
+                                           "user", {"id": email, "fields": {"vars": 1}})
         if not sailthru_response.is_ok():
             error = sailthru_response.get_error()
             logger.error("Error attempting to read user record from Sailthru: %s", error.get_message())
@@ -240,7 +331,8 @@ def _update_unenrolled_list(sailthru_client, email, course_url, unenroll):
 
         if changed:
             # write user record back
-            sailthru_response = sailthru_client.api_post(
+            sailthru_response = _call_sailthru(
+                'post_user', sailthru_client.api_post,
                 'user', {'id': email, 'key': 'email', 'vars': {'unenrolled': unenroll_list}})
 
             if not sailthru_response.is_ok():
@@ -255,6 +347,87 @@ def _update_unenrolled_list(sailthru_client, email, course_url, unenroll):
         return False
 
 
+def _set_pending_cart(sailthru_client, email, site_code, item_id, token):
+    """Record the token of the pending abandoned cart event for an item in the Sailthru user record
+
+    Arguments:
+        sailthru_client (object): SailthruClient
+        email (str): user's email address
+        site_code (str): site code
+        item_id (str): Sailthru purchase item id
+        token (str): token of the pending event, or '' to cancel any pending event
+
+    Returns:
+        True if the token was recorded, else False
+    """
+    try:
+        sailthru_response = _call_sailthru(
+            'post_user', sailthru_client.api_post,
+            'user', {'id': email, 'key': 'email', 'vars': {pending_cart_var(site_code, item_id): token}})
+
+        if not sailthru_response.is_ok():
+            error = sailthru_response.get_error()
+            logger.error("Error attempting to record pending cart in Sailthru: %s", error.get_message())
+            return False
+
+    except SailthruClientError as exc:
+        logger.exception("Exception attempting to record pending cart for %s in Sailthru - %s", email, unicode(exc))
+        return False
+
+    return True
+
+
+def _is_pending_cart_superseded(sailthru_client, email, site_code, item_id, token):
+    """Check the Sailthru user record for a newer abandoned cart event or a completed purchase of an item
+
+    Arguments:
+        see _set_pending_cart
+
+    Returns:
+        tuple: (False if a retryable error occurred, True if the pending event was superseded or cancelled)
+    """
+    try:
+        sailthru_response = _call_sailthru('get_user', sailthru_client.api_get,
+                                           "user", {"id": email, "fields": {"vars": 1}})
+        if not sailthru_response.is_ok():
+            error = sailthru_response.get_error()
+            logger.error("Error attempting to read user record from Sailthru: %s", error.get_message())
+            return not _retryable_sailthru_error(error), False
+
+        response_json = sailthru_response.json or {}
+        return True, is_superseded(response_json.get('vars'), site_code, item_id, token)
+
+    except SailthruClientError as exc:
+        logger.exception("Exception attempting to read user record for %s from Sailthru - %s", email, unicode(exc))
+        return False, False
+
+
+def _call_sailthru(endpoint, method, *args, **kwargs):
+    """Call a SailthruClient method, recording its duration by endpoint and Sailthru error code
+
+    Arguments:
+        endpoint (str): name of the endpoint in the metrics
+        method (callable): bound SailthruClient method
+
+    Returns:
+        the method's response
+    """
+    _last_error.message = None
+    with sailthru_request_seconds.time(endpoint=endpoint, error='exception') as timer:
+        try:
+            sailthru_response = method(*args, **kwargs)
+        except SailthruClientError as exc:
+            _last_error.message = '{} exception: {}'.format(endpoint, exc)
+            raise
+        if sailthru_response.is_ok():
+            timer.labels['error'] = 'none'
+        else:
+            error = sailthru_response.get_error()
+            timer.labels['error'] = str(error.get_error_code())
+            _last_error.message = '{} error {}: {}'.format(endpoint, error.get_error_code(), error.get_message())
+    return sailthru_response
+
+
 def _retryable_sailthru_error(error):
     """ Return True if error should be retried.
 
@@ -6,7 +6,10 @@ from unittest import TestCase
 from mock import patch
 from sailthru.sailthru_error import SailthruClientError
 
-from ecommerce_worker.sailthru.v1.tasks import update_course_enrollment, _update_unenrolled_list, _get_course_content
+from ecommerce_worker.dead_letter import DeadLetterStore
+from ecommerce_worker.sailthru.v1.tasks import (
+    update_course_enrollment, _update_unenrolled_list, _get_course_content, dispatch_tables
+)
 from ecommerce_worker.utils import get_configuration
 
 log = logging.getLogger(__name__)
@@ -21,6 +24,9 @@ class SailthruTests(TestCase):
 
     def setUp(self):
         super(SailthruTests, self).setUp()
+        # dispatch tables are built from the configuration patched by each test
+        dispatch_tables.clear()
+        self.addCleanup(dispatch_tables.clear)
         self.course_id = 'edX/toy/2012_Fall'
         self.course_url = 'http://lms.testserver.fake/courses/edX/toy/2012_Fall/info'
         self.course_id2 = 'edX/toy/2016_Fall'
@@ -318,6 +324,35 @@ class SailthruTests(TestCase):
                                        unit_cost=Decimal(99))
         self.assertTrue(mock_log_error.called)
 
+    @patch('ecommerce_worker.sailthru.v1.tasks.SailthruClient.api_get')
+    def test_retries_exhausted(self, mock_sailthru_api_get):
+        """Tasks running out of retries are recorded with the last Sailthru error."""
+        store = DeadLetterStore(':memory:')
+        mock_sailthru_api_get.return_value = MockSailthruResponse({}, error='Rate limited', code=43)
+        with patch('ecommerce_worker.dead_letter.get_dead_letter_store', return_value=store):
+            update_course_enrollment.delay(TEST_EMAIL,
+                                           self.course_url,
+                                           False,
+                                           'honor',
+                                           course_id=self.course_id,
+                                           unit_cost=Decimal(99),
+                                           site_code='test_site')
+
+        letter, = store.pending()  # pylint: disable=unbalanced-tuple-unpacking
+        self.assertEqual(letter['retries'], get_configuration('SAILTHRU')['SAILTHRU_RETRY_ATTEMPTS'])
+        self.assertEqual(letter['site_code'], 'test_site')
+        self.assertEqual(letter['error'], 'get_user error 43: Rate limited')
+
+    @patch('ecommerce_worker.sailthru.v1.tasks.retry_task')
+    @patch('ecommerce_worker.sailthru.v1.tasks.SailthruClient.api_get')
+    def test_budget_exhausted(self, mock_sailthru_api_get, mock_retry_task):
+        """Tasks whose time budget ran out are retried after SAILTHRU_RETRY_SECONDS."""
+        mock_sailthru_api_get.side_effect = SailthruClientError
+        with patch('ecommerce_worker.deadline.expired', return_value=True):
+            update_course_enrollment.delay(TEST_EMAIL, self.course_url, False, 'honor', course_id=self.course_id,
+                                           unit_cost=Decimal(99))
+        self.assertEqual(mock_retry_task.call_args[0][1], get_configuration('SAILTHRU')['SAILTHRU_RETRY_SECONDS'])
+
     @patch('ecommerce_worker.sailthru.v1.tasks.SailthruClient')
     def test_get_course_content(self, mock_sailthru_client):
         """
@@ -0,0 +1,150 @@
+"""Tests of the Sailthru backfill."""
+from decimal import Decimal
+import json
+from StringIO import StringIO
+from unittest import TestCase
+
+import ddt
+import mock
+from sailthru.sailthru_client import SailthruClient
+
+from ecommerce_worker.sailthru.v1 import backfill as backfill_module
+from ecommerce_worker.sailthru.v1.backfill import (
+    DISABLED, FAILED, IGNORED, INVALID, SENT, Backfill, backfill, main, parse_event, read_records
+)
+from ecommerce_worker.sailthru.v1.tasks import cache, dispatch_tables
+from ecommerce_worker.sailthru.v1.tests.sailthru_tests import MockSailthruResponse
+from ecommerce_worker.streaming import Progress
+from ecommerce_worker.tests.mixins import TemporaryDirectoryMixin
+
+COURSE_URL = 'http://lms.testserver.fake/courses/edX/toy/2012_Fall/info'
+EVENT = {
+    'email': 'test@edx.org', 'course_url': COURSE_URL, 'purchase_incomplete': 'false', 'mode': 'verified',
+    'unit_cost': '49', 'course_id': 'edX/toy/2012_Fall', 'currency': 'USD', 'message_id': '', 'site_code': '',
+}
+
+
+@ddt.ddt
+class BackfillTests(TemporaryDirectoryMixin, TestCase):
+    """Tests covering the Sailthru backfill."""
+
+    def setUp(self):
+        super(BackfillTests, self).setUp()
+        dispatch_tables.clear()
+        self.addCleanup(dispatch_tables.clear)
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.responses = {}
+        for method, response in (('purchase', {'ok': True}), ('api_get', {'title': 'Toy'}),
+                                 ('api_post', {'ok': True})):
+            patcher = mock.patch.object(SailthruClient, method, return_value=MockSailthruResponse(response))
+            self.responses[method] = patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(backfill_module.time, 'sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_read_csv(self):
+        lines = ['email,course_url,mode,unit_cost\n', 'a@example.com,{},audit,0\n'.format(COURSE_URL)]
+        self.assertEqual(list(read_records(lines, 'csv')),
+                         [{'email': 'a@example.com', 'course_url': COURSE_URL, 'mode': 'audit', 'unit_cost': '0'}])
+
+    def test_read_jsonl(self):
+        lines = [json.dumps(EVENT) + '\n', '\n', 'not json\n']
+        self.assertEqual(list(read_records(lines, 'jsonl')), [EVENT, {'line': 'not json'}])
+
+    @ddt.data(
+        ({}, {}),
+        ({'purchase_incomplete': 'True', 'unit_cost': ''}, {'purchase_incomplete': True, 'unit_cost': Decimal(0)}),
+        ({'purchase_incomplete': True, 'unit_cost': 10.5}, {'purchase_incomplete': True, 'unit_cost': Decimal('10.5')}),
+        ({'unit_cost': 19.99}, {'unit_cost': Decimal('19.99')}),
+        ({'site_code': 'edx', 'message_id': 'bid'}, {'site_code': 'edx', 'message_id': 'bid'}),
+    )
+    @ddt.unpack
+    def test_parse_event(self, fields, expected):
+        event = parse_event(dict(EVENT, **fields), site_code='default')
+        self.assertEqual(event, dict({
+            'email': 'test@edx.org', 'course_url': COURSE_URL, 'purchase_incomplete': False, 'mode': 'verified',
+            'unit_cost': Decimal(49), 'course_id': 'edX/toy/2012_Fall', 'message_id': None, 'site_code': 'default',
+        }, **expected))
+
+    @ddt.data({'email': ''}, {'mode': None}, {'unit_cost': 'free'}, {'unit_cost': 'NaN'})
+    def test_invalid_event(self, fields):
+        self.assertEqual(Backfill(0).send(dict(EVENT, **fields)), INVALID)
+        self.assertFalse(self.responses['purchase'].called)
+
+    def test_send(self):
+        """Verify that events are recorded the way update_course_enrollment records them, without emails."""
+        sender = Backfill(0)
+        self.assertEqual(sender.send(EVENT), SENT)
+        self.responses['purchase'].assert_called_once_with(
+            'test@edx.org',
+            [{'id': 'edX/toy/2012_Fall-verified', 'url': COURSE_URL, 'qty': 1, 'title': 'Toy', 'price': 4900,
+              'vars': {'mode': 'verified', 'course_run_id': 'edX/toy/2012_Fall'}}],
+            incomplete=False, message_id=None, options={}
+        )
+
+        # the course content and the client are shared by the events of the site
+        self.assertEqual(sender.send(dict(EVENT, email='other@edx.org')), SENT)
+        self.assertEqual(self.responses['api_get'].call_count, 1)
+        self.assertEqual(len(sender.sites), 1)
+
+    @ddt.data('19.99', 19.99, '0.29', '4.35')
+    def test_price_in_cents(self, unit_cost):
+        """Verify that prices whose float is inexact are recorded to the cent, as the LMS's Decimals are."""
+        Backfill(0).send(dict(EVENT, unit_cost=unit_cost))
+        expected = int(Decimal(str(unit_cost)) * 100)
+        self.assertNotEqual(int(float(unit_cost) * 100), expected)
+        self.assertEqual(self.responses['purchase'].call_args[0][1][0]['price'], expected)
+
+    def test_send_templates(self):
+        Backfill(0, send_templates=True).send(EVENT)
+        self.assertEqual(self.responses['purchase'].call_args[1]['options'], {'send_template': 'upgrade_template'})
+
+    def test_free_event_ignored(self):
+        self.assertEqual(Backfill(0).send(dict(EVENT, mode='audit', unit_cost='0')), IGNORED)
+        self.assertFalse(self.responses['purchase'].called)
+
+    def test_disabled_site(self):
+        disabled = {'SAILTHRU_ENABLE': False}
+        with mock.patch('ecommerce_worker.sailthru.v1.tasks.get_configuration', return_value=disabled):
+            self.assertEqual(Backfill(0).send(EVENT), DISABLED)
+        self.assertFalse(self.responses['purchase'].called)
+
+    def test_retries(self):
+        """Verify that events failing with a retryable error are retried, then written to the failures file."""
+        self.responses['purchase'].return_value = MockSailthruResponse({}, error='rate limited', code=43)
+        failures = StringIO()
+        sender = Backfill(0, max_retries=2, retry_seconds=5, failures=failures)
+        self.assertEqual(sender.send(EVENT), FAILED)
+        self.assertEqual(self.responses['purchase'].call_count, 3)
+        self.assertEqual([call[0][0] for call in self.sleep.call_args_list], [5, 5])
+        self.assertEqual(json.loads(failures.getvalue()), EVENT)
+
+    def test_rate_limited_per_site(self):
+        limiter = mock.Mock()
+        with mock.patch.object(backfill_module, 'RateLimiter', return_value=limiter) as rate_limiter:
+            sender = Backfill(5)
+            sender.send(EVENT)
+            sender.send(dict(EVENT, site_code='test_site'))
+            sender.send(EVENT)
+        self.assertEqual(rate_limiter.call_args_list, [mock.call(5), mock.call(5)])
+        self.assertEqual(limiter.wait.call_count, 3)
+
+    def test_backfill(self):
+        progress = Progress(0, out=StringIO())
+        with mock.patch.object(Backfill, 'send', side_effect=[SENT, RuntimeError('unexpected'), INVALID]):
+            backfill(iter([EVENT, EVENT, EVENT]), Backfill(0), progress, concurrency=1)
+        self.assertEqual(progress.counts, {SENT: 1, FAILED: 1, INVALID: 1})
+
+    def test_command(self):
+        path = self.temporary_path('events.csv')
+        with open(path, 'w') as events:
+            events.write(','.join(sorted(EVENT)) + '\n')
+            events.write(','.join(EVENT[field] for field in sorted(EVENT)) + '\n')
+            events.write(','.join('' for field in sorted(EVENT)) + '\n')
+
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            main([path, '--rate', '0', '--failures', self.temporary_path('failures.jsonl')])
+        self.assertIn('1 invalid, 1 sent', stdout.getvalue())
+        self.assertTrue(self.responses['purchase'].called)
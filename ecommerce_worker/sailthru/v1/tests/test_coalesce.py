@@ -0,0 +1,164 @@
+"""Tests of abandoned cart coalescing."""
+from unittest import TestCase
+
+from mock import patch
+from sailthru.sailthru_error import SailthruClientError
+
+from ecommerce_worker.sailthru.v1.coalesce import is_superseded, new_token, pending_cart_var
+from ecommerce_worker.sailthru.v1.tasks import update_course_enrollment, dispatch_tables
+from ecommerce_worker.sailthru.v1.tests.sailthru_tests import MockSailthruResponse
+from ecommerce_worker.utils import get_configuration
+
+TEST_EMAIL = "test@edx.org"
+
+
+class PendingCartTests(TestCase):
+    """
+    Tests for the pending cart vars.
+    """
+
+    def test_latest_event_wins(self):
+        first, second = new_token(), new_token()
+        user_vars = {pending_cart_var('site', 'course-verified'): second}
+        self.assertTrue(is_superseded(user_vars, 'site', 'course-verified', first))
+        self.assertFalse(is_superseded(user_vars, 'site', 'course-verified', second))
+
+    def test_keys_are_independent(self):
+        names = {pending_cart_var(None, 'course-verified'), pending_cart_var('other_site', 'course-verified'),
+                 pending_cart_var(None, 'course-credit')}
+        self.assertEqual(len(names), 3)
+        self.assertEqual(pending_cart_var(None, 'course-verified'), pending_cart_var('', 'course-verified'))
+
+    def test_cancelled(self):
+        user_vars = {pending_cart_var('site', 'course-verified'): ''}
+        self.assertTrue(is_superseded(user_vars, 'site', 'course-verified', new_token()))
+
+    def test_unknown_events_not_superseded(self):
+        """Events missing from the user record are sent."""
+        self.assertFalse(is_superseded({}, 'site', 'course-verified', new_token()))
+        self.assertFalse(is_superseded(None, 'site', 'course-verified', new_token()))
+
+
+@patch('ecommerce_worker.sailthru.v1.tasks.SailthruClient.purchase')
+@patch('ecommerce_worker.sailthru.v1.tasks.SailthruClient.api_get')
+@patch('ecommerce_worker.sailthru.v1.tasks.SailthruClient.api_post')
+@patch('ecommerce_worker.sailthru.v1.tasks.get_configuration')
+class CoalescedEnrollmentTests(TestCase):
+    """
+    Tests for update_course_enrollment with coalescing enabled.
+
+    The user record is shared by every worker, so tokens recorded by a worker stand for
+    events deferred on any host.
+    """
+
+    def setUp(self):
+        super(CoalescedEnrollmentTests, self).setUp()
+        dispatch_tables.clear()
+        self.addCleanup(dispatch_tables.clear)
+        self.course_id = 'edX/toy/2012_Fall'
+        self.course_url = 'http://lms.testserver.fake/courses/edX/toy/2012_Fall/info'
+        self.item_id = self.course_id + '-verified'
+        self.var = pending_cart_var(None, self.item_id)
+        self.config = dict(get_configuration('SAILTHRU'), SAILTHRU_ABANDONED_CART_COALESCE_SECONDS=60)
+        self.user_vars = {}
+
+    def _enroll(self, purchase_incomplete, coalesce_token=None):
+        """Run the task for a verified seat of the test course"""
+        update_course_enrollment.delay(TEST_EMAIL,
+                                       self.course_url,
+                                       purchase_incomplete,
+                                       'verified',
+                                       course_id=self.course_id,
+                                       unit_cost=49,
+                                       coalesce_token=coalesce_token)
+
+    def _post_user(self, api, data):
+        """Update the vars of the user record"""
+        self.assertEqual(api, 'user')
+        self.user_vars.update(data['vars'])
+        return MockSailthruResponse({'ok': True})
+
+    def _get_user(self, api, data):  # pylint: disable=unused-argument
+        """Read the vars of the user record"""
+        return MockSailthruResponse({'vars': dict(self.user_vars)})
+
+    def _mock_responses(self, mock_get_configuration, mock_api_post, mock_api_get, mock_purchase):
+        """Set up configuration and Sailthru responses"""
+        mock_get_configuration.return_value = self.config
+        mock_api_post.side_effect = self._post_user
+        mock_api_get.side_effect = self._get_user
+        mock_purchase.return_value = MockSailthruResponse({'ok': True})
+
+    def test_deferred_event_sent(self, *mocks):
+        """The deferred event is recorded in the user record, then sent"""
+        self._mock_responses(*mocks)
+        mock_purchase = mocks[-1]
+
+        self._enroll(True)
+        self.assertEqual(mock_purchase.call_count, 1)
+        self.assertTrue(mock_purchase.call_args[1]['incomplete'])
+        self.assertTrue(self.user_vars[self.var])
+
+    def test_superseded_event_dropped(self, *mocks):
+        """An event replaced by a later add-to-cart, on any host, is not sent"""
+        self._mock_responses(*mocks)
+        mock_purchase = mocks[-1]
+
+        self.user_vars[self.var] = 'latest-token'
+        self._enroll(True, coalesce_token='stale-token')
+        mock_purchase.assert_not_called()
+
+        self._enroll(True, coalesce_token='latest-token')
+        self.assertEqual(mock_purchase.call_count, 1)
+
+    def test_completed_purchase_cancels_pending(self, *mocks):
+        """A completed purchase cancels the pending abandoned cart event"""
+        self._mock_responses(*mocks)
+        mock_purchase = mocks[-1]
+
+        self.user_vars[self.var] = 'pending-token'
+        self._enroll(False)
+        self.assertEqual(mock_purchase.call_count, 1)
+        self.assertFalse(mock_purchase.call_args[1]['incomplete'])
+        self.assertEqual(self.user_vars[self.var], '')
+
+        self._enroll(True, coalesce_token='pending-token')
+        self.assertEqual(mock_purchase.call_count, 1)
+
+    def test_unknown_event_sent(self, *mocks):
+        """A deferred event missing from the user record is sent, not dropped"""
+        self._mock_responses(*mocks)
+        mock_purchase = mocks[-1]
+
+        self._enroll(True, coalesce_token='unrecorded-token')
+        self.assertEqual(mock_purchase.call_count, 1)
+        self.assertTrue(mock_purchase.call_args[1]['incomplete'])
+
+    def test_record_failure_sends_now(self, *mocks):
+        """An event which cannot be recorded as pending is sent without waiting"""
+        self._mock_responses(*mocks)
+        mock_api_post, mock_api_get, mock_purchase = mocks[1:]
+        mock_api_post.side_effect = None
+        mock_api_post.return_value = MockSailthruResponse({}, error='error')
+
+        self._enroll(True)
+        # the event was not deferred, so it did not look for newer events
+        self.assertNotIn('user', [call[0][0] for call in mock_api_get.call_args_list])
+        self.assertEqual(mock_purchase.call_count, 1)
+        self.assertTrue(mock_purchase.call_args[1]['incomplete'])
+
+    def test_check_failure(self, *mocks):
+        """A deferred event whose user record cannot be read is retried, unless the error is final"""
+        self._mock_responses(*mocks)
+        mock_api_get, mock_purchase = mocks[2], mocks[-1]
+
+        mock_api_get.side_effect = SailthruClientError
+        with patch('ecommerce_worker.sailthru.v1.tasks._schedule_retry') as schedule_retry:
+            self._enroll(True, coalesce_token='pending-token')
+        self.assertEqual(schedule_retry.call_count, 1)
+        mock_purchase.assert_not_called()
+
+        mock_api_get.side_effect = None
+        mock_api_get.return_value = MockSailthruResponse({}, error='error', code=99)
+        self._enroll(True, coalesce_token='pending-token')
+        self.assertEqual(mock_purchase.call_count, 1)
@@ -0,0 +1,70 @@
+"""Tests of the Sailthru dispatch tables."""
+from unittest import TestCase
+
+import ddt
+from mock import patch
+
+from ecommerce_worker.sailthru.v1.dispatch import SiteDispatch
+from ecommerce_worker.sailthru.v1.tasks import build_dispatch_tables, dispatch_tables, get_site_dispatch
+from ecommerce_worker.utils import get_configuration
+
+
+@ddt.ddt
+class SiteDispatchTests(TestCase):
+    """
+    Tests for SiteDispatch.
+    """
+
+    def setUp(self):
+        super(SiteDispatchTests, self).setUp()
+        self.dispatch = SiteDispatch(get_configuration('SAILTHRU'))
+
+    @ddt.data('verified', 'audit', 'credit')
+    def test_incomplete(self, mode):
+        self.assertEqual(self.dispatch.event(mode, True),
+                         (False, {'reminder_template': 'abandoned_template', 'reminder_time': '+60 minutes'}))
+
+    @ddt.data(
+        ('verified', False, 'upgrade_template'),
+        ('audit', True, 'enroll_template'),
+        ('honor', True, 'enroll_template'),
+        ('credit', True, 'purchase_template'),
+        ('professional', True, 'purchase_template'),
+    )
+    @ddt.unpack
+    def test_complete(self, mode, new_enroll, template):
+        self.assertEqual(self.dispatch.event(mode, False), (new_enroll, {'send_template': template}))
+
+    def test_unconfigured_templates(self):
+        dispatch = SiteDispatch({'SAILTHRU_ENABLE': True})
+        self.assertEqual(dispatch.event('verified', True), (False, {}))
+        self.assertEqual(dispatch.event('verified', False), (False, {}))
+        self.assertEqual(dispatch.event('audit', False), (True, {}))
+
+
+class DispatchTableTests(TestCase):
+    """
+    Tests for the per-site dispatch table registry.
+    """
+
+    def setUp(self):
+        super(DispatchTableTests, self).setUp()
+        dispatch_tables.clear()
+        self.addCleanup(dispatch_tables.clear)
+
+    def test_built_once(self):
+        dispatch = get_site_dispatch(None)
+        with patch('ecommerce_worker.sailthru.v1.tasks.get_configuration') as mock_get_configuration:
+            self.assertIs(get_site_dispatch(None), dispatch)
+            self.assertFalse(mock_get_configuration.called)
+
+    def test_build_on_worker_start(self):
+        with patch('ecommerce_worker.configuration.test.SITE_OVERRIDES', get_configuration('TEST_SITE_OVERRIDES')):
+            build_dispatch_tables()
+        self.assertEqual(set(dispatch_tables), {None, 'test_site'})
+        self.assertEqual(dispatch_tables['test_site'].upgrade, (False, {'send_template': 'site_upgrade_template'}))
+
+    def test_build_without_site_overrides(self):
+        with patch('ecommerce_worker.configuration.test.SITE_OVERRIDES', None):
+            build_dispatch_tables()
+        self.assertEqual(set(dispatch_tables), {None})
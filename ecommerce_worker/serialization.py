@@ -0,0 +1,159 @@
+"""
+Compact binary serializer for task messages.
+
+The 'compact' serializer packs task messages with msgpack. The fields of the message are
+packed by position rather than by name, and keyword arguments which follow the positional
+arguments of a registered task are packed as positional arguments, so that the names of
+update_course_enrollment's optional arguments are not repeated in every message. Packed
+messages larger than COMPACT_COMPRESSION_THRESHOLD bytes are compressed with zlib. Decimals,
+such as the unit_cost of update_course_enrollment, are packed as a msgpack extension type holding
+their string form, and unpacked as the same Decimal.
+
+Other data, such as the task signatures kept by the local stores, is packed as it is.
+
+The serializer is registered with kombu when this module is imported, which celery_app does.
+It requires msgpack-python, listed in requirements/optional.txt. Workers accept compact
+messages once it is registered; producers opt in by setting CELERY_TASK_SERIALIZER to 'compact'.
+"""
+from decimal import Decimal
+import inspect
+import zlib
+
+from celery import current_app
+from kombu.serialization import register as register_serializer
+try:
+    import msgpack
+except ImportError:
+    msgpack = None  # pylint: disable=invalid-name
+
+from ecommerce_worker.utils import get_configuration
+
+SERIALIZER = 'compact'
+CONTENT_TYPE = 'application/x-ecommerce-worker-compact'
+
+# Fields of a Celery task message, in the order they are packed
+MESSAGE_FIELDS = (
+    'task', 'id', 'args', 'kwargs', 'retries', 'eta', 'expires', 'utc',
+    'callbacks', 'errbacks', 'timelimit', 'taskset', 'chord',
+)
+
+# First byte of a serialized payload
+RAW = b'\x00'
+COMPRESSED = b'\x01'
+
+# First item of a packed payload
+PLAIN = 0
+MESSAGE = 1
+
+# Codes of the msgpack extension types
+DECIMAL = 1
+
+# Parameter names of the registered tasks, by task name
+parameter_names = {}  # pylint: disable=invalid-name
+
+
+def _parameter_names(task_name):
+    """Names of the parameters of a registered task, or None if they cannot be told."""
+    if task_name in parameter_names:
+        return parameter_names[task_name]
+
+    task = current_app.tasks.get(task_name)
+    if task is None:
+        return None
+    try:
+        names = inspect.getargspec(task.run).args
+    except TypeError:
+        names = None
+    else:
+        # the task itself is the first argument of bound tasks
+        names = names[1:] if inspect.ismethod(task.run) else names
+    parameter_names[task_name] = names
+    return names
+
+
+def pack_arguments(task_name, args, kwargs):
+    """
+    Move the keyword arguments following the positional arguments of a task into the positional arguments.
+
+    Arguments:
+        task_name (str): name of the task
+        args (list): positional arguments
+        kwargs (dict): keyword arguments
+
+    Returns:
+        tuple: (positional arguments, remaining keyword arguments)
+    """
+    names = _parameter_names(task_name) if kwargs else None
+    if not names:
+        return args, kwargs
+
+    args = list(args or ())
+    kwargs = dict(kwargs)
+    while len(args) < len(names) and names[len(args)] in kwargs:
+        args.append(kwargs.pop(names[len(args)]))
+    return args, kwargs
+
+
+def _is_message(data):
+    """Return True if data is a task message."""
+    return isinstance(data, dict) and 'task' in data and 'id' in data and 'args' in data
+
+
+def pack_extension(value):
+    """Pack values msgpack does not support as extension types."""
+    if isinstance(value, Decimal):
+        return msgpack.ExtType(DECIMAL, str(value).encode('ascii'))
+    raise TypeError('Cannot serialize {!r}'.format(value))
+
+
+def unpack_extension(code, data):
+    """Unpack the extension types packed by pack_extension."""
+    if code == DECIMAL:
+        return Decimal(data.decode('ascii'))
+    return msgpack.ExtType(code, data)
+
+
+def pack(data, compression_threshold=None):
+    """
+    Serialize data with msgpack, compressing it above a size.
+
+    Arguments:
+        data (object): data to serialize
+        compression_threshold (int): size in bytes above which the data is compressed, 0 to never
+            compress it (default: COMPACT_COMPRESSION_THRESHOLD)
+    """
+    if _is_message(data):
+        message = dict(data)
+        message['args'], message['kwargs'] = pack_arguments(message['task'], message['args'], message.get('kwargs'))
+        extra = {key: value for key, value in message.items() if key not in MESSAGE_FIELDS}
+        packed = msgpack.packb([MESSAGE] + [message.get(field) for field in MESSAGE_FIELDS] + [extra],
+                               use_bin_type=True, default=pack_extension)
+    else:
+        packed = msgpack.packb([PLAIN, data], use_bin_type=True, default=pack_extension)
+
+    if compression_threshold is None:
+        compression_threshold = get_configuration('COMPACT_COMPRESSION_THRESHOLD')
+    if compression_threshold and len(packed) > compression_threshold:
+        return COMPRESSED + zlib.compress(packed)
+    return RAW + packed
+
+
+def unpack(payload):
+    """Deserialize data serialized by pack."""
+    packed = zlib.decompress(payload[1:]) if payload[:1] == COMPRESSED else payload[1:]
+    unpacked = msgpack.unpackb(packed, encoding='utf-8', ext_hook=unpack_extension)
+    if unpacked[0] == PLAIN:
+        return unpacked[1]
+
+    message = {str(key): value for key, value in unpacked[-1].items()}
+    message.update(zip(MESSAGE_FIELDS, unpacked[1:-1]))
+    return message
+
+
+def register():
+    """Register the compact serializer with kombu, if msgpack is installed."""
+    if msgpack is not None:
+        register_serializer(SERIALIZER, pack, unpack, content_type=CONTENT_TYPE, content_encoding='binary')
+
+
+register()
@@ -0,0 +1,141 @@
+"""
+Helpers of the commands which process a stream of items, such as orders or events read from a file.
+
+Items are handled from a bounded pool of threads reading a bounded number of items ahead, so
+memory stays constant however long the stream is.
+"""
+from __future__ import print_function
+
+from collections import Counter
+import Queue
+import sys
+import threading
+import time
+
+from ecommerce_worker.concurrency import Lock
+
+# seconds for which blocking calls of the main thread wait at a time, so that it can be interrupted
+POLL_INTERVAL = 0.5
+
+
+def _put(queue, item):
+    """Put an item in a bounded queue, waiting in a way that can be interrupted."""
+    while True:
+        try:
+            queue.put(item, timeout=POLL_INTERVAL)
+            return
+        except Queue.Full:
+            pass
+
+
+def process_stream(items, handle, concurrency=8):
+    """
+    Call handle on each item from concurrency threads, reading at most twice as many items ahead.
+
+    When interrupted, the items being handled are finished, the items read ahead are dropped,
+    and KeyboardInterrupt is raised.
+
+    Arguments:
+        items (iterable): items to handle, read from the calling thread
+        handle (callable): called with each item; it must not raise
+        concurrency (int): number of items handled at a time
+    """
+    queue = Queue.Queue(maxsize=concurrency * 2)
+    stopped = threading.Event()
+
+    def work():
+        """Handle queued items until told to stop."""
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            if not stopped.is_set():
+                handle(item)
+
+    threads = [threading.Thread(target=work, name='Stream-{}'.format(index)) for index in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for item in items:
+            _put(queue, item)
+    except KeyboardInterrupt:
+        stopped.set()
+        raise
+    finally:
+        for __ in threads:
+            _put(queue, None)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(POLL_INTERVAL)
+
+
+class RateLimiter(object):
+    """
+    Spaces the calls of its callers, across threads, to at most rate per second.
+
+    Arguments:
+        rate (float): calls per second (0 for no limit)
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next = 0.0
+        self._lock = Lock()
+
+    def wait(self):
+        """Wait for the turn of the calling thread."""
+        with self._lock:
+            now = time.time()
+            turn = max(now, self.next)
+            self.next = turn + self.interval
+        if turn > now:
+            time.sleep(turn - now)
+
+
+class Progress(object):
+    """
+    Counts the items by outcome and reports the throughput.
+
+    Arguments:
+        interval (float): seconds between two reports (0 disables them)
+        noun (str): what the items are, in reports
+        passed (tuple): outcomes of the items passed over, not counted in the throughput
+        out (file): where reports are written, stdout by default
+    """
+
+    def __init__(self, interval, noun='items', passed=(), out=None):
+        self.interval = interval
+        self.noun = noun
+        self.passed = passed
+        self.out = out or sys.stdout
+        self.counts = Counter()
+        self.started = self.reported = time.time()
+        self._lock = Lock()
+
+    def add(self, outcome):
+        """Count an item, and report the progress if it is due."""
+        with self._lock:
+            self.counts[outcome] += 1
+            now = time.time()
+            if self.interval and now - self.reported >= self.interval:
+                self.reported = now
+                self.report(now)
+
+    def report(self, now=None):
+        """Write the number of items per outcome and the rate at which they are processed."""
+        elapsed = (now or time.time()) - self.started
+        processed = sum(count for outcome, count in self.counts.items() if outcome not in self.passed)
+        print(
+            '{processed} {noun} processed in {elapsed:.0f}s ({rate:.1f}/s): {outcomes}.'.format(
+                processed=processed,
+                noun=self.noun,
+                elapsed=elapsed,
+                rate=processed / elapsed if elapsed > 0 else 0.0,
+                outcomes=', '.join('{} {}'.format(count, outcome.replace('_', ' '))
+                                   for outcome, count in sorted(self.counts.items())) or 'none',
+            ),
+            file=self.out
+        )
+        self.out.flush()
@@ -0,0 +1,17 @@
+"""Helpers shared by the tests."""
+import os
+import shutil
+import tempfile
+
+
+class TemporaryDirectoryMixin(object):
+    """Creates a temporary directory for each test, removed once the test is done."""
+
+    def setUp(self):
+        super(TemporaryDirectoryMixin, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def temporary_path(self, *names):
+        """Path of a file in the temporary directory."""
+        return os.path.join(self.directory, *names)
@@ -0,0 +1,83 @@
+"""Tests of the health-checked broker connection pool."""
+# pylint: disable=protected-access
+import socket
+from unittest import TestCase
+
+import mock
+
+from ecommerce_worker.broker import HealthCheckedConnection, HealthCheckedConnectionPool
+from ecommerce_worker.celery_app import app
+
+
+class HealthCheckedConnectionPoolTests(TestCase):
+    """Tests covering HealthCheckedConnectionPool."""
+
+    def setUp(self):
+        super(HealthCheckedConnectionPoolTests, self).setUp()
+        self.pool = HealthCheckedConnectionPool(HealthCheckedConnection('memory://'), limit=2,
+                                                max_age=300, max_idle=30)
+        self.addCleanup(self.pool.force_close_all)
+        self.now = 1000.0
+        patcher = mock.patch('ecommerce_worker.broker.time.time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def use(self):
+        """Acquire a connection, use it and release it."""
+        connection = self.pool.acquire()
+        connection.default_channel  # pylint: disable=pointless-statement
+        connection.release()
+        return connection
+
+    def test_reuses_healthy_connection(self):
+        connection = self.use()
+        self.now += 10
+        self.assertIs(self.use(), connection)
+
+    def test_unconnected_connection_is_kept(self):
+        connection = self.pool.acquire()
+        self.assertIsNone(self.pool.recycle_reason(connection))
+        connection.release()
+
+    def test_idle_connection_is_replaced(self):
+        connection = self.use()
+        self.now += 30
+        self.assertEqual(self.pool.recycle_reason(connection), 'idle')
+        replacement = self.use()
+        self.assertIsNot(replacement, connection)
+        self.assertTrue(replacement.connected)
+
+    def test_old_connection_is_replaced(self):
+        """Connections in constant use are still replaced once they reach the maximum age."""
+        connection = self.use()
+        for __ in range(10):
+            self.now += 29
+            self.assertIs(self.use(), connection)
+
+        self.now += 10
+        self.assertEqual(self.pool.recycle_reason(connection), 'age')
+        self.assertIsNot(self.use(), connection)
+
+    def test_closed_connection_is_replaced(self):
+        connection = self.use()
+        with mock.patch.object(connection.transport, 'verify_connection', return_value=False):
+            self.assertEqual(self.pool.recycle_reason(connection), 'closed')
+
+    def test_severed_connection_is_replaced(self):
+        """A connection whose peer has gone away is detected through its socket."""
+        connection = self.use()
+        local, remote = socket.socketpair()
+        self.addCleanup(local.close)
+        connection._connection.transport = mock.Mock(sock=local)
+        self.assertIsNone(self.pool.recycle_reason(connection))
+
+        remote.close()
+        self.assertEqual(self.pool.recycle_reason(connection), 'severed')
+
+    def test_app_uses_pool(self):
+        """The Celery app publishes through health-checked connections."""
+        connection = app.connection()
+        self.assertIsInstance(connection, HealthCheckedConnection)
+        pool = connection.Pool(limit=1)
+        self.assertIsInstance(pool, HealthCheckedConnectionPool)
+        self.assertEqual((pool.max_age, pool.max_idle), (300, 30))
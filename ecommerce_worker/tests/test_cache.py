@@ -3,6 +3,7 @@ import logging
 from unittest import TestCase
 
 from ecommerce_worker.cache import Cache
+from ecommerce_worker.metrics import registry
 
 log = logging.getLogger(__name__)
 
@@ -39,3 +40,23 @@ class CacheTests(TestCase):
         self.assertEquals(cache.get('key2'), 'value2')
         self.assertEquals(cache.get('key1'), 'value1')
         self.assertEquals(cache.get('key3'), None)
+
+    def test_cache_metrics(self):
+        """
+        Test that lookups and evictions are counted
+        """
+        def count(event):
+            """Current count of a cache event"""
+            return registry.collect().get(('ecommerce_worker_cache_events_total', (event,)), 0)
+
+        before = {event: count(event) for event in ('hit', 'miss', 'eviction')}
+        cache = Cache()
+        cache.set('key1', 'value1', 100)
+        cache.set('key2', 'value2', -100)
+        cache.set('key3', 'value3', -100)
+        cache.get('key1')
+        cache.get('key2')
+        cache.get('missing')
+
+        self.assertEqual({event: count(event) - before[event] for event in before},
+                         {'hit': 1, 'miss': 2, 'eviction': 2})
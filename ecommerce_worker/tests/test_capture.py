@@ -0,0 +1,193 @@
+"""Tests of the capture of received tasks."""
+from decimal import Decimal
+import os
+from unittest import TestCase, skipIf
+
+import ddt
+import mock
+
+from ecommerce_worker.capture import (
+    Capture, CaptureWriter, capture_record, get_capture_salt, msgpack, pseudonymize, read_capture
+)
+from ecommerce_worker.celery_app import app
+from ecommerce_worker.fulfillment.v1.tasks import fulfill_order
+from ecommerce_worker.sailthru.v1.tasks import update_course_enrollment
+from ecommerce_worker.tests.mixins import TemporaryDirectoryMixin
+from ecommerce_worker.utils import hash_email
+
+COURSE_URL = 'https://courses.example.com/courses/course-v1:edX+DemoX+Demo_Course/info'
+SALT = '0123456789abcdef'
+
+
+def message(task, args, kwargs=None, retries=0):
+    """Body of a task message."""
+    return {'task': task.name, 'id': 'task-id', 'args': args, 'kwargs': kwargs or {}, 'retries': retries}
+
+
+@ddt.ddt
+class CaptureRecordTests(TestCase):
+    """Tests covering the description of captured tasks."""
+
+    @ddt.data('learner@example.com', u'Learner@Example.com ')
+    def test_pseudonymize_email(self, email):
+        pseudonym = pseudonymize(email, SALT)
+        self.assertEqual(pseudonym, pseudonymize('learner@example.com', SALT))
+        self.assertTrue(pseudonym.endswith('@capture.invalid'))
+
+    def test_pseudonyms_are_salted(self):
+        """Pseudonyms differ from the hash_email digests of the logs, and from one capture to the next."""
+        pseudonym = pseudonymize('learner@example.com', SALT)
+        self.assertNotIn(hash_email('learner@example.com'), pseudonym)
+        self.assertNotEqual(pseudonym, pseudonymize('learner@example.com', 'another salt'))
+        self.assertNotEqual(pseudonym, pseudonymize('other@example.com', SALT))
+
+    @ddt.data('EDX-100042', COURSE_URL, Decimal('49.00'), None, 'not an @ddress')
+    def test_keeps_other_values(self, value):
+        self.assertEqual(pseudonymize(value, SALT), value)
+
+    def test_capture_record(self):
+        body = message(update_course_enrollment, ['learner@example.com', COURSE_URL, False, 'verified'],
+                       {'unit_cost': Decimal('49.00'), 'site_code': 'edx'})
+        self.assertEqual(capture_record(update_course_enrollment, body, 1000.0, SALT), [
+            1000.0,
+            update_course_enrollment.name,
+            [pseudonymize('learner@example.com', SALT), COURSE_URL, False, 'verified'],
+            {'unit_cost': Decimal('49.00'), 'site_code': 'edx'},
+            'edx',
+        ])
+
+    def test_site_code_by_position(self):
+        record = capture_record(fulfill_order, message(fulfill_order, ['EDX-1', 'edx']), 1000.0, SALT)
+        self.assertEqual(record[-1], 'edx')
+
+    def test_retries_not_captured(self):
+        self.assertIsNone(capture_record(fulfill_order, message(fulfill_order, ['EDX-1'], retries=1), 1000.0, SALT))
+
+
+@skipIf(msgpack is None, 'msgpack is not installed')
+class CaptureTests(TemporaryDirectoryMixin, TestCase):
+    """Tests covering the capture file and the consumer bootstep."""
+
+    def setUp(self):
+        super(CaptureTests, self).setUp()
+        self.path = self.temporary_path('capture', 'capture.bin')
+
+    def read(self):
+        """The tasks of the capture file."""
+        with open(self.path, 'rb') as capture:
+            return list(read_capture(capture))
+
+    def test_writer(self):
+        writer = CaptureWriter(self.path)
+        self.assertTrue(writer.write([1000.0, 'task', [1], {}, None]))
+        writer.close()
+
+        # appended to by another process
+        writer = CaptureWriter(self.path)
+        writer.write([1001.5, 'task', [], {'a': u'\xe9'}, 'edx'])
+        writer.close()
+
+        self.assertEqual(self.read(), [
+            {'at': 1000.0, 'task': 'task', 'args': [1], 'kwargs': {}, 'site_code': None},
+            {'at': 1001.5, 'task': 'task', 'args': [], 'kwargs': {'a': u'\xe9'}, 'site_code': 'edx'},
+        ])
+
+    def test_decimal_arguments(self):
+        """Verify that the Decimal unit cost of update_course_enrollment is captured and read back as a Decimal."""
+        body = message(update_course_enrollment, ['learner@example.com', COURSE_URL, False, 'verified'],
+                       {'unit_cost': Decimal('49.99'), 'site_code': 'edx'})
+        writer = CaptureWriter(self.path)
+        self.assertTrue(writer.write(capture_record(update_course_enrollment, body, 1000.0, writer.salt)))
+        writer.close()
+
+        unit_cost = self.read()[0]['kwargs']['unit_cost']
+        self.assertIsInstance(unit_cost, Decimal)
+        self.assertEqual(unit_cost, Decimal('49.99'))
+
+    def test_max_bytes(self):
+        writer = CaptureWriter(self.path, max_bytes=1)
+        self.assertTrue(writer.write([1000.0, 'task', [], {}, None]))
+        self.assertFalse(writer.write([1001.0, 'task', [], {}, None]))
+        writer.close()
+        self.assertEqual(len(self.read()), 1)
+
+    def test_max_bytes_shared(self):
+        """Verify that the size reached through the writers of other processes stops the capture."""
+        record = [1000.0, 'task', [], {}, None]
+        writer = CaptureWriter(self.path, max_bytes=len(msgpack.packb(record, use_bin_type=True)) * 2)
+        other_writer = CaptureWriter(self.path)
+        self.addCleanup(writer.close)
+        self.addCleanup(other_writer.close)
+
+        self.assertTrue(writer.write(record))
+        other_writer.write(record)
+        self.assertFalse(writer.write(record))
+        self.assertEqual(len(self.read()), 2)
+
+    def test_salt(self):
+        """Verify that the writers of a capture share its salt, and that another capture has its own."""
+        salt = CaptureWriter(self.path).salt
+        self.assertEqual(len(salt), 32)
+        self.assertEqual(CaptureWriter(self.path).salt, salt)
+        self.assertEqual(get_capture_salt(self.path), salt)
+        self.assertEqual(oct(os.stat(self.path + '.salt').st_mode & 0o777), oct(0o600))
+        self.assertNotEqual(get_capture_salt(self.path + '.next'), salt)
+
+    def test_salt_created_concurrently(self):
+        """Verify that a salt linked by another process first is the one used."""
+        real_link = os.link
+
+        def link_other_salt(source, destination):
+            """Another process links its salt first."""
+            with open(destination, 'w') as salt_file:
+                salt_file.write('other-salt')
+            real_link(source, destination)
+
+        with mock.patch('ecommerce_worker.capture.os.link', side_effect=link_other_salt):
+            self.assertEqual(get_capture_salt(self.path), 'other-salt')
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['capture.bin.salt'])
+
+    def start_consumer(self):
+        """Start the bootstep on a consumer, returning the strategy of fulfill_order it wraps."""
+        strategy = mock.Mock()
+        consumer = mock.Mock(app=app, strategies={fulfill_order.name: strategy})
+        step = Capture(consumer)
+        step.start(consumer)
+        self.addCleanup(step.shutdown, consumer)
+        return consumer, strategy
+
+    def test_captures_received_tasks(self):
+        with mock.patch('ecommerce_worker.configuration.test.CAPTURE_ENABLED', True):
+            with mock.patch('ecommerce_worker.configuration.test.CAPTURE_PATH', self.path, create=True):
+                consumer, strategy = self.start_consumer()
+
+        body = message(fulfill_order, ['EDX-1'], {'site_code': 'edx'})
+        consumer.strategies[fulfill_order.name]('message', body, 'ack', 'reject', [])
+        strategy.assert_called_once_with('message', body, 'ack', 'reject', [])
+
+        captured = self.read()
+        self.assertEqual([(task['task'], task['args'], task['site_code']) for task in captured],
+                         [(fulfill_order.name, ['EDX-1'], 'edx')])
+
+        body = message(update_course_enrollment, ['learner@example.com', COURSE_URL, False, 'verified'],
+                       {'unit_cost': Decimal('49.00')})
+        with mock.patch('ecommerce_worker.capture.logger') as logger:
+            consumer.strategies[fulfill_order.name]('message', body, 'ack', 'reject', [])
+        self.assertFalse(logger.exception.called)
+        self.assertEqual(self.read()[-1]['kwargs'], {'unit_cost': Decimal('49.00')})
+        self.assertEqual(self.read()[-1]['args'][0],
+                         pseudonymize('learner@example.com', get_capture_salt(self.path)))
+
+    def test_capture_failure(self):
+        """Verify that a task which cannot be captured is still handled."""
+        with mock.patch('ecommerce_worker.configuration.test.CAPTURE_ENABLED', True):
+            with mock.patch('ecommerce_worker.configuration.test.CAPTURE_PATH', self.path, create=True):
+                consumer, strategy = self.start_consumer()
+
+        body = message(fulfill_order, [object()])
+        consumer.strategies[fulfill_order.name]('message', body, 'ack', 'reject', [])
+        self.assertTrue(strategy.called)
+
+    def test_disabled(self):
+        consumer, strategy = self.start_consumer()
+        self.assertIs(consumer.strategies[fulfill_order.name], strategy)
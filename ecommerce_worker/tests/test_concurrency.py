@@ -0,0 +1,87 @@
+"""Tests of the primitives shared by the tasks of a worker process."""
+import thread
+import threading
+from unittest import TestCase
+
+from ecommerce_worker.concurrency import Local, Lock, OSThreadLocal, green_library, os_thread_ident
+
+
+def run_in_thread(function):
+    """Run function in another thread (a green thread when the process is patched) and return its result."""
+    results = []
+    worker_thread = threading.Thread(target=lambda: results.append(function()))
+    worker_thread.start()
+    worker_thread.join()
+    return results[0]
+
+
+class LockTests(TestCase):
+    """Tests covering Lock."""
+
+    def test_mutual_exclusion(self):
+        lock = Lock()
+        with lock:
+            self.assertFalse(run_in_thread(lambda: lock.acquire(False)))
+        self.assertTrue(run_in_thread(lambda: lock.acquire(False)))
+        self.assertFalse(lock.acquire(False))
+        lock.release()
+
+    def test_created_on_first_use(self):
+        """Nothing is allocated before the pool has patched the process."""
+        lock = Lock()
+        self.assertNotIn('lock', vars(lock))
+        self.assertTrue(lock.acquire())
+        lock.release()
+        self.assertIn('lock', vars(lock))
+
+
+class LocalTests(TestCase):
+    """Tests covering Local."""
+
+    def test_values_per_thread(self):
+        local = Local()
+        local.value = 'main'
+        self.assertFalse(run_in_thread(lambda: hasattr(local, 'value')))
+
+        def set_value():
+            """Set the value of the calling thread."""
+            local.value = 'other'
+
+        run_in_thread(set_value)
+        self.assertEqual(local.value, 'main')
+
+        del local.value
+        with self.assertRaises(AttributeError):
+            local.value  # pylint: disable=pointless-statement
+
+
+class OSThreadLocalTests(TestCase):
+    """Tests covering OSThreadLocal."""
+
+    def test_values_per_os_thread(self):
+        local = OSThreadLocal()
+        local.value = 'main'
+        if green_library():
+            # green threads share the values of the OS thread running them
+            self.assertEqual(run_in_thread(lambda: local.value), 'main')
+        else:
+            self.assertFalse(run_in_thread(lambda: hasattr(local, 'value')))
+
+        del local.value
+        with self.assertRaises(AttributeError):
+            local.value  # pylint: disable=pointless-statement
+        with self.assertRaises(AttributeError):
+            del local.value
+
+    def test_os_thread_ident(self):
+        get_ident = os_thread_ident()
+        self.assertEqual(get_ident(), get_ident())
+        self.assertEqual(run_in_thread(get_ident) == get_ident(), bool(green_library()))
+
+
+class GreenLibraryTests(TestCase):
+    """Tests covering green_library."""
+
+    def test_green_library(self):
+        """The library is only reported when the thread module is patched."""
+        self.assertEqual(green_library() is None, thread.get_ident is os_thread_ident())
@@ -0,0 +1,102 @@
+"""Tests of the dead-letter store and replay."""
+# pylint: disable=unbalanced-tuple-unpacking
+from unittest import TestCase
+
+import mock
+
+from ecommerce_worker.celery_app import app
+from ecommerce_worker.dead_letter import DeadLetterStore, main, record_exhausted, replay
+from ecommerce_worker.delayed_retry import retry_task
+from ecommerce_worker.fulfillment.v1.tasks import fulfill_order
+from ecommerce_worker.tests.mixins import TemporaryDirectoryMixin
+
+
+class DeadLetterTests(TemporaryDirectoryMixin, TestCase):
+    """Tests covering the capture and replay of tasks whose retries are exhausted."""
+
+    def setUp(self):
+        super(DeadLetterTests, self).setUp()
+        self.store = DeadLetterStore(self.temporary_path('dead_letter.db'))
+        patcher = mock.patch('ecommerce_worker.dead_letter.get_dead_letter_store', return_value=self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.task = app.tasks[fulfill_order.name]
+
+    def exhaust(self, order_number, site_code=None, retries=11, routing_key='fulfillment'):
+        """Exhaust the retries of a fulfillment task received from the broker."""
+        self.task.push_request(id='task-' + order_number, args=(order_number,), kwargs={'site_code': site_code},
+                               retries=retries, called_directly=False, is_eager=False,
+                               delivery_info={'exchange': 'fulfillment', 'routing_key': routing_key})
+        try:
+            with self.assertRaises(ValueError):
+                retry_task(self.task, 2 ** retries, 11, exc=ValueError('server error'))
+        finally:
+            self.task.pop_request()
+
+    def test_records_exhausted_tasks(self):
+        self.exhaust('ORDER-1', site_code='test_site')
+
+        letter, = self.store.pending()
+        self.assertEqual(
+            (letter['task'], letter['task_id'], letter['site_code'], letter['retries'], letter['error']),
+            (fulfill_order.name, 'task-ORDER-1', 'test_site', 11, 'ValueError: server error')
+        )
+        self.assertEqual(list(letter['signature']['args']), ['ORDER-1'])
+        self.assertEqual(letter['signature']['options'], {'exchange': 'fulfillment', 'routing_key': 'fulfillment'})
+
+    def test_retries_are_not_recorded(self):
+        with mock.patch.object(self.task, 'apply_async'):
+            with self.assertRaises(Exception):
+                self.exhaust('ORDER-1', retries=3)
+        self.assertEqual(self.store.pending(), [])
+
+    def test_store_failure_is_not_raised(self):
+        """The task's own failure is reported even if it cannot be recorded."""
+        with mock.patch.object(self.store, 'add', side_effect=IOError):
+            self.exhaust('ORDER-1')
+
+    def test_sailthru_error(self):
+        """Sailthru tasks are recorded with the last error returned by Sailthru."""
+        task = mock.Mock(request=mock.Mock(id='task-id', args=('someone@example.com',), kwargs={}, retries=24,
+                                           delivery_info={}),
+                         serializer='pickle')
+        task.name = 'sailthru_task'
+        task.run = lambda email, site_code=None: None
+        task.subtask.return_value = {'task': 'sailthru_task', 'args': ('someone@example.com',), 'kwargs': {}}
+        record_exhausted(task, 'purchase error 9: Internal error')
+        letter, = self.store.pending()
+        self.assertEqual((letter['task'], letter['error']), ('sailthru_task', 'purchase error 9: Internal error'))
+
+    def test_replay(self):
+        """Tasks are published again, once, to their queue and with a fresh retry budget."""
+        for index in range(5):
+            self.exhaust('ORDER-{}'.format(index), site_code='test_site' if index % 2 else None)
+
+        with mock.patch.object(self.task, 'apply_async') as apply_async:
+            self.assertEqual(replay(self.store, rate=1000, site_code='test_site', batch_size=1), 2)
+            self.assertEqual(replay(self.store, rate=1000, limit=2), 2)
+            self.assertEqual(replay(self.store, rate=1000), 1)
+            self.assertEqual(replay(self.store, rate=1000), 0)
+
+        self.assertEqual([call[0][0] for call in apply_async.call_args_list],
+                         [('ORDER-{}'.format(index),) for index in (1, 3, 0, 2, 4)])
+        self.assertEqual(apply_async.call_args[1], {'exchange': 'fulfillment', 'routing_key': 'fulfillment'})
+
+    def test_replay_rate(self):
+        for index in range(3):
+            self.exhaust('ORDER-{}'.format(index))
+
+        with mock.patch.object(self.task, 'apply_async'):
+            with mock.patch('ecommerce_worker.dead_letter.time.time', return_value=100.0):
+                with mock.patch('ecommerce_worker.dead_letter.time.sleep') as sleep:
+                    replay(self.store, rate=2)
+        self.assertEqual([call[0][0] for call in sleep.call_args_list], [0.5, 1.0])
+
+    def test_command(self):
+        self.exhaust('ORDER-1')
+        with mock.patch.object(self.task, 'apply_async') as apply_async:
+            main(['--list'])
+            self.assertFalse(apply_async.called)
+            main(['--rate', '100'])
+        self.assertTrue(apply_async.called)
+        self.assertEqual(self.store.pending(), [])
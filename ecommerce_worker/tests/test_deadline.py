@@ -0,0 +1,90 @@
+"""Tests of the time budgets of task executions."""
+from unittest import TestCase
+
+import httpretty
+import mock
+import requests
+
+from ecommerce_worker import deadline
+from ecommerce_worker.celery_app import app
+from ecommerce_worker.deadline import DeadlineExceeded, bound_timeout, get_budget, install
+
+
+@app.task(name='ecommerce_worker.tests.test_deadline.budgeted_task')
+def budgeted_task(site_code=None):  # pylint: disable=unused-argument
+    """Task exercised by the tests, returning the time left to it."""
+    return deadline.remaining()
+
+
+BUDGETS = {'ecommerce_worker.tests.test_deadline.budgeted_task': 10}
+
+
+class DeadlineTests(TestCase):
+    """Tests covering the budgets and their application to outbound calls."""
+
+    URL = 'http://api.example.com/resource/'
+
+    def setUp(self):
+        super(DeadlineTests, self).setUp()
+        install()
+        self.addCleanup(deadline.clear)
+
+    def test_bound_timeout(self):
+        self.assertEqual(bound_timeout(None, 3), 3)
+        self.assertEqual(bound_timeout(10, 3), 3)
+        self.assertEqual(bound_timeout(2, 3), 2)
+        self.assertEqual(bound_timeout((1, 10), 3), (1, 3))
+        self.assertEqual(bound_timeout((None, None), 3), (3, 3))
+
+    def test_no_budget(self):
+        self.assertIsNone(deadline.remaining())
+        self.assertFalse(deadline.expired())
+        deadline.start('task', None)
+        self.assertIsNone(deadline.remaining())
+
+    def test_expiry(self):
+        with mock.patch('ecommerce_worker.deadline.time.time', return_value=100):
+            deadline.start('task', 5)
+        with mock.patch('ecommerce_worker.deadline.time.time', return_value=104):
+            self.assertEqual(deadline.remaining(), 1)
+            self.assertFalse(deadline.expired())
+        with mock.patch('ecommerce_worker.deadline.time.time', return_value=105):
+            self.assertTrue(deadline.expired())
+
+    @mock.patch('ecommerce_worker.configuration.test.TASK_DEADLINE_SECONDS', BUDGETS)
+    @mock.patch('ecommerce_worker.configuration.test.SITE_OVERRIDES',
+                {'slow_site': {'TASK_DEADLINE_SECONDS': {'ecommerce_worker.tests.test_deadline.budgeted_task': 60}}})
+    def test_budgets(self):
+        """Budgets are set per task name, and sites can set their own."""
+        self.assertEqual(get_budget(budgeted_task.name), 10)
+        self.assertEqual(get_budget(budgeted_task.name, 'slow_site'), 60)
+        self.assertIsNone(get_budget('other_task'))
+
+        self.assertAlmostEqual(budgeted_task.delay().get(), 10, places=0)
+        self.assertAlmostEqual(budgeted_task.delay(site_code='slow_site').get(), 60, places=0)
+        # the budget ends with the task
+        self.assertIsNone(deadline.remaining())
+
+    def test_timeout_applied(self):
+        """Calls get the remaining budget as their timeout, unless their own is shorter."""
+        original = mock.Mock()
+        send = deadline._wrap_send(original)  # pylint: disable=protected-access
+        request = requests.Request('GET', self.URL).prepare()
+        with mock.patch('ecommerce_worker.deadline.time.time', return_value=100):
+            deadline.start('task', 3)
+            for timeout in (None, 10, 1, (1, 10)):
+                send(mock.Mock(), request, timeout=timeout)
+        self.assertEqual([call[0][3] for call in original.call_args_list], [3, 3, 1, (1, 3)])
+
+    @httpretty.activate
+    def test_budget_exhausted(self):
+        """Calls made once the budget ran out fail without reaching the network."""
+        httpretty.register_uri(httpretty.GET, self.URL, body='{}')
+        deadline.start('task', 5)
+        with mock.patch('ecommerce_worker.deadline.time.time', return_value=1e10):
+            with self.assertRaises(DeadlineExceeded):
+                requests.get(self.URL)
+        self.assertFalse(httpretty.has_request())
+
+        deadline.clear()
+        self.assertEqual(requests.get(self.URL).status_code, 200)
@@ -0,0 +1,171 @@
+"""Tests of the durable delayed retries."""
+# pylint: disable=protected-access
+from unittest import TestCase
+
+from celery.exceptions import Retry
+import mock
+
+from ecommerce_worker.celery_app import app
+from ecommerce_worker.delayed_retry import (
+    DelayedRetryStore, RetryPublisher, defer_task, get_retry_store, retry_task
+)
+from ecommerce_worker.fulfillment.v1.tasks import fulfill_order
+from ecommerce_worker.tests.mixins import TemporaryDirectoryMixin
+
+
+class DelayedRetryTestMixin(TemporaryDirectoryMixin):
+    """Creates a temporary store and the request of a fulfillment task run by a worker."""
+
+    def setUp(self):
+        super(DelayedRetryTestMixin, self).setUp()
+        self.store = DelayedRetryStore(self.temporary_path('delayed_retry.db'))
+        self.task = app.tasks[fulfill_order.name]
+
+    def push_request(self, retries=0):
+        """Run the task as if it had been received from the broker."""
+        self.task.push_request(id='task-id', args=('ORDER-1',), kwargs={'site_code': 'test_site'}, retries=retries,
+                               called_directly=False, is_eager=False,
+                               delivery_info={'exchange': 'celery', 'routing_key': 'celery'})
+        self.addCleanup(self.task.pop_request)
+
+
+class DelayedRetryStoreTests(DelayedRetryTestMixin, TestCase):
+    """Tests covering DelayedRetryStore."""
+
+    def add(self, due, retries=1):
+        """Store a retry of the fulfillment task."""
+        self.store.add(self.task.subtask(('ORDER-1',), {}, retries=retries), due, 'pickle')
+
+    def test_claims_due_retries(self):
+        self.add(100.0, retries=1)
+        self.add(50.0, retries=2)
+        self.add(200.0)
+
+        claimed = self.store.claim(150.0, 10, lease=60)
+        self.assertEqual([task_signature['options']['retries'] for __, task_signature in claimed], [2, 1])
+        self.assertEqual(claimed[0][1]['task'], fulfill_order.name)
+        self.assertEqual(self.store.count(), 3)
+
+    def test_claims_are_exclusive(self):
+        """Claimed retries are not handed out again until they are released or their lease expires."""
+        self.add(100.0)
+        (retry_id, __), = self.store.claim(100.0, 10, lease=60)
+        self.assertEqual(self.store.claim(159.0, 10, lease=60), [])
+        self.assertEqual(len(self.store.claim(160.0, 10, lease=60)), 1)
+
+        self.store.release(retry_id)
+        self.assertEqual(len(self.store.claim(160.0, 10, lease=60)), 1)
+        self.store.remove(retry_id)
+        self.assertEqual(self.store.count(), 0)
+
+    def test_limit(self):
+        for due in range(5):
+            self.add(due)
+        self.assertEqual(len(self.store.claim(10.0, 2, lease=60)), 2)
+        self.assertEqual(len(self.store.claim(10.0, 10, lease=60)), 3)
+
+
+@mock.patch('ecommerce_worker.configuration.test.DURABLE_RETRY_ENABLED', True, create=True)
+class RetryTaskTests(DelayedRetryTestMixin, TestCase):
+    """Tests covering retry_task."""
+
+    def setUp(self):
+        super(RetryTaskTests, self).setUp()
+        patcher = mock.patch('ecommerce_worker.delayed_retry.get_retry_store', return_value=self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_stores_long_delays(self):
+        """Retries are acknowledged and kept in the store rather than published with an ETA."""
+        self.push_request(retries=2)
+        with mock.patch.object(self.task, 'apply_async') as apply_async:
+            with mock.patch('ecommerce_worker.delayed_retry.time.time', return_value=1000.0):
+                with self.assertRaises(Retry):
+                    retry_task(self.task, 3600, 11, exc=ValueError())
+        self.assertFalse(apply_async.called)
+
+        self.assertEqual(self.store.claim(4599.0, 10, lease=60), [])
+        (__, task_signature), = self.store.claim(4600.0, 10, lease=60)
+        self.assertEqual(list(task_signature['args']), ['ORDER-1'])
+        self.assertEqual(task_signature['kwargs'], {'site_code': 'test_site'})
+        self.assertEqual(task_signature['options']['retries'], 3)
+        self.assertEqual(task_signature['options']['task_id'], 'task-id')
+        self.assertEqual(task_signature['options']['routing_key'], 'celery')
+
+    def test_short_delays_use_eta(self):
+        self.push_request()
+        with mock.patch.object(self.task, 'apply_async') as apply_async:
+            with self.assertRaises(Retry):
+                retry_task(self.task, 8, 11)
+        self.assertEqual(apply_async.call_args[1]['countdown'], 8)
+        self.assertEqual(self.store.count(), 0)
+
+    def test_disabled(self):
+        self.push_request()
+        with mock.patch('ecommerce_worker.configuration.test.DURABLE_RETRY_ENABLED', False, create=True):
+            with mock.patch.object(self.task, 'apply_async') as apply_async:
+                with self.assertRaises(Retry):
+                    retry_task(self.task, 3600, 11)
+        self.assertTrue(apply_async.called)
+        self.assertEqual(self.store.count(), 0)
+
+    def test_exhausted(self):
+        """Once the retries are exhausted, the error is raised."""
+        self.push_request(retries=11)
+        with self.assertRaises(ValueError):
+            retry_task(self.task, 3600, 11, exc=ValueError())
+        self.assertEqual(self.store.count(), 0)
+
+    def test_defer_keeps_retry_count(self):
+        """Deferred tasks run again with the retry count they had."""
+        self.push_request(retries=2)
+        with mock.patch.object(self.task, 'apply_async') as apply_async:
+            defer_task(self.task, 8)
+            defer_task(self.task, 3600)
+        self.assertEqual(apply_async.call_args[1]['countdown'], 8)
+        self.assertEqual(apply_async.call_args[1]['retries'], 2)
+
+        (__, task_signature), = self.store.claim(1e10, 10, lease=60)
+        self.assertEqual(task_signature['options']['retries'], 2)
+
+    def test_defer_kwargs(self):
+        """Deferred tasks run again with the given keyword arguments added to their own."""
+        self.push_request()
+        with mock.patch.object(self.task, 'apply_async') as apply_async:
+            defer_task(self.task, 8, kwargs={'deferrals': 1})
+            defer_task(self.task, 3600, kwargs={'deferrals': 2})
+        self.assertEqual(apply_async.call_args[0][1], {'site_code': 'test_site', 'deferrals': 1})
+
+        (__, task_signature), = self.store.claim(1e10, 10, lease=60)
+        self.assertEqual(task_signature['kwargs'], {'site_code': 'test_site', 'deferrals': 2})
+
+
+class RetryPublisherTests(DelayedRetryTestMixin, TestCase):
+    """Tests covering RetryPublisher."""
+
+    def setUp(self):
+        super(RetryPublisherTests, self).setUp()
+        self.publisher = RetryPublisher(self.store, interval=1, batch_size=2)
+        for index in range(5):
+            self.store.add(self.task.subtask(('ORDER-{}'.format(index),), {}, retries=1), index, 'pickle')
+
+    def test_publishes_due_retries(self):
+        with mock.patch.object(self.task, 'apply_async') as apply_async:
+            self.assertEqual(self.publisher.publish_due(), 5)
+        self.assertEqual([call[0][0] for call in apply_async.call_args_list],
+                         [('ORDER-{}'.format(index),) for index in range(5)])
+        self.assertEqual(apply_async.call_args[1]['retries'], 1)
+        self.assertEqual(self.store.count(), 0)
+
+    def test_publish_failure(self):
+        """Retries which could not be published are kept for the next check."""
+        with mock.patch.object(self.task, 'apply_async', side_effect=[None, IOError]):
+            self.assertEqual(self.publisher.publish_due(), 1)
+        self.assertEqual(self.store.count(), 4)
+
+        with mock.patch.object(self.task, 'apply_async'):
+            self.assertEqual(self.publisher.publish_due(), 4)
+
+    def test_get_retry_store(self):
+        self.assertIs(get_retry_store(), get_retry_store())
+        self.assertIsInstance(get_retry_store(), DelayedRetryStore)
@@ -0,0 +1,141 @@
+"""Tests of the outbound HTTP call timing."""
+# pylint: disable=no-value-for-parameter,protected-access
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import threading
+import time
+from unittest import TestCase
+
+import mock
+import requests
+
+from ecommerce_worker import http_timing
+from ecommerce_worker.fulfillment.v1.tasks import fulfill_order
+from ecommerce_worker.metrics import registry
+from ecommerce_worker.utils import hash_email
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    """Answers every request after a short delay."""
+    protocol_version = 'HTTP/1.1'
+    delay = 0.05
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Answer slowly."""
+        self.answer()
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        """Answer slowly."""
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.answer()
+
+    def answer(self):
+        """Send an empty JSON document."""
+        time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('{}')
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class SlowServer(ThreadingMixIn, HTTPServer):
+    """Threaded server for SlowHandler."""
+    daemon_threads = True
+
+
+class HttpTimingTests(TestCase):
+    """Tests covering the timing of HTTP calls."""
+
+    def setUp(self):
+        super(HttpTimingTests, self).setUp()
+        self.server = SlowServer(('127.0.0.1', 0), SlowHandler)
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://localhost:{}'.format(self.server.server_address[1])
+
+        http_timing.install(threshold=0.02, buffer_size=10)
+        http_timing.slow_calls.clear()
+        self.addCleanup(http_timing.install)
+
+    def phase_count(self, phase):
+        """Number of calls to the test server recorded for a phase."""
+        sample = registry.collect().get(('ecommerce_worker_http_phase_seconds', ('localhost', phase)))
+        return sample[-1] if sample else 0
+
+    def test_install_is_idempotent(self):
+        pool_class = http_timing._urllib3_modules()[0].connectionpool.HTTPConnectionPool
+        _make_request = pool_class.__dict__['_make_request']
+        http_timing.install(threshold=0.02, buffer_size=10)
+        self.assertIs(pool_class.__dict__['_make_request'], _make_request)
+
+    def test_slow_call(self):
+        """A slow call is kept with its phases, without its query string."""
+        before = self.phase_count('server')
+        requests.get(self.url + '/user?json=secret')
+        self.assertEqual(self.phase_count('server'), before + 1)
+
+        call, = http_timing.get_slow_calls()
+        self.assertEqual((call['host'], call['method'], call['path'], call['status']),
+                         ('localhost', 'GET', '/user', 200))
+        self.assertGreaterEqual(call['phases_ms']['server'], SlowHandler.delay * 1000 * 0.9)
+        self.assertGreater(call['phases_ms']['connect'], 0)
+        self.assertEqual(call['phases_ms']['tls'], 0)
+        self.assertNotIn('task_id', call)
+
+    def test_fast_call(self):
+        with mock.patch.object(SlowHandler, 'delay', 0):
+            with mock.patch.dict(http_timing._settings, threshold=10):
+                requests.get(self.url)
+        self.assertEqual(http_timing.get_slow_calls(), [])
+
+    def test_buffer_size(self):
+        http_timing.install(threshold=0, buffer_size=2)
+        with mock.patch.object(SlowHandler, 'delay', 0):
+            for index in range(3):
+                requests.get('{}/{}'.format(self.url, index))
+        self.assertEqual([call['path'] for call in http_timing.get_slow_calls()], ['/1', '/2'])
+
+    def test_task_context(self):
+        """Calls made by a task are tagged with the task, site and order."""
+        with mock.patch('ecommerce_worker.configuration.test.ECOMMERCE_API_ROOT', self.url + '/api/v2/'):
+            fulfill_order.delay('ORDER-1', site_code='test_site')
+
+        call, = http_timing.get_slow_calls()
+        self.assertEqual(call['task'], fulfill_order.name)
+        self.assertEqual((call['order_number'], call['site_code']), ('ORDER-1', 'test_site'))
+        self.assertTrue(call['task_id'])
+        self.assertEqual(call['path'], '/api/v2/orders/ORDER-1/fulfill/')
+
+    def test_email_hash(self):
+        """Tasks acting on a user are tagged with a hash of the email address, never the address."""
+        task = mock.Mock(request=mock.Mock(id='task-id', args=('someone@example.com', 'url'), kwargs={}))
+        task.name = 'task'
+        task.run = lambda email, course_url, site_code=None: None
+
+        with mock.patch('ecommerce_worker.http_timing.current_task', task):
+            self.assertEqual(http_timing._task_context(), {
+                'task_id': 'task-id',
+                'task': 'task',
+                'email_hash': hash_email('someone@example.com'),
+            })
+
+    def test_tls_phase(self):
+        """Time spent connecting to an HTTPS server, besides DNS and TCP, is the TLS handshake."""
+        timing = dict.fromkeys(http_timing.PHASES, 0.0)
+
+        def original_connect(connection):  # pylint: disable=unused-argument
+            """Connect over TCP in 0.5 seconds, as part of a 2 second TLS connection."""
+            timing['connect'] += 0.5
+
+        connect = http_timing._wrap_tls_connect(original_connect)
+        with mock.patch.object(http_timing._state, 'timing', timing, create=True):
+            with mock.patch('ecommerce_worker.http_timing.time.time', side_effect=[10.0, 12.0]):
+                connect(None)
+        self.assertEqual(timing['tls'], 1.5)
@@ -0,0 +1,36 @@
+"""Tests of the host-local SQLite store."""
+import os
+from unittest import TestCase
+
+import mock
+
+from ecommerce_worker.local_store import LocalStore, get_local_store_path
+from ecommerce_worker.tests.mixins import TemporaryDirectoryMixin
+from ecommerce_worker.utils import get_configuration
+
+
+class CounterStore(LocalStore):
+    """Minimal store used to exercise the base class."""
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS counter (value INTEGER)',)
+
+
+class LocalStoreTests(TemporaryDirectoryMixin, TestCase):
+    """Tests covering LocalStore."""
+
+    def test_store_path(self):
+        self.assertEqual(get_local_store_path('file.db'),
+                         os.path.join(get_configuration('LOCAL_STATE_DIR'), 'file.db'))
+
+    def test_creates_directory_and_schema(self):
+        store = CounterStore(self.temporary_path('nested', 'counter.db'))
+        store.execute('INSERT INTO counter (value) VALUES (?)', (1,))
+        self.assertEqual(store.execute('SELECT value FROM counter').fetchall(), [(1,)])
+
+    def test_reconnects_after_fork(self):
+        """A process inheriting the store opens its own connection."""
+        store = CounterStore(self.temporary_path('counter.db'))
+        connection = store.connection
+        self.assertIs(store.connection, connection)
+
+        with mock.patch('ecommerce_worker.local_store.os.getpid', return_value=-1):
+            self.assertIsNot(store.connection, connection)
@@ -0,0 +1,307 @@
+"""Tests of the logging configuration."""
+import importlib
+import logging
+from logging.config import DictConfigurator
+import os
+import sys
+import threading
+import time
+from unittest import TestCase
+
+import mock
+
+from ecommerce_worker.configuration.logger import DedupFilter, QueueHandler, get_logger_config
+from ecommerce_worker.tests.mixins import TemporaryDirectoryMixin
+
+
+class RecordingHandler(logging.Handler):
+    """Handler keeping the messages it writes, optionally blocking until released."""
+
+    def __init__(self, release=None):
+        logging.Handler.__init__(self)
+        self.release_event = release
+        self.messages = []
+        self.flushes = 0
+        self.threads = set()
+
+    def emit(self, record):
+        if self.release_event:
+            self.release_event.wait()
+        self.threads.add(threading.current_thread().name)
+        self.messages.append(self.format(record))
+        self.flush()
+
+    def flush(self):
+        self.flushes += 1
+
+
+class QueueHandlerTests(TestCase):
+    """Tests covering QueueHandler."""
+
+    def setUp(self):
+        super(QueueHandlerTests, self).setUp()
+        self.logger = logging.getLogger('ecommerce_worker.tests.queued')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.addCleanup(setattr, self.logger, 'propagate', True)
+
+    def make_handler(self, **kwargs):
+        """Create a handler writing to a RecordingHandler."""
+        target = {'class': 'ecommerce_worker.tests.test_logger.RecordingHandler', 'format': '%(levelname)s %(message)s'}
+        target.update(kwargs.pop('target', {}))
+        handler = QueueHandler(target, **kwargs)
+        self.logger.addHandler(handler)
+        self.addCleanup(self.logger.removeHandler, handler)
+        self.addCleanup(handler.close)
+        return handler
+
+    def test_writes_on_listener_thread(self):
+        handler = self.make_handler(target={'level': 'INFO'})
+        self.logger.debug('filtered by the target level')
+        self.logger.info('hello %s', 'world')
+        handler.flush()
+        self.assertEqual(handler.target.messages, ['INFO hello world'])
+        self.assertEqual(handler.target.threads, {'QueueHandlerListener'})
+
+    def test_batches(self):
+        """Records waiting in the queue are written together, with a single flush."""
+        release = threading.Event()
+        handler = self.make_handler(target={'release': release}, batch_size=50)
+        for index in range(101):
+            self.logger.info('record %d', index)
+        release.set()
+        handler.flush()
+
+        self.assertEqual(len(handler.target.messages), 101)
+        # the first record, then batches of 50 records
+        self.assertEqual(handler.target.flushes, 3)
+
+    def test_drops_when_full(self):
+        """A stalled destination never blocks the logging thread; overflowing records are counted."""
+        release = threading.Event()
+        handler = self.make_handler(target={'release': release}, queue_size=10)
+        self.logger.info('record 0')
+        # wait for the listener to take the first record
+        while not handler._queue.empty():  # pylint: disable=protected-access
+            time.sleep(0.001)
+        for index in range(1, 50):
+            self.logger.info('record %d', index)
+        # the listener holds one record while it waits, 10 wait in the queue
+        self.assertEqual(handler.dropped, 39)
+
+        release.set()
+        handler.flush()
+        self.logger.info('after the stall')
+        handler.flush()
+        self.assertEqual(len(handler.target.messages), 13)
+        self.assertEqual(handler.target.messages[-2:], [
+            'WARNING 39 log records were dropped because the logging queue was full.',
+            'INFO after the stall',
+        ])
+
+    def test_restarts_after_fork(self):
+        """A process inheriting the handler starts its own listener."""
+        handler = self.make_handler()
+        self.logger.info('parent')
+        handler.flush()
+        listener = handler._listener  # pylint: disable=protected-access
+        with mock.patch('ecommerce_worker.configuration.logger.os.getpid', return_value=-1):
+            self.logger.info('child')
+            handler.flush()
+            self.assertIsNot(handler._listener, listener)  # pylint: disable=protected-access
+        self.assertEqual(sorted(handler.target.messages), ['INFO child', 'INFO parent'])
+
+    def test_close_writes_pending_records(self):
+        handler = self.make_handler()
+        for index in range(10):
+            self.logger.info('record %d', index)
+        handler.close()
+        self.assertEqual(len(handler.target.messages), 10)
+
+
+class DedupFilterTests(TestCase):
+    """Tests covering DedupFilter."""
+
+    def setUp(self):
+        super(DedupFilterTests, self).setUp()
+        self.dedup = DedupFilter(window=60, max_keys=3)
+        self.now = 1000.0
+
+    def record(self, msg='Failed to reach %s', args=('service',), level=logging.ERROR, exc_type=None, name='test'):
+        """Build a record created at self.now."""
+        record = logging.makeLogRecord({'name': name, 'levelno': level, 'msg': msg, 'args': args})
+        record.created = self.now
+        if exc_type:
+            record.exc_info = (exc_type, exc_type(), None)
+        return record
+
+    def test_suppresses_repeats(self):
+        self.assertTrue(self.dedup.filter(self.record()))
+        for __ in range(5):
+            self.now += 10
+            # the arguments are not part of the key
+            self.assertFalse(self.dedup.filter(self.record(args=('other service',))))
+
+        self.now = 1060.0
+        record = self.record()
+        self.assertTrue(self.dedup.filter(record))
+        self.assertEqual(record.getMessage(),
+                         'Failed to reach service [5 similar messages suppressed in the last 60 seconds]')
+
+        self.now += 1
+        self.assertFalse(self.dedup.filter(self.record()))
+
+    def test_keys(self):
+        """Records differing by logger, level, template or exception type are kept apart."""
+        self.assertTrue(self.dedup.filter(self.record()))
+        self.assertTrue(self.dedup.filter(self.record(name='other')))
+        self.assertTrue(self.dedup.filter(self.record(level=logging.WARNING)))
+        self.assertTrue(self.dedup.filter(self.record(msg='Other message')))
+        self.assertTrue(self.dedup.filter(self.record(exc_type=ValueError)))
+        self.assertFalse(self.dedup.filter(self.record(exc_type=ValueError)))
+
+    def test_unicode_messages(self):
+        """Non-ASCII templates, unicode or UTF-8 encoded, are keyed and annotated without encoding errors."""
+        for msg in (u'\xc9chec de la commande %s', u'\xc9chec de la commande %s'.encode('utf-8')):
+            self.now = 1000.0
+            self.assertTrue(self.dedup.filter(self.record(msg=msg)))
+            self.now += 10
+            self.assertFalse(self.dedup.filter(self.record(msg=msg)))
+            self.now += 60
+            record = self.record(msg=msg)
+            self.assertTrue(self.dedup.filter(record))
+            self.assertTrue(record.getMessage().endswith('[1 similar messages suppressed in the last 70 seconds]'))
+            self.assertIn('commande service', record.getMessage())
+        self.assertEqual(len(self.dedup._seen), 2)  # pylint: disable=protected-access
+
+    def test_exempt_records(self):
+        """Records logged with extra={'dedup': False}, such as orders given up on, always pass."""
+        for order_number in ('ORDER-1', 'ORDER-2', 'ORDER-1'):
+            record = self.record(msg='Fulfillment of order [%s] failed. Giving up.', args=(order_number,),
+                                 exc_type=ValueError)
+            record.dedup = False
+            self.assertTrue(self.dedup.filter(record))
+        self.assertEqual(self.dedup._seen, {})  # pylint: disable=protected-access
+
+    def test_give_up_logged_for_each_order(self):
+        handler = RecordingHandler()
+        handler.addFilter(self.dedup)
+        logger = logging.getLogger('ecommerce_worker.fulfillment.v1.tasks')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        for order_number in ('ORDER-1', 'ORDER-2'):
+            try:
+                raise ValueError('outage')
+            except ValueError:
+                logger.exception('Fulfillment of order [%s] failed. Giving up.', order_number, extra={'dedup': False})
+        self.assertEqual(len(handler.messages), 2)
+
+    def test_unhashable_messages_pass(self):
+        for __ in range(2):
+            self.assertTrue(self.dedup.filter(self.record(msg={'event': 'failure'}, args=())))
+
+    def test_lower_levels_pass(self):
+        for __ in range(3):
+            self.assertTrue(self.dedup.filter(self.record(level=logging.INFO)))
+
+    def test_shared_by_handlers(self):
+        """A record going through several handlers sharing the filter is counted once."""
+        record = self.record()
+        self.assertTrue(self.dedup.filter(record))
+        self.assertTrue(self.dedup.filter(record))
+        repeat = self.record()
+        self.assertFalse(self.dedup.filter(repeat))
+        self.assertFalse(self.dedup.filter(repeat))
+        self.assertEqual(self.dedup._seen.values(), [[1000.0, 1]])  # pylint: disable=protected-access
+
+    def test_max_keys(self):
+        for index in range(3):
+            self.dedup.filter(self.record(msg='message {}'.format(index)))
+        self.now += 60
+        self.dedup.filter(self.record(msg='message 3'))
+        self.assertEqual(len(self.dedup._seen), 1)  # pylint: disable=protected-access
+
+    def test_suppressed_tracebacks_are_not_formatted(self):
+        handler = RecordingHandler()
+        handler.addFilter(self.dedup)
+        logger = logging.getLogger('ecommerce_worker.tests.dedup')
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        self.addCleanup(setattr, logger, 'propagate', True)
+
+        with mock.patch.object(logging.Formatter, 'formatException', return_value='Traceback') as format_exception:
+            for __ in range(10):
+                try:
+                    raise ValueError('outage')
+                except ValueError:
+                    logger.exception('Call failed')
+        self.assertEqual(len(handler.messages), 1)
+        self.assertEqual(format_exception.call_count, 1)
+
+
+class QueuedLoggerConfigTests(TemporaryDirectoryMixin, TestCase):
+    """Tests covering the queued mode of get_logger_config."""
+
+    def test_unqueued_by_default(self):
+        config = get_logger_config(log_dir=self.directory, dev_env=True)
+        self.assertEqual(config['handlers']['local']['class'], 'logging.handlers.RotatingFileHandler')
+
+    def test_queued_file_handler(self):
+        config = get_logger_config(log_dir=self.directory, dev_env=True, queued=True, queue_size=5)
+        handler = DictConfigurator(config).configure_handler(config['handlers']['local'])
+        self.addCleanup(handler.close)
+
+        self.assertIsInstance(handler, QueueHandler)
+        self.assertEqual(handler.queue_size, 5)
+        self.assertIsInstance(handler.target, logging.handlers.RotatingFileHandler)
+        self.assertEqual(handler.target.level, logging.INFO)
+
+        handler.handle(logging.makeLogRecord({'name': 'test', 'levelno': logging.INFO, 'levelname': 'INFO',
+                                              'msg': 'queued message'}))
+        handler.flush()
+        with open(self.temporary_path('edx.log')) as log_file:
+            self.assertIn('[test] ', log_file.read())
+
+    def test_queued_syslog_handler(self):
+        config = get_logger_config(queued=True)
+        target = config['handlers']['local']['target']
+        self.assertEqual(target['class'], 'logging.handlers.SysLogHandler')
+        self.assertIn('[service_variant=ecomworker]', target['format'])
+        self.assertNotIn('formatter', target)
+
+    def test_dedup(self):
+        config = get_logger_config(dedup_window=30, queued=True)
+        self.assertEqual(config['filters']['dedup']['window'], 30)
+        self.assertEqual(config['handlers']['console']['filters'], ['dedup'])
+        self.assertEqual(config['handlers']['local']['filters'], ['dedup'])
+        self.assertNotIn('filters', config['handlers']['local']['target'])
+
+
+class ProductionLoggingTests(TemporaryDirectoryMixin, TestCase):
+    """Tests covering the logging settings of the production configuration."""
+
+    def load_production(self, settings):
+        """Import the production configuration with settings on disk, returning the logging configuration."""
+        filename = self.temporary_path('worker.yml')
+        with open(filename, 'w') as config_file:
+            config_file.write(settings)
+
+        self.addCleanup(sys.modules.pop, 'ecommerce_worker.configuration.production', None)
+        sys.modules.pop('ecommerce_worker.configuration.production', None)
+        with mock.patch.dict(os.environ, {'ECOMMERCE_WORKER_CFG': filename}):
+            with mock.patch('logging.config.dictConfig') as dict_config:
+                importlib.import_module('ecommerce_worker.configuration.production')
+        return dict_config.call_args[0][0]
+
+    def test_defaults(self):
+        config = self.load_production('BROKER_URL: amqp://\n')
+        self.assertEqual(config['handlers']['local']['class'], 'logging.handlers.SysLogHandler')
+        self.assertNotIn('dedup', config.get('filters', {}))
+
+    def test_settings_from_disk(self):
+        config = self.load_production('LOGGING_QUEUED: true\nLOGGING_QUEUE_SIZE: 500\nLOGGING_DEDUP_WINDOW: 30\n')
+        self.assertEqual(config['handlers']['local']['()'], 'ecommerce_worker.configuration.logger.QueueHandler')
+        self.assertEqual(config['handlers']['local']['queue_size'], 500)
+        self.assertEqual(config['filters']['dedup']['window'], 30)
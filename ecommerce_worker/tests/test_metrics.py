@@ -0,0 +1,145 @@
+"""Tests of the metrics registry and endpoint."""
+import json
+import os
+import threading
+from unittest import TestCase
+import urllib2
+
+import mock
+
+from ecommerce_worker import metrics
+from ecommerce_worker.concurrency import green_library
+from ecommerce_worker.metrics import Registry, SnapshotDirectory, exposition, start_metrics_server
+from ecommerce_worker.tests.mixins import TemporaryDirectoryMixin
+
+
+class RegistryTests(TestCase):
+    """Tests covering Registry and the metric types."""
+
+    def setUp(self):
+        super(RegistryTests, self).setUp()
+        self.registry = Registry()
+        self.counter = self.registry.counter('test_total', 'A counter.', ('kind',))
+        self.histogram = self.registry.histogram('test_seconds', 'A histogram.', ('kind',), buckets=(0.1, 1))
+
+    def test_counter(self):
+        self.counter.inc(kind='a')
+        self.counter.inc(2, kind='a')
+        self.counter.inc(kind='b')
+        self.assertEqual(self.registry.collect(), {('test_total', ('a',)): 3, ('test_total', ('b',)): 1})
+
+    def test_histogram(self):
+        for value in (0.05, 0.5, 0.5, 5):
+            self.histogram.observe(value, kind='a')
+        self.assertEqual(self.registry.collect(), {('test_seconds', ('a',)): [1, 2, 6.05, 4]})
+
+    def test_timer_labels(self):
+        """The labels of a timed block can be set inside it."""
+        with mock.patch('ecommerce_worker.metrics.time.time', side_effect=[10, 10.5]):
+            with self.histogram.time(kind='unknown') as timer:
+                timer.labels['kind'] = 'b'
+        self.assertEqual(self.registry.collect(), {('test_seconds', ('b',)): [0, 1, 0.5, 1]})
+
+    def test_shards_per_thread(self):
+        """Each thread records to its own shard; reading sums them."""
+        recorded = [threading.Event() for __ in range(4)]
+        done = threading.Event()
+
+        def record(event):
+            """Record from another thread, then stay alive so thread identities are not reused."""
+            for __ in range(1000):
+                self.counter.inc(kind='a')
+            event.set()
+            done.wait()
+
+        threads = [threading.Thread(target=record, args=(event,)) for event in recorded]
+        for worker_thread in threads:
+            worker_thread.start()
+        for event in recorded:
+            event.wait()
+        done.set()
+        for worker_thread in threads:
+            worker_thread.join()
+
+        # green threads share the shard of the OS thread running them
+        shards = 1 if green_library() else 4
+        self.assertEqual(len(self.registry._shards), shards)  # pylint: disable=protected-access
+        self.assertEqual(self.registry.collect(), {('test_total', ('a',)): 4000})
+
+    def test_exposition(self):
+        self.counter.inc(kind='a')
+        self.histogram.observe(0.5, kind='b')
+        with mock.patch.object(metrics, 'registry', self.registry):
+            text = exposition(self.registry.collect())
+        self.assertEqual(text.splitlines(), [
+            '# HELP test_total A counter.',
+            '# TYPE test_total counter',
+            'test_total{kind="a"} 1',
+            '# HELP test_seconds A histogram.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{kind="b",le="0.1"} 0',
+            'test_seconds_bucket{kind="b",le="1"} 1',
+            'test_seconds_bucket{kind="b",le="+Inf"} 1',
+            'test_seconds_sum{kind="b"} 0.5',
+            'test_seconds_count{kind="b"} 1',
+        ])
+
+
+class SnapshotDirectoryTests(TemporaryDirectoryMixin, TestCase):
+    """Tests covering the collection of metrics across prefork children."""
+
+    def setUp(self):
+        super(SnapshotDirectoryTests, self).setUp()
+        self.registry = Registry()
+        self.counter = self.registry.counter('test_total', 'A counter.')
+        patcher = mock.patch.object(metrics, 'registry', self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.snapshots = SnapshotDirectory(self.temporary_path('metrics'), 5)
+        self.snapshots.prepare()
+
+    def write_child_snapshot(self, pid, count):
+        """Write the snapshot of a child process."""
+        with open(os.path.join(self.snapshots.path, '{}.json'.format(pid)), 'w') as snapshot_file:
+            json.dump([['test_total', [], count]], snapshot_file)
+
+    def test_child_writes_snapshot(self):
+        self.counter.inc(3)
+        self.snapshots.write()
+        self.assertEqual(os.listdir(self.snapshots.path), [])
+
+        with mock.patch('ecommerce_worker.metrics.os.getpid', return_value=1234):
+            self.snapshots.write()
+            self.counter.inc()
+            # within the interval
+            self.snapshots.write()
+        with open(os.path.join(self.snapshots.path, '1234.json')) as snapshot_file:
+            self.assertEqual(json.load(snapshot_file), [['test_total', [], 3]])
+
+    def test_collect(self):
+        """Samples of live and exited children are summed; exited ones are retired."""
+        self.counter.inc()
+        self.write_child_snapshot(100, 10)
+        self.write_child_snapshot(200, 20)
+
+        with mock.patch('ecommerce_worker.metrics._process_exists', side_effect=lambda pid: pid == 100):
+            self.assertEqual(self.snapshots.collect(), {('test_total', ()): 31})
+            self.assertEqual(sorted(os.listdir(self.snapshots.path)), ['100.json', 'retired.json'])
+
+            self.write_child_snapshot(300, 30)
+            self.assertEqual(self.snapshots.collect(), {('test_total', ()): 61})
+
+    def test_metrics_server(self):
+        self.counter.inc()
+        self.write_child_snapshot(os.getpid(), 1)
+        server = start_metrics_server('127.0.0.1', 0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        with mock.patch.object(metrics, 'snapshots', self.snapshots):
+            body = urllib2.urlopen(url + '/metrics').read()
+        self.assertIn('test_total 2\n', body)
+
+        with self.assertRaises(urllib2.HTTPError):
+            urllib2.urlopen(url + '/other')
@@ -0,0 +1,65 @@
+"""Tests of the preloading of the worker's main process."""
+from unittest import TestCase
+
+from celery.concurrency.prefork import TaskPool as PreforkPool
+from celery.concurrency.solo import TaskPool as SoloPool
+import mock
+
+from ecommerce_worker.fulfillment.v1 import tasks as fulfillment_tasks
+from ecommerce_worker.preload import freeze_objects, preload, reset_sockets, warm_up
+from ecommerce_worker.sailthru.v1 import tasks as sailthru_tasks
+
+
+@mock.patch('ecommerce_worker.configuration.test.PRELOAD_ENABLED', True)
+class PreloadTests(TestCase):
+    """Tests covering the preload of the main process and the reset of the children."""
+
+    def setUp(self):
+        super(PreloadTests, self).setUp()
+        self.addCleanup(sailthru_tasks.dispatch_tables.clear)
+
+    @mock.patch('ecommerce_worker.configuration.test.SITE_OVERRIDES', {'test_site': {}})
+    def test_preload(self):
+        with mock.patch('ecommerce_worker.preload.freeze_objects') as freeze:
+            preload(instance=mock.Mock(pool_cls=PreforkPool))
+        self.assertEqual(sorted(sailthru_tasks.dispatch_tables), [None, 'test_site'])
+        self.assertTrue(freeze.called)
+
+    def test_other_pools(self):
+        """Objects are only frozen for pools which fork."""
+        with mock.patch('ecommerce_worker.preload.freeze_objects') as freeze:
+            preload(instance=mock.Mock(pool_cls=SoloPool))
+        self.assertFalse(freeze.called)
+        self.assertIn(None, sailthru_tasks.dispatch_tables)
+
+    def test_disabled(self):
+        with mock.patch('ecommerce_worker.configuration.test.PRELOAD_ENABLED', False):
+            preload(instance=mock.Mock(pool_cls=PreforkPool))
+        self.assertEqual(sailthru_tasks.dispatch_tables, {})
+
+    def test_failures_are_logged(self):
+        with mock.patch('ecommerce_worker.configuration.test.ECOMMERCE_API_ROOT', None):
+            with self.assertRaises(RuntimeError):
+                warm_up(None)
+            with mock.patch('ecommerce_worker.preload.logger') as logger:
+                preload(instance=mock.Mock(pool_cls=SoloPool))
+        self.assertTrue(logger.warning.called)
+
+    @mock.patch('ecommerce_worker.preload.gc')
+    def test_freeze_objects(self, mock_gc):
+        freeze_objects()
+        self.assertTrue(mock_gc.collect.called)
+        self.assertTrue(mock_gc.freeze.called)
+
+        # without gc.freeze, the thresholds of the garbage collector are kept
+        del mock_gc.freeze
+        freeze_objects()
+        self.assertEqual(mock_gc.collect.call_count, 2)
+        self.assertFalse(mock_gc.set_threshold.called)
+
+    def test_reset_sockets(self):
+        """Children do not use the HTTP sessions of their parent."""
+        session = fulfillment_tasks.get_api_session()
+        self.assertIs(fulfillment_tasks.get_api_session(), session)
+        reset_sockets()
+        self.assertIsNot(fulfillment_tasks.get_api_session(), session)
@@ -0,0 +1,160 @@
+"""Tests of the bulk publishing of task calls."""
+from collections import defaultdict
+import socket
+from unittest import TestCase
+
+from celery import Celery
+import mock
+
+from ecommerce_worker import producer
+from ecommerce_worker.fulfillment.v1.tasks import fulfill_order
+from ecommerce_worker.producer import BulkPublisher, ConfirmTracker, NotConfirmed, PublishReport, publish_many
+
+
+class FakeChannel(object):
+    """Channel in confirm mode, confirming messages as told."""
+
+    def __init__(self):
+        self.events = defaultdict(set)
+        self.confirm_select = mock.Mock()
+
+    def ack(self, delivery_tag, multiple=False):
+        """Acknowledge messages."""
+        for callback in self.events['basic_ack']:
+            callback(delivery_tag, multiple)
+
+    def nack(self, delivery_tag, multiple=False):
+        """Reject messages."""
+        for callback in self.events['basic_nack']:
+            callback(delivery_tag, multiple, False)
+
+
+class PublishManyTests(TestCase):
+    """Tests covering publish_many on a broker without publisher confirms."""
+
+    def setUp(self):
+        super(PublishManyTests, self).setUp()
+        self.app = Celery('test_producer', broker='memory://', amqp='ecommerce_worker.broker:AMQP',
+                          set_as_current=False)
+        self.app.conf.CELERY_TASK_SERIALIZER = 'json'
+        self.addCleanup(self.purge)
+
+    def purge(self):
+        """Empty the queue of the app."""
+        with self.app.connection() as connection:
+            connection.default_channel.queue_purge('celery')
+
+    def queued(self):
+        """Number of messages waiting in the queue of the app."""
+        with self.app.connection() as connection:
+            return connection.default_channel.queue_declare('celery', passive=True).message_count
+
+    def test_publishes_over_one_channel(self):
+        calls = [fulfill_order.s('ORDER-{}'.format(number), site_code='edx') for number in range(25)]
+        calls.append(self.app.signature('unknown.task', args=(1,)))
+        with mock.patch.object(self.app.amqp, 'TaskProducer', wraps=self.app.amqp.TaskProducer) as task_producer:
+            report = publish_many(calls, app=self.app, chunk_size=10)
+
+        self.assertEqual(report.published, 26)
+        self.assertEqual(report.failures, [])
+        self.assertEqual(self.queued(), 26)
+        self.assertEqual(task_producer.call_count, 1)
+
+    def test_reports_failures(self):
+        calls = [fulfill_order.s('ORDER-1'), fulfill_order.s(object()), fulfill_order.s('ORDER-3')]
+        report = publish_many(iter(calls), app=self.app)
+
+        self.assertEqual(report.published, 2)
+        self.assertEqual([(failure.index, failure.call['args']) for failure in report.failures], [(1, calls[1].args)])
+        self.assertEqual(self.queued(), 2)
+
+
+class ConfirmTests(TestCase):
+    """Tests covering the publisher confirms."""
+
+    def setUp(self):
+        super(ConfirmTests, self).setUp()
+        self.app = Celery('test_producer', broker='memory://', set_as_current=False)
+        self.channels = []
+        self.publisher = BulkPublisher(self.app, confirm_timeout=1)
+        patcher = mock.patch.object(self.publisher, 'open', side_effect=self.open)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(self.publisher, 'publish')
+        self.publish = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def open(self):
+        """Open a fake connection in confirm mode."""
+        channel = FakeChannel()
+        self.channels.append(channel)
+        self.publisher.connection = mock.Mock()
+        self.publisher.confirms = ConfirmTracker(channel)
+
+    def chunk(self, *indexes):
+        """A chunk of calls."""
+        return [(index, fulfill_order.s('ORDER-{}'.format(index))) for index in indexes]
+
+    def test_tracker(self):
+        channel = FakeChannel()
+        tracker = ConfirmTracker(channel)
+        channel.confirm_select.assert_called_once_with()
+        for index in range(5):
+            tracker.published(index, None)
+        channel.ack(3, multiple=True)
+        channel.nack(5)
+        self.assertEqual(tracker.take(), (3, [(4, None)], [(3, None)]))
+        self.assertEqual(tracker.take(), (0, [], []))
+
+    def test_waits_for_confirms(self):
+        report = PublishReport()
+        with mock.patch.object(BulkPublisher, 'wait_for_confirms', autospec=True):
+            self.publisher.publish_chunk(self.chunk(0, 1), report)
+        channel = self.channels[0]
+
+        def confirm(timeout):
+            """Acknowledge the first message and reject the second."""
+            self.assertLessEqual(timeout, 1)
+            channel.ack(1)
+            channel.nack(2)
+        self.publisher.connection.drain_events.side_effect = confirm
+        self.publisher.wait_for_confirms(report)
+
+        self.assertEqual(report.published, 1)
+        self.assertEqual([failure.index for failure in report.failures], [1])
+        self.assertIsInstance(report.failures[0].error, NotConfirmed)
+
+    def test_confirm_timeout(self):
+        report = PublishReport()
+        with mock.patch.object(BulkPublisher, 'wait_for_confirms', autospec=True) as wait_for_confirms:
+            self.publisher.publish_chunk(self.chunk(0, 1), report)
+        self.assertTrue(wait_for_confirms.called)
+
+        # the broker keeps the connection busy without confirming anything
+        with mock.patch.object(producer.time, 'time', side_effect=[1000.0, 1000.5, 1001.0]):
+            self.publisher.wait_for_confirms(report)
+        self.assertEqual(self.publisher.connection.drain_events.call_count, 1)
+        self.assertEqual(report.published, 0)
+        self.assertEqual([failure.index for failure in report.failures], [0, 1])
+        self.assertIsInstance(report.failures[0].error, NotConfirmed)
+
+    def test_connection_lost(self):
+        """Verify that the messages not confirmed by a lost connection fail, and publishing goes on."""
+        report = PublishReport()
+        error = socket.error('connection reset')
+        self.publish.side_effect = [None, error, None]
+        with mock.patch.object(BulkPublisher, 'wait_for_confirms', autospec=True):
+            self.publisher.publish_chunk(self.chunk(0, 1, 2), report)
+
+        self.assertEqual(len(self.channels), 2)
+        self.assertEqual(sorted((failure.index, failure.error) for failure in report.failures),
+                         [(0, error), (1, error)])
+        self.assertEqual(self.publisher.confirms.pending.keys(), [1])
+
+    def test_without_confirms(self):
+        publisher = BulkPublisher(self.app, confirm=False)
+        with mock.patch.object(producer, 'ConfirmTracker') as tracker:
+            with mock.patch.object(publisher, 'publish'):
+                publisher.publish_chunk(self.chunk(0), PublishReport())
+        self.assertFalse(tracker.called)
+        publisher.close()
@@ -0,0 +1,116 @@
+"""Tests of the sampled task profiler."""
+# pylint: disable=protected-access
+import os
+import pstats
+from unittest import TestCase
+
+import mock
+
+from ecommerce_worker import profiling
+from ecommerce_worker.celery_app import app
+from ecommerce_worker.profiling import TaskProfiler, get_profiler, reset_profiler
+from ecommerce_worker.tests.mixins import TemporaryDirectoryMixin
+
+
+@app.task(name='ecommerce_worker.tests.test_profiling.profiled_task')
+def profiled_task(value):
+    """Task exercised by the tests."""
+    return sorted(range(value))[-1]
+
+
+class TaskProfilerTests(TemporaryDirectoryMixin, TestCase):
+    """Tests covering TaskProfiler."""
+
+    def dumps(self):
+        """The profile files written so far."""
+        return sorted(name for name in os.listdir(self.directory) if name.endswith('.prof'))
+
+    def profile(self, profiler, task_id, task_name='task'):
+        """Run a profiled piece of work."""
+        profiler.start(task_id, task_name)
+        sorted(range(100))
+        profiler.stop(task_id, task_name)
+
+    def test_unsampled_task(self):
+        """Tasks without a sample rate, or losing the draw, are not profiled."""
+        profiler = TaskProfiler({'task': 0.5}, self.directory, 0, 10)
+        with mock.patch('ecommerce_worker.profiling.random.random', return_value=0.5):
+            self.profile(profiler, 'id-1')
+        self.profile(profiler, 'id-2', 'other_task')
+        profiler.flush()
+        self.assertEqual(self.dumps(), [])
+
+    def test_aggregates_until_interval(self):
+        """Profiles are aggregated in memory, then written once the interval has elapsed."""
+        profiler = TaskProfiler({'task': 1.0}, self.directory, 300, 10)
+        self.profile(profiler, 'id-1')
+        self.profile(profiler, 'id-2')
+        self.assertEqual(self.dumps(), [])
+
+        with mock.patch('ecommerce_worker.profiling.time.time', return_value=profiler._window_start['task'] + 300):
+            self.profile(profiler, 'id-3')
+        dumps = self.dumps()
+        self.assertEqual(len(dumps), 1)
+        self.assertTrue(dumps[0].startswith('task.'))
+
+        stats = pstats.Stats(self.temporary_path(dumps[0]))
+        sort_calls = [count for (__, __, name), (count, __, __, __, __) in stats.stats.items() if 'sorted' in name]
+        self.assertEqual(sort_calls, [3])
+
+    def test_prunes_oldest_dumps(self):
+        profiler = TaskProfiler({'task': 1.0}, self.directory, 0, 2)
+        for index in range(4):
+            with mock.patch('ecommerce_worker.profiling.time.time', return_value=1000 + index):
+                self.profile(profiler, 'id-{}'.format(index))
+        self.assertEqual([name.rsplit('.', 2)[1] for name in self.dumps()], ['1002', '1003'])
+
+    def test_one_profile_per_thread(self):
+        """A task starting while another is profiled on the same thread is not profiled."""
+        profiler = TaskProfiler({'task': 1.0}, self.directory, 300, 10)
+        profiler.start('id-1', 'task')
+        profiler.start('id-2', 'task')
+        profiler.stop('id-2', 'task')
+        profiler.stop('id-1', 'task')
+        self.assertEqual(list(profiler._stats), ['task'])
+
+
+class ProfilingSignalsTests(TemporaryDirectoryMixin, TestCase):
+    """Tests covering the profiling of tasks run by Celery."""
+
+    def setUp(self):
+        super(ProfilingSignalsTests, self).setUp()
+        reset_profiler()
+        self.addCleanup(reset_profiler)
+
+    def configure(self, sample_rates):
+        """Make the profiler use the given sample rates and the test directory."""
+        settings = {
+            'TASK_PROFILING_SAMPLE_RATES': sample_rates,
+            'TASK_PROFILING_DIR': self.directory,
+            'TASK_PROFILING_DUMP_INTERVAL': 300,
+            'TASK_PROFILING_MAX_DUMPS': 10,
+        }
+        patcher = mock.patch('ecommerce_worker.profiling.get_configuration', side_effect=settings.get)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(get_profiler())
+
+    def test_profiles_task(self):
+        self.configure({profiled_task.name: 1.0})
+        profiled_task.delay(10)
+        self.assertEqual(os.listdir(self.directory), [])
+
+        profiling.flush_task_profiles()
+        dumps = os.listdir(self.directory)
+        self.assertEqual(len(dumps), 1)
+        self.assertTrue(dumps[0].startswith(profiled_task.name + '.'))
+
+    def test_profiler_per_process(self):
+        """A forked process builds its own profiler instead of sharing its parent's aggregates."""
+        self.configure({profiled_task.name: 1.0})
+        profiler = get_profiler()
+        self.assertIs(get_profiler(), profiler)
+        with mock.patch('ecommerce_worker.profiling.os.getpid', return_value=-1):
+            self.assertIsNot(get_profiler(), profiler)
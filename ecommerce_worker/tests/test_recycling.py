@@ -0,0 +1,130 @@
+"""Tests of the recycling of prefork children whose memory grows."""
+from unittest import TestCase
+
+from billiard.pool import EX_RECYCLE
+import mock
+
+from ecommerce_worker import recycling
+from ecommerce_worker.recycling import (
+    MB, AllocationTracker, MemoryMonitor, build_monitor, check_memory, exit_when_recycled, read_rss,
+    start_memory_monitor
+)
+
+
+class Leaked(object):
+    """Objects kept alive by the tests."""
+
+
+class MemoryMonitorTests(TestCase):
+    """Tests covering MemoryMonitor."""
+
+    def run_tasks(self, monitor, rss_values):
+        """Run a task per RSS value; return the reason given after each task."""
+        with mock.patch('ecommerce_worker.recycling.read_rss', side_effect=rss_values):
+            return [monitor.task_done() for __ in rss_values]
+
+    def test_rss_limit(self):
+        monitor = MemoryMonitor(100 * MB, 0, warmup_tasks=1, min_tasks=1, check_interval=1)
+        reasons = self.run_tasks(monitor, [90 * MB, 100 * MB, 101 * MB])
+        self.assertEqual(reasons, [None, None, 'rss'])
+
+    def test_growth_limit(self):
+        """Growth is measured from the end of the warm-up, over at least min_tasks tasks."""
+        monitor = MemoryMonitor(0, 1024, warmup_tasks=2, min_tasks=2, check_interval=1)
+        # the warm-up growth is not counted; 1.5 KB per task only counts after two more tasks
+        reasons = self.run_tasks(monitor, [10 * MB, 20 * MB, 20 * MB + 1536, 20 * MB + 3072])
+        self.assertEqual(reasons, [None, None, None, 'growth'])
+        self.assertEqual(monitor.baseline, (2, 20 * MB))
+
+    def test_within_limits(self):
+        monitor = MemoryMonitor(100 * MB, 1024, warmup_tasks=1, min_tasks=1, check_interval=1)
+        reasons = self.run_tasks(monitor, [50 * MB + 512 * task for task in range(100)])
+        self.assertEqual(set(reasons), {None})
+
+    def test_check_interval(self):
+        monitor = MemoryMonitor(100 * MB, 0, warmup_tasks=1, min_tasks=1, check_interval=3)
+        with mock.patch('ecommerce_worker.recycling.read_rss', return_value=200 * MB) as read:
+            reasons = [monitor.task_done() for __ in range(4)]
+        self.assertEqual(reasons, [None, None, 'rss', 'rss'])
+        self.assertEqual(read.call_count, 1)
+
+    def test_unknown_rss(self):
+        monitor = MemoryMonitor(100 * MB, 0, warmup_tasks=1, min_tasks=1, check_interval=1)
+        self.assertEqual(self.run_tasks(monitor, [None]), [None])
+
+    def test_tracker(self):
+        tracker = mock.Mock()
+        monitor = MemoryMonitor(100 * MB, 0, warmup_tasks=1, min_tasks=1, check_interval=1, tracker=tracker,
+                                snapshot_interval=2)
+        self.run_tasks(monitor, [10 * MB, 10 * MB, 200 * MB])
+        self.assertEqual(tracker.log.call_args_list, [mock.call('snapshot'), mock.call('recycle')])
+
+    def test_read_rss(self):
+        self.assertGreater(read_rss(), 0)
+
+
+class AllocationTrackerTests(TestCase):
+    """Tests covering AllocationTracker."""
+
+    @mock.patch('ecommerce_worker.recycling.tracemalloc', None)
+    def test_object_counts(self):
+        """Without tracemalloc, the growth of the live objects of each type is reported."""
+        tracker = AllocationTracker(top=5)
+        leaked = [Leaked() for __ in range(5000)]
+        sites = dict(tracker.snapshot())
+        self.assertGreaterEqual(sites['ecommerce_worker.tests.test_recycling.Leaked'], len(leaked))
+
+        self.assertNotIn('ecommerce_worker.tests.test_recycling.Leaked', dict(tracker.snapshot()))
+        with mock.patch('ecommerce_worker.recycling.logger') as logger:
+            tracker.log('snapshot')
+        self.assertEqual(tracker.unit, 'objects')
+        self.assertLessEqual(logger.info.call_count, 5)
+
+
+class RecyclingTests(TestCase):
+    """Tests covering the signal handlers and the exit of recycled processes."""
+
+    def setUp(self):
+        super(RecyclingTests, self).setUp()
+        self.addCleanup(setattr, recycling, '_monitor', None)
+
+    def test_disabled(self):
+        self.assertIsNone(build_monitor())
+
+    @mock.patch('ecommerce_worker.configuration.test.CHILD_MAX_RSS_MB', 512)
+    def test_build_monitor(self):
+        monitor = build_monitor()
+        self.assertEqual(monitor.max_rss, 512 * MB)
+        self.assertIsNone(monitor.tracker)
+
+    def test_exit_when_recycled(self):
+        """The process takes no job once it must be replaced."""
+        process = mock.Mock()
+        wait_for_job = process.wait_for_job
+        monitor = mock.Mock(reason=None)
+        exit_when_recycled(process, monitor)
+
+        self.assertEqual(process.wait_for_job(), wait_for_job.return_value)
+        monitor.reason = 'rss'
+        with self.assertRaises(SystemExit) as context:
+            process.wait_for_job()
+        self.assertEqual(context.exception.code, EX_RECYCLE)
+        self.assertEqual(wait_for_job.call_count, 1)
+
+    @mock.patch('ecommerce_worker.configuration.test.CHILD_MAX_RSS_MB', 512)
+    def test_signal_handlers(self):
+        process = mock.Mock()
+        wait_for_job = process.wait_for_job
+        with mock.patch('ecommerce_worker.recycling.current_process', return_value=process):
+            start_memory_monitor()
+        self.assertIsNot(process.wait_for_job, wait_for_job)
+
+        check_memory()
+        self.assertEqual(recycling._monitor.tasks, 1)  # pylint: disable=protected-access
+
+    @mock.patch('ecommerce_worker.configuration.test.CHILD_MAX_RSS_MB', 512)
+    def test_not_a_pool_process(self):
+        with mock.patch('ecommerce_worker.recycling.current_process', return_value=mock.Mock(spec=['name'])):
+            with mock.patch('ecommerce_worker.recycling.logger') as logger:
+                start_memory_monitor()
+        self.assertTrue(logger.warning.called)
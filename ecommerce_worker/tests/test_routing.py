@@ -0,0 +1,185 @@
+"""Tests of the priority lanes, per-site routing and fair sharing."""
+# pylint: disable=protected-access
+from collections import Counter
+from unittest import TestCase
+
+from celery.app.amqp import Queues
+import ddt
+from kombu.async.semaphore import LaxBoundedSemaphore
+import mock
+
+from ecommerce_worker.celery_app import app
+from ecommerce_worker.fulfillment.v1.tasks import fulfill_order
+from ecommerce_worker.routing import (
+    DeficitRoundRobinQueue, FairShare, TaskRouter, add_site_queues, configure_lane, get_site_code, is_priority,
+    site_queue
+)
+from ecommerce_worker.sailthru.v1.tasks import update_course_enrollment
+
+SITE_OVERRIDES = {'site_a': {}, 'site_b': {}}
+
+
+@ddt.ddt
+@mock.patch('ecommerce_worker.configuration.test.FAIR_SHARE_ENABLED', True)
+@mock.patch('ecommerce_worker.configuration.test.SITE_OVERRIDES', SITE_OVERRIDES)
+class SiteRoutingTests(TestCase):
+    """Tests covering TaskRouter and the site queues consumed by workers."""
+
+    @ddt.data(
+        ((), {'site_code': 'site_a'}, 'fulfillment.site_a'),
+        (('ORDER-1', 'site_b'), {}, 'fulfillment.site_b'),
+        (('ORDER-1',), {}, 'fulfillment'),
+        (('ORDER-1',), {'site_code': 'unknown'}, 'fulfillment'),
+    )
+    @ddt.unpack
+    def test_routes_by_site(self, args, kwargs, queue):
+        self.assertEqual(TaskRouter().route_for_task(fulfill_order.name, args, kwargs), {'queue': queue})
+
+    def test_other_tasks(self):
+        self.assertIsNone(TaskRouter().route_for_task('other.task', (), {'site_code': 'site_a'}))
+
+    def test_disabled(self):
+        with mock.patch('ecommerce_worker.configuration.test.FAIR_SHARE_ENABLED', False):
+            self.assertIsNone(TaskRouter().route_for_task(fulfill_order.name, (), {'site_code': 'site_a'}))
+
+    def test_app_routes(self):
+        """Tasks published by the app go to their site's queue."""
+        route = app.amqp.router.route({}, fulfill_order.name, ('ORDER-1',), {'site_code': 'site_a'})
+        self.assertEqual(route['queue'].name, 'fulfillment.site_a')
+        self.assertEqual(route['queue'].routing_key, 'fulfillment.site_a')
+
+    def test_worker_queues(self):
+        """Workers consume the site queues of the shared queues they were started with."""
+        queues = Queues()
+        queues.select(['fulfillment'])
+        add_site_queues(instance=mock.Mock(app=mock.Mock(amqp=mock.Mock(queues=queues))))
+        self.assertEqual(sorted(queues.consume_from),
+                         ['fulfillment', 'fulfillment.site_a', 'fulfillment.site_b'])
+
+    def test_get_site_code(self):
+        self.assertEqual(get_site_code(None, ('ORDER-1', 'site_a'), None), None)
+        self.assertEqual(get_site_code(fulfill_order, ('ORDER-1', 'site_a'), None), 'site_a')
+        self.assertEqual(get_site_code(fulfill_order, (), {}), None)
+        self.assertEqual(site_queue('email_marketing', 'site_b'), 'email_marketing.site_b')
+
+
+@ddt.ddt
+@mock.patch('ecommerce_worker.configuration.test.PRIORITY_LANES_ENABLED', True)
+class PriorityLaneTests(TestCase):
+    """Tests covering the routing of priority tasks and the settings of the lanes' workers."""
+
+    @ddt.data(
+        (fulfill_order.name, ('ORDER-1',), {}, 'priority'),
+        (update_course_enrollment.name, ('a@example.com', 'url', False, 'verified'), {}, 'priority'),
+        (update_course_enrollment.name, ('a@example.com', 'url'), {'purchase_incomplete': False, 'mode': 'credit'},
+         'priority'),
+        (update_course_enrollment.name, ('a@example.com', 'url', True, 'verified'), {}, 'email_marketing'),
+        (update_course_enrollment.name, ('a@example.com', 'url', False, 'audit'), {}, 'email_marketing'),
+    )
+    @ddt.unpack
+    def test_routes_priority_tasks(self, task, args, kwargs, queue):
+        self.assertEqual(TaskRouter().route_for_task(task, args, kwargs), {'queue': queue})
+
+    @mock.patch('ecommerce_worker.configuration.test.FAIR_SHARE_ENABLED', True)
+    @mock.patch('ecommerce_worker.configuration.test.SITE_OVERRIDES', SITE_OVERRIDES)
+    def test_priority_site_queues(self):
+        """With fair sharing, each site has a sub-queue of the priority lane."""
+        self.assertEqual(TaskRouter().route_for_task(fulfill_order.name, ('ORDER-1', 'site_a')),
+                         {'queue': 'priority.site_a'})
+        queues = Queues()
+        queues.select(['priority'])
+        add_site_queues(instance=mock.Mock(app=mock.Mock(amqp=mock.Mock(queues=queues))))
+        self.assertEqual(sorted(queues.consume_from), ['priority', 'priority.site_a', 'priority.site_b'])
+
+    def test_is_priority(self):
+        self.assertFalse(is_priority('other.task', None, (), {}))
+        self.assertTrue(is_priority(update_course_enrollment.name, None, (), {'mode': 'verified'}))
+
+    @ddt.data(
+        ('priority@host', 4, 1),
+        ('bulk@host', 4, 4),
+        ('celery@host', 8, 4),
+    )
+    @ddt.unpack
+    def test_configure_lane(self, hostname, concurrency, prefetch_multiplier):
+        worker = mock.Mock(hostname=hostname, concurrency=8, prefetch_multiplier=4)
+        configure_lane(sender=worker)
+        self.assertEqual((worker.concurrency, worker.prefetch_multiplier), (concurrency, prefetch_multiplier))
+
+
+class DeficitRoundRobinQueueTests(TestCase):
+    """Tests covering DeficitRoundRobinQueue."""
+
+    def drain(self, queue):
+        """Pop every item of the queue."""
+        items = []
+        while len(queue):
+            items.append(queue.popleft())
+        return items
+
+    def test_round_robin(self):
+        """A flood from one key does not delay the items of the other keys."""
+        queue = DeficitRoundRobinQueue(lambda item: item[0])
+        for index in range(5):
+            queue.append(('flood', index))
+        queue.append(('quiet', 0))
+        queue.append(('other', 0))
+
+        self.assertEqual(self.drain(queue), [('flood', 0), ('quiet', 0), ('other', 0), ('flood', 1),
+                                             ('flood', 2), ('flood', 3), ('flood', 4)])
+        with self.assertRaises(IndexError):
+            queue.popleft()
+
+    def test_weights(self):
+        queue = DeficitRoundRobinQueue(lambda item: item[0], weights={'heavy': 3, 'light': 0.5})
+        for index in range(40):
+            queue.append(('heavy', index))
+            queue.append(('light', index))
+            queue.append(('normal', index))
+
+        served = Counter(key for key, __ in [queue.popleft() for __ in range(45)])
+        self.assertEqual(served, {'heavy': 30, 'normal': 10, 'light': 5})
+        self.assertEqual(len(queue), 75)
+
+    def test_clear(self):
+        queue = DeficitRoundRobinQueue(lambda item: item)
+        queue.append(1)
+        queue.clear()
+        self.assertEqual(len(queue), 0)
+        queue.append(2)
+        self.assertEqual(queue.popleft(), 2)
+
+
+@mock.patch('ecommerce_worker.configuration.test.FAIR_SHARE_ENABLED', True)
+class FairShareTests(TestCase):
+    """Tests covering the FairShare bootstep."""
+
+    def request(self, site_code):
+        """A task request received from the broker."""
+        return mock.Mock(task=fulfill_order, args=('ORDER-1',), kwargs={'site_code': site_code})
+
+    def test_waiting_tasks_are_shared(self):
+        worker = mock.Mock(semaphore=LaxBoundedSemaphore(1))
+        FairShare(worker).create(worker)
+
+        executed = []
+        for site_code in ['site_a'] * 4 + ['site_b']:
+            worker.semaphore.acquire(executed.append, self.request(site_code))
+        self.assertEqual(len(worker.semaphore._waiting), 4)
+        for __ in range(4):
+            worker.semaphore.release()
+        self.assertEqual([request.kwargs['site_code'] for request in executed],
+                         ['site_a', 'site_a', 'site_b', 'site_a', 'site_a'])
+
+    def test_pool_without_semaphore(self):
+        worker = mock.Mock(semaphore=None)
+        FairShare(worker).create(worker)
+
+    @mock.patch('ecommerce_worker.configuration.test.FAIR_SHARE_WEIGHTS', {'site_a': 0})
+    def test_invalid_weights(self):
+        worker = mock.Mock(semaphore=LaxBoundedSemaphore(1))
+        with self.assertRaises(ValueError):
+            FairShare(worker).create(worker)
+
+    def test_registered(self):
+        self.assertIn(FairShare, app.steps['worker'])
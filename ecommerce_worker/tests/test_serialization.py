@@ -0,0 +1,85 @@
+"""Tests of the compact serializer."""
+from decimal import Decimal
+from unittest import TestCase, skipIf
+
+from kombu.exceptions import EncodeError
+from kombu.serialization import dumps, loads, prepare_accept_content
+import mock
+
+from ecommerce_worker.celery_app import app
+from ecommerce_worker.fulfillment.v1.tasks import fulfill_order
+from ecommerce_worker.local_store import dump_payload, load_payload
+from ecommerce_worker.sailthru.v1.tasks import update_course_enrollment
+from ecommerce_worker.serialization import CONTENT_TYPE, COMPRESSED, RAW, msgpack, pack_arguments
+
+
+def message(task, args, kwargs):
+    """A task message as published by Celery."""
+    return {
+        'task': task, 'id': 'task-id', 'args': args, 'kwargs': kwargs, 'retries': 0, 'eta': None,
+        'expires': None, 'utc': True, 'callbacks': None, 'errbacks': None, 'timelimit': [None, None],
+        'taskset': None, 'chord': None,
+    }
+
+
+@skipIf(msgpack is None, 'msgpack is not installed')
+class CompactSerializerTests(TestCase):
+    """Tests covering the compact serializer."""
+
+    def test_round_trip(self):
+        body = message(update_course_enrollment.name, ['a@example.com', 'url', False, 'verified'],
+                       {'unit_cost': 49, 'course_id': 'course-v1:edX+DemoX+Demo', 'site_code': 'edx'})
+        content_type, content_encoding, payload = dumps(body, serializer='compact')
+        self.assertEqual((content_type, content_encoding), (CONTENT_TYPE, 'binary'))
+        self.assertEqual(payload[:1], RAW)
+
+        # unit_cost and course_id follow the positional arguments, site_code does not
+        self.assertEqual(loads(payload, content_type, content_encoding), dict(
+            body, args=['a@example.com', 'url', False, 'verified', 49, 'course-v1:edX+DemoX+Demo'],
+            kwargs={'site_code': 'edx'}
+        ))
+
+    def test_decimal_round_trip(self):
+        """Decimal unit costs, as sent by the LMS, are unpacked as the same Decimal."""
+        body = message(update_course_enrollment.name, ['a@example.com', 'url', False, 'verified'],
+                       {'unit_cost': Decimal('49.99'), 'course_id': 'course-v1:edX+DemoX+Demo'})
+        content_type, content_encoding, payload = dumps(body, serializer='compact')
+        unit_cost = loads(payload, content_type, content_encoding)['args'][4]
+        self.assertIsInstance(unit_cost, Decimal)
+        self.assertEqual(unit_cost, Decimal('49.99'))
+        self.assertEqual(int(unit_cost * 100), 4999)
+
+    def test_unsupported_type(self):
+        with self.assertRaises(EncodeError):
+            dumps({'value': object()}, serializer='compact')
+
+    def test_smaller_than_pickle(self):
+        body = message(update_course_enrollment.name, ['a@example.com', 'url', False, 'verified'],
+                       {'unit_cost': 49, 'course_id': 'course-v1:edX+DemoX+Demo'})
+        self.assertLess(len(dumps(body, serializer='compact')[2]), len(dumps(body, serializer='pickle')[2]) / 2)
+
+    @mock.patch('ecommerce_worker.configuration.test.COMPACT_COMPRESSION_THRESHOLD', 100)
+    def test_compression(self):
+        body = message(fulfill_order.name, ['ORDER-1'], {'site_code': 'x' * 200})
+        content_type, content_encoding, payload = dumps(body, serializer='compact')
+        self.assertEqual(payload[:1], COMPRESSED)
+        self.assertLess(len(payload), 100)
+        unpacked = loads(payload, content_type, content_encoding)
+        self.assertEqual(unpacked, dict(body, args=['ORDER-1', 'x' * 200], kwargs={}))
+
+    def test_other_data(self):
+        """Data other than task messages, such as stored signatures, is packed as it is."""
+        task_signature = dict(fulfill_order.subtask(('ORDER-1',), {'site_code': 'edx'}, retries=2))
+        stored = load_payload(*dump_payload(task_signature, 'compact'))
+        self.assertEqual(stored['kwargs'], {'site_code': 'edx'})
+        self.assertEqual(stored['options'], {'retries': 2})
+
+    def test_pack_arguments(self):
+        self.assertEqual(pack_arguments('unknown.task', ['a'], {'b': 1}), (['a'], {'b': 1}))
+        self.assertEqual(pack_arguments(fulfill_order.name, (), {'order_number': 'ORDER-1'}), (['ORDER-1'], {}))
+        self.assertEqual(pack_arguments(fulfill_order.name, ['ORDER-1'], None), (['ORDER-1'], None))
+
+    def test_accepted_by_workers(self):
+        accept = prepare_accept_content(app.conf.CELERY_ACCEPT_CONTENT)
+        content_type, content_encoding, payload = dumps(message(fulfill_order.name, ['ORDER-1'], {}), 'compact')
+        self.assertEqual(loads(payload, content_type, content_encoding, accept=accept)['args'], ['ORDER-1'])
@@ -0,0 +1,99 @@
+"""Tests of the helpers of stream processing commands."""
+from StringIO import StringIO
+import threading
+from unittest import TestCase
+
+import mock
+
+from ecommerce_worker import streaming
+from ecommerce_worker.streaming import Progress, RateLimiter, process_stream
+
+
+class ProcessStreamTests(TestCase):
+    """Tests covering process_stream."""
+
+    def test_handles_every_item(self):
+        handled = []
+        lock = threading.Lock()
+
+        def handle(item):
+            """Record the item."""
+            with lock:
+                handled.append(item)
+
+        process_stream(iter(range(100)), handle, concurrency=4)
+        self.assertEqual(sorted(handled), range(100))
+
+    def test_reads_ahead_a_bounded_number_of_items(self):
+        release = threading.Event()
+        read = []
+
+        def items():
+            """Items counting how many were read."""
+            for item in range(100):
+                read.append(item)
+                yield item
+
+        def handle(item):  # pylint: disable=unused-argument
+            """Block until released."""
+            release.wait()
+
+        thread = threading.Thread(target=process_stream, args=(items(), handle, 2))
+        thread.start()
+        # two items being handled, and four waiting
+        thread.join(1)
+        self.assertLessEqual(len(read), 2 + 4 + 1)
+        release.set()
+        thread.join()
+        self.assertEqual(len(read), 100)
+
+    def test_interrupted(self):
+        handled = []
+
+        def items():
+            """Items interrupted after the first one."""
+            yield 1
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            process_stream(items(), handled.append, concurrency=1)
+        self.assertLessEqual(len(handled), 1)
+
+
+class RateLimiterTests(TestCase):
+    """Tests covering RateLimiter."""
+
+    def test_spaces_calls(self):
+        limiter = RateLimiter(4)
+        with mock.patch.object(streaming.time, 'time', return_value=1000.0):
+            with mock.patch.object(streaming.time, 'sleep') as sleep:
+                for __ in range(3):
+                    limiter.wait()
+        self.assertEqual([call[0][0] for call in sleep.call_args_list], [0.25, 0.5])
+
+    def test_no_limit(self):
+        limiter = RateLimiter(0)
+        with mock.patch.object(streaming.time, 'sleep') as sleep:
+            for __ in range(3):
+                limiter.wait()
+        self.assertFalse(sleep.called)
+
+
+class ProgressTests(TestCase):
+    """Tests covering Progress."""
+
+    def test_reports(self):
+        out = StringIO()
+        with mock.patch.object(streaming.time, 'time', return_value=1000.0):
+            progress = Progress(10, 'orders', passed=('skipped',), out=out)
+            progress.add('fulfilled')
+        self.assertEqual(out.getvalue(), '')
+
+        with mock.patch.object(streaming.time, 'time', return_value=1010.0):
+            progress.add('skipped')
+            progress.add('already_fulfilled')
+        self.assertEqual(out.getvalue(), '1 orders processed in 10s (0.1/s): 1 fulfilled, 1 skipped.\n')
+
+        progress.report(1020.0)
+        self.assertEqual(out.getvalue().splitlines()[-1],
+                         '2 orders processed in 20s (0.1/s): 1 already fulfilled, 1 fulfilled, 1 skipped.')
@@ -5,7 +5,7 @@ import ddt
 import mock
 
 from ecommerce_worker.configuration.test import ECOMMERCE_API_ROOT
-from ecommerce_worker.utils import get_configuration
+from ecommerce_worker.utils import get_configuration, hash_email
 
 
 @ddt.ddt
@@ -48,3 +48,14 @@ class GetConfigurationTests(TestCase):
         with mock.patch.dict(self.SITE_OVERRIDES_MODULE, self.OVERRIDES_DICT):
             test_setting = get_configuration(self.TEST_SETTING, site_code=site_code)
             self.assertEqual(test_setting, ECOMMERCE_API_ROOT)
+
+
+class HashEmailTests(TestCase):
+    """Tests covering the hash_email operation."""
+
+    def test_hash_email(self):
+        """Addresses differing only in case or surrounding whitespace share a hash."""
+        digest = hash_email('Someone@Example.com ')
+        self.assertEqual(len(digest), 16)
+        self.assertEqual(digest, hash_email(u'someone@example.com'))
+        self.assertNotEqual(digest, hash_email('someone.else@example.com'))
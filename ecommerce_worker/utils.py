@@ -1,4 +1,5 @@
 """Helper functions."""
+import hashlib
 import os
 import sys
 
@@ -42,3 +43,18 @@ def get_configuration(variable, site_code=None):
     if setting_value is None:
         raise RuntimeError('Worker is improperly configured: {} is unset in {}.'.format(variable, module))
     return setting_value
+
+
+def hash_email(email):
+    """
+    Get a stable pseudonym for an email address, for use in logs and diagnostics.
+
+    Arguments:
+        email (str): The email address.
+
+    Returns:
+        str: The first 16 hex digits of the SHA-256 digest of the lowercased address.
+    """
+    if isinstance(email, unicode):
+        email = email.encode('utf-8')
+    return hashlib.sha256(email.strip().lower()).hexdigest()[:16]
@@ -23,9 +23,16 @@ setup(
     author='edX',
     author_email='oscm@edx.org',
     license='AGPL',
-    packages=find_packages(exclude=['*.tests']),
+    packages=find_packages(exclude=['*.tests', 'benchmarks', 'benchmarks.*']),
     install_requires=[
         'celery>=3.1.18,<4.0.0',
         'edx-rest-api-client>=1.5.0,<2.0.0'
     ],
+    entry_points={
+        'console_scripts': [
+            'ecommerce-worker-replay = ecommerce_worker.dead_letter:main',
+            'ecommerce-worker-fulfill = ecommerce_worker.fulfillment.v1.bulk:main',
+            'ecommerce-worker-sailthru-backfill = ecommerce_worker.sailthru.v1.backfill:main',
+        ],
+    },
 )